@@ -1,5 +1,7 @@
+from datetime import timedelta
+from django.utils import timezone
 from enum import Enum
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 from data_refinery_common import utils
 from data_refinery_common.logging import get_and_configure_logger
@@ -13,6 +15,33 @@ from data_refinery_common.models import (
 
 logger = get_and_configure_logger(__name__)
 
+# The RAM amounts in MB that per-sample processor jobs can be
+# dispatched with. Each has its own Nomad job spec, see
+# format_nomad_with_env.sh.
+RAM_TIERS = [2048, 3072, 4096, 8192, 12288, 16384, 32768, 65536]
+# determine_ram_amount picks the smallest tier that at least this
+# fraction of jobs like the one being created would have fit into.
+# Running out of memory means a retry, which can take hours for a
+# large FASTQ, so this leans towards giving jobs too much.
+RAM_SUCCESS_TARGET = float(utils.get_env_variable_gracefully("RAM_SUCCESS_TARGET", "0.95"))
+# A job's peak memory is multiplied by this before checking whether it
+# fits into a tier, since peaks vary between runs of the same input.
+RAM_HEADROOM = 1.2
+# A failed job which used at least this fraction of its RAM is
+# assumed to have run out of it.
+RAM_EXHAUSTED_FRACTION = 0.9
+# How many of the most recent similar jobs to learn from, and how many
+# are needed before trusting them over the static defaults.
+RAM_HISTORY_SIZE = 500
+MIN_RAM_OBSERVATIONS = 20
+# Jobs whose input was within this factor of the new job's input size
+# count as similar to it.
+INPUT_SIZE_FACTOR = 2
+# Jobs get created in bursts for the same platform and organism, so
+# the history is only looked up this often.
+RAM_HISTORY_CACHE_TIME = timedelta(minutes=10)
+_RAM_HISTORY_CACHE = {}  # type: Dict[Tuple, Tuple]
+
 
 class PipelineEnums(Enum):
     """An abstract class to enumerate valid processor pipelines.
@@ -29,8 +58,10 @@ class ProcessorPipeline(PipelineEnums):
     AGILENT_ONECOLOR_TO_PCL = "AGILENT_ONECOLOR_TO_PCL"  # Currently unsupported
     AGILENT_TWOCOLOR_TO_PCL = "AGILENT_TWOCOLOR_TO_PCL"
     SALMON = "SALMON"
+    SALMON_BATCH = "SALMON_BATCH"
     TXIMPORT = "TXIMPORT"
     ILLUMINA_TO_PCL = "ILLUMINA_TO_PCL"
+    TRANSCRIPTOME_INDEX = "TRANSCRIPTOME_INDEX"
     TRANSCRIPTOME_INDEX_LONG = "TRANSCRIPTOME_INDEX_LONG"
     TRANSCRIPTOME_INDEX_SHORT = "TRANSCRIPTOME_INDEX_SHORT"
     SMASHER = "SMASHER"
@@ -197,9 +228,10 @@ def determine_processor_pipeline(sample_object: Sample, original_file=None) -> P
     # Shouldn't get here, but just in case
     return ProcessorPipeline.NONE
 
-def determine_ram_amount(sample: Sample, job) -> int:
+def _determine_default_ram_amount(sample: Sample, job) -> int:
     """
     Determines the amount of RAM in MB required for a given ProcessorJob
+    before there are any similar jobs to learn from.
     """
 
     if job.pipeline_applied == ProcessorPipeline.NO_OP.value:
@@ -222,10 +254,190 @@ def determine_ram_amount(sample: Sample, job) -> int:
         return 2048
     elif job.pipeline_applied == ProcessorPipeline.AGILENT_ONECOLOR_TO_PCL.value:
         return 2048
-    elif job.pipeline_applied == ProcessorPipeline.SALMON.value:
+    elif job.pipeline_applied in [ProcessorPipeline.SALMON.value,
+                                  ProcessorPipeline.SALMON_BATCH.value]:
         return 12288
     elif job.pipeline_applied == ProcessorPipeline.NONE.value:
         return 1024
     else:
         logger.error("Found a job without an expected pipeline!", job=job, pipeline=job.pipeline_applied)
         return 1024
+
+
+def get_job_sample(job: ProcessorJob) -> Optional[Sample]:
+    """Returns one of the samples job is processing, or None if it
+    isn't processing any."""
+    return Sample.objects.filter(
+        original_files__processor_jobs=job
+    ).select_related('organism').first()
+
+
+def _get_ram_history(pipeline: str, platform: str, organism: str) -> List[Tuple]:
+    """Returns (input_size, peak_memory, ram_amount, success) for the
+    most recent jobs of pipeline that recorded their peak memory.
+
+    Jobs on the same platform for the same organism are used if there
+    are enough of them, otherwise the platform or only the pipeline
+    has to do.
+    """
+    key = (pipeline, platform, organism)
+    cached = _RAM_HISTORY_CACHE.get(key)
+    if cached and cached[0] > timezone.now() - RAM_HISTORY_CACHE_TIME:
+        return cached[1]
+
+    jobs = ProcessorJob.objects.filter(pipeline_applied=pipeline, peak_memory__isnull=False)
+    for filters in [{"platform_accession_code": platform, "organism_name": organism},
+                    {"platform_accession_code": platform},
+                    {}]:
+        history = list(
+            jobs.filter(**filters)
+            .order_by('-id')
+            .values_list('input_size', 'peak_memory', 'ram_amount', 'success')[:RAM_HISTORY_SIZE]
+        )
+        if len(history) >= MIN_RAM_OBSERVATIONS:
+            break
+
+    _RAM_HISTORY_CACHE[key] = (timezone.now(), history)
+    return history
+
+
+def predict_ram_success(history: List[Tuple], input_size: int, ram_amount: int) -> Optional[float]:
+    """Returns the fraction of the jobs in history with an input like
+    input_size that would have fit into ram_amount.
+
+    Jobs with similar input sizes are preferred. If there aren't enough
+    of them, only jobs with at least as much input are used so that the
+    prediction errs on the side of more RAM. Failed jobs count against
+    ram_amount if they ran out of at least that much. Returns None if
+    there aren't enough jobs to go on.
+    """
+    similar = history
+    if input_size:
+        similar = [job for job in history
+                   if job[0] and input_size / INPUT_SIZE_FACTOR <= job[0] <= input_size * INPUT_SIZE_FACTOR]
+        if len(similar) < MIN_RAM_OBSERVATIONS:
+            similar = [job for job in history if job[0] and job[0] >= input_size / INPUT_SIZE_FACTOR]
+
+    fit = 0
+    total = 0
+    for _, peak_memory, job_ram_amount, success in similar:
+        if success:
+            total += 1
+            if peak_memory * RAM_HEADROOM <= ram_amount:
+                fit += 1
+        elif job_ram_amount >= ram_amount and peak_memory >= job_ram_amount * RAM_EXHAUSTED_FRACTION:
+            total += 1
+
+    if total < MIN_RAM_OBSERVATIONS:
+        return None
+
+    return fit / total
+
+
+def predict_ram_amount(pipeline: str,
+                       platform: str,
+                       organism: str,
+                       input_size: int,
+                       minimum: int = 0) -> Optional[int]:
+    """Returns the smallest RAM tier above minimum that jobs like this
+    one are predicted to succeed with, or None if there isn't enough
+    history to say."""
+    history = _get_ram_history(pipeline, platform, organism)
+    for ram_amount in RAM_TIERS:
+        if ram_amount <= minimum:
+            continue
+
+        success = predict_ram_success(history, input_size, ram_amount)
+        if success is None:
+            return None
+        if success >= RAM_SUCCESS_TARGET:
+            return ram_amount
+
+    return None
+
+
+def determine_ram_amount(sample: Sample, job, original_files: List[OriginalFile] = None) -> int:
+    """
+    Determines the amount of RAM in MB required for a given ProcessorJob
+
+    Once enough jobs like it have recorded their peak memory this is
+    the smallest tier they are predicted to fit into, based on the size
+    of original_files. Until then it's a static value per pipeline.
+    """
+    default_ram_amount = _determine_default_ram_amount(sample, job)
+    if default_ram_amount not in RAM_TIERS or not sample:
+        return default_ram_amount
+
+    if original_files:
+        input_size = sum(original_file.size_in_bytes or 0 for original_file in original_files)
+    else:
+        input_size = job.input_size
+
+    organism = sample.organism.name if sample.organism else None
+    predicted_ram_amount = predict_ram_amount(job.pipeline_applied,
+                                              sample.platform_accession_code,
+                                              organism,
+                                              input_size)
+    if predicted_ram_amount:
+        if predicted_ram_amount != default_ram_amount:
+            logger.debug("Predicted RAM amount for job.",
+                         pipeline=job.pipeline_applied,
+                         platform=sample.platform_accession_code,
+                         organism=organism,
+                         input_size=input_size,
+                         default_ram_amount=default_ram_amount,
+                         ram_amount=predicted_ram_amount)
+        return predicted_ram_amount
+
+    return default_ram_amount
+
+
+def record_oom_kill(job: ProcessorJob) -> None:
+    """Records that job was killed for running out of memory.
+
+    It never got to record its own resource usage, so it's counted as
+    having used all of its RAM, which is what predict_ram_success
+    looks for in failed jobs.
+    """
+    job.peak_memory = job.ram_amount
+    if job.input_size is None:
+        job.input_size = sum(original_file.size_in_bytes or 0 for original_file in job.original_files.all())
+
+    if not job.platform_accession_code:
+        sample = get_job_sample(job)
+        if sample:
+            job.platform_accession_code = sample.platform_accession_code
+            job.organism_name = sample.organism.name if sample.organism else None
+
+    job.save()
+
+
+def determine_retry_ram_amount(job: ProcessorJob) -> Optional[int]:
+    """Returns the smallest RAM tier larger than job's that jobs like it
+    are predicted to succeed with, or None if there isn't enough
+    history to say.
+
+    This can skip tiers that similar jobs have rarely fit into. If job
+    recorded its own peak memory, tiers it wouldn't fit into are
+    skipped as well.
+    """
+    platform = job.platform_accession_code
+    organism = job.organism_name
+    if not platform:
+        sample = get_job_sample(job)
+        if not sample:
+            return None
+        platform = sample.platform_accession_code
+        organism = sample.organism.name if sample.organism else None
+
+    input_size = job.input_size
+    if input_size is None:
+        # Jobs which ran out of memory were killed before they could
+        # record anything.
+        input_size = sum(original_file.size_in_bytes or 0 for original_file in job.original_files.all())
+
+    minimum = job.ram_amount
+    if job.peak_memory:
+        minimum = max(minimum, int(job.peak_memory * RAM_HEADROOM))
+
+    return predict_ram_amount(job.pipeline_applied, platform, organism, input_size, minimum)
@@ -2,10 +2,18 @@
 
 from __future__ import absolute_import, unicode_literals
 import nomad
+import os
+import requests
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from django.db.models import Case, CharField, IntegerField, Value, When
 from enum import Enum
 from nomad.api.exceptions import URLNotFoundNomadException
+from requests.adapters import HTTPAdapter
+from typing import List
+from urllib3.util.retry import Retry
 
 from data_refinery_common.utils import get_env_variable, get_env_variable_gracefully, get_volume_index
 from data_refinery_common.models import ProcessorJob, SurveyJob, DownloaderJob
@@ -22,25 +30,96 @@ NOMAD_DOWNLOADER_JOB = "DOWNLOADER"
 NONE_JOB_ERROR_TEMPLATE = "send_job was called with NONE job_type: {} for {} job {}"
 
 
-def send_job(job_type: Enum, job, is_dispatch=False) -> bool:
+# How long to wait on Nomad, how many times to retry requests which
+# couldn't connect or got a 502/503/504 back, and how many connections
+# to keep open to it.
+NOMAD_TIMEOUT = int(get_env_variable_gracefully("NOMAD_TIMEOUT", "30"))
+NOMAD_RETRIES = int(get_env_variable_gracefully("NOMAD_RETRIES", "3"))
+NOMAD_POOL_SIZE = int(get_env_variable_gracefully("NOMAD_POOL_SIZE", "16"))
+
+# How many jobs send_jobs dispatches at once.
+MAX_DISPATCH_THREADS = int(get_env_variable_gracefully("MAX_DISPATCH_THREADS", "8"))
+
+# Every caller in a process shares one client so that its connections
+# to Nomad are kept alive between dispatches.
+_NOMAD_CLIENT = None
+_NOMAD_CLIENT_PID = None
+_NOMAD_CLIENT_LOCK = threading.Lock()
+
+
+def create_nomad_client(timeout: int=NOMAD_TIMEOUT) -> nomad.Nomad:
+    """Returns a new Nomad client for the configured Nomad server whose
+    connections are pooled and retried.
+
+    Only connection errors are retried for dispatches, since a dispatch
+    which reached Nomad can't safely be sent again.
+    """
+    nomad_host = get_env_variable("NOMAD_HOST")
+    nomad_port = get_env_variable("NOMAD_PORT", "4646")
+    nomad_client = nomad.Nomad(nomad_host, port=int(nomad_port), timeout=timeout)
+
+    retries = Retry(total=NOMAD_RETRIES,
+                    backoff_factor=0.5,
+                    status_forcelist=[502, 503, 504],
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=NOMAD_POOL_SIZE, max_retries=retries)
+
+    # Each of the client's endpoints (job, jobs, nodes...) has its own
+    # session, so mount the same adapter on all of them to share one
+    # pool of connections.
+    for endpoint in vars(nomad_client).values():
+        session = getattr(endpoint, "session", None)
+        if isinstance(session, requests.Session):
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+    return nomad_client
+
+
+def get_nomad_client() -> nomad.Nomad:
+    """Returns this process's Nomad client for the configured Nomad
+    server, creating it the first time it's needed."""
+    global _NOMAD_CLIENT, _NOMAD_CLIENT_PID
+
+    with _NOMAD_CLIENT_LOCK:
+        # A forked process can't share its parent's connections.
+        if _NOMAD_CLIENT is None or _NOMAD_CLIENT_PID != os.getpid():
+            _NOMAD_CLIENT = create_nomad_client()
+            _NOMAD_CLIENT_PID = os.getpid()
+
+        return _NOMAD_CLIENT
+
+
+def send_job(job_type: Enum,
+             job,
+             is_dispatch=False,
+             nomad_client: nomad.Nomad=None,
+             persist=True) -> bool:
     """Queues a worker job by sending a Nomad Job dispatch message.
 
     job_type must be a valid Enum for ProcessorPipelines or
     Downloaders as defined in data_refinery_common.job_lookup.
     job must be an existing ProcessorJob or DownloaderJob record.
+    nomad_client defaults to the process's shared client. If persist is False the job's
+    new nomad_job_id is only set on the object and the caller must
+    save it, which lets jobs be dispatched from threads without a
+    database connection each.
 
     Returns True if the job was successfully dispatch, return False otherwise.
     """
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = nomad.Nomad(nomad_host, port=int(nomad_port), timeout=30)
+    if not nomad_client:
+        nomad_client = get_nomad_client()
 
     is_processor = True
-    if job_type is ProcessorPipeline.TRANSCRIPTOME_INDEX_LONG \
+    if job_type is ProcessorPipeline.TRANSCRIPTOME_INDEX \
+       or job_type is ProcessorPipeline.TRANSCRIPTOME_INDEX_LONG \
        or job_type is ProcessorPipeline.TRANSCRIPTOME_INDEX_SHORT:
         nomad_job = NOMAD_TRANSCRIPTOME_JOB
     elif job_type is ProcessorPipeline.SALMON:
         nomad_job = ProcessorPipeline.SALMON.value
+    elif job_type is ProcessorPipeline.SALMON_BATCH:
+        # Batches of samples are quantified in the same image as single samples.
+        nomad_job = ProcessorPipeline.SALMON.value
     elif job_type is ProcessorPipeline.AFFY_TO_PCL:
         nomad_job = ProcessorPipeline.AFFY_TO_PCL.value
     elif job_type is ProcessorPipeline.NO_OP:
@@ -86,11 +165,16 @@ def send_job(job_type: Enum, job, is_dispatch=False) -> bool:
         # have an attached volume index, so use that.
         if job.volume_index is None:
             job.volume_index = get_volume_index()
-            job.save()
+            if persist:
+                job.save()
         nomad_job = nomad_job + "_" + job.volume_index + "_" + str(job.ram_amount)
     elif isinstance(job, SurveyJob):
         nomad_job = nomad_job + "_" + str(job.ram_amount)
     elif isinstance(job, DownloaderJob):
+        # The Foreman places downloader jobs on a volume to spread new
+        # work between them. Otherwise Nomad puts them anywhere.
+        if job.volume_index is not None:
+            nomad_job = nomad_job + "_" + job.volume_index
         nomad_job = nomad_job + "_" + str(job.ram_amount)
 
     # We only want to dispatch processor jobs directly.
@@ -100,11 +184,12 @@ def send_job(job_type: Enum, job, is_dispatch=False) -> bool:
             nomad_response = nomad_client.job.dispatch_job(nomad_job, meta={"JOB_NAME": job_type.value,
                                                                             "JOB_ID": str(job.id)})
             job.nomad_job_id = nomad_response["DispatchedJobID"]
-            job.save()
+            if persist:
+                job.save()
             return True
         except URLNotFoundNomadException:
-            logger.info("Dispatching Nomad job of type %s for job spec %s to host %s and port %s failed.",
-                job_type, nomad_job, nomad_host, nomad_port, job=str(job.id))
+            logger.info("Dispatching Nomad job of type %s for job spec %s failed.",
+                job_type, nomad_job, job=str(job.id))
             raise
         except Exception as e:
             logger.info('Unable to Dispatch Nomad Job.',
@@ -115,5 +200,60 @@ def send_job(job_type: Enum, job, is_dispatch=False) -> bool:
             raise
     else:
         job.num_retries = job.num_retries - 1
-        job.save()
+        if persist:
+            job.save()
     return True
+
+
+def _save_dispatched_jobs(jobs: List) -> None:
+    """Saves the fields send_job sets on each of jobs with one update."""
+    job_model = type(jobs[0])
+    fields = {"nomad_job_id": CharField(), "num_retries": IntegerField()}
+    if job_model is ProcessorJob:
+        fields["volume_index"] = CharField()
+
+    job_model.objects.filter(id__in=[job.id for job in jobs]).update(**{
+        field: Case(*[When(id=job.id, then=Value(getattr(job, field))) for job in jobs],
+                    output_field=output_field)
+        for field, output_field in fields.items()
+    })
+
+
+def send_jobs(job_type: Enum,
+              jobs: List,
+              is_dispatch=False,
+              nomad_client: nomad.Nomad=None,
+              max_workers: int=MAX_DISPATCH_THREADS) -> List[bool]:
+    """Queues each of jobs, which all run job_type, like send_job does.
+
+    The jobs are dispatched up to max_workers at a time over one Nomad
+    client and then saved with a single update rather than one save
+    per job.
+
+    Returns whether each job was successfully dispatched, in the same
+    order as jobs. Unlike send_job, failures are logged rather than
+    raised so that one job can't keep the rest from being saved.
+    """
+    if not jobs:
+        return []
+
+    if not nomad_client:
+        nomad_client = get_nomad_client()
+
+    def dispatch(job) -> bool:
+        try:
+            return bool(send_job(job_type, job, is_dispatch=is_dispatch, nomad_client=nomad_client, persist=False))
+        except Exception:
+            # send_job logs why.
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs)))) as executor:
+        results = list(executor.map(dispatch, jobs))
+
+    _save_dispatched_jobs(jobs)
+
+    logger.debug("Queued %d of %d %s jobs.",
+                 results.count(True),
+                 len(jobs),
+                 job_type.value)
+    return results
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.8 on 2019-05-06 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_refinery_common', '0019_sample_is_blacklisted'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloaderjob',
+            name='bytes_downloaded',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='downloaderjob',
+            name='volume_disk_usage',
+            field=models.FloatField(null=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 2.1.8 on 2019-05-09 14:37
+
+from django.db import migrations
+
+
+# Partial indexes matching the filters the Foreman's retry passes use
+# to find failed, hung and lost jobs. Those are a tiny fraction of
+# each table, so these indexes stay small no matter how many jobs
+# have finished. The passes page through them in order of id, and
+# keeping created_at (and volume_index for processor jobs) in the
+# index lets Postgres check those without visiting the table.
+FAILED = "success = false AND retried = false"
+HUNG = ("success IS NULL AND retried = false AND no_retry = false"
+        " AND start_time IS NOT NULL AND end_time IS NULL")
+LOST = ("success IS NULL AND retried = false AND no_retry = false"
+        " AND start_time IS NULL AND end_time IS NULL")
+
+INDEXES = [
+    ("downloader_jobs_failed_retry_idx", "downloader_jobs", "id, created_at", FAILED + " AND no_retry = false"),
+    ("downloader_jobs_hung_retry_idx", "downloader_jobs", "id, created_at", HUNG),
+    ("downloader_jobs_lost_retry_idx", "downloader_jobs", "id, created_at", LOST),
+    ("processor_jobs_failed_retry_idx", "processor_jobs", "id, volume_index, created_at", FAILED),
+    ("processor_jobs_hung_retry_idx", "processor_jobs", "id, volume_index, created_at", HUNG),
+    ("processor_jobs_lost_retry_idx", "processor_jobs", "id, volume_index, created_at", LOST),
+    ("survey_jobs_failed_retry_idx", "survey_jobs", "id, created_at", FAILED),
+    ("survey_jobs_hung_retry_idx", "survey_jobs", "id, created_at", HUNG),
+    ("survey_jobs_lost_retry_idx", "survey_jobs", "id, created_at", LOST),
+]
+
+
+class Migration(migrations.Migration):
+
+    # The job tables are written to constantly, so build the indexes
+    # without locking them, which can't be done inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('data_refinery_common', '0020_downloaderjob_throughput'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({}) WHERE {};".format(*index),
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS {};".format(index[0]),
+        )
+        for index in INDEXES
+    ]
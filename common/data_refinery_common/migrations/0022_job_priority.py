@@ -0,0 +1,23 @@
+# Generated by Django 2.1.8 on 2019-05-13 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_refinery_common', '0021_retry_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloaderjob',
+            name='priority',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='processorjob',
+            name='priority',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 2.1.8 on 2019-05-13 11:04
+
+from django.db import migrations
+
+
+# The Foreman's retry passes now page through downloader and processor
+# jobs in order of priority and then id, so rebuild their partial
+# indexes from 0021_retry_partial_indexes in that order. The survey
+# job indexes are left alone since survey jobs have no priority.
+FAILED = "success = false AND retried = false"
+HUNG = ("success IS NULL AND retried = false AND no_retry = false"
+        " AND start_time IS NOT NULL AND end_time IS NULL")
+LOST = ("success IS NULL AND retried = false AND no_retry = false"
+        " AND start_time IS NULL AND end_time IS NULL")
+
+INDEXES = [
+    ("downloader_jobs_failed_retry_idx", "downloader_jobs", "id, created_at", FAILED + " AND no_retry = false"),
+    ("downloader_jobs_hung_retry_idx", "downloader_jobs", "id, created_at", HUNG),
+    ("downloader_jobs_lost_retry_idx", "downloader_jobs", "id, created_at", LOST),
+    ("processor_jobs_failed_retry_idx", "processor_jobs", "id, volume_index, created_at", FAILED),
+    ("processor_jobs_hung_retry_idx", "processor_jobs", "id, volume_index, created_at", HUNG),
+    ("processor_jobs_lost_retry_idx", "processor_jobs", "id, volume_index, created_at", LOST),
+]
+
+
+def create_index(name, table, columns, condition):
+    return "CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({}) WHERE {};".format(
+        name, table, columns, condition)
+
+
+def drop_index(name):
+    return "DROP INDEX CONCURRENTLY IF EXISTS {};".format(name)
+
+
+def replace_index(name, table, columns, condition):
+    """Builds the index ordered by priority first and then drops the
+    old one, so the retry queries always have one to use."""
+    priority_name = name.replace("_retry_idx", "_priority_idx")
+    return [
+        migrations.RunSQL(
+            create_index(priority_name, table, "priority DESC, " + columns, condition),
+            reverse_sql=drop_index(priority_name),
+        ),
+        migrations.RunSQL(
+            drop_index(name),
+            reverse_sql=create_index(name, table, columns, condition),
+        ),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    # The job tables are written to constantly, so build the indexes
+    # without locking them, which can't be done inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('data_refinery_common', '0022_job_priority'),
+    ]
+
+    operations = [operation for index in INDEXES for operation in replace_index(*index)]
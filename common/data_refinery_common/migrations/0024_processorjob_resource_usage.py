@@ -0,0 +1,33 @@
+# Generated by Django 2.1.8 on 2019-05-16 10:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_refinery_common', '0023_priority_retry_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processorjob',
+            name='input_size',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='processorjob',
+            name='organism_name',
+            field=models.CharField(max_length=256, null=True),
+        ),
+        migrations.AddField(
+            model_name='processorjob',
+            name='peak_memory',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='processorjob',
+            name='platform_accession_code',
+            field=models.CharField(max_length=256, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.1.8 on 2019-05-16 10:24
+
+from django.db import migrations
+
+
+# job_lookup.determine_ram_amount looks up the most recent jobs of a
+# pipeline, platform and organism which recorded their peak memory.
+# Only jobs which ended on a worker have, so keep the index to those.
+INDEX = ("processor_jobs_ram_history_idx", "processor_jobs",
+         "pipeline_applied, platform_accession_code, organism_name, id DESC",
+         "peak_memory IS NOT NULL")
+
+
+class Migration(migrations.Migration):
+
+    # The job tables are written to constantly, so build the index
+    # without locking them, which can't be done inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('data_refinery_common', '0024_processorjob_resource_usage'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({}) WHERE {};".format(*INDEX),
+            reverse_sql="DROP INDEX CONCURRENTLY IF EXISTS {};".format(INDEX[0]),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.8 on 2019-05-20 09:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_refinery_common', '0025_ram_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloaderjob',
+            name='volume_index',
+            field=models.CharField(max_length=3, null=True),
+        ),
+        migrations.AddField(
+            model_name='processorjob',
+            name='volume_disk_usage',
+            field=models.FloatField(null=True),
+        ),
+    ]
@@ -99,6 +99,23 @@ class ProcessorJob(models.Model):
     ram_amount = models.IntegerField(default=2048)
     volume_index = models.CharField(max_length=3, null=True)
 
+    # Jobs with a higher priority get retried first. This is kept up to
+    # date by the Foreman, see foreman.main.update_job_priorities.
+    priority = models.IntegerField(default=0)
+
+    # Reported by the worker when the job ends so that
+    # job_lookup.determine_ram_amount can learn how much RAM jobs on
+    # each platform and organism need for a given amount of input.
+    # peak_memory is in MB and input_size in bytes.
+    peak_memory = models.IntegerField(null=True)
+    input_size = models.BigIntegerField(null=True)
+    platform_accession_code = models.CharField(max_length=256, null=True)
+    organism_name = models.CharField(max_length=256, null=True)
+
+    # How full the job's volume was when it ended, so the Foreman can
+    # tell which volumes have room for more work.
+    volume_disk_usage = models.FloatField(null=True)
+
     # Tracking
     start_time = models.DateTimeField(null=True)
     end_time = models.DateTimeField(null=True)
@@ -174,6 +191,19 @@ class DownloaderJob(models.Model):
 
     # Resources
     ram_amount = models.IntegerField(default=1024)
+    # The volume the Foreman placed this job on, or the one it ran on
+    # if it wasn't placed. The processor jobs it creates use the same one.
+    volume_index = models.CharField(max_length=3, null=True)
+
+    # Jobs with a higher priority get retried first. This is kept up to
+    # date by the Foreman, see foreman.main.update_job_priorities.
+    priority = models.IntegerField(default=0)
+
+    # Reported by the worker when the job ends so the Foreman can tell
+    # how fast each node and source is downloading and how full the
+    # node's volume is getting.
+    bytes_downloaded = models.BigIntegerField(null=True)
+    volume_disk_usage = models.FloatField(null=True)
 
     # This field represents how many times this job has been
     # retried. It starts at 0 and each time the job has to be retried
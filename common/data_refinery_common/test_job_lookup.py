@@ -0,0 +1,100 @@
+from django.test import TestCase
+
+from data_refinery_common import job_lookup
+from data_refinery_common.models import (
+    Organism,
+    OriginalFile,
+    OriginalFileSampleAssociation,
+    ProcessorJob,
+    ProcessorJobOriginalFileAssociation,
+    Sample,
+)
+
+
+GIGABYTE = 1024 * 1024 * 1024
+PLATFORM = "IlluminaHiSeq2500"
+
+
+class RamPredictionTestCase(TestCase):
+    def setUp(self):
+        job_lookup._RAM_HISTORY_CACHE.clear()
+
+        self.homo_sapiens = Organism(name="HOMO_SAPIENS", taxonomy_id=9606, is_scientific_name=True)
+        self.homo_sapiens.save()
+
+        self.sample = Sample(accession_code="SRR123",
+                             title="SRR123",
+                             platform_accession_code=PLATFORM,
+                             organism=self.homo_sapiens)
+        self.sample.save()
+
+    def tearDown(self):
+        job_lookup._RAM_HISTORY_CACHE.clear()
+
+    def create_finished_jobs(self, num_jobs, input_size, peak_memory, ram_amount=12288, success=True):
+        for i in range(num_jobs):
+            ProcessorJob(pipeline_applied="SALMON",
+                         ram_amount=ram_amount,
+                         success=success,
+                         input_size=input_size,
+                         peak_memory=peak_memory,
+                         platform_accession_code=PLATFORM,
+                         organism_name="HOMO_SAPIENS").save()
+
+    def create_original_file(self, size_in_bytes):
+        original_file = OriginalFile(source_filename="SRR123.sra",
+                                     filename="SRR123.sra",
+                                     size_in_bytes=size_in_bytes)
+        original_file.save()
+        OriginalFileSampleAssociation(original_file=original_file, sample=self.sample).save()
+        return original_file
+
+    def test_defaults_without_history(self):
+        job = ProcessorJob(pipeline_applied="SALMON")
+        original_file = self.create_original_file(GIGABYTE)
+
+        self.assertEqual(job_lookup.determine_ram_amount(self.sample, job, [original_file]), 12288)
+
+    def test_smallest_tier_for_input_size(self):
+        self.create_finished_jobs(30, GIGABYTE, 2000)
+        self.create_finished_jobs(30, 30 * GIGABYTE, 20000, ram_amount=32768)
+
+        job = ProcessorJob(pipeline_applied="SALMON")
+        small_file = self.create_original_file(GIGABYTE)
+        large_file = self.create_original_file(25 * GIGABYTE)
+
+        self.assertEqual(job_lookup.determine_ram_amount(self.sample, job, [small_file]), 3072)
+        self.assertEqual(job_lookup.determine_ram_amount(self.sample, job, [large_file]), 32768)
+
+        # Without similar jobs only larger ones are used.
+        medium_file = self.create_original_file(6 * GIGABYTE)
+        self.assertEqual(job_lookup.determine_ram_amount(self.sample, job, [medium_file]), 32768)
+
+    def test_jobs_which_ran_out_of_memory(self):
+        self.create_finished_jobs(20, GIGABYTE, 2000)
+        self.create_finished_jobs(5, GIGABYTE, 3000, ram_amount=3072, success=False)
+
+        history = job_lookup._get_ram_history("SALMON", PLATFORM, "HOMO_SAPIENS")
+        self.assertEqual(job_lookup.predict_ram_success(history, GIGABYTE, 3072), 0.8)
+        self.assertEqual(job_lookup.predict_ram_success(history, GIGABYTE, 4096), 1.0)
+
+        job = ProcessorJob(pipeline_applied="SALMON")
+        original_file = self.create_original_file(GIGABYTE)
+        self.assertEqual(job_lookup.determine_ram_amount(self.sample, job, [original_file]), 4096)
+
+    def test_retry_skips_tiers(self):
+        self.create_finished_jobs(30, 10 * GIGABYTE, 20000, ram_amount=32768)
+
+        job = ProcessorJob(pipeline_applied="SALMON", ram_amount=12288, success=False)
+        job.save()
+        original_file = self.create_original_file(10 * GIGABYTE)
+        ProcessorJobOriginalFileAssociation(processor_job=job, original_file=original_file).save()
+
+        self.assertEqual(job_lookup.determine_retry_ram_amount(job), 32768)
+
+        # A job's own peak memory rules out tiers it wouldn't fit into.
+        job.peak_memory = 30000
+        job.input_size = 10 * GIGABYTE
+        job.platform_accession_code = PLATFORM
+        job.organism_name = "HOMO_SAPIENS"
+        self.assertEqual(job_lookup.determine_retry_ram_amount(job), 65536)
@@ -0,0 +1,84 @@
+import os
+
+from django.test import TestCase
+from unittest.mock import MagicMock, patch
+
+from data_refinery_common import message_queue
+from data_refinery_common.job_lookup import Downloaders, ProcessorPipeline
+from data_refinery_common.models import DownloaderJob, ProcessorJob
+
+
+class MessageQueueTestCase(TestCase):
+    @patch.dict(os.environ, {"NOMAD_HOST": "nomad", "NOMAD_PORT": "4646"})
+    def test_get_nomad_client(self):
+        message_queue._NOMAD_CLIENT = None
+
+        nomad_client = message_queue.get_nomad_client()
+        self.assertIs(message_queue.get_nomad_client(), nomad_client)
+
+        # A forked process gets its own client.
+        message_queue._NOMAD_CLIENT_PID = -1
+        self.assertIsNot(message_queue.get_nomad_client(), nomad_client)
+
+    @patch('data_refinery_common.message_queue.send_job')
+    def test_send_jobs(self, mock_send_job):
+        jobs = [ProcessorJob(pipeline_applied="SALMON", ram_amount=12288) for i in range(4)]
+        for job in jobs:
+            job.save()
+
+        def send_job(job_type, job, **kwargs):
+            self.assertFalse(kwargs["persist"])
+            if job.id == jobs[1].id:
+                raise Exception("Nomad is down")
+
+            job.volume_index = "2"
+            job.nomad_job_id = "SALMON_2_12288/dispatch-" + str(job.id)
+            return True
+
+        mock_send_job.side_effect = send_job
+
+        results = message_queue.send_jobs(ProcessorPipeline.SALMON, jobs, nomad_client="client")
+        self.assertEqual(results, [True, False, True, True])
+        self.assertEqual(mock_send_job.call_count, 4)
+        self.assertEqual({call[1]["nomad_client"] for call in mock_send_job.call_args_list}, {"client"})
+
+        for job, result in zip(jobs, results):
+            job.refresh_from_db()
+            if result:
+                self.assertEqual(job.nomad_job_id, "SALMON_2_12288/dispatch-" + str(job.id))
+                self.assertEqual(job.volume_index, "2")
+            else:
+                self.assertIsNone(job.nomad_job_id)
+                self.assertIsNone(job.volume_index)
+
+    @patch('data_refinery_common.message_queue.get_nomad_client')
+    def test_send_jobs_not_dispatched(self, mock_get_nomad_client):
+        """Downloader jobs aren't dispatched outside of the Foreman in the
+        cloud, but the Foreman gets their retry back."""
+        jobs = [DownloaderJob(downloader_task="SRA", num_retries=1) for i in range(2)]
+        for job in jobs:
+            job.save()
+
+        with self.settings(RUNNING_IN_CLOUD=True):
+            results = message_queue.send_jobs(Downloaders.SRA, jobs)
+
+        self.assertEqual(results, [True, True])
+        mock_get_nomad_client.return_value.job.dispatch_job.assert_not_called()
+        for job in jobs:
+            job.refresh_from_db()
+            self.assertEqual(job.num_retries, 0)
+
+    def test_send_placed_downloader_job(self):
+        nomad_client = MagicMock()
+        nomad_client.job.dispatch_job.return_value = {"DispatchedJobID": "DOWNLOADER_2_1024/dispatch-1"}
+
+        job = DownloaderJob(downloader_task="SRA", volume_index="2")
+        job.save()
+
+        self.assertTrue(message_queue.send_job(Downloaders.SRA, job, is_dispatch=True, nomad_client=nomad_client))
+        self.assertEqual(nomad_client.job.dispatch_job.call_args[0][0], "DOWNLOADER_2_1024")
+
+        # Jobs which weren't placed can go anywhere.
+        job.volume_index = None
+        message_queue.send_job(Downloaders.SRA, job, is_dispatch=True, nomad_client=nomad_client)
+        self.assertEqual(nomad_client.job.dispatch_job.call_args[0][0], "DOWNLOADER_1024")
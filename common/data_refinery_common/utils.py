@@ -6,6 +6,7 @@ import io
 import os
 import re
 import requests
+import shutil
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
@@ -85,34 +86,57 @@ def get_volume_index(path='/home/user/data_store/VOLUME_INDEX') -> str:
 
     return default
 
+def get_volume_disk_usage(path='/home/user/data_store') -> float:
+    """Returns the fraction of the disk holding path that is in use,
+    or None if it can't be read."""
+    try:
+        disk_usage = shutil.disk_usage(path)
+        return disk_usage.used / disk_usage.total
+    except OSError:
+        return None
+
 def get_nomad_jobs() -> list:
     """Calls nomad service and return all jobs"""
+    # message_queue imports this module, so it can't be imported at the top.
+    from data_refinery_common.message_queue import get_nomad_client
+
     try:
-        nomad_host = get_env_variable("NOMAD_HOST")
-        nomad_port = get_env_variable("NOMAD_PORT", "4646")
-        nomad_client = nomad.Nomad(nomad_host, port=int(nomad_port), timeout=30)
-        return nomad_client.jobs.get_jobs()
+        return get_nomad_client().jobs.get_jobs()
     except nomad.api.exceptions.BaseNomadException:
         # Nomad is not available right now
         return []
 
-def get_active_volumes() -> Set[str]:
+# Node details are only fetched again when a node's ModifyIndex
+# changes, so each call doesn't cost one request per node.
+_NODE_VOLUME_INDICES = {}
+
+def get_active_volumes(nomad_client: nomad.Nomad=None) -> Set[str]:
     """Returns a Set of indices for volumes that are currently mounted.
 
     These can be used to determine which jobs would actually be able
     to be placed if they were queued up.
     """
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = nomad.Nomad(nomad_host, port=int(nomad_port), timeout=30)
+    if not nomad_client:
+        from data_refinery_common.message_queue import get_nomad_client
+        nomad_client = get_nomad_client()
 
     volumes = set()
     try:
         for node in nomad_client.nodes.get_nodes():
-            node_detail = nomad_client.node.get_node(node["ID"])
-            if 'Status' in node_detail and node_detail['Status'] == 'ready' \
-               and 'Meta' in node_detail and 'volume_index' in node_detail['Meta']:
-                volumes.add(node_detail['Meta']['volume_index'])
+            if node.get('Status', None) != 'ready':
+                continue
+
+            modify_index, volume_index = _NODE_VOLUME_INDICES.get(node["ID"], (None, None))
+            if modify_index is None or modify_index != node.get('ModifyIndex', None):
+                node_detail = nomad_client.node.get_node(node["ID"])
+                volume_index = None
+                if 'Status' in node_detail and node_detail['Status'] == 'ready' \
+                   and 'Meta' in node_detail and 'volume_index' in node_detail['Meta']:
+                    volume_index = node_detail['Meta']['volume_index']
+                _NODE_VOLUME_INDICES[node["ID"]] = (node.get('ModifyIndex', None), volume_index)
+
+            if volume_index:
+                volumes.add(volume_index)
     except nomad.api.exceptions.BaseNomadException:
         # Nomad is down, return the empty set.
         pass
@@ -1,33 +1,51 @@
+import concurrent.futures
 import datetime
 import nomad
 import socket
 import sys
+import threading
 import time
 import traceback
 
 from django.conf import settings
 #from django.core.paginator import Paginator
 from data_refinery_foreman.foreman.performant_pagination.pagination import PerformantPaginator as Paginator
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import (
+    Case,
+    Count,
+    F,
+    IntegerField,
+    Max,
+    Q,
+    Sum,
+    Value,
+    When,
+    prefetch_related_objects,
+)
 from django.utils import timezone
 from functools import wraps
 from nomad import Nomad
 from nomad.api.exceptions import URLNotFoundNomadException
-from typing import List, Set
+from typing import Dict, List, Optional, Set, Tuple
 
 from data_refinery_common.job_lookup import (
     Downloaders,
     ProcessorPipeline,
     SurveyJobTypes,
-    does_processor_job_have_samples,
+    determine_retry_ram_amount,
     is_file_rnaseq,
+    record_oom_kill,
 )
 from data_refinery_common.logging import get_and_configure_logger
-from data_refinery_common.message_queue import send_job
+from data_refinery_common import message_queue
+from data_refinery_common.message_queue import create_nomad_client, get_nomad_client
 from data_refinery_common.models import (
     ComputedFile,
     DownloaderJob,
     DownloaderJobOriginalFileAssociation,
+    Experiment,
+    OriginalFile,
     ProcessorJob,
     ProcessorJobDatasetAssociation,
     ProcessorJobOriginalFileAssociation,
@@ -36,13 +54,16 @@ from data_refinery_common.models import (
 )
 from data_refinery_common.utils import (
     get_active_volumes,
-    get_env_variable,
     get_env_variable_gracefully
 )
 
 
 logger = get_and_configure_logger(__name__)
 
+# How many requests can be made to Nomad at once when looking up the
+# statuses of jobs which weren't in the cluster state's job list.
+MAX_STATUS_LOOKUP_THREADS = int(get_env_variable_gracefully("MAX_STATUS_LOOKUP_THREADS", 16))
+
 # Maximum number of retries, so the number of attempts will be one
 # greater than this because of the first attempt
 MAX_NUM_RETRIES = 2
@@ -71,6 +92,37 @@ HARD_MAX_DOWNLOADER_JOBS = 750
 # excessive spinning.
 MIN_LOOP_TIME = datetime.timedelta(seconds=15)
 
+# How long each retry pass may run before it stops at the end of its
+# current page, so that one slow pass can't hold up the whole loop.
+MAX_PASS_TIME = datetime.timedelta(minutes=5)
+
+# How often the health file is written while waiting on the passes.
+HEARTBEAT_TIME = datetime.timedelta(seconds=60)
+
+# The share of the total job capacity reserved for processor jobs at
+# the start of each loop, the rest being left to survey jobs.
+# Processors get most of it so we process data sitting on disk rather
+# than end up with tons and tons of unqueued jobs.
+PROCESSOR_CAPACITY_SHARE = 0.9
+
+# Whether the Foreman reacts to Nomad jobs ending as it happens rather
+# than only polling, see monitor_jobs.
+FOREMAN_EVENT_DRIVEN = get_env_variable_gracefully("FOREMAN_EVENT_DRIVEN", "False") == "True"
+
+# How long each blocking query waits for Nomad's job list to change,
+# and the least time between them so a busy cluster can't make us
+# fetch the job list over and over.
+BLOCKING_QUERY_WAIT = datetime.timedelta(seconds=30)
+MIN_EVENT_LOOP_TIME = datetime.timedelta(seconds=2)
+
+# How frequently the event-driven Foreman still runs every pass over
+# the whole database, in case it missed something.
+RECONCILIATION_TIME = datetime.timedelta(minutes=10)
+
+# How frequently the event-driven Foreman runs the lost passes between
+# sweeps, see LOST_PASSES.
+LOST_PASS_TIME = datetime.timedelta(minutes=1)
+
 # How frequently we dispatch Janitor jobs and clean unplaceable jobs
 # out of the Nomad queue.
 JANITOR_DISPATCH_TIME = datetime.timedelta(minutes=30)
@@ -110,6 +162,17 @@ HGU133PLUS2_ACCESSION_LIST = read_config_list("config/hgu133plus2_accessions.txt
 ##
 
 
+def hand_back_folded_jobs(batch_job: ProcessorJob, new_batch_job: ProcessorJob=None) -> None:
+    """SALMON jobs folded into a SALMON_BATCH job are only closed out
+    by the batch itself. When the batch is retried they're folded into
+    its retry instead. When it's given up on, new_batch_job is None and
+    they're handed back to the lost pass to be run by themselves."""
+    ProcessorJob.objects.filter(
+        pipeline_applied=ProcessorPipeline.SALMON.value,
+        retried=False,
+        retried_job=batch_job
+    ).update(retried_job=new_batch_job)
+
 def handle_repeated_failure(job) -> None:
     """If a job fails too many times, log it and stop retrying."""
     # Not strictly retried but will prevent the job from getting
@@ -121,15 +184,115 @@ def handle_repeated_failure(job) -> None:
     job.success = False
     job.save()
 
+    if isinstance(job, ProcessorJob) and job.pipeline_applied == ProcessorPipeline.SALMON_BATCH.value:
+        hand_back_folded_jobs(job)
+
     # At some point this should become more noisy/attention
     # grabbing. However for the time being just logging should be
     # sufficient because all log messages will be closely monitored
     # during early testing stages.
     logger.warn("%s #%d failed %d times!!!", job.__class__.__name__, job.id, MAX_NUM_RETRIES + 1, failure_reason=job.failure_reason)
 
+def _create_retry_associations(new_job, last_job) -> List:
+    """Returns unsaved associations between new_job and the files and
+    datasets of the job it retries."""
+    if isinstance(new_job, DownloaderJob):
+        return [DownloaderJobOriginalFileAssociation(downloader_job=new_job, original_file=original_file)
+                for original_file in last_job.original_files.all()]
+
+    associations = [ProcessorJobOriginalFileAssociation(processor_job=new_job, original_file=original_file)
+                    for original_file in last_job.original_files.all()]
+    associations.extend([ProcessorJobDatasetAssociation(processor_job=new_job, dataset=dataset)
+                         for dataset in last_job.datasets.all()])
+    return associations
+
+def bulk_requeue_jobs(retries: List[Tuple]) -> int:
+    """Requeues many downloader or processor jobs at once.
+
+    retries holds a (last_job, new_job, job_type) tuple for each job
+    being requeued, where new_job is the unsaved job that retries
+    last_job and job_type is what send_job should dispatch it as. The
+    new jobs and their associations are created in bulk, dispatched
+    with send_jobs, and then the jobs which were dispatched are marked
+    as retried with one update. New jobs which couldn't be
+    dispatched are deleted so their old jobs get retried in a later
+    loop.
+
+    Returns the number of jobs which were dispatched.
+    """
+    if not retries:
+        return 0
+
+    job_model = type(retries[0][1])
+    with transaction.atomic():
+        job_model.objects.bulk_create([new_job for _, new_job, _ in retries])
+
+        associations_by_model = {}
+        for last_job, new_job, _ in retries:
+            for association in _create_retry_associations(new_job, last_job):
+                associations_by_model.setdefault(type(association), []).append(association)
+
+        for association_model, associations in associations_by_model.items():
+            association_model.objects.bulk_create(associations)
+
+    # send_jobs dispatches and saves jobs of a single type at a time.
+    retries_by_type = {}
+    for retry in retries:
+        retries_by_type.setdefault(retry[2], []).append(retry)
+
+    nomad_client = get_nomad_client()
+    dispatched = []
+    not_dispatched = []
+    for job_type, typed_retries in retries_by_type.items():
+        results = message_queue.send_jobs(job_type,
+                                          [new_job for _, new_job, _ in typed_retries],
+                                          is_dispatch=True,
+                                          nomad_client=nomad_client)
+        for (last_job, new_job, _), result in zip(typed_retries, results):
+            if result:
+                logger.debug("Requeued %s which had ID %d with a new %s with ID %d.",
+                             job_model.__name__,
+                             last_job.id,
+                             job_model.__name__,
+                             new_job.id)
+                dispatched.append((last_job, new_job, job_type))
+            else:
+                logger.error("Failed to requeue %s which had ID %d with a new %s with ID %d.",
+                             job_model.__name__,
+                             last_job.id,
+                             job_model.__name__,
+                             new_job.id)
+                not_dispatched.append(new_job)
+
+    with transaction.atomic():
+        if dispatched:
+            job_model.objects.filter(id__in=[last_job.id for last_job, _, _ in dispatched]).update(
+                retried=True,
+                success=False,
+                retried_job=Case(*[When(id=last_job.id, then=Value(new_job.id))
+                                   for last_job, new_job, _ in dispatched],
+                                 output_field=IntegerField())
+            )
+
+            for last_job, new_job, job_type in dispatched:
+                if job_type == ProcessorPipeline.SALMON_BATCH:
+                    hand_back_folded_jobs(last_job, new_job)
+
+        if not_dispatched:
+            # Can't communicate with nomad just now, leave the jobs for a later loop.
+            job_model.objects.filter(id__in=[new_job.id for new_job in not_dispatched]).delete()
+
+    for last_job, new_job, _ in dispatched:
+        last_job.retried = True
+        last_job.success = False
+        last_job.retried_job = new_job
+
+    return len(dispatched)
+
 def get_max_downloader_jobs(window=datetime.timedelta(minutes=2), nomad_client=None):
     """Fetches the desired maximum number of downloader jobs available
-    based on the cluster size.
+    based on the cluster size and how well each node has been
+    downloading recently.
 
     If this has been calculated recently, returns a cached value, else
     it will calculate it fresh every `window`.
@@ -146,9 +309,7 @@ def get_max_downloader_jobs(window=datetime.timedelta(minutes=2), nomad_client=N
     if (timezone.now() - TIME_OF_LAST_SIZE_CHECK > window):
         # Assuming they're all similar to an X1, give 50 downloaders per node.
         if not nomad_client:
-            nomad_host = get_env_variable("NOMAD_HOST")
-            nomad_port = get_env_variable("NOMAD_PORT", "4646")
-            nomad_client = Nomad(nomad_host, port=int(nomad_port), timeout=30)
+            nomad_client = get_nomad_client()
 
         try:
             num_active_nodes = 0
@@ -168,7 +329,7 @@ def get_max_downloader_jobs(window=datetime.timedelta(minutes=2), nomad_client=N
         else:
             num_smasher_nodes = 0
 
-        MAX_TOTAL_DOWNLOADER_JOBS = (num_active_nodes - num_smasher_nodes) * DOWNLOADER_JOBS_PER_NODE
+        MAX_TOTAL_DOWNLOADER_JOBS = get_total_downloader_limit(num_active_nodes - num_smasher_nodes)
         TIME_OF_LAST_SIZE_CHECK = timezone.now()
 
     if MAX_TOTAL_DOWNLOADER_JOBS > HARD_MAX_DOWNLOADER_JOBS:
@@ -177,148 +338,808 @@ def get_max_downloader_jobs(window=datetime.timedelta(minutes=2), nomad_client=N
         return MAX_TOTAL_DOWNLOADER_JOBS
 
 ##
-# Job Prioritization
+# Cluster State
 ##
 
+class ClusterState:
+    """A snapshot of the Nomad cluster shared by every pass of one
+    monitor_jobs loop.
 
-def prioritize_salmon_jobs(jobs: List) -> List:
-    """Prioritizes salmon experiments based on how close to completion they are.
+    Listing every job in Nomad gets slow once the queue is large, so
+    it's done once per loop rather than by every pass for every page.
+    Jobs dispatched after the snapshot was taken are counted against
+    it so that capacity still goes down as passes queue jobs.
 
-    This is because salmon experiments have a final processing step
-    that must be performed on all the samples in the experiment, so if
-    9/10 samples in an experiment are processed then they can't
-    actually be used until that last sample is processed.
+    The passes for each job type run in their own thread, so the
+    counts are guarded by a lock and each thread's current pass and
+    its deadline are kept thread-local.
     """
-    # The strategy for doing so is to build a mapping between every
-    # salmon job in `jobs` to a priority. This priority will be what
-    # percentage of the samples in this experiment have been
-    # processed. Once we have that mapping we can sort those jobs by
-    # that priority and move them to the front of the list.
-    prioritized_jobs = []
-    for job in jobs:
+
+    def __init__(self, nomad_client: Nomad=None):
+        if not nomad_client:
+            nomad_client = get_nomad_client()
+
+        self.nomad_client = nomad_client
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Fetches the jobs and volumes from Nomad again. Node details
+        are only fetched for nodes which have changed."""
+        self.num_jobs_dispatched = {"processor": 0, "downloader": 0, "survey": 0}
+        self.capacity_limits = {}
+
         try:
-            if type(job) == ProcessorJob and not does_processor_job_have_samples(job):
+            self.active_volumes = get_active_volumes(self.nomad_client)
+        except Exception:
+            logger.exception("Could not get the active volumes from Nomad.")
+            self.active_volumes = set()
+
+        try:
+            self.placement = VolumePlacement(self.active_volumes)
+        except Exception:
+            logger.exception("Could not measure the work waiting on each volume.")
+            self.placement = None
+
+        try:
+            self.jobs = self.nomad_client.jobs.get_jobs()
+        except Exception:
+            # Nomad is down, so nothing should be queued until it's back.
+            logger.exception("Could not get the list of jobs from Nomad.")
+            self.jobs = None
+
+        # The job list includes every dispatched job Nomad hasn't
+        # garbage collected yet, along with its status.
+        self.job_statuses = {}
+        for job in (self.jobs or []):
+            self.job_statuses[job["ID"]] = job["Status"]
+
+        self.taken_at = timezone.now()
+
+    def update_jobs(self, jobs: List[Dict]) -> None:
+        """Replaces the job list with a newer one, such as one returned
+        by a blocking query, without fetching everything else again.
+
+        The jobs which were dispatched since the last list are in this
+        one, so they stop being counted on top of it.
+        """
+        with self._lock:
+            self.jobs = jobs
+            self.job_statuses = {job["ID"]: job["Status"] for job in jobs}
+            self.num_jobs_dispatched = {"processor": 0, "downloader": 0, "survey": 0}
+            self.taken_at = timezone.now()
+
+    def _get_job_status(self, nomad_job_id: str) -> str:
+        try:
+            return self.nomad_client.job.get_job(nomad_job_id)["Status"]
+        except URLNotFoundNomadException:
+            return None
+
+    def get_job_statuses(self,
+                         nomad_job_ids: List[str],
+                         recheck_not_running: bool=False) -> Dict[str, str]:
+        """Returns a dict from each of nomad_job_ids to the status of
+        its Nomad job, or None if Nomad doesn't know about it.
+
+        Statuses come from the job list when possible. Jobs which
+        weren't in it, because they were dispatched after it was
+        fetched or because it couldn't be, are looked up in parallel.
+        IDs which couldn't be looked up are left out so that their
+        jobs get another chance next loop.
+
+        The hung passes set recheck_not_running, since a job which was
+        pending when the job list was fetched may have started since.
+        Then any status other than running is looked up again too.
+        """
+        statuses = {}
+        missing_ids = set()
+        for nomad_job_id in nomad_job_ids:
+            if not nomad_job_id:
                 continue
+            elif nomad_job_id in self.job_statuses and not (
+                    recheck_not_running and self.job_statuses[nomad_job_id] != "running"):
+                statuses[nomad_job_id] = self.job_statuses[nomad_job_id]
+            else:
+                missing_ids.add(nomad_job_id)
 
-            # Salmon jobs are specifc to one sample.
-            sample = job.get_samples().pop()
+        if not missing_ids:
+            return statuses
 
-            # Skip jobs that aren't for Salmon. Handle both ProcessorJobs and DownloaderJobs.
-            if type(job) is ProcessorJob and job.pipeline_applied != ProcessorPipeline.SALMON.value:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_STATUS_LOOKUP_THREADS) as executor:
+            futures = {executor.submit(self._get_job_status, nomad_job_id): nomad_job_id
+                       for nomad_job_id in missing_ids}
+
+            for future in concurrent.futures.as_completed(futures):
+                nomad_job_id = futures[future]
+                try:
+                    statuses[nomad_job_id] = future.result()
+                except nomad.api.exceptions.BaseNomadException:
+                    raise
+                except Exception:
+                    logger.exception("Couldn't query Nomad about job.", nomad_job_id=nomad_job_id)
+
+        return statuses
+
+    def record_dispatched(self, num_jobs: int, job_type: str) -> None:
+        """Counts jobs of job_type ("processor", "downloader" or
+        "survey") dispatched since the snapshot was taken."""
+        with self._lock:
+            self.num_jobs_dispatched[job_type] += num_jobs
+
+        if getattr(self._local, "pass_name", None):
+            self._local.jobs_dispatched += num_jobs
+
+    def partition_capacity(self) -> Dict[str, int]:
+        """Splits the capacity of the queue between the job types up
+        front so that their passes can run at the same time without
+        all of them filling the same room.
+
+        Downloader jobs have their own limit. Processor jobs get
+        PROCESSOR_CAPACITY_SHARE of the total and survey jobs the rest.
+        """
+        self.capacity_limits = {}
+
+        MAX_TOTAL_JOBS = int(get_env_variable_gracefully("MAX_TOTAL_JOBS", DEFAULT_MAX_JOBS))
+        total_capacity = max(MAX_TOTAL_JOBS - self.count_jobs(), 0)
+        processor_capacity = int(total_capacity * PROCESSOR_CAPACITY_SHARE)
+
+        self.capacity_limits = {
+            "processor": processor_capacity,
+            "downloader": max(get_capacity_for_downloader_jobs(self), 0),
+            "survey": total_capacity - processor_capacity,
+        }
+        return self.capacity_limits
+
+    def get_remaining_capacity(self, job_type: str) -> int:
+        """Returns how much of the capacity partitioned to job_type
+        hasn't been used yet, or sys.maxsize if it wasn't partitioned."""
+        if job_type not in self.capacity_limits:
+            return sys.maxsize
+
+        with self._lock:
+            return self.capacity_limits[job_type] - self.num_jobs_dispatched[job_type]
+
+    def start_pass(self, pass_name: str, time_budget: datetime.timedelta) -> None:
+        """Starts timing a pass run by the current thread."""
+        self._local.pass_name = pass_name
+        self._local.jobs_dispatched = 0
+        self._local.started_at = timezone.now()
+        self._local.deadline = self._local.started_at + time_budget
+
+    def finish_pass(self) -> Dict:
+        """Stops timing the current thread's pass and returns its
+        metrics."""
+        metrics = {
+            "pass_name": self._local.pass_name,
+            "duration": (timezone.now() - self._local.started_at).total_seconds(),
+            "jobs_dispatched": self._local.jobs_dispatched,
+            "out_of_time": self.is_out_of_time(),
+        }
+        self._local.pass_name = None
+        self._local.deadline = None
+        return metrics
+
+    def is_out_of_time(self) -> bool:
+        """Whether the current thread's pass has used up its time
+        budget. Passes check this between pages and stop early."""
+        deadline = getattr(self._local, "deadline", None)
+        return deadline is not None and timezone.now() > deadline
+
+    def count_jobs(self) -> int:
+        """Counts every job in Nomad, or returns sys.maxsize if Nomad
+        couldn't be reached."""
+        if self.jobs is None:
+            return sys.maxsize
+
+        with self._lock:
+            return len(self.jobs) + sum(self.num_jobs_dispatched.values())
+
+    def count_downloader_jobs_in_queue(self) -> int:
+        """Counts how many downloader jobs in the Nomad queue do not have status of 'dead'."""
+        if self.jobs is None:
+            # Nomad is down, return an impossibly high number to prevent
+            # additonal queuing from happening:
+            return sys.maxsize
+
+        total = 0
+        for job in self.jobs:
+            if not job["ID"].startswith("DOWNLOADER"):
                 continue
-            elif type(job) is DownloaderJob:
-                is_salmon_sample = False
-                for original_file in sample.original_files.all():
-                    if is_file_rnaseq(original_file.filename):
-                        is_salmon_sample = True
 
-                if not is_salmon_sample:
-                    continue
+            if job['ParameterizedJob'] and job['JobSummary'].get('Children', None):
+                total = total + job['JobSummary']['Children']['Pending']
+                total = total + job['JobSummary']['Children']['Running']
 
-            # Get a set of unique samples that share at least one
-            # experiment with the sample this job is for.
-            related_samples = set()
-            for experiment in sample.experiments.all():
-                for related_sample in experiment.samples.all():
-                    related_samples.add(related_sample)
-
-            # We cannot simply filter on is_processed because that field
-            # doesn't get set until every sample in an experiment is processed.
-            # Instead we are looking for one successful processor job.
-            processed_samples = 0
-            for related_sample in related_samples:
-                original_files = related_sample.original_files
-                if original_files.count() == 0:
-                    logger.error("Salmon sample found without any original files!!!", sample=related_sample)
-                elif original_files.first().processor_jobs.filter(success=True).count() >= 1:
-                    processed_samples += 1
-
-            experiment_completion_percent = processed_samples / len(related_samples)
-            prioritized_jobs.append({"job": job, "priority": experiment_completion_percent})
-        except:
-            logger.debug("Exception caught while prioritizing salmon jobs!", job=job)
+        with self._lock:
+            return total + self.num_jobs_dispatched["downloader"]
 
 
-    sorted_job_mappings = sorted(prioritized_jobs, reverse=True, key=lambda k: k["priority"])
-    sorted_jobs = [job_mapping["job"] for job_mapping in sorted_job_mappings]
+##
+# Adaptive Downloader Concurrency
+##
 
-    # Remove all the jobs we're moving to the front of the list
-    for job in sorted_jobs:
-        jobs.remove(job)
+# Each node's and each source's downloader limit is adjusted AIMD
+# style every time get_max_downloader_jobs recalculates: raised by a
+# fixed step while it's being hit without trouble, and cut in half as
+# soon as a node's volume fills up, jobs start failing, or its
+# throughput drops while it's at its limit. For a source that usually
+# means NCBI/EBI are throttling us, for a node that its network or
+# disk can't keep up.
+DOWNLOADER_METRICS_WINDOW = datetime.timedelta(minutes=10)
+DOWNLOADER_LIMIT_INCREASE = 10
+DOWNLOADER_LIMIT_DECREASE_FACTOR = 0.5
+MIN_DOWNLOADER_JOBS_PER_NODE = 10
+MAX_DOWNLOADER_JOBS_PER_NODE = 300
+MIN_DOWNLOADER_JOBS_PER_SOURCE = 10
+MAX_DOWNLOADER_ERROR_RATE = 0.2
+MAX_VOLUME_DISK_USAGE = 0.9
+# How far a node's or source's throughput can fall between measurements before
+# we back off.
+THROUGHPUT_DROP_TOLERANCE = 0.1
+
+NODE_DOWNLOADER_LIMITS = {}
+SOURCE_DOWNLOADER_LIMITS = {}
+LAST_SOURCE_THROUGHPUT = {}
+LAST_NODE_THROUGHPUT = {}
+
+
+def adjust_downloader_limit(limit: int, congested: bool, saturated: bool, minimum: int, maximum: int) -> int:
+    """Additive increase, multiplicative decrease.
+
+    A limit which isn't being reached is left alone since there's
+    nothing to learn from raising it.
+    """
+    if congested:
+        return max(minimum, int(limit * DOWNLOADER_LIMIT_DECREASE_FACTOR))
+    elif saturated:
+        return min(maximum, limit + DOWNLOADER_LIMIT_INCREASE)
+    else:
+        return limit
+
+
+def get_downloader_metrics(field: str, window=DOWNLOADER_METRICS_WINDOW) -> Dict:
+    """Aggregates the downloader jobs that ended within `window` by
+    `field`, which should be either worker_id or downloader_task."""
+    metrics = DownloaderJob.objects.filter(
+        end_time__gt=timezone.now() - window
+    ).values(field).annotate(
+        num_jobs=Count("id"),
+        num_failed=Count("id", filter=Q(success=False)),
+        bytes_downloaded=Sum("bytes_downloaded"),
+        volume_disk_usage=Max("volume_disk_usage"),
+    )
 
-    return sorted_jobs + jobs
+    return {row[field]: row for row in metrics if row[field]}
 
 
-def prioritize_zebrafish_jobs(jobs: List) -> List:
-    """Moves zebrafish jobs to the beginnging of the input list."""
-    zebrafish_jobs = []
-    for job in jobs:
-        try:
-            if type(job) == ProcessorJob and not does_processor_job_have_samples(job):
-                continue
+def count_downloader_jobs_in_flight(field: str="downloader_task") -> Dict[str, int]:
+    """Returns how many downloader jobs have been sent to Nomad and
+    haven't finished yet, grouped by `field`, which should be either
+    worker_id or downloader_task.
 
-            # There aren't cross-species jobs, so just checking one sample's organism will be sufficient.
-            samples = job.get_samples()
+    Jobs are only counted against a worker_id once they've started
+    on it.
+    """
+    counts = DownloaderJob.objects.filter(
+        nomad_job_id__isnull=False,
+        end_time__isnull=True,
+        success__isnull=True,
+        retried=False
+    ).values(field).annotate(num_jobs=Count("id"))
+
+    return {row[field]: row["num_jobs"] for row in counts if row[field]}
+
+
+def is_throttled(saturated: bool, throughput: float, last_throughput: Optional[float]) -> bool:
+    """Fewer bytes coming in while we're hitting the limit means more
+    connections are only making things worse."""
+    return (saturated
+            and last_throughput is not None
+            and throughput < last_throughput * (1 - THROUGHPUT_DROP_TOLERANCE))
+
+
+def update_downloader_limits(window=DOWNLOADER_METRICS_WINDOW) -> None:
+    """Adjusts the per-node and per-source downloader limits based on
+    the jobs which ended within `window`."""
+    node_metrics = get_downloader_metrics("worker_id", window)
+    node_jobs_in_flight = count_downloader_jobs_in_flight("worker_id")
+    for worker_id, metrics in node_metrics.items():
+        error_rate = metrics["num_failed"] / metrics["num_jobs"]
+        disk_usage = metrics["volume_disk_usage"] or 0
+        throughput = (metrics["bytes_downloaded"] or 0) / window.total_seconds()
+        limit = NODE_DOWNLOADER_LIMITS.get(worker_id, DOWNLOADER_JOBS_PER_NODE)
+        saturated = node_jobs_in_flight.get(worker_id, 0) >= limit
+        throttled = is_throttled(saturated, throughput, LAST_NODE_THROUGHPUT.get(worker_id, None))
+
+        NODE_DOWNLOADER_LIMITS[worker_id] = adjust_downloader_limit(
+            limit,
+            congested=(throttled
+                       or disk_usage > MAX_VOLUME_DISK_USAGE
+                       or error_rate > MAX_DOWNLOADER_ERROR_RATE),
+            saturated=saturated,
+            minimum=MIN_DOWNLOADER_JOBS_PER_NODE,
+            maximum=MAX_DOWNLOADER_JOBS_PER_NODE
+        )
+        LAST_NODE_THROUGHPUT[worker_id] = throughput
+
+    # Nodes that haven't finished anything lately have probably gone away.
+    for worker_id in set(NODE_DOWNLOADER_LIMITS) - set(node_metrics):
+        del NODE_DOWNLOADER_LIMITS[worker_id]
+        LAST_NODE_THROUGHPUT.pop(worker_id, None)
+
+    jobs_in_flight = count_downloader_jobs_in_flight("downloader_task")
+    for source, metrics in get_downloader_metrics("downloader_task", window).items():
+        error_rate = metrics["num_failed"] / metrics["num_jobs"]
+        throughput = (metrics["bytes_downloaded"] or 0) / window.total_seconds()
+        limit = SOURCE_DOWNLOADER_LIMITS.get(source, HARD_MAX_DOWNLOADER_JOBS)
+        saturated = jobs_in_flight.get(source, 0) >= limit
+        throttled = is_throttled(saturated, throughput, LAST_SOURCE_THROUGHPUT.get(source, None))
+
+        SOURCE_DOWNLOADER_LIMITS[source] = adjust_downloader_limit(
+            limit,
+            congested=(throttled or error_rate > MAX_DOWNLOADER_ERROR_RATE),
+            saturated=saturated,
+            minimum=MIN_DOWNLOADER_JOBS_PER_SOURCE,
+            maximum=HARD_MAX_DOWNLOADER_JOBS
+        )
+        LAST_SOURCE_THROUGHPUT[source] = throughput
 
-            for sample in samples:
-                if sample.organism.name == 'DANIO_RERIO':
-                    zebrafish_jobs.append(job)
-                    break
-        except:
-            logger.debug("Exception caught while prioritizing zebrafish jobs!", job=job)
+        logger.info("Adjusted downloader limit.",
+                    downloader_task=source,
+                    limit=SOURCE_DOWNLOADER_LIMITS[source],
+                    bytes_per_second=throughput,
+                    error_rate=error_rate)
 
-    # Remove all the jobs we're moving to the front of the list
-    for job in zebrafish_jobs:
-        jobs.remove(job)
 
-    return zebrafish_jobs + jobs
+def get_total_downloader_limit(num_nodes: int) -> int:
+    """Sums the downloader limits of `num_nodes` nodes. Nodes which
+    haven't reported any jobs yet get the default limit."""
+    try:
+        update_downloader_limits()
+    except Exception:
+        logger.exception("Could not update downloader limits.")
 
+    reported_limits = sorted(NODE_DOWNLOADER_LIMITS.values(), reverse=True)[:max(num_nodes, 0)]
+    num_unreported_nodes = max(num_nodes - len(reported_limits), 0)
+    return sum(reported_limits) + num_unreported_nodes * DOWNLOADER_JOBS_PER_NODE
 
-def prioritize_jobs_by_accession(jobs: List, accession_list: List[str]) -> List:
-    """Moves jobs whose accessions are in accession_lst to the beginning of the input list."""
-    prioritized_jobs = []
-    for job in jobs:
-        try:
-            if type(job) == ProcessorJob and not does_processor_job_have_samples(job):
-                continue
 
-            # All samples in a job correspond to the same experiment, so just check one sample.
-            samples = job.get_samples()
-
-            # Iterate through all the samples' experiments until one is
-            # found with an accession in `accession_list`.
-            is_prioritized_job = False
-            for sample in samples:
-                if is_prioritized_job:
-                    # We found one! So stop looping
-                    break
-
-                for experiment in sample.experiments.all():
-                    if experiment.accession_code in accession_list:
-                        prioritized_jobs.append(job)
-                        is_prioritized_job = True
-                        break
-        except:
-            logger.exception("Exception caught while prioritizing jobs by accession!", job=job)
+##
+# Volume Placement
+##
+
+# Processor jobs have to run on the volume their files were downloaded
+# to, so where downloader jobs run decides where the processing
+# happens. Each downloader job the Foreman dispatches is placed on the
+# mounted volume with the least work waiting on it, skipping volumes
+# which are fuller than MAX_VOLUME_DISK_USAGE. If none have room, it's
+# left to Nomad like before.
+#
+# Work stranded on a volume which has been unmounted for longer than
+# UNMOUNTED_VOLUME_GRACE_TIME is moved to a mounted one by downloading
+# its files again, since original files only ever live on the volume
+# they were downloaded to. The grace time keeps us from downloading
+# everything again whenever a node gets cycled.
+VOLUME_METRICS_WINDOW = datetime.timedelta(hours=1)
+UNMOUNTED_VOLUME_GRACE_TIME = datetime.timedelta(hours=2)
+MIGRATION_BATCH_SIZE = 500
+# These pipelines aren't tied to the files on a volume. Janitor jobs
+# are, but there's nothing to clean up on a volume that isn't mounted.
+UNPLACED_PIPELINES = ["SMASHER", "QN_REFERENCE", "RUN_QN_JOB", "COMPENDIA", "JANITOR"]
+
+# When each volume with work waiting on it was first seen unmounted.
+UNMOUNTED_VOLUMES = {}
+
+
+def _count_jobs_by_volume(jobs, counts: Dict[str, int]) -> None:
+    """Adds the number of unfinished jobs in jobs on each volume to
+    counts. Started and unstarted jobs are counted separately so that
+    each query matches one of the hung and lost partial indexes."""
+    jobs = jobs.filter(
+        success=None,
+        retried=False,
+        no_retry=False,
+        end_time=None,
+        volume_index__isnull=False
+    )
+    for started in [True, False]:
+        rows = jobs.filter(
+            start_time__isnull=not started
+        ).values("volume_index").annotate(num_jobs=Count("id"))
+
+        for row in rows:
+            counts[row["volume_index"]] = counts.get(row["volume_index"], 0) + row["num_jobs"]
+
+
+def count_volume_backlogs() -> Dict[str, int]:
+    """Returns how many jobs are waiting on each volume.
+
+    That's the processor jobs which haven't finished plus the downloader
+    jobs placed on it which haven't, since those will create more
+    processor jobs on the same volume.
+    """
+    backlogs = {}
+    _count_jobs_by_volume(ProcessorJob.objects.exclude(pipeline_applied__in=UNPLACED_PIPELINES), backlogs)
+    _count_jobs_by_volume(DownloaderJob.objects.all(), backlogs)
+    return backlogs
+
+
+def get_volume_disk_usages(window=VOLUME_METRICS_WINDOW) -> Dict[str, float]:
+    """Returns the latest disk usage reported for each volume by a job
+    which ended within window. Janitor jobs run on every mounted volume
+    regularly, so even idle volumes report in."""
+    latest_reports = {}
+    for job_model in [ProcessorJob, DownloaderJob]:
+        reports = job_model.objects.filter(
+            end_time__gt=timezone.now() - window,
+            volume_index__isnull=False,
+            volume_disk_usage__isnull=False
+        ).order_by(
+            "volume_index",
+            "-end_time"
+        ).distinct(
+            "volume_index"
+        ).values_list("volume_index", "end_time", "volume_disk_usage")
+
+        for volume_index, end_time, disk_usage in reports:
+            if volume_index not in latest_reports or latest_reports[volume_index][0] < end_time:
+                latest_reports[volume_index] = (end_time, disk_usage)
+
+    return {volume_index: report[1] for volume_index, report in latest_reports.items()}
+
+
+class VolumePlacement:
+    """How much work is waiting on each volume and how full each one
+    is, taken along with the rest of ClusterState.
+
+    Jobs placed since then are added to their volume's backlog so that
+    one pass doesn't send everything to the same volume.
+    """
+
+    def __init__(self, active_volumes: Set[str]):
+        self.active_volumes = set(active_volumes)
+        self.backlogs = count_volume_backlogs()
+        self.disk_usages = get_volume_disk_usages()
+        self._lock = threading.Lock()
+
+    def has_room(self, volume_index: str) -> bool:
+        return (self.disk_usages.get(volume_index) or 0) <= MAX_VOLUME_DISK_USAGE
+
+    def choose_volume(self) -> str:
+        """Returns the mounted volume with room that has the least work
+        waiting on it and counts one more job against it. Returns None
+        if no mounted volume has room."""
+        with self._lock:
+            candidates = [volume_index for volume_index in self.active_volumes if self.has_room(volume_index)]
+            if not candidates:
+                return None
+
+            volume_index = min(candidates, key=lambda volume_index: (self.backlogs.get(volume_index, 0),
+                                                                      self.disk_usages.get(volume_index) or 0,
+                                                                      volume_index))
+            self.backlogs[volume_index] = self.backlogs.get(volume_index, 0) + 1
+            return volume_index
+
+    def get_unmounted_volumes(self) -> Set[str]:
+        """Returns the volumes with work waiting on them which aren't mounted."""
+        return {volume_index for volume_index, num_jobs in self.backlogs.items()
+                if num_jobs and volume_index not in self.active_volumes}
+
+
+def place_downloader_job(job: DownloaderJob, placement: VolumePlacement) -> None:
+    """Places job on a volume, unless it's already on a mounted one."""
+    if placement and job.volume_index not in placement.active_volumes:
+        job.volume_index = placement.choose_volume()
+
+
+def get_volumes_to_migrate(placement: VolumePlacement) -> Set[str]:
+    """Returns the volumes which have had work waiting on them while
+    unmounted for longer than UNMOUNTED_VOLUME_GRACE_TIME."""
+    # Without knowing which volumes are mounted they all look unmounted.
+    if not placement or not placement.active_volumes:
+        return set()
+
+    now = timezone.now()
+    unmounted_volumes = placement.get_unmounted_volumes()
+    for volume_index in set(UNMOUNTED_VOLUMES) - unmounted_volumes:
+        del UNMOUNTED_VOLUMES[volume_index]
+
+    for volume_index in unmounted_volumes:
+        UNMOUNTED_VOLUMES.setdefault(volume_index, now)
+
+    return {volume_index for volume_index in unmounted_volumes
+            if now - UNMOUNTED_VOLUMES[volume_index] >= UNMOUNTED_VOLUME_GRACE_TIME}
+
+
+def get_stranded_processor_jobs(volumes: Set[str]):
+    """Returns the processor jobs on volumes which still need to be run
+    or retried, most important first."""
+    return ProcessorJob.objects.filter(
+        Q(success=None) | Q(success=False),
+        volume_index__in=volumes,
+        retried=False,
+        no_retry=False
+    ).exclude(
+        pipeline_applied__in=UNPLACED_PIPELINES
+    ).order_by(
+        '-priority',
+        'id'
+    ).prefetch_related(
+        "original_files"
+    )
+
+
+def migrate_stranded_processor_jobs(cluster_state: ClusterState=None) -> int:
+    """Moves the work stranded on volumes which have been unmounted for
+    too long onto mounted ones.
+
+    Each stranded job is marked as retried and a new downloader job is
+    created for its files, based on the downloader job that last
+    downloaded them and placed on a mounted volume. It creates new processor jobs on
+    that volume once it has downloaded them. The new downloader jobs
+    are dispatched by the lost downloader pass as capacity allows.
+
+    Jobs whose files weren't downloaded by a downloader job, or whose
+    downloader job is still going, are left where they are.
+
+    Returns the number of processor jobs migrated.
+    """
+    if not cluster_state:
+        cluster_state = ClusterState()
+
+    placement = cluster_state.placement
+    volumes = get_volumes_to_migrate(placement)
+    if not volumes:
+        return 0
+
+    stranded_jobs = list(get_stranded_processor_jobs(volumes)[:MIGRATION_BATCH_SIZE])
+    file_ids = {original_file.id for job in stranded_jobs for original_file in job.original_files.all()}
+
+    # The latest downloader job for each file is the one that put it on
+    # the unmounted volume.
+    downloader_job_ids = {}
+    for original_file_id, downloader_job_id in DownloaderJobOriginalFileAssociation.objects.filter(
+            original_file_id__in=file_ids
+    ).values_list("original_file_id", "downloader_job_id"):
+        downloader_job_ids[original_file_id] = max(downloader_job_id,
+                                                   downloader_job_ids.get(original_file_id, 0))
+
+    last_downloader_jobs = DownloaderJob.objects.in_bulk(set(downloader_job_ids.values()))
+
+    # Jobs that need files from the same downloader job share one new
+    # downloader job.
+    jobs_by_downloader_job = {}
+    for job in stranded_jobs:
+        job_downloader_ids = {downloader_job_ids[original_file.id] for original_file in job.original_files.all()
+                              if original_file.id in downloader_job_ids}
+        if not job_downloader_ids:
+            continue
+
+        downloader_job = last_downloader_jobs[max(job_downloader_ids)]
+        if downloader_job.success is None and not downloader_job.retried:
+            continue
+
+        jobs_by_downloader_job.setdefault(downloader_job, []).append(job)
+
+    if not jobs_by_downloader_job:
+        return 0
+
+    new_jobs = []
+    for last_downloader_job, jobs in jobs_by_downloader_job.items():
+        new_job = DownloaderJob(downloader_task=last_downloader_job.downloader_task,
+                                accession_code=last_downloader_job.accession_code,
+                                ram_amount=last_downloader_job.ram_amount,
+                                priority=max(job.priority for job in jobs))
+        place_downloader_job(new_job, placement)
+        new_jobs.append((last_downloader_job, new_job))
+
+    migrated_job_ids = [job.id for jobs in jobs_by_downloader_job.values() for job in jobs]
+    with transaction.atomic():
+        DownloaderJob.objects.bulk_create([new_job for _, new_job in new_jobs])
+
+        # Only the stranded jobs' own files are downloaded again, not
+        # everything else their last downloader job fetched.
+        associations = []
+        redownloaded_file_ids = set()
+        for last_downloader_job, new_job in new_jobs:
+            for job in jobs_by_downloader_job[last_downloader_job]:
+                for original_file in job.original_files.all():
+                    if original_file.id not in downloader_job_ids \
+                       or original_file.id in redownloaded_file_ids:
+                        continue
+
+                    associations.append(DownloaderJobOriginalFileAssociation(downloader_job=new_job,
+                                                                             original_file=original_file))
+                    redownloaded_file_ids.add(original_file.id)
+
+        DownloaderJobOriginalFileAssociation.objects.bulk_create(associations)
+        OriginalFile.objects.filter(id__in=redownloaded_file_ids).update(is_downloaded=False)
+
+        migrated_jobs = ProcessorJob.objects.filter(id__in=migrated_job_ids)
+        migrated_jobs.filter(end_time=None).update(end_time=timezone.now())
+        migrated_jobs.update(
+            success=False,
+            retried=True,
+            failure_reason="Migrated off of unmounted volume by downloading its files again."
+        )
+
+    logger.info("Migrated processor jobs off of unmounted volumes.",
+                volumes=volumes,
+                num_processor_jobs=len(migrated_job_ids),
+                num_downloader_jobs=len(new_jobs))
+    return len(migrated_job_ids)
+
+
+##
+# Job Prioritization
+##
+
+# We want zebrafish data first, then hgu133plus2, then data related to
+# pediatric cancer, then to finish salmon experiments that are close
+# to completion. Each of these is worth more than all of the ones
+# after it put together, so they can be added up into one priority
+# that the retry queries order by.
+PRIORITY_ORGANISMS = ["DANIO_RERIO"]
+ORGANISM_PRIORITY = 4000
+HGU133PLUS2_PRIORITY = 2000
+PEDIATRIC_PRIORITY = 1000
+# A salmon job gets up to this much for the fraction of its
+# experiment's samples which have already been processed.
+MAX_COMPLETION_PRIORITY = 999
+
+# How frequently the priorities of jobs which may be retried are
+# recalculated, and how many are recalculated at a time.
+PRIORITY_UPDATE_TIME = datetime.timedelta(minutes=10)
+PRIORITY_BATCH_SIZE = 5000
+
+
+def get_experiment_completions(experiment_ids: Set[int]) -> Dict[int, float]:
+    """Returns the fraction of each experiment's samples which have been
+    processed.
+
+    This matters for salmon experiments because they have a final
+    processing step that must be performed on all the samples in the
+    experiment, so if 9/10 samples in an experiment are processed then
+    they can't actually be used until that last sample is processed.
+    """
+    # We cannot simply filter on is_processed because that field
+    # doesn't get set until every sample in an experiment is processed.
+    # Instead we are looking for one successful processor job.
+    experiments = Experiment.objects.filter(
+        id__in=experiment_ids
+    ).annotate(
+        num_samples=Count('samples', distinct=True),
+        num_processed_samples=Count(
+            'samples',
+            filter=Q(samples__original_files__processor_jobs__success=True),
+            distinct=True
+        )
+    ).values_list('id', 'num_samples', 'num_processed_samples')
+
+    return {experiment_id: num_processed_samples / num_samples
+            for experiment_id, num_samples, num_processed_samples in experiments
+            if num_samples}
+
+
+def compute_job_priorities(job_model, job_ids: List[int]) -> Dict[int, int]:
+    """Returns the priority of each of the jobs of job_model with an id in
+    job_ids.
+
+    Everything needed is pulled out of the database with two queries
+    rather than by walking each job's samples and experiments.
+    """
+    fields = [
+        'id',
+        'original_files__samples__organism__name',
+        'original_files__samples__experiments__id',
+        'original_files__samples__experiments__accession_code',
+        'original_files__filename',
+    ]
+    if job_model == ProcessorJob:
+        fields.append('pipeline_applied')
+
+    pediatric_accessions = set(PEDIATRIC_ACCESSION_LIST)
+    hgu133plus2_accessions = set(HGU133PLUS2_ACCESSION_LIST)
+
+    priorities = {}
+    salmon_experiments = {}
+    for row in job_model.objects.filter(id__in=job_ids).values_list(*fields):
+        job_id, organism_name, experiment_id, accession_code, filename = row[:5]
+        priorities.setdefault(job_id, set())
+        if organism_name in PRIORITY_ORGANISMS:
+            priorities[job_id].add(ORGANISM_PRIORITY)
+        if accession_code in hgu133plus2_accessions:
+            priorities[job_id].add(HGU133PLUS2_PRIORITY)
+        if accession_code in pediatric_accessions:
+            priorities[job_id].add(PEDIATRIC_PRIORITY)
+
+        if job_model == ProcessorJob:
+            is_salmon = row[5] == ProcessorPipeline.SALMON.value
+        else:
+            is_salmon = is_file_rnaseq(filename)
+
+        if is_salmon and experiment_id:
+            salmon_experiments.setdefault(job_id, set()).add(experiment_id)
+
+    completions = get_experiment_completions(
+        set().union(*salmon_experiments.values())
+    )
+
+    job_priorities = {}
+    for job_id, parts in priorities.items():
+        completion = max([completions.get(experiment_id, 0)
+                          for experiment_id in salmon_experiments.get(job_id, [])],
+                         default=0)
+        job_priorities[job_id] = sum(parts) + int(completion * MAX_COMPLETION_PRIORITY)
+
+    return job_priorities
+
+
+def get_prioritizable_jobs(job_model):
+    """Returns the jobs of job_model which may still be retried, which
+    are the ones whose priority matters."""
+    return job_model.objects.filter(
+        Q(success=False) | Q(success=None, end_time=None),
+        retried=False,
+        no_retry=False,
+        created_at__gt=JOB_CREATED_AT_CUTOFF
+    ).only(
+        'id', 'priority'
+    )
 
-    # Remove all the jobs we're moving to the front of the list
-    for job in prioritized_jobs:
-        jobs.remove(job)
 
-    return prioritized_jobs + jobs
+def update_job_priorities() -> int:
+    """Recalculates the priorities of the downloader and processor jobs
+    which may be retried and saves the ones that changed.
+
+    Jobs start out with no priority when they're created and retries
+    inherit the priority of the jobs they retry, so this keeps them up
+    to date as experiments get processed. Returns the number of jobs
+    whose priority changed.
+    """
+    num_updated = 0
+    for job_model in [DownloaderJob, ProcessorJob]:
+        paginator = Paginator(get_prioritizable_jobs(job_model),
+                              PRIORITY_BATCH_SIZE,
+                              ordering='id',
+                              allow_previous=False)
+        page = paginator.page()
+        while True:
+            current_priorities = {job.id: job.priority for job in page.object_list}
+            new_priorities = compute_job_priorities(job_model, list(current_priorities.keys()))
+
+            # There are only a handful of distinct priorities, so
+            # update all of the jobs which share one at once.
+            jobs_by_priority = {}
+            for job_id, priority in new_priorities.items():
+                if priority != current_priorities[job_id]:
+                    jobs_by_priority.setdefault(priority, []).append(job_id)
+
+            for priority, job_ids in jobs_by_priority.items():
+                num_updated += job_model.objects.filter(id__in=job_ids).update(priority=priority)
+
+            if page.has_next():
+                page = paginator.page(page.next_page_number())
+            else:
+                break
+
+    logger.info("Updated job priorities.", num_updated=num_updated)
+    return num_updated
 
 
 ##
 # Downloaders
 ##
 
-def requeue_downloader_job(last_job: DownloaderJob) -> bool:
-    """Queues a new downloader job.
+def create_downloader_job_retry(last_job: DownloaderJob) -> DownloaderJob:
+    """Returns an unsaved downloader job to retry last_job with.
 
     The new downloader job will have num_retries one greater than
     last_job.num_retries.
 
-    Returns True upon successful dispatching, False otherwise.
+    Returns None and marks last_job as not to be retried if it
+    shouldn't be.
     """
     num_retries = last_job.num_retries + 1
 
@@ -329,10 +1150,11 @@ def requeue_downloader_job(last_job: DownloaderJob) -> bool:
         elif ram_amount == 4096:
             ram_amount = 8192
 
+    # These are usually prefetched, so pick the first ones out of
+    # memory rather than querying for them.
+    original_files = list(last_job.original_files.all())
 
-    original_file = last_job.original_files.first()
-
-    if not original_file:
+    if not original_files:
         last_job.no_retry = True
         last_job.success = False
         last_job.failure_reason = "Foreman told to requeue a DownloaderJob without an OriginalFile - why?!"
@@ -340,8 +1162,9 @@ def requeue_downloader_job(last_job: DownloaderJob) -> bool:
         logger.info("Foreman told to requeue a DownloaderJob without an OriginalFile - why?!",
             last_job=str(last_job)
             )
-        return False
+        return None
 
+    original_file = min(original_files, key=lambda original_file: original_file.id)
     if not original_file.needs_processing():
         last_job.no_retry = True
         last_job.success = False
@@ -350,16 +1173,17 @@ def requeue_downloader_job(last_job: DownloaderJob) -> bool:
         logger.info("Foreman told to redownload job with prior successful processing.",
             last_job=str(last_job)
             )
-        return False
+        return None
 
-    first_sample = original_file.samples.first()
+    samples = list(original_file.samples.all())
+    first_sample = min(samples, key=lambda sample: sample.id) if samples else None
     if first_sample and first_sample.is_blacklisted:
         last_job.no_retry = True
         last_job.success = False
         last_job.failure_reason = "Sample run accession has been blacklisted by SRA."
         last_job.save()
         logger.info("Avoiding requeuing for DownloaderJob for blacklisted run accession: " + str(first_sample.accession_code))
-        return False
+        return None
 
     # This is a magic string that all the dbGaP studies appear to have
     if first_sample and ("in the dbGaP study" in first_sample.title):
@@ -368,118 +1192,98 @@ def requeue_downloader_job(last_job: DownloaderJob) -> bool:
         last_job.failure_reason = "Sample is dbGaP access controlled."
         last_job.save()
         logger.info("Avoiding requeuing for DownloaderJob for dbGaP run accession: " + str(first_sample.accession_code))
-        return False
+        return None
 
-    new_job = DownloaderJob(num_retries=num_retries,
-                            downloader_task=last_job.downloader_task,
-                            ram_amount=ram_amount,
-                            accession_code=last_job.accession_code,
-                            was_recreated=last_job.was_recreated)
-    new_job.save()
+    return DownloaderJob(num_retries=num_retries,
+                         downloader_task=last_job.downloader_task,
+                         ram_amount=ram_amount,
+                         accession_code=last_job.accession_code,
+                         was_recreated=last_job.was_recreated,
+                         priority=last_job.priority)
 
-    for original_file in last_job.original_files.all():
-        DownloaderJobOriginalFileAssociation.objects.get_or_create(downloader_job=new_job,
-                                                           original_file=original_file)
-
-    logger.debug("Requeuing Downloader Job which had ID %d with a new Downloader Job with ID %d.",
-                 last_job.id,
-                 new_job.id)
-    try:
-        if send_job(Downloaders[last_job.downloader_task], job=new_job, is_dispatch=True):
-            last_job.retried = True
-            last_job.success = False
-            last_job.retried_job = new_job
-            last_job.save()
-        else:
-            # Can't communicate with nomad just now, leave the job for a later loop.
-            new_job.delete()
-            return False
-    except:
-        logger.error("Failed to requeue Downloader Job which had ID %d with a new Downloader Job with ID %d.",
-                     last_job.id,
-                     new_job.id)
-        # Can't communicate with nomad just now, leave the job for a later loop.
-        new_job.delete()
-        return False
-
-    return True
 
+def requeue_downloader_job(last_job: DownloaderJob) -> bool:
+    """Queues a new downloader job.
 
-def count_downloader_jobs_in_queue(nomad_client: Nomad) -> int:
-    """Counts how many downloader jobs in the Nomad queue do not have status of 'dead'."""
-    try:
-        all_downloader_jobs = nomad_client.jobs.get_jobs(prefix="DOWNLOADER")
-    except:
-        # Nomad is down, return an impossibly high number to prevent
-        # additonal queuing from happening:
-        return sys.maxsize
+    The new downloader job will have num_retries one greater than
+    last_job.num_retries.
 
-    total = 0
-    for job in all_downloader_jobs:
-        if job['ParameterizedJob'] and job['JobSummary'].get('Children', None):
-            total = total + job['JobSummary']['Children']['Pending']
-            total = total + job['JobSummary']['Children']['Running']
+    Returns True upon successful dispatching, False otherwise.
+    """
+    new_job = create_downloader_job_retry(last_job)
+    if not new_job:
+        return False
 
-    return total
+    return bulk_requeue_jobs([(last_job, new_job, Downloaders[last_job.downloader_task])]) == 1
 
 
-def get_capacity_for_downloader_jobs(nomad_client) -> bool:
+def get_capacity_for_downloader_jobs(cluster_state: ClusterState) -> int:
     """Returns how many downloader jobs the queue has capacity for.
     """
 
-    current_max_downloader_jobs = get_max_downloader_jobs(nomad_client=nomad_client)
-    current_downloader_jobs_in_queue = count_downloader_jobs_in_queue(nomad_client)
-    return current_max_downloader_jobs - current_downloader_jobs_in_queue
+    current_max_downloader_jobs = get_max_downloader_jobs(nomad_client=cluster_state.nomad_client)
+    current_downloader_jobs_in_queue = cluster_state.count_downloader_jobs_in_queue()
+    return min(current_max_downloader_jobs - current_downloader_jobs_in_queue,
+               cluster_state.get_remaining_capacity("downloader"))
 
 
 def handle_downloader_jobs(jobs: List[DownloaderJob],
-                           queue_capacity=MAX_TOTAL_DOWNLOADER_JOBS) -> None:
+                           queue_capacity=MAX_TOTAL_DOWNLOADER_JOBS,
+                           placement: VolumePlacement=None) -> int:
     """For each job in jobs, either retry it or log it.
 
-    No more than queue_capacity jobs will be retried.
+    No more than queue_capacity jobs will be retried. Returns the
+    number of jobs that were. If placement is given, the retries are
+    placed on volumes with it.
     """
-    # We want zebrafish data first, then hgu133plus2, then data
-    # related to pediatric cancer, then to finish salmon experiments
-    # that are close to completion.
-    # Each function moves the jobs it prioritizes to the front of the
-    # list, so apply them in backwards order.
-    # jobs = prioritize_salmon_jobs(jobs)
-    # jobs = prioritize_jobs_by_accession(jobs, PEDIATRIC_ACCESSION_LIST)
-    # jobs = prioritize_jobs_by_accession(jobs, HGU133PLUS2_ACCESSION_LIST)
-    # jobs = prioritize_zebrafish_jobs(jobs)
+    prefetch_related_objects(jobs, "original_files__samples")
 
-    jobs_dispatched = 0
+    retries = []
+    jobs_in_flight = count_downloader_jobs_in_flight()
     for count, job in enumerate(jobs):
-        if jobs_dispatched >= queue_capacity:
+        if len(retries) >= queue_capacity:
             logger.info("We hit the maximum downloader jobs / capacity ceiling, so we're not handling any more downloader jobs now.")
-            return
+            break
 
         if job.num_retries < MAX_NUM_RETRIES:
-            requeue_success = requeue_downloader_job(job)
-            if requeue_success:
-                jobs_dispatched = jobs_dispatched + 1
+            source_limit = SOURCE_DOWNLOADER_LIMITS.get(job.downloader_task, HARD_MAX_DOWNLOADER_JOBS)
+            if jobs_in_flight.get(job.downloader_task, 0) >= source_limit:
+                continue
+
+            new_job = create_downloader_job_retry(job)
+            if new_job:
+                place_downloader_job(new_job, placement)
+                retries.append((job, new_job, Downloaders[job.downloader_task]))
+                jobs_in_flight[job.downloader_task] = jobs_in_flight.get(job.downloader_task, 0) + 1
         else:
             handle_repeated_failure(job)
 
-def retry_failed_downloader_jobs() -> None:
-    """Handle downloader jobs that were marked as a failure."""
-    failed_jobs = DownloaderJob.objects.filter(
+    return bulk_requeue_jobs(retries)
+
+def get_failed_downloader_jobs():
+    """Returns the downloader jobs that were marked as a failure."""
+    return DownloaderJob.objects.filter(
         success=False,
         retried=False,
         no_retry=False,
         created_at__gt=JOB_CREATED_AT_CUTOFF
     ).order_by(
+        '-priority',
         'id'
     ).prefetch_related(
         "original_files__samples"
     )
 
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = Nomad(nomad_host, port=int(nomad_port), timeout=30)
-    queue_capacity = get_capacity_for_downloader_jobs(nomad_client)
+def retry_failed_downloader_jobs(cluster_state: ClusterState=None) -> None:
+    """Handle downloader jobs that were marked as a failure."""
+    if not cluster_state:
+        cluster_state = ClusterState()
+
+    failed_jobs = get_failed_downloader_jobs()
 
-    paginator = Paginator(failed_jobs, PAGE_SIZE)
+    queue_capacity = get_capacity_for_downloader_jobs(cluster_state)
+
+    paginator = Paginator(failed_jobs, PAGE_SIZE, ordering=('-priority', 'id'), allow_previous=False)
     page = paginator.page()
     page_count = 0
 
@@ -494,18 +1298,20 @@ def retry_failed_downloader_jobs() -> None:
 
         )
 
-        handle_downloader_jobs(page.object_list, queue_capacity)
+        jobs_dispatched = handle_downloader_jobs(page.object_list, queue_capacity, cluster_state.placement)
+
+        cluster_state.record_dispatched(jobs_dispatched, "downloader")
 
-        if page.has_next():
+        if page.has_next() and not cluster_state.is_out_of_time():
             page = paginator.page(page.next_page_number())
             page_count = page_count + 1
-            queue_capacity = get_capacity_for_downloader_jobs(nomad_client)
+            queue_capacity = get_capacity_for_downloader_jobs(cluster_state)
         else:
             break
 
-def retry_hung_downloader_jobs() -> None:
-    """Retry downloader jobs that were started but never finished."""
-    potentially_hung_jobs = DownloaderJob.objects.filter(
+def get_hung_downloader_jobs():
+    """Returns the downloader jobs that were started but never finished."""
+    return DownloaderJob.objects.filter(
         success=None,
         retried=False,
         end_time=None,
@@ -513,39 +1319,42 @@ def retry_hung_downloader_jobs() -> None:
         no_retry=False,
         created_at__gt=JOB_CREATED_AT_CUTOFF
     ).order_by(
+        '-priority',
         'id'
     ).prefetch_related(
         "original_files__samples"
     )
 
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = Nomad(nomad_host, port=int(nomad_port), timeout=30)
-    queue_capacity = get_capacity_for_downloader_jobs(nomad_client)
+def retry_hung_downloader_jobs(cluster_state: ClusterState=None) -> None:
+    """Retry downloader jobs that were started but never finished."""
+    if not cluster_state:
+        cluster_state = ClusterState()
+
+    potentially_hung_jobs = get_hung_downloader_jobs()
+
+    queue_capacity = get_capacity_for_downloader_jobs(cluster_state)
 
     if queue_capacity <= 0:
         logger.info("Not handling failed (explicitly-marked-as-failure) downloader jobs "
                     "because there is no capacity for them.")
 
-    paginator = Paginator(potentially_hung_jobs, PAGE_SIZE)
+    paginator = Paginator(potentially_hung_jobs, PAGE_SIZE, ordering=('-priority', 'id'), allow_previous=False)
     page = paginator.page()
     page_count = 0
     while queue_capacity > 0:
+        job_statuses = cluster_state.get_job_statuses([job.nomad_job_id for job in page.object_list],
+                                                      recheck_not_running=True)
         hung_jobs = []
         for job in page.object_list:
-            try:
-                job_status = nomad_client.job.get_job(job.nomad_job_id)["Status"]
-                if job_status != "running":
-                    # Make sure it didn't finish since our original query.
-                    job.refresh_from_db()
-                    if job.end_time is None:
-                        hung_jobs.append(job)
-            except URLNotFoundNomadException:
-                hung_jobs.append(job)
-            except nomad.api.exceptions.BaseNomadException:
-                raise
-            except Exception:
-                logger.exception("Couldn't query Nomad about Downloader Job.", downloader_job=job.id)
+            if job.nomad_job_id not in job_statuses:
+                continue
+
+            # A status of None means Nomad doesn't know about the job.
+            if job_statuses[job.nomad_job_id] != "running":
+                # Make sure it didn't finish since our original query.
+                job.refresh_from_db()
+                if job.end_time is None:
+                    hung_jobs.append(job)
 
         if hung_jobs:
             logger.info(
@@ -553,26 +1362,19 @@ def retry_hung_downloader_jobs() -> None:
                 page_count,
                 jobs_count=len(hung_jobs)
             )
-            handle_downloader_jobs(hung_jobs, queue_capacity)
+            jobs_dispatched = handle_downloader_jobs(hung_jobs, queue_capacity, cluster_state.placement)
+            cluster_state.record_dispatched(jobs_dispatched, "downloader")
 
-        if page.has_next():
+        if page.has_next() and not cluster_state.is_out_of_time():
             page = paginator.page(page.next_page_number())
             page_count = page_count + 1
-            queue_capacity = get_capacity_for_downloader_jobs(nomad_client)
+            queue_capacity = get_capacity_for_downloader_jobs(cluster_state)
         else:
             break
 
-def retry_lost_downloader_jobs() -> None:
-    """Retry downloader jobs that went too long without being started.
-
-    Idea: at some point this function could integrate with the spot
-    instances to determine if jobs are hanging due to a lack of
-    instances. A naive time-based implementation like this could end
-    up retrying every single queued job if there were a long period
-    during which the price of spot instance is higher than our bid
-    price.
-    """
-    potentially_lost_jobs = DownloaderJob.objects.filter(
+def get_lost_downloader_jobs():
+    """Returns the downloader jobs that were never started."""
+    return DownloaderJob.objects.filter(
         success=None,
         retried=False,
         start_time=None,
@@ -580,34 +1382,57 @@ def retry_lost_downloader_jobs() -> None:
         no_retry=False,
         created_at__gt=JOB_CREATED_AT_CUTOFF
     ).order_by(
+        '-priority',
         'id'
     ).prefetch_related(
         "original_files__samples"
     )
 
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = Nomad(nomad_host, port=int(nomad_port), timeout=30)
-    queue_capacity = get_capacity_for_downloader_jobs(nomad_client)
+def retry_lost_downloader_jobs(cluster_state: ClusterState=None) -> None:
+    """Retry downloader jobs that went too long without being started.
+
+    Idea: at some point this function could integrate with the spot
+    instances to determine if jobs are hanging due to a lack of
+    instances. A naive time-based implementation like this could end
+    up retrying every single queued job if there were a long period
+    during which the price of spot instance is higher than our bid
+    price.
+    """
+    if not cluster_state:
+        cluster_state = ClusterState()
+
+    potentially_lost_jobs = get_lost_downloader_jobs()
+
+    queue_capacity = get_capacity_for_downloader_jobs(cluster_state)
 
     if queue_capacity <= 0:
         logger.info("Not handling failed (explicitly-marked-as-failure) downloader jobs "
                     "because there is no capacity for them.")
 
-    paginator = Paginator(potentially_lost_jobs, PAGE_SIZE)
+    paginator = Paginator(potentially_lost_jobs, PAGE_SIZE, ordering=('-priority', 'id'), allow_previous=False)
     page = paginator.page()
     page_count = 0
     while queue_capacity > 0:
+        job_statuses = cluster_state.get_job_statuses([job.nomad_job_id for job in page.object_list])
         lost_jobs = []
         jobs_queued_from_this_page = 0
         for job in page.object_list:
             try:
                 if job.nomad_job_id:
-                    job_status = nomad_client.job.get_job(job.nomad_job_id)["Status"]
+                    if job.nomad_job_id not in job_statuses:
+                        continue
+
+                    job_status = job_statuses[job.nomad_job_id]
+                    if job_status is None:
+                        logger.debug(("Determined that a downloader job needs to be requeued because "
+                                      "querying for its Nomad job failed: "),
+                                     job_id=job.id
+                        )
+                        lost_jobs.append(job)
                     # If the job is still pending, then it makes sense that it
                     # hasn't started and if it's running then it may not have
                     # been able to mark the job record as started yet.
-                    if job_status != "pending" and job_status != "running":
+                    elif job_status != "pending" and job_status != "running":
                         logger.debug(("Determined that a downloader job needs to be requeued because its"
                                       " Nomad Job's status is: %s."),
                                      job_status,
@@ -617,21 +1442,17 @@ def retry_lost_downloader_jobs() -> None:
                 elif jobs_queued_from_this_page < queue_capacity:
                     # The job never got put in the Nomad queue, no
                     # need to recreate it, we just gotta queue it up!
-                    send_job(Downloaders[job.downloader_task], job=job, is_dispatch=True)
+                    place_downloader_job(job, cluster_state.placement)
+                    message_queue.send_job(Downloaders[job.downloader_task], job=job, is_dispatch=True)
                     jobs_queued_from_this_page += 1
             except socket.timeout:
                 logger.info("Timeout connecting to Nomad - is Nomad down?", job_id=job.id)
-            except URLNotFoundNomadException:
-                logger.debug(("Determined that a downloader job needs to be requeued because "
-                                  "querying for its Nomad job failed: "),
-                                 job_id=job.id
-                )
-                lost_jobs.append(job)
             except nomad.api.exceptions.BaseNomadException:
                 raise
             except Exception:
-                logger.exception("Couldn't query Nomad about Downloader Job.", downloader_job=job.id)
+                logger.exception("Couldn't queue Downloader Job.", downloader_job=job.id)
 
+        cluster_state.record_dispatched(jobs_queued_from_this_page, "downloader")
         remaining_capacity = queue_capacity - jobs_queued_from_this_page
         if lost_jobs and remaining_capacity > 0:
             logger.info(
@@ -639,12 +1460,13 @@ def retry_lost_downloader_jobs() -> None:
                 page_count,
                 len_jobs=len(lost_jobs)
             )
-            handle_downloader_jobs(lost_jobs, remaining_capacity)
+            jobs_dispatched = handle_downloader_jobs(lost_jobs, remaining_capacity, cluster_state.placement)
+            cluster_state.record_dispatched(jobs_dispatched, "downloader")
 
-        if page.has_next():
+        if page.has_next() and not cluster_state.is_out_of_time():
             page = paginator.page(page.next_page_number())
             page_count = page_count + 1
-            queue_capacity = get_capacity_for_downloader_jobs(nomad_client)
+            queue_capacity = get_capacity_for_downloader_jobs(cluster_state)
         else:
             break
 
@@ -653,8 +1475,8 @@ def retry_lost_downloader_jobs() -> None:
 # Processors
 ##
 
-def requeue_processor_job(last_job: ProcessorJob) -> None:
-    """Queues a new processor job.
+def create_processor_job_retry(last_job: ProcessorJob) -> ProcessorJob:
+    """Returns an unsaved processor job to retry last_job with.
 
     The new processor job will have num_retries one greater than
     last_job.num_retries.
@@ -665,8 +1487,17 @@ def requeue_processor_job(last_job: ProcessorJob) -> None:
     # Try it again with an increased RAM amount, if possible.
     new_ram_amount = last_job.ram_amount
 
+    # Once enough similar jobs have recorded their peak memory, skip
+    # straight to the smallest amount the retry is likely to fit into
+    # rather than climbing the ladder below one failure at a time.
+    predicted_ram_amount = None
+    if last_job.pipeline_applied in ["SALMON", "SALMON_BATCH", "AFFY_TO_PCL"]:
+        predicted_ram_amount = determine_retry_ram_amount(last_job)
+
     # These initial values are set in common/job_lookup.py:determine_ram_amount
-    if last_job.pipeline_applied == "SALMON":
+    if predicted_ram_amount:
+        new_ram_amount = predicted_ram_amount
+    elif last_job.pipeline_applied in ["SALMON", "SALMON_BATCH"]:
         if new_ram_amount == 12288:
             new_ram_amount = 16384
         elif new_ram_amount == 16384:
@@ -681,116 +1512,96 @@ def requeue_processor_job(last_job: ProcessorJob) -> None:
         elif new_ram_amount == 4096:
             new_ram_amount = 8192
 
-    new_job = ProcessorJob(num_retries=num_retries,
-                           pipeline_applied=last_job.pipeline_applied,
-                           ram_amount=new_ram_amount,
-                           volume_index=last_job.volume_index)
-    new_job.save()
+    return ProcessorJob(num_retries=num_retries,
+                        pipeline_applied=last_job.pipeline_applied,
+                        ram_amount=new_ram_amount,
+                        volume_index=last_job.volume_index,
+                        priority=last_job.priority)
 
-    for original_file in last_job.original_files.all():
-        ProcessorJobOriginalFileAssociation.objects.get_or_create(processor_job=new_job,
-                                                          original_file=original_file)
 
-    for dataset in last_job.datasets.all():
-        ProcessorJobDatasetAssociation.objects.get_or_create(processor_job=new_job,
-                                                     dataset=dataset)
+def requeue_processor_job(last_job: ProcessorJob) -> bool:
+    """Queues a new processor job.
 
-    try:
-        logger.debug("Requeuing Processor Job which had ID %d with a new Processor Job with ID %d.",
-                     last_job.id,
-                     new_job.id)
-        if send_job(ProcessorPipeline[last_job.pipeline_applied], job=new_job, is_dispatch=True):
-            last_job.retried = True
-            last_job.success = False
-            last_job.retried_job = new_job
-            last_job.save()
-        else:
-            # Can't communicate with nomad just now, leave the job for a later loop.
-            new_job.delete()
-    except:
-        logger.error("Failed to requeue Processor Job which had ID %d with a new Processor Job with ID %d.",
-                     last_job.id,
-                     new_job.id)
-        # Can't communicate with nomad just now, leave the job for a later loop.
-        new_job.delete()
+    The new processor job will have num_retries one greater than
+    last_job.num_retries.
+
+    Returns True upon successful dispatching, False otherwise.
+    """
+    new_job = create_processor_job_retry(last_job)
+    return bulk_requeue_jobs([(last_job, new_job, ProcessorPipeline[last_job.pipeline_applied])]) == 1
 
 
-def get_capacity_for_processor_jobs(nomad_client) -> bool:
+def get_capacity_for_processor_jobs(cluster_state: ClusterState) -> int:
     """Returns how many processor jobs the queue has capacity for.
     """
     # Maximum number of total jobs running at a time.
     # We do this now rather than import time for testing purposes.
     MAX_TOTAL_JOBS = int(get_env_variable_gracefully("MAX_TOTAL_JOBS", DEFAULT_MAX_JOBS))
-    len_all_jobs = len(nomad_client.jobs.get_jobs())
-    return MAX_TOTAL_JOBS - len_all_jobs
+    return min(MAX_TOTAL_JOBS - cluster_state.count_jobs(),
+               cluster_state.get_remaining_capacity("processor"))
 
 
 def handle_processor_jobs(jobs: List[ProcessorJob],
                           queue_capacity: int = None,
-                          ignore_ceiling=False) -> None:
+                          ignore_ceiling=False) -> int:
     """For each job in jobs, either retry it or log it.
 
-    No more than queue_capacity jobs will be retried.
+    No more than queue_capacity jobs will be retried. Returns the
+    number of jobs that were.
     """
     # Maximum number of total jobs running at a time.
     # We do this now rather than import time for testing purposes.
     if queue_capacity is None:
         queue_capacity = int(get_env_variable_gracefully("MAX_TOTAL_JOBS", DEFAULT_MAX_JOBS))
 
-    # We want zebrafish data first, then hgu133plus2, then data
-    # related to pediatric cancer, then to finish salmon experiments
-    # that are close to completion.
-    # Each function moves the jobs it prioritizes to the front of the
-    # list, so apply them in backwards order.
-    # jobs = prioritize_salmon_jobs(jobs)
-    # jobs = prioritize_jobs_by_accession(jobs, PEDIATRIC_ACCESSION_LIST)
-    # jobs = prioritize_jobs_by_accession(jobs, HGU133PLUS2_ACCESSION_LIST)
-    # jobs = prioritize_zebrafish_jobs(jobs)
-
-    jobs_dispatched = 0
+    retries = []
     for count, job in enumerate(jobs):
 
-        if not ignore_ceiling and jobs_dispatched >= queue_capacity:
+        if not ignore_ceiling and len(retries) >= queue_capacity:
                 logger.info("We hit the maximum total jobs ceiling, so we're not handling any more processor jobs now.")
-                return
+                break
 
         if job.num_retries < MAX_NUM_RETRIES:
-            requeue_processor_job(job)
-            jobs_dispatched = jobs_dispatched + 1
+            retries.append((job, create_processor_job_retry(job), ProcessorPipeline[job.pipeline_applied]))
         else:
             handle_repeated_failure(job)
 
+    prefetch_related_objects([job for job, _, _ in retries], "original_files", "datasets")
+    return bulk_requeue_jobs(retries)
 
 
-def retry_failed_processor_jobs() -> None:
-    """Handle processor jobs that were marked as a failure.
+def get_failed_processor_jobs(active_volumes: Set[str]):
+    """Returns the processor jobs that were marked as a failure.
 
-    Ignores Janitor jobs since they are queued every half hour anyway."""
-    try:
-        active_volumes = get_active_volumes()
-    except:
-        # If we cannot reach Nomad now then we can wait until a later loop.
-        pass
-
-    failed_jobs = ProcessorJob.objects.filter(
+    SALMON jobs which have been folded into a SALMON_BATCH job are left
+    to the batch."""
+    return ProcessorJob.objects.filter(
         success=False,
         retried=False,
+        retried_job=None,
         volume_index__in=active_volumes,
         created_at__gt=JOB_CREATED_AT_CUTOFF
     ).exclude(
         pipeline_applied="JANITOR"
     ).order_by(
+        '-priority',
         'id'
     ).prefetch_related(
         "original_files__samples"
     )
 
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = Nomad(nomad_host, port=int(nomad_port), timeout=30)
-    queue_capacity = get_capacity_for_processor_jobs(nomad_client)
+def retry_failed_processor_jobs(cluster_state: ClusterState=None) -> None:
+    """Handle processor jobs that were marked as a failure.
 
-    paginator = Paginator(failed_jobs, 200)
+    Ignores Janitor jobs since they are queued every half hour anyway."""
+    if not cluster_state:
+        cluster_state = ClusterState()
+
+    failed_jobs = get_failed_processor_jobs(cluster_state.active_volumes)
+
+    queue_capacity = get_capacity_for_processor_jobs(cluster_state)
+
+    paginator = Paginator(failed_jobs, 200, ordering=('-priority', 'id'), allow_previous=False)
     page = paginator.page()
     page_count = 0
     while queue_capacity > 0:
@@ -798,26 +1609,19 @@ def retry_failed_processor_jobs() -> None:
             "Handling page %d of failed (explicitly-marked-as-failure) processor jobs!",
             page_count
         )
-        handle_processor_jobs(page.object_list, queue_capacity)
+        jobs_dispatched = handle_processor_jobs(page.object_list, queue_capacity)
+        cluster_state.record_dispatched(jobs_dispatched, "processor")
 
-        if page.has_next():
+        if page.has_next() and not cluster_state.is_out_of_time():
             page = paginator.page(page.next_page_number())
             page_count = page_count + 1
-            queue_capacity = get_capacity_for_processor_jobs(nomad_client)
+            queue_capacity = get_capacity_for_processor_jobs(cluster_state)
         else:
             break
 
-def retry_hung_processor_jobs() -> None:
-    """Retry processor jobs that were started but never finished.
-
-    Ignores Janitor jobs since they are queued every half hour anyway."""
-    try:
-        active_volumes = get_active_volumes()
-    except:
-        # If we cannot reach Nomad now then we can wait until a later loop.
-        pass
-
-    potentially_hung_jobs = ProcessorJob.objects.filter(
+def get_hung_processor_jobs(active_volumes: Set[str]):
+    """Returns the processor jobs that were started but never finished."""
+    return ProcessorJob.objects.filter(
         success=None,
         retried=False,
         end_time=None,
@@ -828,45 +1632,89 @@ def retry_hung_processor_jobs() -> None:
     ).exclude(
         pipeline_applied="JANITOR"
     ).order_by(
+        '-priority',
         'id'
     ).prefetch_related(
         "original_files__samples"
     )
 
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = Nomad(nomad_host, port=int(nomad_port), timeout=30)
-    queue_capacity = get_capacity_for_processor_jobs(nomad_client)
+def _was_oom_killed(allocation: Dict) -> bool:
+    """Returns whether any task in a Nomad allocation was killed for
+    running out of memory."""
+    for task_state in (allocation.get("TaskStates") or {}).values():
+        for event in task_state.get("Events") or []:
+            if (event.get("Details") or {}).get("oom_killed") == "true":
+                return True
+
+    return False
+
+
+def record_oom_kills(jobs: List[ProcessorJob], nomad_client: Nomad) -> int:
+    """Looks up the allocations of each of jobs' Nomad jobs and records
+    the jobs which were killed for running out of memory in their RAM
+    history, see job_lookup.record_oom_kill. Those jobs never reach
+    end_job so this is the only way they get counted.
 
-    paginator = Paginator(potentially_hung_jobs, 200)
+    Returns how many of jobs were OOM killed.
+    """
+    jobs = [job for job in jobs if job.nomad_job_id and not job.peak_memory]
+    if not jobs:
+        return 0
+
+    num_killed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_STATUS_LOOKUP_THREADS) as executor:
+        futures = {executor.submit(nomad_client.job.get_allocations, job.nomad_job_id): job
+                   for job in jobs}
+
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                allocations = future.result()
+            except Exception:
+                logger.exception("Couldn't get the allocations of a processor job's Nomad job.",
+                                 processor_job=job.id,
+                                 nomad_job_id=job.nomad_job_id)
+                continue
+
+            if any(_was_oom_killed(allocation) for allocation in allocations or []):
+                logger.info("Processor job ran out of memory.",
+                            processor_job=job.id,
+                            ram_amount=job.ram_amount)
+                record_oom_kill(job)
+                num_killed += 1
+
+    return num_killed
+
+
+def retry_hung_processor_jobs(cluster_state: ClusterState=None) -> None:
+    """Retry processor jobs that were started but never finished.
+
+    Ignores Janitor jobs since they are queued every half hour anyway."""
+    if not cluster_state:
+        cluster_state = ClusterState()
+
+    potentially_hung_jobs = get_hung_processor_jobs(cluster_state.active_volumes)
+
+    queue_capacity = get_capacity_for_processor_jobs(cluster_state)
+
+    paginator = Paginator(potentially_hung_jobs, 200, ordering=('-priority', 'id'), allow_previous=False)
     page = paginator.page()
     page_count = 0
     while queue_capacity > 0:
+        job_statuses = cluster_state.get_job_statuses([job.nomad_job_id for job in page.object_list],
+                                                      recheck_not_running=True)
         hung_jobs = []
         for job in page.object_list:
-            try:
-                job_status = nomad_client.job.get_job(job.nomad_job_id)["Status"]
-                if job_status != "running":
-                    # Make sure it didn't finish since our original query.
-                    job.refresh_from_db()
-                    if job.end_time is None:
-                        hung_jobs.append(job)
-            except URLNotFoundNomadException:
-                hung_jobs.append(job)
-            except TypeError:
-                # Almost certainly a python-nomad issue:
-                # File "/usr/local/lib/python3.5/dist-packages/nomad/api/job.py", line 63, in get_job
-                #   return self.request(id, method="get").json()
-                # File "/usr/local/lib/python3.5/dist-packages/nomad/api/base.py", line 74, in request
-                #   endpoint = self._endpoint_builder(self.ENDPOINT, *args)
-                # File "/usr/local/lib/python3.5/dist-packages/nomad/api/base.py", line 28, in _endpoint_builder
-                #   u = "/".join(args)
-                # TypeError: sequence item 1: expected str instance, NoneType found
-                logger.info("Couldn't query Nomad about Processor Job.", processor_job=job.id)
-            except nomad.api.exceptions.BaseNomadException:
-                raise
-            except Exception:
-                logger.exception("Couldn't query Nomad about Processor Job.", processor_job=job.id)
+            # Jobs without a nomad_job_id can't be looked up.
+            if job.nomad_job_id not in job_statuses:
+                continue
+
+            # A status of None means Nomad doesn't know about the job.
+            if job_statuses[job.nomad_job_id] != "running":
+                # Make sure it didn't finish since our original query.
+                job.refresh_from_db()
+                if job.end_time is None:
+                    hung_jobs.append(job)
 
         if hung_jobs:
             logger.info(
@@ -874,28 +1722,26 @@ def retry_hung_processor_jobs() -> None:
                 page_count,
                 len_jobs=len(hung_jobs)
             )
-            handle_processor_jobs(hung_jobs, queue_capacity)
+            record_oom_kills(hung_jobs, cluster_state.nomad_client)
+            jobs_dispatched = handle_processor_jobs(hung_jobs, queue_capacity)
+            cluster_state.record_dispatched(jobs_dispatched, "processor")
 
-        if page.has_next():
+        if page.has_next() and not cluster_state.is_out_of_time():
             page = paginator.page(page.next_page_number())
             page_count = page_count + 1
-            queue_capacity = get_capacity_for_processor_jobs(nomad_client)
+            queue_capacity = get_capacity_for_processor_jobs(cluster_state)
         else:
             break
 
-def retry_lost_processor_jobs() -> None:
-    """Retry processor jobs which never even got started for too long.
-
-    Ignores Janitor jobs since they are queued every half hour anyway."""
-    try:
-        active_volumes = get_active_volumes()
-    except:
-        # If we cannot reach Nomad now then we can wait until a later loop.
-        pass
+def get_lost_processor_jobs(active_volumes: Set[str]):
+    """Returns the processor jobs that were never started.
 
-    potentially_lost_jobs = ProcessorJob.objects.filter(
+    SALMON jobs which have been folded into a SALMON_BATCH job are left
+    to the batch."""
+    return ProcessorJob.objects.filter(
         success=None,
         retried=False,
+        retried_job=None,
         start_time=None,
         end_time=None,
         no_retry=False,
@@ -904,52 +1750,58 @@ def retry_lost_processor_jobs() -> None:
     ).exclude(
         pipeline_applied="JANITOR"
     ).order_by(
+        '-priority',
         'id'
     ).prefetch_related(
         "original_files__samples"
     )
 
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = Nomad(nomad_host, port=int(nomad_port), timeout=5)
-    queue_capacity = get_capacity_for_processor_jobs(nomad_client)
+def retry_lost_processor_jobs(cluster_state: ClusterState=None) -> None:
+    """Retry processor jobs which never even got started for too long.
+
+    Ignores Janitor jobs since they are queued every half hour anyway."""
+    if not cluster_state:
+        cluster_state = ClusterState()
+
+    potentially_lost_jobs = get_lost_processor_jobs(cluster_state.active_volumes)
 
-    paginator = Paginator(potentially_lost_jobs, 200)
+    queue_capacity = get_capacity_for_processor_jobs(cluster_state)
+
+    paginator = Paginator(potentially_lost_jobs, 200, ordering=('-priority', 'id'), allow_previous=False)
     page = paginator.page()
     page_count = 0
     while queue_capacity > 0:
+        job_statuses = cluster_state.get_job_statuses([job.nomad_job_id for job in page.object_list])
         lost_jobs = []
         for job in page.object_list:
-            try:
-                if job.nomad_job_id:
-                    job_status = nomad_client.job.get_job(job.nomad_job_id)["Status"]
-                    # If the job is still pending, then it makes sense that it
-                    # hasn't started and if it's running then it may not have
-                    # been able to mark the job record as started yet.
-                    if job_status != "pending" and job_status != "running":
-                        logger.debug(("Determined that a processor job needs to be requeued because its"
-                                      " Nomad Job's status is: %s."),
-                                     job_status,
-                                     job_id=job.id
-                        )
-                        lost_jobs.append(job)
-                else:
-                    # If there is no nomad_job_id field set, we could be
-                    # in the small window where the job was created but
-                    # hasn't yet gotten a chance to be queued.
-                    # If this job really should be restarted we'll get it in the next loop.
-                    if timezone.now() - job.created_at > MIN_LOOP_TIME:
-                        lost_jobs.append(job)
-            except URLNotFoundNomadException:
-                logger.debug(("Determined that a processor job needs to be requeued because "
+            if job.nomad_job_id:
+                if job.nomad_job_id not in job_statuses:
+                    continue
+
+                job_status = job_statuses[job.nomad_job_id]
+                if job_status is None:
+                    logger.debug(("Determined that a processor job needs to be requeued because "
                                   "querying for its Nomad job failed: "),
                                  job_id=job.id
-                )
-                lost_jobs.append(job)
-            except nomad.api.exceptions.BaseNomadException:
-                raise
-            except Exception:
-                logger.exception("Couldn't query Nomad about Processor Job.", processor_job=job.id)
+                    )
+                    lost_jobs.append(job)
+                # If the job is still pending, then it makes sense that it
+                # hasn't started and if it's running then it may not have
+                # been able to mark the job record as started yet.
+                elif job_status != "pending" and job_status != "running":
+                    logger.debug(("Determined that a processor job needs to be requeued because its"
+                                  " Nomad Job's status is: %s."),
+                                 job_status,
+                                 job_id=job.id
+                    )
+                    lost_jobs.append(job)
+            else:
+                # If there is no nomad_job_id field set, we could be
+                # in the small window where the job was created but
+                # hasn't yet gotten a chance to be queued.
+                # If this job really should be restarted we'll get it in the next loop.
+                if timezone.now() - job.created_at > MIN_LOOP_TIME:
+                    lost_jobs.append(job)
 
         if lost_jobs:
             logger.info(
@@ -957,12 +1809,13 @@ def retry_lost_processor_jobs() -> None:
                 page_count,
                 len_jobs=len(lost_jobs)
             )
-            handle_processor_jobs(lost_jobs, queue_capacity)
+            jobs_dispatched = handle_processor_jobs(lost_jobs, queue_capacity)
+            cluster_state.record_dispatched(jobs_dispatched, "processor")
 
-        if page.has_next():
+        if page.has_next() and not cluster_state.is_out_of_time():
             page = paginator.page(page.next_page_number())
             page_count = page_count + 1
-            queue_capacity = get_capacity_for_processor_jobs(nomad_client)
+            queue_capacity = get_capacity_for_processor_jobs(cluster_state)
         else:
             break
 
@@ -1006,7 +1859,7 @@ def requeue_survey_job(last_job: SurveyJob) -> None:
                  new_job.id)
 
     try:
-        if send_job(SurveyJobTypes.SURVEYOR, job=new_job, is_dispatch=True):
+        if message_queue.send_job(SurveyJobTypes.SURVEYOR, job=new_job, is_dispatch=True):
             last_job.retried = True
             last_job.success = False
             last_job.retried_job = new_job
@@ -1023,20 +1876,21 @@ def requeue_survey_job(last_job: SurveyJob) -> None:
 
     return True
 
-def get_capacity_for_survey_jobs(nomad_client) -> bool:
+def get_capacity_for_survey_jobs(cluster_state: ClusterState) -> int:
     """Returns how many survey jobs the queue has capacity for.
     """
     # Maximum number of total jobs running at a time.
     # We do this now rather than import time for testing purposes.
     MAX_TOTAL_JOBS = int(get_env_variable_gracefully("MAX_TOTAL_JOBS", DEFAULT_MAX_JOBS))
-    len_all_jobs = len(nomad_client.jobs.get_jobs())
-    return MAX_TOTAL_JOBS - len_all_jobs
+    return min(MAX_TOTAL_JOBS - cluster_state.count_jobs(),
+               cluster_state.get_remaining_capacity("survey"))
 
 
-def handle_survey_jobs(jobs: List[SurveyJob], queue_capacity: int = None) -> None:
+def handle_survey_jobs(jobs: List[SurveyJob], queue_capacity: int = None) -> int:
     """For each job in jobs, either retry it or log it.
 
-    No more than queue_capacity jobs will be retried.
+    No more than queue_capacity jobs will be retried. Returns the
+    number of jobs that were.
     """
     # Maximum number of total jobs running at a time.
     # We do this now rather than import time for testing purposes.
@@ -1046,7 +1900,7 @@ def handle_survey_jobs(jobs: List[SurveyJob], queue_capacity: int = None) -> Non
     for count, job in enumerate(jobs):
         if jobs_dispatched >= queue_capacity:
             logger.info("We hit the maximum total jobs ceiling, so we're not handling any more survey jobs now.")
-            return
+            return jobs_dispatched
 
         if job.num_retries < MAX_NUM_RETRIES:
             requeue_survey_job(job)
@@ -1054,21 +1908,27 @@ def handle_survey_jobs(jobs: List[SurveyJob], queue_capacity: int = None) -> Non
         else:
             handle_repeated_failure(job)
 
+    return jobs_dispatched
 
-def retry_failed_survey_jobs() -> None:
-    """Handle survey jobs that were marked as a failure."""
-    failed_jobs = SurveyJob.objects.filter(
+
+def get_failed_survey_jobs():
+    """Returns the survey jobs that were marked as a failure."""
+    return SurveyJob.objects.filter(
         success=False,
         retried=False,
         created_at__gt=JOB_CREATED_AT_CUTOFF
     ).order_by('pk')
 
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = Nomad(nomad_host, port=int(nomad_port), timeout=30)
-    queue_capacity = get_capacity_for_survey_jobs(nomad_client)
+def retry_failed_survey_jobs(cluster_state: ClusterState=None) -> None:
+    """Handle survey jobs that were marked as a failure."""
+    if not cluster_state:
+        cluster_state = ClusterState()
+
+    failed_jobs = get_failed_survey_jobs()
+
+    queue_capacity = get_capacity_for_survey_jobs(cluster_state)
 
-    paginator = Paginator(failed_jobs, 200)
+    paginator = Paginator(failed_jobs, 200, ordering='id', allow_previous=False)
     page = paginator.page()
     page_count = 0
     while queue_capacity > 0:
@@ -1076,19 +1936,20 @@ def retry_failed_survey_jobs() -> None:
             "Handling page %d of failed (explicitly-marked-as-failure) survey jobs!",
             page_count
         )
-        handle_survey_jobs(page.object_list, queue_capacity)
+        jobs_dispatched = handle_survey_jobs(page.object_list, queue_capacity)
+        cluster_state.record_dispatched(jobs_dispatched, "survey")
 
-        if page.has_next():
+        if page.has_next() and not cluster_state.is_out_of_time():
             page = paginator.page(page.next_page_number())
             page_count = page_count + 1
-            queue_capacity = get_capacity_for_survey_jobs(nomad_client)
+            queue_capacity = get_capacity_for_survey_jobs(cluster_state)
         else:
             break
 
 
-def retry_hung_survey_jobs() -> None:
-    """Retry survey jobs that were started but never finished."""
-    potentially_hung_jobs = SurveyJob.objects.filter(
+def get_hung_survey_jobs():
+    """Returns the survey jobs that were started but never finished."""
+    return SurveyJob.objects.filter(
         success=None,
         retried=False,
         end_time=None,
@@ -1097,36 +1958,38 @@ def retry_hung_survey_jobs() -> None:
         created_at__gt=JOB_CREATED_AT_CUTOFF
     ).order_by('pk')
 
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = Nomad(nomad_host, port=int(nomad_port), timeout=30)
-    queue_capacity = get_capacity_for_survey_jobs(nomad_client)
+def retry_hung_survey_jobs(cluster_state: ClusterState=None) -> None:
+    """Retry survey jobs that were started but never finished."""
+    if not cluster_state:
+        cluster_state = ClusterState()
+
+    potentially_hung_jobs = get_hung_survey_jobs()
 
-    paginator = Paginator(potentially_hung_jobs, 200)
+    queue_capacity = get_capacity_for_survey_jobs(cluster_state)
+
+    paginator = Paginator(potentially_hung_jobs, 200, ordering='id', allow_previous=False)
     page = paginator.page()
     page_count = 0
     while queue_capacity > 0:
+        job_statuses = cluster_state.get_job_statuses([job.nomad_job_id for job in page.object_list],
+                                                      recheck_not_running=True)
         hung_jobs = []
         for job in page.object_list:
-            try:
-                # Surveyor jobs didn't always have nomad_job_ids. If they
-                # don't have one then by this point they've definitely died.
-                if job.nomad_job_id:
-                    job_status = nomad_client.job.get_job(job.nomad_job_id)["Status"]
-                else:
-                    job_status = "absent"
-
-                if job_status != "running":
-                    # Make sure it didn't finish since our original query.
-                    job.refresh_from_db()
-                    if job.end_time is None:
-                        hung_jobs.append(job)
-            except URLNotFoundNomadException:
-                hung_jobs.append(job)
-            except nomad.api.exceptions.BaseNomadException:
-                raise
-            except Exception:
-                logger.exception("Couldn't query Nomad about SurveyJob Job.", survey_job=job.id)
+            # Surveyor jobs didn't always have nomad_job_ids. If they
+            # don't have one then by this point they've definitely died.
+            if job.nomad_job_id:
+                if job.nomad_job_id not in job_statuses:
+                    continue
+                job_status = job_statuses[job.nomad_job_id]
+            else:
+                job_status = "absent"
+
+            # A status of None means Nomad doesn't know about the job.
+            if job_status != "running":
+                # Make sure it didn't finish since our original query.
+                job.refresh_from_db()
+                if job.end_time is None:
+                    hung_jobs.append(job)
 
         if hung_jobs:
             logger.info(
@@ -1134,18 +1997,19 @@ def retry_hung_survey_jobs() -> None:
                 page_count,
                 len_jobs=len(hung_jobs)
             )
-            handle_survey_jobs(hung_jobs, queue_capacity)
+            jobs_dispatched = handle_survey_jobs(hung_jobs, queue_capacity)
+            cluster_state.record_dispatched(jobs_dispatched, "survey")
 
-        if page.has_next():
+        if page.has_next() and not cluster_state.is_out_of_time():
             page = paginator.page(page.next_page_number())
             page_count = page_count + 1
-            queue_capacity = get_capacity_for_survey_jobs(nomad_client)
+            queue_capacity = get_capacity_for_survey_jobs(cluster_state)
         else:
             break
 
-def retry_lost_survey_jobs() -> None:
-    """Retry survey jobs which never even got started for too long."""
-    potentially_lost_jobs = SurveyJob.objects.filter(
+def get_lost_survey_jobs():
+    """Returns the survey jobs that were never started."""
+    return SurveyJob.objects.filter(
         success=None,
         retried=False,
         start_time=None,
@@ -1154,45 +2018,47 @@ def retry_lost_survey_jobs() -> None:
         created_at__gt=JOB_CREATED_AT_CUTOFF
     ).order_by('pk')
 
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = Nomad(nomad_host, port=int(nomad_port), timeout=30)
-    queue_capacity = get_capacity_for_survey_jobs(nomad_client)
+def retry_lost_survey_jobs(cluster_state: ClusterState=None) -> None:
+    """Retry survey jobs which never even got started for too long."""
+    if not cluster_state:
+        cluster_state = ClusterState()
+
+    potentially_lost_jobs = get_lost_survey_jobs()
+
+    queue_capacity = get_capacity_for_survey_jobs(cluster_state)
 
-    paginator = Paginator(potentially_lost_jobs, 200)
+    paginator = Paginator(potentially_lost_jobs, 200, ordering='id', allow_previous=False)
     page = paginator.page()
     page_count = 0
     while queue_capacity > 0:
+        job_statuses = cluster_state.get_job_statuses([job.nomad_job_id for job in page.object_list])
         lost_jobs = []
         for job in page.object_list:
-            try:
-                # Surveyor jobs didn't always have nomad_job_ids. If they
-                # don't have one then by this point they've definitely died.
-                if job.nomad_job_id:
-                    job_status = nomad_client.job.get_job(job.nomad_job_id)["Status"]
-                else:
-                    job_status = "absent"
+            # Surveyor jobs didn't always have nomad_job_ids. If they
+            # don't have one then by this point they've definitely died.
+            if job.nomad_job_id:
+                if job.nomad_job_id not in job_statuses:
+                    continue
+                job_status = job_statuses[job.nomad_job_id]
+            else:
+                job_status = "absent"
 
-                # If the job is still pending, then it makes sense that it
-                # hasn't started and if it's running then it may not have
-                # been able to mark the job record as started yet.
-                if job_status != "pending" and job_status != "running":
-                    logger.debug(("Determined that a survey job needs to be requeued because its"
-                                 " Nomad Job's status is: %s."),
-                                job_status,
-                                job_id=job.id
-                    )
-                    lost_jobs.append(job)
-            except URLNotFoundNomadException:
+            if job_status is None:
                 logger.debug(("Determined that a survey job needs to be requeued because "
                               "querying for its Nomad job failed."),
                              job_id=job.id
                 )
                 lost_jobs.append(job)
-            except nomad.api.exceptions.BaseNomadException:
-                raise
-            except Exception:
-                logger.exception("Couldn't query Nomad about Processor Job.", survey_job=job.id)
+            # If the job is still pending, then it makes sense that it
+            # hasn't started and if it's running then it may not have
+            # been able to mark the job record as started yet.
+            elif job_status != "pending" and job_status != "running":
+                logger.debug(("Determined that a survey job needs to be requeued because its"
+                             " Nomad Job's status is: %s."),
+                            job_status,
+                            job_id=job.id
+                )
+                lost_jobs.append(job)
 
         if lost_jobs:
             logger.info(
@@ -1200,12 +2066,13 @@ def retry_lost_survey_jobs() -> None:
                 page_count,
                 len_jobs=len(lost_jobs)
             )
-            handle_survey_jobs(lost_jobs, queue_capacity)
+            jobs_dispatched = handle_survey_jobs(lost_jobs, queue_capacity)
+            cluster_state.record_dispatched(jobs_dispatched, "survey")
 
-        if page.has_next():
+        if page.has_next() and not cluster_state.is_out_of_time():
             page = paginator.page(page.next_page_number())
             page_count = page_count + 1
-            queue_capacity = get_capacity_for_survey_jobs(nomad_client)
+            queue_capacity = get_capacity_for_survey_jobs(cluster_state)
         else:
             break
 
@@ -1213,15 +2080,12 @@ def retry_lost_survey_jobs() -> None:
 # Janitor
 ##
 
-def send_janitor_jobs():
+def send_janitor_jobs(cluster_state: ClusterState=None):
     """Dispatch a Janitor job for each instance in the cluster"""
-    try:
-        active_volumes = get_active_volumes()
-    except:
-        # If we cannot reach Nomad now then we can wait until a later loop.
-        pass
+    if not cluster_state:
+        cluster_state = ClusterState()
 
-    for volume_index in active_volumes:
+    for volume_index in cluster_state.active_volumes:
         new_job = ProcessorJob(num_retries=0,
                                pipeline_applied="JANITOR",
                                ram_amount=2048,
@@ -1232,7 +2096,8 @@ def send_janitor_jobs():
             index=volume_index
         )
         try:
-            send_job(ProcessorPipeline["JANITOR"], job=new_job, is_dispatch=True)
+            message_queue.send_job(ProcessorPipeline["JANITOR"], job=new_job, is_dispatch=True)
+            cluster_state.record_dispatched(1, "processor")
         except Exception as e:
             # If we can't dispatch this job, something else has gone wrong.
             continue
@@ -1241,15 +2106,9 @@ def send_janitor_jobs():
 # Smasher
 ##
 
-def retry_lost_smasher_jobs() -> None:
-    """Retry smasher jobs which never even got started for too long."""
-    try:
-        active_volumes = get_active_volumes()
-    except:
-        # If we cannot reach Nomad now then we can wait until a later loop.
-        pass
-
-    potentially_lost_jobs = ProcessorJob.objects.filter(
+def get_lost_smasher_jobs():
+    """Returns the smasher jobs that were never started."""
+    return ProcessorJob.objects.filter(
         success=None,
         retried=False,
         start_time=None,
@@ -1259,55 +2118,57 @@ def retry_lost_smasher_jobs() -> None:
         created_at__gt=(timezone.now() - datetime.timedelta(hours=24))
     )
 
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = Nomad(nomad_host, port=int(nomad_port), timeout=5)
+def retry_lost_smasher_jobs(cluster_state: ClusterState=None) -> None:
+    """Retry smasher jobs which never even got started for too long."""
+    if not cluster_state:
+        cluster_state = ClusterState()
 
+    potentially_lost_jobs = list(get_lost_smasher_jobs())
+    job_statuses = cluster_state.get_job_statuses([job.nomad_job_id for job in potentially_lost_jobs])
     lost_jobs = []
     for job in potentially_lost_jobs:
-        try:
-            if job.nomad_job_id:
-                job_status = nomad_client.job.get_job(job.nomad_job_id)["Status"]
-                # If the job is still pending, then it makes sense that it
-                # hasn't started and if it's running then it may not have
-                # been able to mark the job record as started yet.
-                if job_status != "pending" and job_status != "running":
-                    logger.debug(("Determined that a smasher job needs to be requeued because its"
-                                  " Nomad Job's status is: %s."),
-                                 job_status,
-                                 job_id=job.id
-                    )
-                    lost_jobs.append(job)
-            else:
-                # If there is no nomad_job_id field set, we could be
-                # in the small window where the job was created but
-                # hasn't yet gotten a chance to be queued.
-                # If this job really should be restarted we'll get it in the next loop.
-                if timezone.now() - job.created_at > MIN_LOOP_TIME:
-                    lost_jobs.append(job)
-        except URLNotFoundNomadException:
-            logger.debug(("Determined that a smasher job needs to be requeued because "
+        if job.nomad_job_id:
+            if job.nomad_job_id not in job_statuses:
+                continue
+
+            job_status = job_statuses[job.nomad_job_id]
+            if job_status is None:
+                logger.debug(("Determined that a smasher job needs to be requeued because "
                               "querying for its Nomad job failed: "),
                              job_id=job.id
-            )
-            lost_jobs.append(job)
-        except nomad.api.exceptions.BaseNomadException:
-            raise
-        except Exception:
-            logger.exception("Couldn't query Nomad about smasher Job.", processor_job=job.id)
+                )
+                lost_jobs.append(job)
+            # If the job is still pending, then it makes sense that it
+            # hasn't started and if it's running then it may not have
+            # been able to mark the job record as started yet.
+            elif job_status != "pending" and job_status != "running":
+                logger.debug(("Determined that a smasher job needs to be requeued because its"
+                              " Nomad Job's status is: %s."),
+                             job_status,
+                             job_id=job.id
+                )
+                lost_jobs.append(job)
+        else:
+            # If there is no nomad_job_id field set, we could be
+            # in the small window where the job was created but
+            # hasn't yet gotten a chance to be queued.
+            # If this job really should be restarted we'll get it in the next loop.
+            if timezone.now() - job.created_at > MIN_LOOP_TIME:
+                lost_jobs.append(job)
 
     if lost_jobs:
         logger.info(
             "Handling lost (never-started) smasher jobs!",
             len_jobs=len(lost_jobs)
         )
-        handle_processor_jobs(lost_jobs, sys.maxsize, ignore_ceiling=True)
+        jobs_dispatched = handle_processor_jobs(lost_jobs, sys.maxsize, ignore_ceiling=True)
+        cluster_state.record_dispatched(jobs_dispatched, "processor")
 
 ##
 # Handling of node cycling
 ##
 
-def cleanup_the_queue():
+def cleanup_the_queue(cluster_state: ClusterState=None):
     """This cleans up any jobs which cannot currently be queued.
 
     We often have more volumes than instances because we have enough
@@ -1318,21 +2179,23 @@ def cleanup_the_queue():
     with those volumes cannot be placed and just clog up the queue.
 
     Therefore we clear out jobs of that type every once in a while so
-    our queue is dedicated to jobs that can actually be placed.
+    our queue is dedicated to jobs that can actually be placed. This
+    includes downloader jobs which were placed on a volume that has
+    since been unmounted, which get placed again when they're retried.
+    Work that stays stranded is moved by migrate_stranded_processor_jobs.
     """
     logger.info("Removing all jobs from Nomad queue whose volumes are not mounted.")
 
     # Smasher and QN Reference jobs aren't tied to a specific EBS volume.
     indexed_job_types = [e.value for e in ProcessorPipeline if e.value not in ["SMASHER", "QN_REFERENCE"]]
 
-    nomad_host = get_env_variable("NOMAD_HOST")
-    nomad_port = get_env_variable("NOMAD_PORT", "4646")
-    nomad_client = nomad.Nomad(nomad_host, port=int(nomad_port), timeout=30)
+    if not cluster_state:
+        cluster_state = ClusterState()
 
-    try:
-        active_volumes = get_active_volumes()
-        jobs = nomad_client.jobs.get_jobs()
-    except:
+    nomad_client = cluster_state.nomad_client
+    active_volumes = cluster_state.active_volumes
+    jobs = cluster_state.jobs
+    if jobs is None or not active_volumes:
         # If we cannot reach Nomad now then we can wait until a later loop.
         return
 
@@ -1347,36 +2210,41 @@ def cleanup_the_queue():
         if "ParameterizedJob" not in job or job["ParameterizedJob"]:
             continue
 
-        for job_type in indexed_job_types:
-            # We're only concerned with jobs that have to be tied to a volume index.
-            if "ParentID" not in job or not job["ParentID"].startswith(job_type):
+        parent_id = job.get("ParentID", None) or ""
+        split_parent_id = parent_id.split("_")
+        if parent_id.startswith("DOWNLOADER"):
+            # Only downloader jobs which were placed on a volume have
+            # an index, in which case their ParentID has the pattern
+            # DOWNLOADER_<index>_<RAM-amount>.
+            if len(split_parent_id) != 3:
                 continue
-
+            job_model = DownloaderJob
+        elif any(parent_id.startswith(job_type) for job_type in indexed_job_types):
             # If this job has an index, then its ParentID will
             # have the pattern of <job-type>_<index>_<RAM-amount>
-            # and we want to check the value of <index>:
-            split_parent_id = job["ParentID"].split("_")
             if len(split_parent_id) < 2:
                 continue
-            else:
-                index = split_parent_id[-2]
+            job_model = ProcessorJob
+        else:
+            # We're only concerned with jobs that have to be tied to a volume index.
+            continue
 
-            if index not in active_volumes:
-                # The index for this job isn't currently mounted, kill
-                # the job and decrement the retry counter (since it
-                # will be incremented when it is requeued).
-                try:
-                    nomad_client.job.deregister_job(job["ID"], purge=True)
-                    job_record = ProcessorJob(nomad_job_id=job["ID"])
-                    job_record.num_retries = job_record.num_retries - 1
-                    job_record.save()
-                    num_jobs_killed += 1
-                except:
-                    logger.exception("Could not remove Nomad job from the Nomad queue.",
-                                     nomad_job_id=job["ID"],
-                                     job_type=job_type)
-                    # If we can't do this for some reason, we'll get it next loop.
-                    pass
+        # We want to check the value of <index>:
+        index = split_parent_id[-2]
+        if index not in active_volumes:
+            # The index for this job isn't currently mounted, kill
+            # the job and decrement the retry counter (since it
+            # will be incremented when it is requeued).
+            try:
+                nomad_client.job.deregister_job(job["ID"], purge=True)
+                job_model.objects.filter(nomad_job_id=job["ID"]).update(num_retries=F("num_retries") - 1)
+                num_jobs_killed += 1
+            except:
+                logger.exception("Could not remove Nomad job from the Nomad queue.",
+                                 nomad_job_id=job["ID"],
+                                 parent_id=parent_id)
+                # If we can't do this for some reason, we'll get it next loop.
+                pass
 
     logger.info("Removed %d jobs from the Nomad queue.", num_jobs_killed)
 
@@ -1400,7 +2268,239 @@ def clean_database():
 # Main loop
 ##
 
-def monitor_jobs():
+# Passes for the same job type share that type's capacity, so they run
+# one after another. The order of processor -> downloader -> surveyor
+# used to matter when every pass ran in sequence; now each type gets
+# its share of the capacity up front instead.
+PASSES_BY_JOB_TYPE = [
+    [
+        retry_failed_processor_jobs,
+        retry_hung_processor_jobs,
+        retry_lost_processor_jobs,
+        retry_lost_smasher_jobs,
+    ],
+    [
+        retry_failed_downloader_jobs,
+        retry_hung_downloader_jobs,
+        # The downloader jobs this creates are dispatched by the lost pass.
+        migrate_stranded_processor_jobs,
+        retry_lost_downloader_jobs,
+    ],
+    [
+        retry_failed_survey_jobs,
+        retry_hung_survey_jobs,
+        retry_lost_survey_jobs,
+    ],
+]
+
+# The metrics of the last run of each pass, keyed by the pass's name.
+LAST_PASS_METRICS = {}
+
+
+def run_passes(passes: List, cluster_state: ClusterState, time_budget=MAX_PASS_TIME) -> List[Dict]:
+    """Runs each of passes in turn, giving each time_budget to finish.
+
+    Returns the duration and number of jobs dispatched for each pass.
+    """
+    all_metrics = []
+    for function in passes:
+        cluster_state.start_pass(function.__name__, time_budget)
+        try:
+            function(cluster_state)
+        except Exception as e:
+            logger.error("Caught exception in %s: ", function.__name__)
+            traceback.print_exc(chain=False)
+
+        metrics = cluster_state.finish_pass()
+        logger.info("Finished foreman pass.", **metrics)
+        LAST_PASS_METRICS[function.__name__] = metrics
+        all_metrics.append(metrics)
+
+    return all_metrics
+
+
+def _run_passes_in_thread(passes: List, cluster_state: ClusterState) -> List[Dict]:
+    try:
+        return run_passes(passes, cluster_state)
+    finally:
+        # Each thread gets its own database connection, which
+        # wouldn't be closed otherwise.
+        connection.close()
+
+
+def write_health_file() -> None:
+    """Writes the time to the health file for Monit to check."""
+    now_secs = int(time.time())
+    with open('/tmp/foreman_last_time', 'w') as timefile:
+        timefile.write(str(now_secs))
+
+
+def run_sweep(executor: concurrent.futures.Executor,
+              cluster_state: ClusterState,
+              extra_work: List=None) -> None:
+    """Runs the passes for each job type at the same time, plus each
+    function in extra_work, and waits for all of them to finish."""
+    capacity_limits = cluster_state.partition_capacity()
+    logger.info("Partitioned queue capacity between job types.", **capacity_limits)
+
+    # Requeue jobs of each job type at the same time so that one
+    # slow pass doesn't hold up the others.
+    futures = [executor.submit(_run_passes_in_thread, passes, cluster_state)
+               for passes in PASSES_BY_JOB_TYPE]
+    futures.extend([executor.submit(_run_passes_in_thread, [work], cluster_state)
+                    for work in (extra_work or [])])
+
+    # Keep Monit happy while the passes are running. Passes stop
+    # once their time budget runs out, so this won't wait forever.
+    not_done = futures
+    while not_done:
+        _, not_done = concurrent.futures.wait(not_done, timeout=HEARTBEAT_TIME.total_seconds())
+        write_health_file()
+
+
+##
+# Event-Driven Monitoring
+##
+
+class NomadJobWatcher:
+    """Watches Nomad's job list with blocking queries.
+
+    Each query only returns once Nomad's X-Nomad-Index has moved past
+    the one from the last query, which happens as soon as any job is
+    dispatched or changes status, or once BLOCKING_QUERY_WAIT passes.
+    """
+
+    def __init__(self, nomad_client: Nomad=None, wait=BLOCKING_QUERY_WAIT):
+        if not nomad_client:
+            # The request has to be allowed to take longer than Nomad
+            # will hold on to it.
+            nomad_client = create_nomad_client(timeout=int(wait.total_seconds()) + 30)
+
+        self.nomad_client = nomad_client
+        self.wait = wait
+        self.index = 0
+
+    def wait_for_changes(self) -> Tuple[List[Dict], List[Dict]]:
+        """Returns Nomad's job list once it has changed, along with the
+        jobs in it which changed since the last call. Every job counts
+        as changed on the first call."""
+        response = self.nomad_client.jobs.request(
+            method="get",
+            params={"index": self.index, "wait": "{}s".format(int(self.wait.total_seconds()))}
+        )
+        jobs = response.json()
+        index = int(response.headers.get("X-Nomad-Index", 0))
+
+        # Nomad's index can go backwards, such as when a new leader is
+        # elected, in which case everything has to be looked at again.
+        if index < self.index:
+            self.index = 0
+
+        changed_jobs = [job for job in jobs if job.get("ModifyIndex", 0) > self.index]
+        self.index = index
+        return jobs, changed_jobs
+
+
+# The pass which retries each type of job once it's been marked as
+# failed.
+FAILED_PASSES_BY_JOB_TYPE = {
+    "processor": retry_failed_processor_jobs,
+    "downloader": retry_failed_downloader_jobs,
+    "survey": retry_failed_survey_jobs,
+}
+
+
+def record_terminated_jobs(nomad_jobs: List[Dict], nomad_client: Nomad) -> Dict[str, int]:
+    """Marks the jobs whose Nomad job is dead but which never finished
+    as failed, so they can be retried without waiting for the hung or
+    lost passes to find them.
+
+    A worker records that its job finished before it exits, so a dead
+    Nomad job for an unfinished job means the worker died or never
+    started. Processor jobs that died because they ran out of memory
+    are recorded as such. Smasher and Janitor jobs are left to their
+    own passes.
+
+    Returns how many jobs of each type with a dead Nomad job are now
+    waiting on the failed pass, whether they were marked as failed
+    here or their worker reported the failure itself.
+    """
+    # Dispatched jobs have a parent, the parameterized job specs don't.
+    dead_job_ids = [job["ID"] for job in nomad_jobs
+                    if job.get("Status") == "dead" and job.get("ParentID")]
+    if not dead_job_ids:
+        return {}
+
+    dead_jobs = {
+        # SALMON jobs folded into a SALMON_BATCH job exit without
+        # starting, the batch closes them out.
+        "processor": ProcessorJob.objects.exclude(
+            pipeline_applied__in=["JANITOR", "SMASHER"]
+        ).exclude(retried_job__isnull=False),
+        "downloader": DownloaderJob.objects.all(),
+        "survey": SurveyJob.objects.all(),
+    }
+
+    num_terminated = {}
+    num_failed = {}
+    for job_type, jobs in dead_jobs.items():
+        jobs = jobs.filter(nomad_job_id__in=dead_job_ids, retried=False)
+        unfinished_jobs = jobs.filter(success=None, end_time=None)
+        if job_type == "processor":
+            record_oom_kills(list(unfinished_jobs), nomad_client)
+
+        num_terminated[job_type] = unfinished_jobs.update(
+            success=False,
+            end_time=timezone.now(),
+            failure_reason="The job's Nomad job ended before the job finished."
+        )
+        num_failed[job_type] = jobs.filter(success=False, no_retry=False).count()
+
+    logger.info("Recorded jobs whose Nomad jobs ended.", **num_terminated)
+    return num_failed
+
+
+# The passes which requeue jobs that were never dispatched or whose
+# Nomad job went missing, such as new downloader jobs created by the
+# surveyor. Nothing happens in Nomad for those, so they're run every
+# LOST_PASS_TIME rather than waiting for the next sweep.
+LOST_PASSES = [
+    retry_lost_processor_jobs,
+    retry_lost_smasher_jobs,
+    retry_lost_downloader_jobs,
+    retry_lost_survey_jobs,
+]
+
+
+def handle_job_changes(cluster_state: ClusterState,
+                       jobs: List[Dict],
+                       changed_jobs: List[Dict],
+                       run_lost_passes: bool=False) -> Dict[str, int]:
+    """Brings cluster_state up to date with Nomad's job list and retries
+    the jobs whose Nomad jobs ended without them succeeding. Also runs
+    the lost passes if run_lost_passes is True.
+
+    Only a handful of jobs end at a time, so their failed passes are
+    run one after another in this thread.
+
+    Returns how many failed jobs of each type were found to have ended.
+    """
+    cluster_state.update_jobs(jobs)
+    num_failed = record_terminated_jobs(changed_jobs, cluster_state.nomad_client)
+
+    passes = [FAILED_PASSES_BY_JOB_TYPE[job_type]
+              for job_type, num_jobs in num_failed.items() if num_jobs]
+    if run_lost_passes:
+        passes = passes + LOST_PASSES
+
+    if passes:
+        cluster_state.partition_capacity()
+        run_passes(passes, cluster_state)
+
+    return num_failed
+
+
+def monitor_jobs(event_driven: bool=FOREMAN_EVENT_DRIVEN):
     """Main Foreman thread that helps manage the Nomad job queue.
 
     Will find jobs that failed, hung, or got lost and requeue them.
@@ -1410,59 +2510,79 @@ def monitor_jobs():
     Also cleans jobs out of the Nomad queue which cannot be queued
     because the volume containing the job's data isn't mounted.
 
+    Also spreads downloader jobs between the mounted volumes and moves
+    work off of volumes which stay unmounted.
+
     It does so on a loop forever that won't spin faster than
     MIN_LOOP_TIME, but it may spin slower than that.
+
+    If event_driven is True it instead waits on Nomad for jobs to end
+    and retries them right away, only running every pass over the
+    whole database every RECONCILIATION_TIME.
     """
     last_janitorial_time = timezone.now()
     last_dbclean_time = timezone.now()
+    # Update the priorities on the first loop so the passes start out
+    # in the right order.
+    last_priority_update_time = timezone.now() - PRIORITY_UPDATE_TIME
+    last_sweep_time = None
+    last_lost_pass_time = timezone.now()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(PASSES_BY_JOB_TYPE) + 1)
+    watcher = NomadJobWatcher() if event_driven else None
+    cluster_state = None
 
     while(True):
         # Perform two heartbeats, one for the logs and one for Monit:
         logger.info("The Foreman's heart is beating, but he does not feel.")
-
-        # Write the health file for Monit to check
-        now_secs = int(time.time())
-        with open('/tmp/foreman_last_time', 'w') as timefile:
-            timefile.write(str(now_secs))
+        write_health_file()
 
         start_time = timezone.now()
 
-        # Requeue jobs of each failure class for each job type.
-        # The order of processor -> downloader -> surveyor is intentional.
-        # Processors go first so we process data sitting on disk.
-        # Downloaders go first so we actually queue up the jobs in the database.
-        # Surveyors go last so we don't end up with tons and tons of unqueued jobs.
-        requeuing_functions_in_order = [
-            retry_failed_processor_jobs,
-            retry_hung_processor_jobs,
-            retry_lost_processor_jobs,
-            retry_failed_downloader_jobs,
-            retry_hung_downloader_jobs,
-            retry_lost_downloader_jobs,
-            retry_failed_survey_jobs,
-            retry_hung_survey_jobs,
-            retry_lost_survey_jobs,
-            retry_lost_smasher_jobs
-        ]
-
-        for function in requeuing_functions_in_order:
+        if timezone.now() - last_priority_update_time >= PRIORITY_UPDATE_TIME:
             try:
-                function()
-            except Exception as e:
-                logger.error("Caught exception in %s: ", function.__name__)
-                traceback.print_exc(chain=False)
-
-        if timezone.now() - last_janitorial_time > JANITOR_DISPATCH_TIME:
-            send_janitor_jobs()
-            cleanup_the_queue()
-            last_janitorial_time = timezone.now()
+                update_job_priorities()
+            except Exception:
+                logger.exception("Caught exception while updating job priorities.")
+            last_priority_update_time = timezone.now()
+
+        if not watcher or not last_sweep_time or timezone.now() - last_sweep_time >= RECONCILIATION_TIME:
+            # Every pass this loop works from the same view of the
+            # cluster rather than asking Nomad for it over and over.
+            cluster_state = ClusterState()
+
+            extra_work = []
+            if timezone.now() - last_janitorial_time > JANITOR_DISPATCH_TIME:
+                def janitorial_work():
+                    send_janitor_jobs(cluster_state)
+                    cleanup_the_queue(cluster_state)
+
+                extra_work.append(janitorial_work)
+                last_janitorial_time = timezone.now()
+
+            run_sweep(executor, cluster_state, extra_work=extra_work)
+            last_sweep_time = timezone.now()
+            # The sweep ran the lost passes too.
+            last_lost_pass_time = last_sweep_time
+        else:
+            try:
+                jobs, changed_jobs = watcher.wait_for_changes()
+                run_lost_passes = timezone.now() - last_lost_pass_time >= LOST_PASS_TIME
+                handle_job_changes(cluster_state, jobs, changed_jobs, run_lost_passes)
+                if run_lost_passes:
+                    last_lost_pass_time = timezone.now()
+            except Exception:
+                logger.exception("Caught exception while waiting on Nomad for job changes.")
+                # Start over from the full job list next time.
+                watcher.index = 0
 
         if timezone.now() - last_dbclean_time > DBCLEAN_TIME:
             clean_database()
             last_dbclean_time = timezone.now()
 
+        min_loop_time = MIN_EVENT_LOOP_TIME if watcher else MIN_LOOP_TIME
         loop_time = timezone.now() - start_time
-        if loop_time < MIN_LOOP_TIME:
-            remaining_time = MIN_LOOP_TIME - loop_time
+        if loop_time < min_loop_time:
+            remaining_time = min_loop_time - loop_time
             if remaining_time.seconds > 0:
                 time.sleep(remaining_time.seconds)
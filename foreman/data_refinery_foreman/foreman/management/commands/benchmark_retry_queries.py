@@ -0,0 +1,152 @@
+"""This command seeds the job tables with millions of jobs and then
+times how long it takes the Foreman to page through the failed, hung
+and lost jobs of each type the same way its retry passes do.
+
+Almost all of the seeded jobs have finished successfully, like in
+production, so this shows whether the retry queries stay fast as the
+tables grow. The seeded jobs are deleted afterwards unless --keep is
+passed.
+"""
+
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.models import DownloaderJob, ProcessorJob, SurveyJob
+from data_refinery_foreman.foreman import main
+from data_refinery_foreman.foreman.performant_pagination.pagination import PerformantPaginator as Paginator
+
+
+logger = get_and_configure_logger(__name__)
+
+# Seeded jobs get this prefix on their nomad_job_id so they can be
+# found and deleted again.
+BENCHMARK_PREFIX = "BENCHMARK/"
+ACTIVE_VOLUMES = {"0", "1", "2"}
+# The order the retry passes page through downloader and processor jobs.
+PRIORITY_ORDERING = ('-priority', 'id')
+BATCH_SIZE = 10000
+
+
+def make_job(model, state: str, number: int):
+    """Returns an unsaved job of model in state "succeeded", "failed",
+    "hung" or "lost"."""
+    now = timezone.now()
+    job = model(nomad_job_id=BENCHMARK_PREFIX + str(number))
+
+    if state in ["succeeded", "failed", "hung"]:
+        job.start_time = now
+    if state in ["succeeded", "failed"]:
+        job.end_time = now
+        job.success = state == "succeeded"
+
+    if model == ProcessorJob:
+        # Include jobs on volumes which aren't mounted.
+        job.volume_index = str(random.randint(0, 5))
+    if model != SurveyJob:
+        job.priority = random.choice([0, 0, 0, main.PEDIATRIC_PRIORITY, main.ORGANISM_PRIORITY])
+    return job
+
+
+def seed_jobs(model, num_jobs: int, retryable_fraction: float) -> None:
+    states = ["failed", "hung", "lost"]
+    for start in range(0, num_jobs, BATCH_SIZE):
+        jobs = []
+        for number in range(start, min(start + BATCH_SIZE, num_jobs)):
+            if random.random() < retryable_fraction:
+                state = random.choice(states)
+            else:
+                state = "succeeded"
+            jobs.append(make_job(model, state, number))
+
+        model.objects.bulk_create(jobs)
+
+
+def time_pages(queryset, page_size: int, ordering) -> dict:
+    """Pages through queryset like the retry passes do."""
+    started_at = time.monotonic()
+    paginator = Paginator(queryset, page_size, ordering=ordering, allow_previous=False)
+    page = paginator.page()
+    num_pages = 1
+    num_jobs = len(page.object_list)
+    while page.has_next():
+        page = paginator.page(page.next_page_number())
+        num_pages += 1
+        num_jobs += len(page.object_list)
+
+    return {
+        "seconds": time.monotonic() - started_at,
+        "pages": num_pages,
+        "jobs": num_jobs,
+    }
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--num-jobs",
+            type=int,
+            default=1000000,
+            help=("How many jobs of each type to seed."))
+
+        parser.add_argument(
+            "--retryable-fraction",
+            type=float,
+            default=0.01,
+            help=("The fraction of seeded jobs which are failed, hung or lost."))
+
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            help=("Print the query plan for the first page of each query."))
+
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help=("Don't delete the seeded jobs afterwards."))
+
+    def handle(self, *args, **options):
+        if settings.RUNNING_IN_CLOUD:
+            raise CommandError("Refusing to seed millions of jobs into a production database.")
+
+        queries = [
+            ("failed downloader jobs", main.get_failed_downloader_jobs(), main.PAGE_SIZE, PRIORITY_ORDERING),
+            ("hung downloader jobs", main.get_hung_downloader_jobs(), main.PAGE_SIZE, PRIORITY_ORDERING),
+            ("lost downloader jobs", main.get_lost_downloader_jobs(), main.PAGE_SIZE, PRIORITY_ORDERING),
+            ("failed processor jobs", main.get_failed_processor_jobs(ACTIVE_VOLUMES), 200, PRIORITY_ORDERING),
+            ("hung processor jobs", main.get_hung_processor_jobs(ACTIVE_VOLUMES), 200, PRIORITY_ORDERING),
+            ("lost processor jobs", main.get_lost_processor_jobs(ACTIVE_VOLUMES), 200, PRIORITY_ORDERING),
+            ("failed survey jobs", main.get_failed_survey_jobs(), 200, ('id',)),
+            ("hung survey jobs", main.get_hung_survey_jobs(), 200, ('id',)),
+            ("lost survey jobs", main.get_lost_survey_jobs(), 200, ('id',)),
+        ]
+
+        for model in [DownloaderJob, ProcessorJob, SurveyJob]:
+            started_at = time.monotonic()
+            seed_jobs(model, options["num_jobs"], options["retryable_fraction"])
+            self.stdout.write("Seeded {} {}s in {:.1f} seconds.".format(
+                options["num_jobs"], model.__name__, time.monotonic() - started_at))
+
+        with connection.cursor() as cursor:
+            for model in [DownloaderJob, ProcessorJob, SurveyJob]:
+                cursor.execute("ANALYZE {}".format(model._meta.db_table))
+
+        try:
+            for name, queryset, page_size, ordering in queries:
+                if options["explain"]:
+                    self.stdout.write(queryset.order_by(*ordering)[:page_size].explain(analyze=True))
+
+                results = time_pages(queryset, page_size, ordering)
+                self.stdout.write("Paged through {jobs} {name} in {pages} pages in {seconds:.2f} seconds."
+                                  .format(name=name, **results))
+        finally:
+            if not options["keep"]:
+                with connection.cursor() as cursor:
+                    for model in [DownloaderJob, ProcessorJob, SurveyJob]:
+                        cursor.execute("DELETE FROM {} WHERE nomad_job_id LIKE %s".format(model._meta.db_table),
+                                       [BENCHMARK_PREFIX + "%"])
@@ -67,7 +67,7 @@ def create_processor_jobs_for_original_files(original_files: List[OriginalFile],
         else:
             processor_job = ProcessorJob()
             processor_job.pipeline_applied = pipeline_to_apply.value
-            processor_job.ram_amount = determine_ram_amount(sample_object, processor_job)
+            processor_job.ram_amount = determine_ram_amount(sample_object, processor_job, [original_file])
             processor_job.volume_index = volume_index
             processor_job.save()
 
@@ -105,7 +105,7 @@ def create_processor_job_for_original_files(original_files: List[OriginalFile],
     else:
         processor_job = ProcessorJob()
         processor_job.pipeline_applied = pipeline_to_apply.value
-        processor_job.ram_amount = determine_ram_amount(sample_object, processor_job)
+        processor_job.ram_amount = determine_ram_amount(sample_object, processor_job, original_files)
         processor_job.volume_index = volume_index
         processor_job.save()
         for original_file in original_files:
@@ -0,0 +1,123 @@
+"""This command folds SALMON processor jobs which haven't started yet
+into SALMON_BATCH jobs so that the samples in each batch can be
+quantified back to back by one worker, only loading the index once.
+
+Jobs can only be batched with other jobs on the same EBS volume
+because that's where their files were downloaded to. They are also
+grouped by organism so that every sample in the batch uses the same
+pair of transcriptome indices.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from data_refinery_common.job_lookup import ProcessorPipeline
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.message_queue import send_job
+from data_refinery_common.models import ProcessorJob, ProcessorJobOriginalFileAssociation
+
+
+logger = get_and_configure_logger(__name__)
+
+DEFAULT_BATCH_SIZE = 50
+
+
+def group_jobs_for_batching(jobs):
+    """Returns a mapping from (volume_index, organism_id) to the jobs
+    which can share a batch."""
+    groups = {}
+    for job in jobs:
+        original_file = job.original_files.first()
+        if not original_file:
+            continue
+
+        sample = original_file.samples.first()
+        if not sample or not sample.organism_id:
+            continue
+
+        groups.setdefault((job.volume_index, sample.organism_id), []).append(job)
+
+    return groups
+
+
+def create_batch_job(jobs) -> ProcessorJob:
+    """Creates a SALMON_BATCH job for the files of `jobs`.
+
+    The jobs it replaces only get pointed at the batch here. They are
+    closed out by the batch once it starts, or handed back if their
+    sample can't be run as part of it. See salmon._prepare_batch_files.
+    """
+    with transaction.atomic():
+        batch_job = ProcessorJob()
+        batch_job.pipeline_applied = ProcessorPipeline.SALMON_BATCH.value
+        batch_job.ram_amount = max(job.ram_amount for job in jobs)
+        batch_job.volume_index = jobs[0].volume_index
+        batch_job.save()
+
+        for job in jobs:
+            for original_file in job.original_files.all():
+                ProcessorJobOriginalFileAssociation.objects.get_or_create(
+                    processor_job=batch_job,
+                    original_file=original_file
+                )
+
+            # If the Nomad job for this one still runs, start_job will
+            # see that it has been folded into the batch and stop.
+            job.retried_job = batch_job
+            job.save()
+
+    return batch_job
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--experiment-accession",
+            type=str,
+            help=("Only batch jobs for samples in this experiment."))
+
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help=("The maximum number of samples to put in each batch."))
+
+    def handle(self, *args, **options):
+        jobs = ProcessorJob.objects.filter(
+            pipeline_applied=ProcessorPipeline.SALMON.value,
+            start_time__isnull=True,
+            success__isnull=True,
+            retried=False,
+            retried_job__isnull=True,
+            no_retry=False,
+            volume_index__isnull=False
+        )
+
+        if options["experiment_accession"]:
+            jobs = jobs.filter(
+                original_files__samples__experiments__accession_code=options["experiment_accession"]
+            ).distinct()
+
+        batch_size = options["batch_size"]
+        for (volume_index, organism_id), group in group_jobs_for_batching(jobs).items():
+            for start in range(0, len(group), batch_size):
+                batch_jobs = group[start:start + batch_size]
+
+                # A batch of one is just a slower SALMON job.
+                if len(batch_jobs) < 2:
+                    continue
+
+                batch_job = create_batch_job(batch_jobs)
+
+                logger.info("Created salmon batch job.",
+                            processor_job=batch_job.id,
+                            volume_index=volume_index,
+                            organism=organism_id,
+                            num_jobs=len(batch_jobs))
+
+                try:
+                    send_job(ProcessorPipeline.SALMON_BATCH, job=batch_job, is_dispatch=True)
+                except Exception:
+                    # The foreman will dispatch it once Nomad is reachable again.
+                    logger.exception("Failed to dispatch salmon batch job.",
+                                     processor_job=batch_job.id)
@@ -3,12 +3,22 @@ This command will run the Foreman's main function monitor_jobs.
 This will cause the Foreman to check for a number of different
 failures for both the DownloaderJobs and ProcessorJobs and requeue
 those jobs it detects as failed.
+
+With --event-driven it waits on Nomad for jobs to end instead of
+polling for them, see monitor_jobs.
 """
 
 from django.core.management.base import BaseCommand
-from data_refinery_foreman.foreman.main import monitor_jobs
+from data_refinery_foreman.foreman.main import FOREMAN_EVENT_DRIVEN, monitor_jobs
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--event-driven",
+            action="store_true",
+            default=FOREMAN_EVENT_DRIVEN,
+            help=("React to Nomad jobs ending as it happens rather than only polling."))
+
     def handle(self, *args, **options):
-        monitor_jobs()
+        monitor_jobs(event_driven=options["event_driven"])
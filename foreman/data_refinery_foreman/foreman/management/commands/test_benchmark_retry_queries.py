@@ -0,0 +1,25 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from data_refinery_common.models import DownloaderJob, ProcessorJob, SurveyJob
+
+
+class BenchmarkRetryQueriesTestCase(TestCase):
+    def test_benchmark(self):
+        # A job which wasn't seeded shouldn't be cleaned up.
+        DownloaderJob(nomad_job_id="DOWNLOADER/dispatch-1528945054-e8eaf540").save()
+
+        out = StringIO()
+        call_command("benchmark_retry_queries", num_jobs=500, retryable_fraction=0.5, stdout=out)
+
+        output = out.getvalue()
+        self.assertIn("Seeded 500 ProcessorJobs", output)
+        for job_type in ["downloader", "processor", "survey"]:
+            for state in ["failed", "hung", "lost"]:
+                self.assertIn(" {} {} jobs in ".format(state, job_type), output)
+
+        self.assertEqual(DownloaderJob.objects.count(), 1)
+        self.assertEqual(ProcessorJob.objects.count(), 0)
+        self.assertEqual(SurveyJob.objects.count(), 0)
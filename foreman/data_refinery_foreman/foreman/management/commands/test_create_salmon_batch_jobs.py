@@ -0,0 +1,88 @@
+from django.core.management import call_command
+from django.test import TestCase
+from unittest.mock import patch
+
+from data_refinery_common.job_lookup import ProcessorPipeline
+from data_refinery_common.models import (
+    Organism,
+    OriginalFile,
+    OriginalFileSampleAssociation,
+    ProcessorJob,
+    ProcessorJobOriginalFileAssociation,
+    Sample,
+)
+
+
+def create_salmon_job(accession_code: str, organism: Organism, volume_index: str) -> ProcessorJob:
+    sample = Sample()
+    sample.accession_code = accession_code
+    sample.organism = organism
+    sample.source_database = "SRA"
+    sample.technology = "RNA-SEQ"
+    sample.save()
+
+    original_file = OriginalFile()
+    original_file.filename = accession_code + ".sra"
+    original_file.source_filename = accession_code + ".sra"
+    original_file.is_downloaded = True
+    original_file.save()
+
+    OriginalFileSampleAssociation.objects.create(original_file=original_file, sample=sample)
+
+    processor_job = ProcessorJob()
+    processor_job.pipeline_applied = ProcessorPipeline.SALMON.value
+    processor_job.ram_amount = 12288
+    processor_job.volume_index = volume_index
+    processor_job.save()
+
+    ProcessorJobOriginalFileAssociation.objects.create(processor_job=processor_job,
+                                                       original_file=original_file)
+
+    return processor_job
+
+
+class CreateSalmonBatchJobsTestCase(TestCase):
+    @patch('data_refinery_foreman.foreman.management.commands.create_salmon_batch_jobs.send_job')
+    def test_batches_by_volume_and_organism(self, mock_send_job):
+        human = Organism(name="HOMO_SAPIENS", taxonomy_id=9606, is_scientific_name=True)
+        human.save()
+        mouse = Organism(name="MUS_MUSCULUS", taxonomy_id=10090, is_scientific_name=True)
+        mouse.save()
+
+        human_jobs = [create_salmon_job("SRR" + str(i), human, "0") for i in range(3)]
+        # Different volume, so it can't join the human batch.
+        other_volume_job = create_salmon_job("SRR10", human, "1")
+        # Only one mouse job, so it isn't worth batching.
+        mouse_job = create_salmon_job("SRR20", mouse, "0")
+
+        call_command("create_salmon_batch_jobs", "--batch-size", "2")
+
+        batch_jobs = ProcessorJob.objects.filter(
+            pipeline_applied=ProcessorPipeline.SALMON_BATCH.value
+        ).order_by("id")
+        self.assertEqual(batch_jobs.count(), 1)
+        self.assertEqual(batch_jobs[0].original_files.count(), 2)
+        self.assertEqual(mock_send_job.call_count, 1)
+
+        # The folded jobs are only closed out once the batch starts.
+        for job in human_jobs[:2]:
+            job.refresh_from_db()
+            self.assertFalse(job.retried)
+            self.assertIsNone(job.success)
+            self.assertEqual(job.retried_job, batch_jobs[0])
+
+        # The leftover job would be a batch of one, so it's left alone.
+        human_jobs[2].refresh_from_db()
+        self.assertFalse(human_jobs[2].retried)
+        self.assertIsNone(human_jobs[2].retried_job)
+
+        # Jobs which have already been folded aren't batched again.
+        call_command("create_salmon_batch_jobs", "--batch-size", "2")
+        self.assertEqual(ProcessorJob.objects.filter(
+            pipeline_applied=ProcessorPipeline.SALMON_BATCH.value
+        ).count(), 1)
+
+        other_volume_job.refresh_from_db()
+        self.assertFalse(other_volume_job.retried)
+        mouse_job.refresh_from_db()
+        self.assertFalse(mouse_job.retried)
@@ -6,6 +6,7 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 from base64 import b64decode, b64encode
 from django.core.paginator import Page
+from django.db.models import Q
 
 
 # we inherit from Page, even though it's a bit odd since we're so
@@ -51,14 +52,22 @@ class PerformantPage(Page):
 class PerformantPaginator(object):
 
     def __init__(self, queryset, per_page=25, ordering='pk', allow_count=False,
-                 allow_empty_first_page=True, orphans=0):
+                 allow_empty_first_page=True, orphans=0, allow_previous=True):
         '''As a general rule you should ensure there's an appropriate index for
         the field provided in ordering.
 
+        ordering may also be a tuple of fields, e.g. ('-priority', 'id'), in
+        which case pages are ordered by each field in turn. The last field
+        should be unique so that no two objects share a token.
+
         allow_count (default False) indicates whether or not to allow count
         queries that can be extremely expensive on large and fast changing
         datasets.
 
+        allow_previous (default True) indicates whether or not to look up the
+        token of the previous page, which takes an extra query per page. Code
+        that only ever walks forward through the pages can turn it off.
+
         allow_empty_first_page and orphans are currently ignored and only exist
         to allow dropping in place of Django's built-in pagination.
         '''
@@ -66,11 +75,18 @@ class PerformantPaginator(object):
         self.per_page = int(per_page)
         self.ordering = ordering
         self.allow_count = allow_count
+        self.allow_previous = allow_previous
 
-        field = ordering.replace('-', '')
-        self._reverse_ordering = field if ordering[0] == '-' else \
-            '-{0}'.format(ordering)
-        self._field = field
+        if isinstance(ordering, (list, tuple)):
+            self._orderings = list(ordering)
+        else:
+            self._orderings = [ordering]
+
+        self._fields = [o.replace('-', '') for o in self._orderings]
+        self._reverse_orderings = [
+            field if o[0] == '-' else '-{0}'.format(o)
+            for o, field in zip(self._orderings, self._fields)
+        ]
 
     def __repr__(self):
         return '<PerformantPaginator (%d, %s %d)>' % (self.per_page,
@@ -89,53 +105,67 @@ class PerformantPaginator(object):
         # TODO: validate format for field type?
         return number
 
+    def _value_to_string(self, obj, field):
+        if field == 'pk':
+            return obj._meta.pk.value_to_string(obj)
+
+        pieces = field.split('__')
+        if len(pieces) > 1:
+            # traverse relationships, -1 will be our final field
+            for piece in pieces[:-1]:
+                obj = getattr(obj, piece)
+        # obj is now the object on which our final field lives
+        return obj._meta.get_field(pieces[-1]).value_to_string(obj)
+
     def _object_to_token(self, obj):
-        field = self._field
+        # each field's value is encoded on its own and they're joined with
+        # '.', which can't appear in base64, so a single field's token is
+        # just its encoded value
+        return b'.'.join(b64encode(self._value_to_string(obj, field).encode())
+                         for field in self._fields)
+
+    def _string_to_value(self, field, value):
+        meta = self.queryset.model._meta
         if field == 'pk':
-            value = obj._meta.pk.value_to_string(obj)
-        else:
-            pieces = field.split('__')
-            if len(pieces) > 1:
-                # traverse relationships, -1 will be our final field
-                for piece in pieces[:-1]:
-                    obj = getattr(obj, piece)
-            # obj is now the object on which our final field lives
-            value = obj._meta.get_field(pieces[-1]).value_to_string(obj)
-
-        # return our value
-        value_bytes = value.encode()
-        return b64encode(value_bytes)
+            return meta.pk.to_python(value)
+
+        pieces = field.split('__')
+        if len(pieces) > 1:
+            # traverse relationships, -1 will be our final field
+            for piece in pieces[:-1]:
+                # grab the ForeignKey field, then its RelatedObject, which
+                # holds it's parent_model (the one at the other end of the
+                # relationship) and finally its _meta which is what we're
+                # after
+                meta = meta.get_field(piece).related.parent_model._meta
+
+        return meta.get_field(pieces[-1]).to_python(value)
 
     def _token_to_clause(self, token, rev=False):
         # in the forward direction we want things that are greater than our
         # value, but if the ordering is -, we want less than. if rev=True we
         # fip it
         direction = ('lt', 'gt') if rev else ('gt', 'lt')
-        if self.ordering[0] == '-':
-            d = direction[1]
-        else:
-            d = direction[0]
-
-        token = b64decode(token)
-
-        field = self._field
-        meta = self.queryset.model._meta
-        if field == 'pk':
-            value = meta.pk.to_python(token)
-        else:
-            pieces = field.split('__')
-            if len(pieces) > 1:
-                # traverse relationships, -1 will be our final field
-                for piece in pieces[:-1]:
-                    # grab the ForeignKey field, then its RelatedObject, which
-                    # holds it's parent_model (the one at the other end of the
-                    # relationship) and finally its _meta which is what we're
-                    # after
-                    meta = meta.get_field(piece).related.parent_model._meta
 
-            value = meta.get_field(pieces[-1]).to_python(token)
-
-        return {'{0}__{1}'.format(self._field, d): value}
+        if not isinstance(token, bytes):
+            token = token.encode()
+        values = [self._string_to_value(field, b64decode(piece))
+                  for field, piece in zip(self._fields, token.split(b'.'))]
+
+        # with more than one field we want things past our value in the
+        # first field, or equal to it there and past it in the second, and
+        # so on
+        clause = Q()
+        equal_to = {}
+        for ordering, field, value in zip(self._orderings, self._fields,
+                                          values):
+            d = direction[1] if ordering[0] == '-' else direction[0]
+            past = dict(equal_to)
+            past['{0}__{1}'.format(field, d)] = value
+            clause |= Q(**past)
+            equal_to[field] = value
+
+        return clause
 
     def page(self, token=None):
         # work around generics being integer specific with a default of 1,
@@ -150,10 +180,10 @@ class PerformantPaginator(object):
         if token:
             # we're paged in a bit, token will be the values of the final
             # object of the previous page, so we'll start with it
-            qs = qs.filter(**self._token_to_clause(token))
+            qs = qs.filter(self._token_to_clause(token))
 
         # apply our ordering
-        qs = qs.order_by(self.ordering)
+        qs = qs.order_by(*self._orderings)
 
         # get our object list, +1 to see if there's more to come
         object_list = list(qs[:self.per_page + 1])
@@ -169,10 +199,10 @@ class PerformantPaginator(object):
         previous_token = None
         # if we have a truthy token, not including '', we'll check to see if
         # there's a prev
-        if token:
+        if token and self.allow_previous:
             clause = self._token_to_clause(token, rev=True)
-            qs = self.queryset.filter(**clause).only(self._field) \
-                .order_by(self._reverse_ordering)
+            qs = self.queryset.filter(clause).only(*self._fields) \
+                .order_by(*self._reverse_orderings)
             try:
                 previous_token = self._object_to_token(qs[self.per_page - 1])
             except IndexError:
@@ -1,5 +1,6 @@
 from unittest.mock import patch, MagicMock
 import datetime
+import socket
 import time
 from django.utils import timezone
 from django.test import TestCase
@@ -61,7 +62,7 @@ class ForemanTestCase(TestCase):
 
         return job
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_requeuing_downloader_job(self, mock_send_job):
         mock_send_job.return_value = True
 
@@ -81,7 +82,7 @@ class ForemanTestCase(TestCase):
 
         self.assertEqual(retried_job.original_files.count(), 2)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_repeated_download_failures(self, mock_send_job):
         """Jobs will be repeatedly retried."""
         mock_send_job.return_value = True
@@ -110,7 +111,7 @@ class ForemanTestCase(TestCase):
         self.assertEqual(last_job.num_retries, main.MAX_NUM_RETRIES)
         self.assertFalse(last_job.success)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_retrying_failed_downloader_jobs(self, mock_send_job):
         mock_send_job.return_value = True
 
@@ -130,7 +131,7 @@ class ForemanTestCase(TestCase):
         retried_job = jobs[1]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_retrying_many_failed_downloader_jobs(self, mock_send_job):
         mock_send_job.return_value = True
 
@@ -141,9 +142,10 @@ class ForemanTestCase(TestCase):
             job.save()
 
         main.retry_failed_downloader_jobs()
-        # No jobs actually make it in Nomad queue, so expect
-        # DOWNLOADER_JOBS_PER_NODE jobs per page.
-        self.assertEqual(len(mock_send_job.mock_calls), main.DOWNLOADER_JOBS_PER_NODE * NUM_PAGES)
+        # No jobs actually make it in Nomad queue, but the cluster
+        # state counts the ones that were dispatched, so expect
+        # DOWNLOADER_JOBS_PER_NODE jobs in total rather than per page.
+        self.assertEqual(len(mock_send_job.mock_calls), main.DOWNLOADER_JOBS_PER_NODE)
 
         jobs = DownloaderJob.objects.order_by('id')
 
@@ -152,15 +154,15 @@ class ForemanTestCase(TestCase):
         self.assertEqual(original_job.num_retries, 0)
         self.assertFalse(original_job.success)
 
-        retried_job = jobs[10001]
+        retried_job = jobs[main.PAGE_SIZE * NUM_PAGES]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_retrying_hung_downloader_jobs(self, mock_nomad, mock_send_job):
         mock_send_job.return_value = True
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -185,13 +187,13 @@ class ForemanTestCase(TestCase):
         retried_job = jobs[1]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_not_retrying_hung_downloader_jobs(self, mock_nomad, mock_send_job):
         """Tests that we don't restart downloader jobs that are still running."""
         mock_send_job.return_value = True
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -215,12 +217,12 @@ class ForemanTestCase(TestCase):
 
         self.assertEqual(jobs.count(), 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_retrying_lost_downloader_jobs(self, mock_nomad, mock_send_job):
         mock_send_job.return_value = True
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -245,13 +247,13 @@ class ForemanTestCase(TestCase):
         retried_job = jobs[1]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_not_retrying_old_downloader_jobs(self, mock_nomad, mock_send_job):
         """Makes sure temporary logic to limit the Foreman's scope works."""
         mock_send_job.return_value = True
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -270,7 +272,7 @@ class ForemanTestCase(TestCase):
         jobs = DownloaderJob.objects.order_by('id')
         self.assertEqual(1, DownloaderJob.objects.all().count())
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_retrying_lost_downloader_jobs_time(self, mock_send_job):
         mock_send_job.return_value = True
 
@@ -290,13 +292,13 @@ class ForemanTestCase(TestCase):
         retried_job = jobs[1]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_not_retrying_lost_downloader_jobs(self, mock_nomad, mock_send_job):
         """Make sure that we don't retry downloader jobs we shouldn't."""
         mock_send_job.return_value = True
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -355,7 +357,7 @@ class ForemanTestCase(TestCase):
         return job
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_requeuing_processor_job(self, mock_send_job, mock_get_active_volumes):
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
@@ -375,7 +377,7 @@ class ForemanTestCase(TestCase):
         self.assertEqual(retried_job.num_retries, 1)
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_requeuing_processor_job_w_more_ram(self, mock_send_job, mock_get_active_volumes):
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
@@ -395,8 +397,53 @@ class ForemanTestCase(TestCase):
         self.assertEqual(original_job.ram_amount, 16384)
         self.assertEqual(retried_job.ram_amount, 32768)
 
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    def test_bulk_requeue_processor_jobs(self, mock_send_job):
+        jobs = [self.create_processor_job(pipeline="SALMON", ram_amount=12288) for i in range(6)]
+        for job in jobs:
+            job.success = False
+            job.save()
+
+        dataset = Dataset()
+        dataset.save()
+        ProcessorJobDatasetAssociation(processor_job=jobs[0], dataset=dataset).save()
+
+        # Every other dispatch fails.
+        def send_job(job_type, job, **kwargs):
+            self.assertFalse(kwargs["persist"])
+            if job.id % 2:
+                raise Exception("Nomad is down")
+
+            job.nomad_job_id = "SALMON_1_16384/dispatch-" + str(job.id)
+            return True
+
+        mock_send_job.side_effect = send_job
+
+        jobs_dispatched = main.handle_processor_jobs(jobs)
+        self.assertEqual(len(mock_send_job.mock_calls), 6)
+        self.assertEqual(jobs_dispatched, 3)
+
+        # The jobs which couldn't be dispatched are left for a later loop.
+        retried_jobs = ProcessorJob.objects.filter(num_retries=1)
+        self.assertEqual(retried_jobs.count(), 3)
+        self.assertEqual(ProcessorJob.objects.filter(retried=False, num_retries=0).count(), 3)
+
+        for retried_job in retried_jobs:
+            self.assertEqual(retried_job.ram_amount, 16384)
+            self.assertEqual(retried_job.nomad_job_id, "SALMON_1_16384/dispatch-" + str(retried_job.id))
+            self.assertEqual(retried_job.original_files.count(), 2)
+
+            original_job = ProcessorJob.objects.get(retried_job=retried_job)
+            self.assertTrue(original_job.retried)
+            self.assertFalse(original_job.success)
+
+        # Associations for the jobs that were deleted went with them.
+        self.assertEqual(ProcessorJobOriginalFileAssociation.objects.count(), 6 * 2 + 3 * 2)
+        self.assertEqual(ProcessorJobDatasetAssociation.objects.count(),
+                         2 if jobs[0].retried else 1)
+
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_repeated_processor_failures(self, mock_send_job, mock_get_active_volumes):
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
@@ -427,7 +474,7 @@ class ForemanTestCase(TestCase):
         self.assertFalse(last_job.success)
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_retrying_failed_processor_jobs(self, mock_send_job, mock_get_active_volumes):
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
@@ -449,7 +496,7 @@ class ForemanTestCase(TestCase):
         self.assertEqual(retried_job.num_retries, 1)
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_not_retrying_wrong_volume_index(self, mock_send_job, mock_get_active_volumes):
         """If a volume isn't mounted then we shouldn't queue jobs for it."""
         mock_send_job.return_value = True
@@ -471,13 +518,13 @@ class ForemanTestCase(TestCase):
         self.assertEqual(len(jobs), 1)
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_retrying_hung_processor_jobs(self, mock_nomad, mock_send_job, mock_get_active_volumes):
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -503,14 +550,49 @@ class ForemanTestCase(TestCase):
         self.assertEqual(retried_job.num_retries, 1)
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
+    def test_hung_processor_job_oom_killed(self, mock_nomad, mock_send_job, mock_get_active_volumes):
+        mock_send_job.return_value = True
+        mock_get_active_volumes.return_value = {"1", "2", "3"}
+
+        def mock_init_nomad():
+            ret_value = MagicMock()
+            ret_value.job.get_job.side_effect = lambda _: {"Status": "dead"}
+            ret_value.job.get_allocations.side_effect = lambda _: [{
+                "TaskStates": {
+                    "affy_to_pcl": {"Events": [
+                        {"Type": "Started", "Details": {}},
+                        {"Type": "Terminated", "Details": {"exit_code": "137", "oom_killed": "true"}},
+                    ]},
+                },
+            }]
+            return ret_value
+
+        mock_nomad.side_effect = mock_init_nomad
+
+        job = self.create_processor_job()
+        job.start_time = timezone.now()
+        job.save()
+
+        main.retry_hung_processor_jobs()
+        self.assertEqual(len(mock_send_job.mock_calls), 1)
+
+        # The job never got to record its own memory usage, so it's
+        # recorded as having used all of its RAM.
+        original_job = ProcessorJob.objects.order_by('id')[0]
+        self.assertTrue(original_job.retried)
+        self.assertEqual(original_job.peak_memory, original_job.ram_amount)
+
+    @patch('data_refinery_foreman.foreman.main.get_active_volumes')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_not_retrying_hung_processor_jobs(self, mock_nomad, mock_send_job, mock_get_active_volumes):
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
 
         """Tests that we don't restart processor jobs that are still running."""
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -535,13 +617,13 @@ class ForemanTestCase(TestCase):
         self.assertEqual(jobs.count(), 1)
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_retrying_lost_processor_jobs(self, mock_nomad, mock_send_job, mock_get_active_volumes):
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -568,13 +650,13 @@ class ForemanTestCase(TestCase):
         self.assertEqual(retried_job.num_retries, 1)
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_retrying_lost_smasher_jobs(self, mock_nomad, mock_send_job, mock_get_active_volumes):
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -600,13 +682,13 @@ class ForemanTestCase(TestCase):
         retried_job = jobs[1]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_not_retrying_old_processor_jobs(self, mock_nomad, mock_send_job):
         """Makes sure temporary logic to limit the Foreman's scope works."""
         mock_send_job.return_value = True
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -626,14 +708,14 @@ class ForemanTestCase(TestCase):
         self.assertEqual(1, ProcessorJob.objects.all().count())
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_not_retrying_lost_processor_jobs(self, mock_nomad, mock_send_job, mock_get_active_volumes):
         """Make sure that we don't retry processor jobs we shouldn't."""
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -659,7 +741,7 @@ class ForemanTestCase(TestCase):
         self.assertEqual(jobs.count(), 1)
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_retrying_lost_processor_jobs_time(self, mock_send_job, mock_get_active_volumes):
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
@@ -682,7 +764,7 @@ class ForemanTestCase(TestCase):
 
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_not_retrying_janitor_jobs(self, mock_send_job, mock_get_active_volumes):
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
@@ -712,7 +794,7 @@ class ForemanTestCase(TestCase):
 
         return job
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_requeuing_survey_job(self, mock_send_job):
         mock_send_job.return_value = True
 
@@ -730,7 +812,7 @@ class ForemanTestCase(TestCase):
         retried_job = jobs[1]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_repeated_survey_failures(self, mock_send_job):
         """Jobs will be repeatedly retried."""
         mock_send_job.return_value = True
@@ -773,7 +855,7 @@ class ForemanTestCase(TestCase):
             result = main.requeue_survey_job(job)
             self.assertTrue(result)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_retrying_failed_survey_jobs(self, mock_send_job):
         mock_send_job.return_value = True
 
@@ -793,12 +875,12 @@ class ForemanTestCase(TestCase):
         retried_job = jobs[1]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_retrying_hung_survey_jobs(self, mock_nomad, mock_send_job):
         mock_send_job.return_value = True
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -823,13 +905,13 @@ class ForemanTestCase(TestCase):
         retried_job = jobs[1]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_not_retrying_hung_survey_jobs(self, mock_nomad, mock_send_job):
         """Tests that we don't restart survey jobs that are still running."""
         mock_send_job.return_value = True
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -853,12 +935,12 @@ class ForemanTestCase(TestCase):
 
         self.assertEqual(jobs.count(), 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_retrying_lost_survey_jobs(self, mock_nomad, mock_send_job):
         mock_send_job.return_value = True
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -884,13 +966,13 @@ class ForemanTestCase(TestCase):
         retried_job = jobs[1]
         self.assertEqual(retried_job.num_retries, 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_not_retrying_old_survey_jobs(self, mock_nomad, mock_send_job):
         """Makes sure temporary logic to limit the Foreman's scope works."""
         mock_send_job.return_value = True
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -909,13 +991,13 @@ class ForemanTestCase(TestCase):
         jobs = SurveyJob.objects.order_by('id')
         self.assertEqual(1, SurveyJob.objects.all().count())
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
-    @patch('data_refinery_foreman.foreman.main.Nomad')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch('data_refinery_foreman.foreman.main.get_nomad_client')
     def test_not_retrying_lost_survey_jobs(self, mock_nomad, mock_send_job):
         """Make sure that we don't retry survey jobs we shouldn't."""
         mock_send_job.return_value = True
 
-        def mock_init_nomad(host, port=0, timeout=0):
+        def mock_init_nomad():
             ret_value = MagicMock()
             ret_value.job = MagicMock()
             ret_value.job.get_job = MagicMock()
@@ -940,7 +1022,7 @@ class ForemanTestCase(TestCase):
         # Make sure no additional job was created.
         self.assertEqual(jobs.count(), 1)
 
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_retrying_lost_survey_jobs_time(self, mock_send_job):
         mock_send_job.return_value = True
 
@@ -961,7 +1043,7 @@ class ForemanTestCase(TestCase):
         self.assertEqual(retried_job.num_retries, 1)
 
     @patch('data_refinery_foreman.foreman.main.get_active_volumes')
-    @patch('data_refinery_foreman.foreman.main.send_job')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
     def test_janitor(self, mock_send_job, mock_get_active_volumes):
         mock_send_job.return_value = True
         mock_get_active_volumes.return_value = {"1", "2", "3"}
@@ -982,9 +1064,424 @@ class ForemanTestCase(TestCase):
             self.assertTrue(p.volume_index in ixs)
             ixs.remove(p.volume_index)
 
+    @patch('data_refinery_foreman.foreman.main.get_active_volumes')
+    def test_cluster_state(self, mock_get_active_volumes):
+        mock_get_active_volumes.return_value = {"1", "2"}
+        mock_nomad = MagicMock()
+        mock_nomad.jobs.get_jobs.return_value = [
+            {"ID": "DOWNLOADER", "ParameterizedJob": True,
+             "JobSummary": {"Children": {"Pending": 3, "Running": 2, "Dead": 10}}},
+            {"ID": "DOWNLOADER/dispatch-1528945054-e8eaf540", "ParameterizedJob": False,
+             "JobSummary": {}},
+            {"ID": "SALMON_1_12288", "ParameterizedJob": True,
+             "JobSummary": {"Children": {"Pending": 4, "Running": 1, "Dead": 0}}},
+        ]
+
+        cluster_state = main.ClusterState(mock_nomad)
+        self.assertEqual(cluster_state.active_volumes, {"1", "2"})
+        self.assertEqual(cluster_state.count_jobs(), 3)
+        self.assertEqual(cluster_state.count_downloader_jobs_in_queue(), 5)
+
+        cluster_state.record_dispatched(4, "downloader")
+        cluster_state.record_dispatched(2, "processor")
+        self.assertEqual(cluster_state.count_jobs(), 9)
+        self.assertEqual(cluster_state.count_downloader_jobs_in_queue(), 9)
+
+        # Nomad was only asked once, no matter how often it was counted.
+        mock_nomad.jobs.get_jobs.assert_called_once_with()
+
+        # If Nomad can't be reached nothing should be queued.
+        mock_nomad.jobs.get_jobs.side_effect = Exception("Nomad is down")
+        cluster_state.refresh()
+        self.assertTrue(main.get_capacity_for_processor_jobs(cluster_state) <= 0)
+        self.assertTrue(main.get_capacity_for_downloader_jobs(cluster_state) <= 0)
+
+    @patch('data_refinery_foreman.foreman.main.get_active_volumes')
+    @patch('data_refinery_foreman.foreman.main.get_max_downloader_jobs')
+    def test_run_passes(self, mock_get_max_downloader_jobs, mock_get_active_volumes):
+        mock_get_active_volumes.return_value = set()
+        mock_get_max_downloader_jobs.return_value = 100
+        mock_nomad = MagicMock()
+        mock_nomad.jobs.get_jobs.return_value = []
+
+        cluster_state = main.ClusterState(mock_nomad)
+        self.env = EnvironmentVarGuard()
+        self.env.set('MAX_TOTAL_JOBS', '1000')
+        with self.env:
+            self.assertEqual(cluster_state.partition_capacity(),
+                             {"processor": 900, "downloader": 100, "survey": 100})
+
+        def fast_pass(cluster_state):
+            # Only the processor share of the capacity is available.
+            self.assertEqual(main.get_capacity_for_processor_jobs(cluster_state), 900)
+            cluster_state.record_dispatched(3, "processor")
+            self.assertEqual(main.get_capacity_for_processor_jobs(cluster_state), 897)
+
+        pages_handled = []
+        def slow_pass(cluster_state):
+            # Passes stop between pages once they run out of time.
+            while not cluster_state.is_out_of_time():
+                pages_handled.append(1)
+                time.sleep(0.1)
+
+        def broken_pass(cluster_state):
+            raise Exception("Nomad is down")
+
+        metrics = main.run_passes([fast_pass, slow_pass, broken_pass],
+                                  cluster_state,
+                                  datetime.timedelta(seconds=0.5))
+
+        self.assertEqual([pass_metrics["pass_name"] for pass_metrics in metrics],
+                         ["fast_pass", "slow_pass", "broken_pass"])
+        self.assertEqual(metrics[0]["jobs_dispatched"], 3)
+        self.assertFalse(metrics[0]["out_of_time"])
+        self.assertTrue(metrics[1]["out_of_time"])
+        self.assertTrue(len(pages_handled) < 10)
+        self.assertEqual(metrics[2]["jobs_dispatched"], 0)
+        self.assertEqual(main.LAST_PASS_METRICS["fast_pass"], metrics[0])
+
+        # Outside of a pass there's no time budget.
+        self.assertFalse(cluster_state.is_out_of_time())
+
+    @patch('data_refinery_foreman.foreman.main.get_active_volumes')
+    def test_get_job_statuses(self, mock_get_active_volumes):
+        mock_get_active_volumes.return_value = set()
+        mock_nomad = MagicMock()
+        mock_nomad.jobs.get_jobs.return_value = [
+            {"ID": "PROCESSOR/dispatch-1", "ParameterizedJob": False, "Status": "running"},
+        ]
+
+        def get_job(nomad_job_id):
+            if nomad_job_id == "PROCESSOR/dispatch-2":
+                return {"Status": "pending"}
+            elif nomad_job_id == "PROCESSOR/dispatch-3":
+                raise main.URLNotFoundNomadException(MagicMock())
+            else:
+                raise socket.timeout()
+
+        mock_nomad.job.get_job.side_effect = get_job
+
+        cluster_state = main.ClusterState(mock_nomad)
+        statuses = cluster_state.get_job_statuses([
+            "PROCESSOR/dispatch-1",
+            "PROCESSOR/dispatch-2",
+            "PROCESSOR/dispatch-3",
+            "PROCESSOR/dispatch-4",
+            None,
+        ])
+
+        # Jobs in the job list aren't looked up again, jobs Nomad
+        # doesn't know about have no status, and jobs it couldn't be
+        # asked about are left out.
+        self.assertEqual(statuses, {
+            "PROCESSOR/dispatch-1": "running",
+            "PROCESSOR/dispatch-2": "pending",
+            "PROCESSOR/dispatch-3": None,
+        })
+        self.assertEqual(mock_nomad.job.get_job.call_count, 3)
+
+    @patch('data_refinery_foreman.foreman.main.get_active_volumes')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    def test_hung_pass_rechecks_stale_statuses(self, mock_send_job, mock_get_active_volumes):
+        mock_send_job.return_value = True
+        mock_get_active_volumes.return_value = {"1"}
+
+        job = self.create_processor_job()
+        mock_nomad = MagicMock()
+        mock_nomad.jobs.get_jobs.return_value = [
+            {"ID": job.nomad_job_id, "ParameterizedJob": False, "Status": "pending"},
+        ]
+        mock_nomad.job.get_job.return_value = {"Status": "running"}
+        cluster_state = main.ClusterState(mock_nomad)
+
+        # The job started after the job list was fetched.
+        job.start_time = timezone.now()
+        job.save()
+
+        main.retry_hung_processor_jobs(cluster_state)
+
+        mock_nomad.job.get_job.assert_called_once_with(job.nomad_job_id)
+        self.assertEqual(len(mock_send_job.mock_calls), 0)
+        job.refresh_from_db()
+        self.assertFalse(job.retried)
+
+    def test_nomad_job_watcher(self):
+        mock_nomad = MagicMock()
+        responses = [
+            ({"X-Nomad-Index": "10"}, [
+                {"ID": "SALMON_1_12288", "ModifyIndex": 2, "Status": "running"},
+                {"ID": "SALMON_1_12288/dispatch-1", "ModifyIndex": 8, "Status": "running"},
+            ]),
+            ({"X-Nomad-Index": "12"}, [
+                {"ID": "SALMON_1_12288", "ModifyIndex": 2, "Status": "running"},
+                {"ID": "SALMON_1_12288/dispatch-1", "ModifyIndex": 12, "Status": "dead"},
+            ]),
+            # A new leader was elected.
+            ({"X-Nomad-Index": "5"}, [
+                {"ID": "SALMON_1_12288", "ModifyIndex": 2, "Status": "running"},
+            ]),
+        ]
+
+        def request(**kwargs):
+            headers, jobs = responses.pop(0)
+            return MagicMock(headers=headers, json=MagicMock(return_value=jobs))
+
+        mock_nomad.jobs.request.side_effect = request
+
+        watcher = main.NomadJobWatcher(mock_nomad)
+        jobs, changed_jobs = watcher.wait_for_changes()
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(len(changed_jobs), 2)
+        self.assertEqual(mock_nomad.jobs.request.call_args[1]["params"]["index"], 0)
+
+        jobs, changed_jobs = watcher.wait_for_changes()
+        self.assertEqual(mock_nomad.jobs.request.call_args[1]["params"]["index"], 10)
+        self.assertEqual([job["ID"] for job in changed_jobs], ["SALMON_1_12288/dispatch-1"])
+
+        jobs, changed_jobs = watcher.wait_for_changes()
+        self.assertEqual(len(changed_jobs), 1)
+        self.assertEqual(watcher.index, 5)
+
+    @patch('data_refinery_foreman.foreman.main.get_active_volumes')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    def test_handle_job_changes(self, mock_send_job, mock_get_active_volumes):
+        mock_send_job.return_value = True
+        mock_get_active_volumes.return_value = {"1"}
+
+        died_job = self.create_processor_job()
+        died_job.nomad_job_id = "AFFY_TO_PCL_1_2048/dispatch-1"
+        died_job.start_time = timezone.now()
+        died_job.save()
+
+        finished_job = self.create_processor_job()
+        finished_job.nomad_job_id = "AFFY_TO_PCL_1_2048/dispatch-2"
+        finished_job.start_time = timezone.now()
+        finished_job.end_time = timezone.now()
+        finished_job.success = True
+        finished_job.save()
+
+        running_job = self.create_downloader_job()
+        running_job.nomad_job_id = "DOWNLOADER_1024/dispatch-3"
+        running_job.save()
+
+        jobs = [
+            {"ID": "AFFY_TO_PCL_1_2048", "ParentID": "", "Status": "running"},
+            {"ID": "AFFY_TO_PCL_1_2048/dispatch-1", "ParentID": "AFFY_TO_PCL_1_2048", "Status": "dead"},
+            {"ID": "AFFY_TO_PCL_1_2048/dispatch-2", "ParentID": "AFFY_TO_PCL_1_2048", "Status": "dead"},
+            {"ID": "DOWNLOADER_1024/dispatch-3", "ParentID": "DOWNLOADER_1024", "Status": "running"},
+        ]
+
+        mock_nomad = MagicMock()
+        mock_nomad.jobs.get_jobs.return_value = []
+        cluster_state = main.ClusterState(mock_nomad)
+        cluster_state.record_dispatched(5, "processor")
+
+        num_terminated = main.handle_job_changes(cluster_state, jobs, jobs)
+
+        self.assertEqual(num_terminated, {"processor": 1, "downloader": 0, "survey": 0})
+        self.assertEqual(cluster_state.job_statuses["DOWNLOADER_1024/dispatch-3"], "running")
+        # The jobs dispatched earlier are in the new job list, so only
+        # the retry is counted on top of it.
+        self.assertEqual(cluster_state.count_jobs(), len(jobs) + 1)
+
+        # The job whose Nomad job died was retried straight away.
+        died_job.refresh_from_db()
+        self.assertFalse(died_job.success)
+        self.assertTrue(died_job.retried)
+        self.assertEqual(len(mock_send_job.mock_calls), 1)
+
+        finished_job.refresh_from_db()
+        self.assertTrue(finished_job.success)
+        running_job.refresh_from_db()
+        self.assertIsNone(running_job.success)
+
+    @patch('data_refinery_foreman.foreman.main.get_active_volumes')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    def test_handle_job_changes_worker_reported_failure(self, mock_send_job, mock_get_active_volumes):
+        mock_send_job.return_value = True
+        mock_get_active_volumes.return_value = {"1"}
+
+        # The worker recorded the failure itself before its Nomad job ended.
+        failed_job = self.create_processor_job()
+        failed_job.nomad_job_id = "AFFY_TO_PCL_1_2048/dispatch-1"
+        failed_job.start_time = timezone.now()
+        failed_job.end_time = timezone.now()
+        failed_job.success = False
+        failed_job.failure_reason = "Could not read the CEL file."
+        failed_job.save()
+
+        jobs = [
+            {"ID": "AFFY_TO_PCL_1_2048", "ParentID": "", "Status": "running"},
+            {"ID": "AFFY_TO_PCL_1_2048/dispatch-1", "ParentID": "AFFY_TO_PCL_1_2048", "Status": "dead"},
+        ]
+
+        mock_nomad = MagicMock()
+        mock_nomad.jobs.get_jobs.return_value = []
+        cluster_state = main.ClusterState(mock_nomad)
+
+        num_failed = main.handle_job_changes(cluster_state, jobs, jobs)
+
+        self.assertEqual(num_failed, {"processor": 1, "downloader": 0, "survey": 0})
+
+        # It was retried without waiting for the next sweep, and the
+        # worker's failure reason was kept.
+        failed_job.refresh_from_db()
+        self.assertTrue(failed_job.retried)
+        self.assertEqual(failed_job.failure_reason, "Could not read the CEL file.")
+        self.assertEqual(len(mock_send_job.mock_calls), 1)
+
+    @patch('data_refinery_foreman.foreman.main.get_active_volumes')
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    def test_handle_job_changes_folded_job(self, mock_send_job, mock_get_active_volumes):
+        mock_send_job.return_value = True
+        mock_get_active_volumes.return_value = {"1"}
+
+        batch_job = self.create_processor_job(pipeline="SALMON_BATCH")
+        batch_job.nomad_job_id = "SALMON_BATCH_1_16384/dispatch-2"
+        batch_job.save()
+
+        # The folded job's own Nomad job exits without starting it,
+        # leaving it to the batch.
+        folded_job = self.create_processor_job(pipeline="SALMON")
+        folded_job.nomad_job_id = "SALMON_1_12288/dispatch-1"
+        folded_job.retried_job = batch_job
+        folded_job.save()
+
+        jobs = [
+            {"ID": "SALMON_1_12288", "ParentID": "", "Status": "running"},
+            {"ID": "SALMON_1_12288/dispatch-1", "ParentID": "SALMON_1_12288", "Status": "dead"},
+        ]
+
+        mock_nomad = MagicMock()
+        mock_nomad.jobs.get_jobs.return_value = []
+        cluster_state = main.ClusterState(mock_nomad)
+
+        num_failed = main.handle_job_changes(cluster_state, jobs, jobs)
+        self.assertEqual(num_failed, {"processor": 0, "downloader": 0, "survey": 0})
+
+        # It's still there for the batch to close out.
+        folded_job.refresh_from_db()
+        self.assertIsNone(folded_job.success)
+        self.assertFalse(folded_job.retried)
+        self.assertEqual(len(mock_send_job.mock_calls), 0)
+
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    def test_folded_jobs_follow_their_batch(self, mock_send_job):
+        mock_send_job.return_value = True
+
+        batch_job = self.create_processor_job(pipeline="SALMON_BATCH")
+        batch_job.success = False
+        batch_job.save()
+
+        folded_job = self.create_processor_job(pipeline="SALMON")
+        folded_job.retried_job = batch_job
+        folded_job.save()
+
+        # The retry of the batch takes its folded jobs over.
+        main.handle_processor_jobs([batch_job])
+        batch_job.refresh_from_db()
+        folded_job.refresh_from_db()
+        self.assertTrue(batch_job.retried)
+        self.assertEqual(folded_job.retried_job, batch_job.retried_job)
+
+        # Once the batch is given up on they're run by themselves.
+        retried_batch_job = batch_job.retried_job
+        retried_batch_job.success = False
+        retried_batch_job.num_retries = main.MAX_NUM_RETRIES
+        retried_batch_job.save()
+        main.handle_processor_jobs([retried_batch_job])
+
+        folded_job.refresh_from_db()
+        self.assertIsNone(folded_job.retried_job)
+        self.assertFalse(folded_job.retried)
+        self.assertIn(folded_job, main.get_lost_processor_jobs({"1"}))
+
     def test_get_max_downloader_jobs(self):
         self.assertNotEqual(main.get_max_downloader_jobs(), 0)
 
+    @patch.dict('data_refinery_foreman.foreman.main.NODE_DOWNLOADER_LIMITS', clear=True)
+    @patch.dict('data_refinery_foreman.foreman.main.SOURCE_DOWNLOADER_LIMITS', clear=True)
+    @patch.dict('data_refinery_foreman.foreman.main.LAST_SOURCE_THROUGHPUT', clear=True)
+    @patch.dict('data_refinery_foreman.foreman.main.LAST_NODE_THROUGHPUT', clear=True)
+    def test_update_downloader_limits(self):
+        def create_finished_job(downloader_task, worker_id, success, disk_usage):
+            job = DownloaderJob(downloader_task=downloader_task,
+                                worker_id=worker_id,
+                                start_time=timezone.now() - datetime.timedelta(minutes=2),
+                                end_time=timezone.now(),
+                                success=success,
+                                bytes_downloaded=1024 * 1024 if success else 0,
+                                volume_disk_usage=disk_usage)
+            job.save()
+
+        # ArrayExpress is failing most of its jobs and the second
+        # node's volume is nearly full.
+        for i in range(10):
+            create_finished_job("SRA", "node-1", True, 0.5)
+            create_finished_job("ARRAY_EXPRESS", "node-2", i < 2, 0.95)
+
+        # The first node is running as many jobs as it's allowed to.
+        for i in range(main.DOWNLOADER_JOBS_PER_NODE):
+            DownloaderJob(downloader_task="SRA",
+                          worker_id="node-1",
+                          nomad_job_id="DOWNLOADER/dispatch-" + str(i),
+                          start_time=timezone.now()).save()
+
+        main.update_downloader_limits()
+
+        self.assertEqual(main.NODE_DOWNLOADER_LIMITS["node-1"],
+                         main.DOWNLOADER_JOBS_PER_NODE + main.DOWNLOADER_LIMIT_INCREASE)
+        self.assertEqual(main.NODE_DOWNLOADER_LIMITS["node-2"],
+                         int(main.DOWNLOADER_JOBS_PER_NODE * main.DOWNLOADER_LIMIT_DECREASE_FACTOR))
+        self.assertEqual(main.SOURCE_DOWNLOADER_LIMITS["SRA"], main.HARD_MAX_DOWNLOADER_JOBS)
+        self.assertEqual(main.SOURCE_DOWNLOADER_LIMITS["ARRAY_EXPRESS"],
+                         int(main.HARD_MAX_DOWNLOADER_JOBS * main.DOWNLOADER_LIMIT_DECREASE_FACTOR))
+
+        # A third node which hasn't reported yet gets the default.
+        self.assertEqual(main.get_total_downloader_limit(3),
+                         main.NODE_DOWNLOADER_LIMITS["node-1"]
+                         + main.NODE_DOWNLOADER_LIMITS["node-2"]
+                         + main.DOWNLOADER_JOBS_PER_NODE)
+
+    @patch.dict('data_refinery_foreman.foreman.main.NODE_DOWNLOADER_LIMITS', clear=True)
+    @patch.dict('data_refinery_foreman.foreman.main.SOURCE_DOWNLOADER_LIMITS', clear=True)
+    @patch.dict('data_refinery_foreman.foreman.main.LAST_SOURCE_THROUGHPUT', clear=True)
+    @patch.dict('data_refinery_foreman.foreman.main.LAST_NODE_THROUGHPUT', clear=True)
+    def test_unsaturated_node_keeps_downloader_limit(self):
+        for i in range(10):
+            DownloaderJob(downloader_task="SRA",
+                          worker_id="node-1",
+                          start_time=timezone.now() - datetime.timedelta(minutes=2),
+                          end_time=timezone.now(),
+                          success=True,
+                          bytes_downloaded=1024 * 1024,
+                          volume_disk_usage=0.5).save()
+
+        # Only a couple of jobs are running on it, well under its limit.
+        for i in range(2):
+            DownloaderJob(downloader_task="SRA",
+                          worker_id="node-1",
+                          nomad_job_id="DOWNLOADER/dispatch-" + str(i),
+                          start_time=timezone.now()).save()
+
+        main.update_downloader_limits()
+        main.update_downloader_limits()
+
+        self.assertEqual(main.NODE_DOWNLOADER_LIMITS["node-1"], main.DOWNLOADER_JOBS_PER_NODE)
+
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    @patch.dict('data_refinery_foreman.foreman.main.SOURCE_DOWNLOADER_LIMITS', {"SRA": 1})
+    def test_source_downloader_limit(self, mock_send_job):
+        mock_send_job.return_value = True
+
+        jobs = [self.create_downloader_job(str(i)) for i in range(3)]
+        for job in jobs:
+            job.success = False
+            job.save()
+
+        main.handle_downloader_jobs(jobs)
+        self.assertEqual(len(mock_send_job.mock_calls), 1)
+
     def test_cleandb(self):
 
         sample = Sample()
@@ -1026,355 +1523,422 @@ class ForemanTestCase(TestCase):
         main.clean_database()
         self.assertEqual(sample.get_most_recent_smashable_result_file().id, 1)
 
-# class JobPrioritizationTestCase(TestCase):
-#     def setUp(self):
-#         """Create a lot of resources that could be associated with either
-#         ProcessorJobs or DownloaderJobs. Since the logic of when to actually
-#         queue these is the same, we can use these for testing both. However
-#         The actual jobs that will be queued need to be created by the job-type
-#         specific functions.
-#         """
-#         human = Organism(name="HOMO_SAPIENS", taxonomy_id=9606, is_scientific_name=True)
-#         human.save()
-#         zebrafish = Organism(name="DANIO_RERIO", taxonomy_id=1337, is_scientific_name=True)
-#         zebrafish.save()
-
-#         # Salmon experiment that is 50% complete.
-#         experiment = Experiment(accession_code='ERP036000')
-#         experiment.save()
-
-#         ## First sample, this one has been processed.
-#         pj = ProcessorJob()
-#         pj.accession_code = "ERR036000"
-#         pj.pipeline_applied = "SALMON"
-#         pj.success = True
-#         pj.save()
-
-#         og = OriginalFile()
-#         og.filename = "ERR036000.fastq.gz"
-#         og.source_filename = "ERR036000.fastq.gz"
-#         og.source_url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR036/ERR036000/ERR036000_1.fastq.gz"
-#         og.is_archive = True
-#         og.save()
-
-#         sample = Sample()
-#         sample.accession_code = 'ERR036000'
-#         sample.organism = human
-#         sample.save()
-
-#         assoc = OriginalFileSampleAssociation()
-#         assoc.sample = sample
-#         assoc.original_file = og
-#         assoc.save()
-
-#         assoc = ProcessorJobOriginalFileAssociation()
-#         assoc.processor_job = pj
-#         assoc.original_file = og
-#         assoc.save()
-
-#         assoc = ExperimentSampleAssociation()
-#         assoc.sample = sample
-#         assoc.experiment = experiment
-#         assoc.save()
-
-#         ## Second sample, this one hasn't been processed.
-#         self.in_progress_salmon_og = OriginalFile()
-#         self.in_progress_salmon_og.filename = "ERR036001.fastq.gz"
-#         self.in_progress_salmon_og.source_filename = "ERR036001.fastq.gz"
-#         self.in_progress_salmon_og.source_url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR036/ERR036001/ERR036001_1.fastq.gz"
-#         self.in_progress_salmon_og.is_archive = True
-#         self.in_progress_salmon_og.save()
-
-#         self.in_progress_salmon_sample = Sample()
-#         self.in_progress_salmon_sample.accession_code = 'ERR036001'
-#         self.in_progress_salmon_sample.organism = human
-#         self.in_progress_salmon_sample.save()
-
-#         assoc = OriginalFileSampleAssociation()
-#         assoc.sample = self.in_progress_salmon_sample
-#         assoc.original_file = self.in_progress_salmon_og
-#         assoc.save()
-
-#         assoc = ExperimentSampleAssociation()
-#         assoc.sample = self.in_progress_salmon_sample
-#         assoc.experiment = experiment
-#         assoc.save()
-
-
-#         # Salmon experiment that is 0% complete.
-#         experiment = Experiment(accession_code='ERP037000')
-#         experiment.save()
-
-#         self.unstarted_salmon_og = OriginalFile()
-#         self.unstarted_salmon_og.filename = "ERR037001.fastq.gz"
-#         self.unstarted_salmon_og.source_filename = "ERR037001.fastq.gz"
-#         self.unstarted_salmon_og.source_url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR037/ERR037001/ERR037001_1.fastq.gz"
-#         self.unstarted_salmon_og.is_archive = True
-#         self.unstarted_salmon_og.save()
-
-#         self.unstarted_salmon_sample = Sample()
-#         self.unstarted_salmon_sample.accession_code = 'ERR037001'
-#         self.unstarted_salmon_sample.organism = human
-#         self.unstarted_salmon_sample.save()
-
-#         assoc = OriginalFileSampleAssociation()
-#         assoc.sample = self.unstarted_salmon_sample
-#         assoc.original_file = self.unstarted_salmon_og
-#         assoc.save()
-
-#         assoc = ExperimentSampleAssociation()
-#         assoc.sample = self.unstarted_salmon_sample
-#         assoc.experiment = experiment
-#         assoc.save()
-
-
-#         # Zebrafish experiment.
-#         experiment = Experiment(accession_code='ERP038000')
-#         experiment.save()
-
-#         self.zebrafish_og = OriginalFile()
-#         self.zebrafish_og.source_filename = "ERR038001.fastq.gz"
-#         self.zebrafish_og.source_url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR038/ERR038001/ERR038001_1.fastq.gz"
-#         self.zebrafish_og.is_archive = True
-#         self.zebrafish_og.save()
-
-#         self.zebrafish_sample = Sample()
-#         self.zebrafish_sample.accession_code = 'ERR038001'
-#         self.zebrafish_sample.organism = zebrafish
-#         self.zebrafish_sample.save()
-
-#         assoc = OriginalFileSampleAssociation()
-#         assoc.sample = self.zebrafish_sample
-#         assoc.original_file = self.zebrafish_og
-#         assoc.save()
-
-#         assoc = ExperimentSampleAssociation()
-#         assoc.sample = self.zebrafish_sample
-#         assoc.experiment = experiment
-#         assoc.save()
-
-
-#         # Pediatric experiment.
-#         experiment = Experiment(accession_code='GSE100568')
-#         experiment.save()
-
-#         self.pediatric_og = OriginalFile()
-#         self.pediatric_og.source_url = "https://www.ncbi.nlm.nih.gov/geo/download/?acc=GSE100568&format=file"
-#         self.pediatric_og.is_archive = True
-#         self.pediatric_og.save()
-
-#         self.pediatric_sample = Sample()
-#         self.pediatric_sample.accession_code = 'GSM2687180'
-#         self.pediatric_sample.organism = human
-#         self.pediatric_sample.save()
-
-#         assoc = OriginalFileSampleAssociation()
-#         assoc.sample = self.pediatric_sample
-#         assoc.original_file = self.pediatric_og
-#         assoc.save()
-
-#         assoc = ExperimentSampleAssociation()
-#         assoc.sample = self.pediatric_sample
-#         assoc.experiment = experiment
-#         assoc.save()
-
-
-#         # hgu133plus2 experiment.
-#         experiment = Experiment(accession_code='GSE100014')
-#         experiment.save()
-
-#         self.hgu133plus2_og = OriginalFile()
-#         self.hgu133plus2_og.source_url = "https://www.ncbi.nlm.nih.gov/geo/download/?acc=GSE100014&format=file"
-#         self.hgu133plus2_og.is_archive = True
-#         self.hgu133plus2_og.save()
-
-#         self.hgu133plus2_sample = Sample()
-#         self.hgu133plus2_sample.accession_code = 'GSM2667926'
-#         self.hgu133plus2_sample.organism = human
-#         self.hgu133plus2_sample.save()
-
-#         assoc = OriginalFileSampleAssociation()
-#         assoc.sample = self.hgu133plus2_sample
-#         assoc.original_file = self.hgu133plus2_og
-#         assoc.save()
-
-#         assoc = ExperimentSampleAssociation()
-#         assoc.sample = self.hgu133plus2_sample
-#         assoc.experiment = experiment
-#         assoc.save()
-
-#     @patch('data_refinery_foreman.foreman.main.Nomad')
-#     @patch('data_refinery_foreman.foreman.main.requeue_downloader_job')
-#     def test_handle_downloader_jobs(self, mock_requeue_downloader_job, mock_nomad):
-#         """Tests the prioritization of downloader jobs.
-
-#         We want zebrafish jobs to be first, then jobs for hgu133plus2,
-#         then jobs for pediatric cancer, finally salmon jobs should be
-#         prioritized based on how close to completion they are."""
-
-#         def mock_init_nomad(host, port=0, timeout=0):
-#             ret_value = MagicMock()
-#             ret_value.jobs = MagicMock()
-#             ret_value.jobs.get_jobs = MagicMock()
-#             ret_value.jobs.get_jobs.side_effect = lambda: []
-#             return ret_value
-
-#         mock_nomad.side_effect = mock_init_nomad
-
-#         unstarted_salmon_job = DownloaderJob()
-#         unstarted_salmon_job.accession_code = self.unstarted_salmon_sample.accession_code
-#         unstarted_salmon_job.save()
-
-#         assoc = DownloaderJobOriginalFileAssociation()
-#         assoc.downloader_job = unstarted_salmon_job
-#         assoc.original_file = self.unstarted_salmon_og
-#         assoc.save()
-
-#         in_progress_salmon_job = DownloaderJob()
-#         in_progress_salmon_job.accession_code = self.in_progress_salmon_sample.accession_code
-#         in_progress_salmon_job.save()
-
-#         assoc = DownloaderJobOriginalFileAssociation()
-#         assoc.downloader_job = in_progress_salmon_job
-#         assoc.original_file = self.in_progress_salmon_og
-#         assoc.save()
-
-#         zebrafish_job = DownloaderJob()
-#         zebrafish_job.accession_code = self.zebrafish_sample.accession_code
-#         zebrafish_job.save()
-
-#         assoc = DownloaderJobOriginalFileAssociation()
-#         assoc.downloader_job = zebrafish_job
-#         assoc.original_file = self.zebrafish_og
-#         assoc.save()
-
-#         pediatric_job = DownloaderJob()
-#         pediatric_job.accession_code = self.pediatric_sample.accession_code
-#         pediatric_job.save()
-
-#         assoc = DownloaderJobOriginalFileAssociation()
-#         assoc.downloader_job = pediatric_job
-#         assoc.original_file = self.pediatric_og
-#         assoc.save()
-
-#         hgu133plus2_job = DownloaderJob()
-#         hgu133plus2_job.accession_code = self.hgu133plus2_sample.accession_code
-#         hgu133plus2_job.save()
-
-#         assoc = DownloaderJobOriginalFileAssociation()
-#         assoc.downloader_job = hgu133plus2_job
-#         assoc.original_file = self.hgu133plus2_og
-#         assoc.save()
-
-#         jobs = [unstarted_salmon_job,
-#                 in_progress_salmon_job,
-#                 hgu133plus2_job,
-#                 zebrafish_job,
-#                 pediatric_job
-#         ]
-#         jobs_in_correct_order = [zebrafish_job,
-#                                  hgu133plus2_job,
-#                                  pediatric_job,
-#                                  in_progress_salmon_job,
-#                                  unstarted_salmon_job
-#         ]
-
-#         main.handle_downloader_jobs(jobs)
-
-#         for count, job in enumerate(jobs_in_correct_order):
-#             # Calls are a weird object that I think is just basically
-#             # a tuple. Index 1 of a call object is the arguments
-#             # tuple, we're interested in the first argument
-#             job_called_at_count = mock_requeue_downloader_job.mock_calls[count][1][0]
-#             self.assertEqual(job.id, job_called_at_count.id)
-
-
-#     @patch('data_refinery_foreman.foreman.main.Nomad')
-#     @patch('data_refinery_foreman.foreman.main.requeue_processor_job')
-#     def test_handle_processor_jobs(self, mock_requeue_processor_job, mock_nomad):
-#         """Tests the prioritization of processor jobs.
-
-#         We want zebrafish jobs to be first, then jobs for hgu133plus2,
-#         then jobs for pediatric cancer, finally salmon jobs should be
-#         prioritized based on how close to completion they are."""
-
-#         def mock_init_nomad(host, port=0, timeout=0):
-#             ret_value = MagicMock()
-#             ret_value.jobs = MagicMock()
-#             ret_value.jobs.get_jobs = MagicMock()
-#             ret_value.jobs.get_jobs.side_effect = lambda: []
-#             return ret_value
-
-#         mock_nomad.side_effect = mock_init_nomad
-
-#         unstarted_salmon_job = ProcessorJob()
-#         unstarted_salmon_job.accession_code = self.unstarted_salmon_sample.accession_code
-#         unstarted_salmon_job.pipeline_applied = "SALMON"
-#         unstarted_salmon_job.save()
-
-#         assoc = ProcessorJobOriginalFileAssociation()
-#         assoc.processor_job = unstarted_salmon_job
-#         assoc.original_file = self.unstarted_salmon_og
-#         assoc.save()
-
-#         in_progress_salmon_job = ProcessorJob()
-#         in_progress_salmon_job.accession_code = self.in_progress_salmon_sample.accession_code
-#         in_progress_salmon_job.pipeline_applied = "SALMON"
-#         in_progress_salmon_job.save()
-
-#         assoc = ProcessorJobOriginalFileAssociation()
-#         assoc.processor_job = in_progress_salmon_job
-#         assoc.original_file = self.in_progress_salmon_og
-#         assoc.save()
-
-#         zebrafish_job = ProcessorJob()
-#         zebrafish_job.accession_code = self.zebrafish_sample.accession_code
-#         zebrafish_job.pipeline_applied = "SALMON"
-#         zebrafish_job.save()
-
-#         assoc = ProcessorJobOriginalFileAssociation()
-#         assoc.processor_job = zebrafish_job
-#         assoc.original_file = self.zebrafish_og
-#         assoc.save()
-
-#         pediatric_job = ProcessorJob()
-#         pediatric_job.accession_code = self.pediatric_sample.accession_code
-#         pediatric_job.pipeline_applied = "SALMON"
-#         pediatric_job.save()
-
-#         assoc = ProcessorJobOriginalFileAssociation()
-#         assoc.processor_job = pediatric_job
-#         assoc.original_file = self.pediatric_og
-#         assoc.save()
-
-#         hgu133plus2_job = ProcessorJob()
-#         hgu133plus2_job.accession_code = self.hgu133plus2_sample.accession_code
-#         hgu133plus2_job.pipeline_applied = "SALMON"
-#         hgu133plus2_job.save()
-
-#         assoc = ProcessorJobOriginalFileAssociation()
-#         assoc.processor_job = hgu133plus2_job
-#         assoc.original_file = self.hgu133plus2_og
-#         assoc.save()
-
-#         jobs = [unstarted_salmon_job,
-#                 in_progress_salmon_job,
-#                 hgu133plus2_job,
-#                 zebrafish_job,
-#                 pediatric_job
-#         ]
-#         jobs_in_correct_order = [zebrafish_job,
-#                                  hgu133plus2_job,
-#                                  pediatric_job,
-#                                  in_progress_salmon_job,
-#                                  unstarted_salmon_job
-#         ]
-
-#         main.handle_processor_jobs(jobs)
-
-#         for count, job in enumerate(jobs_in_correct_order):
-#             # Calls are a weird object that I think is just basically
-#             # a tuple. Index 1 of a call object is the arguments
-#             # tuple, we're interested in the first argument
-#             job_called_at_count = mock_requeue_processor_job.mock_calls[count][1][0]
-#             self.assertEqual(job.id, job_called_at_count.id)
+class JobPrioritizationTestCase(TestCase):
+    def setUp(self):
+        """Create a lot of resources that could be associated with either
+        ProcessorJobs or DownloaderJobs. Since the logic of how to prioritize
+        these is the same, we can use these for testing both. However
+        The actual jobs that will be prioritized need to be created by the
+        job-type specific functions.
+        """
+        human = Organism(name="HOMO_SAPIENS", taxonomy_id=9606, is_scientific_name=True)
+        human.save()
+        zebrafish = Organism(name="DANIO_RERIO", taxonomy_id=1337, is_scientific_name=True)
+        zebrafish.save()
+
+        # Salmon experiment that is 50% complete.
+        experiment = Experiment(accession_code='ERP036000')
+        experiment.save()
+
+        ## First sample, this one has been processed.
+        pj = ProcessorJob()
+        pj.accession_code = "ERR036000"
+        pj.pipeline_applied = "SALMON"
+        pj.success = True
+        pj.save()
+
+        og = OriginalFile()
+        og.filename = "ERR036000.fastq.gz"
+        og.source_filename = "ERR036000.fastq.gz"
+        og.source_url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR036/ERR036000/ERR036000_1.fastq.gz"
+        og.is_archive = True
+        og.save()
+
+        sample = Sample()
+        sample.accession_code = 'ERR036000'
+        sample.organism = human
+        sample.save()
+
+        assoc = OriginalFileSampleAssociation()
+        assoc.sample = sample
+        assoc.original_file = og
+        assoc.save()
+
+        assoc = ProcessorJobOriginalFileAssociation()
+        assoc.processor_job = pj
+        assoc.original_file = og
+        assoc.save()
+
+        assoc = ExperimentSampleAssociation()
+        assoc.sample = sample
+        assoc.experiment = experiment
+        assoc.save()
+
+        ## Second sample, this one hasn't been processed.
+        self.in_progress_salmon_og = OriginalFile()
+        self.in_progress_salmon_og.filename = "ERR036001.fastq.gz"
+        self.in_progress_salmon_og.source_filename = "ERR036001.fastq.gz"
+        self.in_progress_salmon_og.source_url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR036/ERR036001/ERR036001_1.fastq.gz"
+        self.in_progress_salmon_og.is_archive = True
+        self.in_progress_salmon_og.save()
+
+        self.in_progress_salmon_sample = Sample()
+        self.in_progress_salmon_sample.accession_code = 'ERR036001'
+        self.in_progress_salmon_sample.organism = human
+        self.in_progress_salmon_sample.save()
+
+        assoc = OriginalFileSampleAssociation()
+        assoc.sample = self.in_progress_salmon_sample
+        assoc.original_file = self.in_progress_salmon_og
+        assoc.save()
+
+        assoc = ExperimentSampleAssociation()
+        assoc.sample = self.in_progress_salmon_sample
+        assoc.experiment = experiment
+        assoc.save()
+
+
+        # Salmon experiment that is 0% complete.
+        experiment = Experiment(accession_code='ERP037000')
+        experiment.save()
+
+        self.unstarted_salmon_og = OriginalFile()
+        self.unstarted_salmon_og.filename = "ERR037001.fastq.gz"
+        self.unstarted_salmon_og.source_filename = "ERR037001.fastq.gz"
+        self.unstarted_salmon_og.source_url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR037/ERR037001/ERR037001_1.fastq.gz"
+        self.unstarted_salmon_og.is_archive = True
+        self.unstarted_salmon_og.save()
+
+        self.unstarted_salmon_sample = Sample()
+        self.unstarted_salmon_sample.accession_code = 'ERR037001'
+        self.unstarted_salmon_sample.organism = human
+        self.unstarted_salmon_sample.save()
+
+        assoc = OriginalFileSampleAssociation()
+        assoc.sample = self.unstarted_salmon_sample
+        assoc.original_file = self.unstarted_salmon_og
+        assoc.save()
+
+        assoc = ExperimentSampleAssociation()
+        assoc.sample = self.unstarted_salmon_sample
+        assoc.experiment = experiment
+        assoc.save()
+
+
+        # Zebrafish experiment.
+        experiment = Experiment(accession_code='ERP038000')
+        experiment.save()
+
+        self.zebrafish_og = OriginalFile()
+        self.zebrafish_og.source_filename = "ERR038001.fastq.gz"
+        self.zebrafish_og.source_url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR038/ERR038001/ERR038001_1.fastq.gz"
+        self.zebrafish_og.is_archive = True
+        self.zebrafish_og.save()
+
+        self.zebrafish_sample = Sample()
+        self.zebrafish_sample.accession_code = 'ERR038001'
+        self.zebrafish_sample.organism = zebrafish
+        self.zebrafish_sample.save()
+
+        assoc = OriginalFileSampleAssociation()
+        assoc.sample = self.zebrafish_sample
+        assoc.original_file = self.zebrafish_og
+        assoc.save()
+
+        assoc = ExperimentSampleAssociation()
+        assoc.sample = self.zebrafish_sample
+        assoc.experiment = experiment
+        assoc.save()
+
+
+        # Pediatric experiment.
+        experiment = Experiment(accession_code='GSE100568')
+        experiment.save()
+
+        self.pediatric_og = OriginalFile()
+        self.pediatric_og.source_url = "https://www.ncbi.nlm.nih.gov/geo/download/?acc=GSE100568&format=file"
+        self.pediatric_og.is_archive = True
+        self.pediatric_og.save()
+
+        self.pediatric_sample = Sample()
+        self.pediatric_sample.accession_code = 'GSM2687180'
+        self.pediatric_sample.organism = human
+        self.pediatric_sample.save()
+
+        assoc = OriginalFileSampleAssociation()
+        assoc.sample = self.pediatric_sample
+        assoc.original_file = self.pediatric_og
+        assoc.save()
+
+        assoc = ExperimentSampleAssociation()
+        assoc.sample = self.pediatric_sample
+        assoc.experiment = experiment
+        assoc.save()
+
+
+        # hgu133plus2 experiment.
+        experiment = Experiment(accession_code='GSE100014')
+        experiment.save()
+
+        self.hgu133plus2_og = OriginalFile()
+        self.hgu133plus2_og.source_url = "https://www.ncbi.nlm.nih.gov/geo/download/?acc=GSE100014&format=file"
+        self.hgu133plus2_og.is_archive = True
+        self.hgu133plus2_og.save()
+
+        self.hgu133plus2_sample = Sample()
+        self.hgu133plus2_sample.accession_code = 'GSM2667926'
+        self.hgu133plus2_sample.organism = human
+        self.hgu133plus2_sample.save()
+
+        assoc = OriginalFileSampleAssociation()
+        assoc.sample = self.hgu133plus2_sample
+        assoc.original_file = self.hgu133plus2_og
+        assoc.save()
+
+        assoc = ExperimentSampleAssociation()
+        assoc.sample = self.hgu133plus2_sample
+        assoc.experiment = experiment
+        assoc.save()
+
+    def create_job(self, job_model, original_file, **kwargs):
+        job = job_model(success=False, **kwargs)
+        job.save()
+
+        if job_model == DownloaderJob:
+            assoc = DownloaderJobOriginalFileAssociation()
+            assoc.downloader_job = job
+        else:
+            assoc = ProcessorJobOriginalFileAssociation()
+            assoc.processor_job = job
+        assoc.original_file = original_file
+        assoc.save()
+
+        return job
+
+    def assert_retried_in_order(self, jobs, jobs_in_correct_order):
+        main.update_job_priorities()
+
+        for job in jobs:
+            job.refresh_from_db()
+        self.assertEqual(jobs_in_correct_order[0].priority, main.ORGANISM_PRIORITY)
+        self.assertEqual(jobs_in_correct_order[1].priority, main.HGU133PLUS2_PRIORITY)
+        self.assertEqual(jobs_in_correct_order[2].priority, main.PEDIATRIC_PRIORITY)
+        self.assertEqual(jobs_in_correct_order[3].priority, int(0.5 * main.MAX_COMPLETION_PRIORITY))
+        self.assertEqual(jobs_in_correct_order[4].priority, 0)
+
+        if type(jobs[0]) == DownloaderJob:
+            failed_jobs = main.get_failed_downloader_jobs()
+        else:
+            failed_jobs = main.get_failed_processor_jobs({"1"})
+
+        # Page through them two at a time like the retry passes do.
+        paginator = main.Paginator(failed_jobs, 2, ordering=('-priority', 'id'), allow_previous=False)
+        page = paginator.page()
+        jobs_in_retry_order = list(page.object_list)
+        while page.has_next():
+            page = paginator.page(page.next_page_number())
+            jobs_in_retry_order.extend(page.object_list)
+
+        self.assertEqual([job.id for job in jobs_in_retry_order],
+                         [job.id for job in jobs_in_correct_order])
+
+        # Nothing changed, so there's nothing to update.
+        self.assertEqual(main.update_job_priorities(), 0)
+
+    def test_downloader_job_priorities(self):
+        """Tests the prioritization of downloader jobs.
+
+        We want zebrafish jobs to be first, then jobs for hgu133plus2,
+        then jobs for pediatric cancer, finally salmon jobs should be
+        prioritized based on how close to completion they are."""
+        unstarted_salmon_job = self.create_job(DownloaderJob, self.unstarted_salmon_og,
+                                               accession_code=self.unstarted_salmon_sample.accession_code)
+        in_progress_salmon_job = self.create_job(DownloaderJob, self.in_progress_salmon_og,
+                                                 accession_code=self.in_progress_salmon_sample.accession_code)
+        zebrafish_job = self.create_job(DownloaderJob, self.zebrafish_og,
+                                        accession_code=self.zebrafish_sample.accession_code)
+        pediatric_job = self.create_job(DownloaderJob, self.pediatric_og,
+                                        accession_code=self.pediatric_sample.accession_code)
+        hgu133plus2_job = self.create_job(DownloaderJob, self.hgu133plus2_og,
+                                          accession_code=self.hgu133plus2_sample.accession_code)
+
+        jobs = [unstarted_salmon_job,
+                in_progress_salmon_job,
+                hgu133plus2_job,
+                zebrafish_job,
+                pediatric_job
+        ]
+        jobs_in_correct_order = [zebrafish_job,
+                                 hgu133plus2_job,
+                                 pediatric_job,
+                                 in_progress_salmon_job,
+                                 unstarted_salmon_job
+        ]
+        self.assert_retried_in_order(jobs, jobs_in_correct_order)
+
+    def test_processor_job_priorities(self):
+        """Tests the prioritization of processor jobs.
+
+        We want zebrafish jobs to be first, then jobs for hgu133plus2,
+        then jobs for pediatric cancer, finally salmon jobs should be
+        prioritized based on how close to completion they are."""
+        def create_salmon_job(original_file):
+            return self.create_job(ProcessorJob, original_file, pipeline_applied="SALMON", volume_index="1")
+
+        unstarted_salmon_job = create_salmon_job(self.unstarted_salmon_og)
+        in_progress_salmon_job = create_salmon_job(self.in_progress_salmon_og)
+        zebrafish_job = create_salmon_job(self.zebrafish_og)
+        pediatric_job = create_salmon_job(self.pediatric_og)
+        hgu133plus2_job = create_salmon_job(self.hgu133plus2_og)
+
+        jobs = [unstarted_salmon_job,
+                in_progress_salmon_job,
+                hgu133plus2_job,
+                zebrafish_job,
+                pediatric_job
+        ]
+        jobs_in_correct_order = [zebrafish_job,
+                                 hgu133plus2_job,
+                                 pediatric_job,
+                                 in_progress_salmon_job,
+                                 unstarted_salmon_job
+        ]
+        self.assert_retried_in_order(jobs, jobs_in_correct_order)
+
+    @patch('data_refinery_foreman.foreman.main.message_queue.send_job')
+    def test_retries_keep_priority(self, mock_send_job):
+        mock_send_job.return_value = True
+
+        zebrafish_job = self.create_job(ProcessorJob, self.zebrafish_og,
+                                        pipeline_applied="SALMON", volume_index="1")
+        main.update_job_priorities()
+        zebrafish_job.refresh_from_db()
+
+        self.assertTrue(main.requeue_processor_job(zebrafish_job))
+        self.assertEqual(zebrafish_job.retried_job.priority, main.ORGANISM_PRIORITY)
+
+
+class VolumePlacementTestCase(TestCase):
+    def setUp(self):
+        main.UNMOUNTED_VOLUMES.clear()
+
+    def tearDown(self):
+        main.UNMOUNTED_VOLUMES.clear()
+
+    def create_processor_job(self, volume_index, **kwargs):
+        job = ProcessorJob(pipeline_applied="SALMON", volume_index=volume_index, **kwargs)
+        job.save()
+        return job
+
+    def create_downloaded_file(self, downloader_job, processor_job):
+        original_file = OriginalFile(source_filename="SRR123.sra", filename="SRR123.sra", is_downloaded=True)
+        original_file.save()
+        DownloaderJobOriginalFileAssociation(downloader_job=downloader_job, original_file=original_file).save()
+        ProcessorJobOriginalFileAssociation(processor_job=processor_job, original_file=original_file).save()
+        return original_file
+
+    @patch('data_refinery_foreman.foreman.main.get_active_volumes')
+    def test_choose_volume(self, mock_get_active_volumes):
+        mock_get_active_volumes.return_value = {"1", "2", "3"}
+
+        for i in range(3):
+            self.create_processor_job("1")
+        self.create_processor_job("2")
+        DownloaderJob(downloader_task="SRA", volume_index="2", nomad_job_id="DOWNLOADER_2_1024/dispatch-1").save()
+
+        # Volume 3 is idle but full.
+        self.create_processor_job("3", end_time=timezone.now(), success=True, volume_disk_usage=0.95)
+
+        cluster_state = main.ClusterState(MagicMock())
+        placement = cluster_state.placement
+        self.assertEqual(placement.backlogs, {"1": 3, "2": 2})
+        self.assertFalse(placement.has_room("3"))
+
+        self.assertEqual([placement.choose_volume() for i in range(3)], ["2", "1", "2"])
+
+        job = DownloaderJob(downloader_task="SRA")
+        main.place_downloader_job(job, placement)
+        self.assertEqual(job.volume_index, "1")
+
+        # Jobs already on a mounted volume stay there.
+        main.place_downloader_job(job, placement)
+        self.assertEqual(job.volume_index, "1")
+
+    @patch('data_refinery_foreman.foreman.main.get_active_volumes')
+    def test_migrate_stranded_processor_jobs(self, mock_get_active_volumes):
+        mock_get_active_volumes.return_value = {"1"}
+
+        downloader_job = DownloaderJob(downloader_task="SRA", accession_code="SRR123", success=True)
+        downloader_job.save()
+        stranded_job = self.create_processor_job("4", priority=main.PEDIATRIC_PRIORITY)
+        original_file = self.create_downloaded_file(downloader_job, stranded_job)
+        # The same downloader job fetched another file whose processor
+        # job has already finished.
+        finished_job = self.create_processor_job("4", end_time=timezone.now(), success=True)
+        finished_file = self.create_downloaded_file(downloader_job, finished_job)
+
+        # This one's files are still being downloaded again.
+        running_downloader_job = DownloaderJob(downloader_task="SRA", accession_code="SRR456")
+        running_downloader_job.save()
+        waiting_job = self.create_processor_job("4")
+        self.create_downloaded_file(running_downloader_job, waiting_job)
+
+        cluster_state = main.ClusterState(MagicMock())
+
+        # Volumes get some time to come back first.
+        self.assertEqual(main.migrate_stranded_processor_jobs(cluster_state), 0)
+        self.assertIn("4", main.UNMOUNTED_VOLUMES)
+
+        main.UNMOUNTED_VOLUMES["4"] = timezone.now() - main.UNMOUNTED_VOLUME_GRACE_TIME
+        self.assertEqual(main.migrate_stranded_processor_jobs(cluster_state), 1)
+
+        stranded_job.refresh_from_db()
+        self.assertTrue(stranded_job.retried)
+        self.assertFalse(stranded_job.success)
+        self.assertIsNotNone(stranded_job.end_time)
+
+        new_downloader_job = original_file.downloader_jobs.exclude(id=downloader_job.id).get()
+        self.assertEqual(new_downloader_job.volume_index, "1")
+        self.assertEqual(new_downloader_job.accession_code, "SRR123")
+        self.assertEqual(new_downloader_job.priority, main.PEDIATRIC_PRIORITY)
+        self.assertIsNone(new_downloader_job.nomad_job_id)
+        original_file.refresh_from_db()
+        self.assertFalse(original_file.is_downloaded)
+
+        # Only the stranded job's own files are downloaded again.
+        self.assertEqual(list(new_downloader_job.original_files.all()), [original_file])
+        finished_file.refresh_from_db()
+        self.assertTrue(finished_file.is_downloaded)
+
+        waiting_job.refresh_from_db()
+        self.assertFalse(waiting_job.retried)
+
+    @patch('data_refinery_foreman.foreman.main.get_active_volumes')
+    def test_cleanup_the_queue(self, mock_get_active_volumes):
+        mock_get_active_volumes.return_value = {"1"}
+
+        placed_job = DownloaderJob(downloader_task="SRA", num_retries=1,
+                                   volume_index="4", nomad_job_id="DOWNLOADER_4_1024/dispatch-1")
+        placed_job.save()
+        stranded_job = self.create_processor_job("4", num_retries=1, nomad_job_id="SALMON_4_12288/dispatch-3")
+
+        mock_nomad = MagicMock()
+        mock_nomad.jobs.get_jobs.return_value = [
+            {"ID": "DOWNLOADER_4_1024", "ParameterizedJob": True},
+            {"ID": "DOWNLOADER_4_1024/dispatch-1", "ParentID": "DOWNLOADER_4_1024", "ParameterizedJob": False},
+            {"ID": "DOWNLOADER_1024/dispatch-2", "ParentID": "DOWNLOADER_1024", "ParameterizedJob": False},
+            {"ID": "SALMON_4_12288/dispatch-3", "ParentID": "SALMON_4_12288", "ParameterizedJob": False},
+            {"ID": "SALMON_1_12288/dispatch-4", "ParentID": "SALMON_1_12288", "ParameterizedJob": False},
+        ]
+        cluster_state = main.ClusterState(mock_nomad)
+
+        main.cleanup_the_queue(cluster_state)
+
+        deregistered_ids = [call[0][0] for call in mock_nomad.job.deregister_job.call_args_list]
+        self.assertEqual(deregistered_ids, ["DOWNLOADER_4_1024/dispatch-1", "SALMON_4_12288/dispatch-3"])
+
+        placed_job.refresh_from_db()
+        self.assertEqual(placed_job.num_retries, 0)
+        stranded_job.refresh_from_db()
+        self.assertEqual(stranded_job.num_retries, 0)
+        self.assertEqual(ProcessorJob.objects.count(), 1)
@@ -48,6 +48,9 @@ class ExternalSourceSurveyor:
                 files_to_download.append(og_file)
 
         download_urls_with_jobs = {}
+        # The new jobs are queued all at once at the end, grouped by
+        # their downloader task.
+        jobs_to_queue = {}
         for original_file in files_to_download:
 
             # We don't need to create multiple downloaders for the same file.
@@ -87,21 +90,26 @@ class ExternalSourceSurveyor:
                 )
 
                 download_urls_with_jobs[original_file.source_url] = downloader_job
-
-                try:
-                    logger.info("Queuing downloader job for URL: " + original_file.source_url,
-                                 survey_job=self.survey_job.id,
-                                 downloader_job=downloader_job.id)
-                    message_queue.send_job(downloader_task, downloader_job)
-                except Exception as e:
+                jobs_to_queue.setdefault(downloader_task, []).append((downloader_job, original_file))
+
+        for downloader_task, new_jobs in jobs_to_queue.items():
+            downloader_jobs = [downloader_job for downloader_job, _ in new_jobs]
+            logger.info("Queuing downloader jobs.",
+                        survey_job=self.survey_job.id,
+                        downloader_task=downloader_task.value,
+                        downloader_jobs=[downloader_job.id for downloader_job in downloader_jobs])
+            results = message_queue.send_jobs(downloader_task, downloader_jobs)
+
+            for (downloader_job, original_file), was_queued in zip(new_jobs, results):
+                if not was_queued:
                     # If the task doesn't get sent we don't want the
                     # downloader_job to be left floating
-                    logger.exception("Failed to enqueue downloader job for URL: "
-                                     + original_file.source_url,
-                                     survey_job=self.survey_job.id,
-                                     downloader_job=downloader_job.id)
+                    logger.error("Failed to enqueue downloader job for URL: "
+                                 + original_file.source_url,
+                                 survey_job=self.survey_job.id,
+                                 downloader_job=downloader_job.id)
                     downloader_job.success = False
-                    downloader_job.failure_reason = str(e)
+                    downloader_job.failure_reason = "Failed to enqueue downloader job."
                     downloader_job.save()
 
     def queue_downloader_job_for_original_files(self,
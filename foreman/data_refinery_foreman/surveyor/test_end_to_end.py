@@ -21,6 +21,7 @@ from data_refinery_common.models import (
     Experiment,
     ExperimentAnnotation,
     ExperimentSampleAssociation,
+    OrganismIndex,
     OriginalFile,
     OriginalFileSampleAssociation,
     ProcessorJob,
@@ -442,10 +443,9 @@ class GeoCelgzRedownloadingTestCase(TransactionTestCase):
         self.env = EnvironmentVarGuard()
         self.env.set('RUNING_IN_CLOUD', 'False')
         with self.env:
-            for length in ["LONG", "SHORT"]:
-                work_dir_glob = LOCAL_ROOT_DIR + "/Caenorhabditis_elegans/" + length + "/processor_job_*"
-                for work_dir in glob.glob(work_dir_glob):
-                    shutil.rmtree(work_dir)
+            work_dir_glob = LOCAL_ROOT_DIR + "/Caenorhabditis_elegans/processor_job_*"
+            for work_dir in glob.glob(work_dir_glob):
+                shutil.rmtree(work_dir)
 
             # Prevent a call being made to NCBI's API to determine
             # organism name/id.
@@ -486,11 +486,9 @@ class GeoCelgzRedownloadingTestCase(TransactionTestCase):
             processor_jobs = ProcessorJob.objects.all()
             for processor_job in processor_jobs:
                 # It's hard to guarantee that we'll be able to delete
-                # the files before the first job starts, but since
-                # they both don't start at the same time we'll
-                # definitely get it before the second one. This is
-                # actually kinda desirable for testing though because
-                # we should be able to handle it either way.
+                # the file before the job starts. This is actually
+                # kinda desirable for testing though because we should
+                # be able to handle it either way.
                 try:
                     wait_for_job(processor_job, ProcessorJob, start_time)
                 except:
@@ -517,13 +515,12 @@ class GeoCelgzRedownloadingTestCase(TransactionTestCase):
             self.assertTrue(recreated_job.success)
 
             # Once the Downloader job succeeds, it should create one
-            # and only one processor job, which the total goes back up to 2:
+            # and only one processor job, which builds both index lengths:
             processor_jobs = ProcessorJob.objects.all()
-            self.assertEqual(processor_jobs.count(), 3)
+            self.assertEqual(processor_jobs.count(), 2)
 
-            # And finally we can make sure that both of the
-            # processor jobs were successful, including the one that
-            # got recreated.
+            # And finally we can make sure that the processor job
+            # was successful, including the one that got recreated.
             logger.info("Downloader Jobs finished, waiting for processor Jobs to complete.")
             successful_processor_jobs = []
             for processor_job in processor_jobs:
@@ -537,24 +534,16 @@ class GeoCelgzRedownloadingTestCase(TransactionTestCase):
                 except:
                     pass
 
-            # While one of the original ProcessorJobs will definitely
-            # delete itself, it is hard to be sure of what will happen
-            # to the other because of the racing that happens between
-            # processor jobs getting started and us deleting the files
-            # they need.
-            # Therefore, we're just going to verify that one processor
-            # job completed successfully for each length, since that
-            # is the main thing we need.
-            has_long = False
-            has_short = False
+            # The original ProcessorJob may or may not have deleted
+            # itself depending on whether it started before we deleted
+            # its file, but one of them must have built both indices.
+            self.assertTrue(len(successful_processor_jobs) > 0)
             for processor_job in successful_processor_jobs:
-                if processor_job.pipeline_applied == "TRANSCRIPTOME_INDEX_LONG":
-                    has_long = True
-                elif processor_job.pipeline_applied == "TRANSCRIPTOME_INDEX_SHORT":
-                    has_short = True
+                self.assertEqual(processor_job.pipeline_applied, "TRANSCRIPTOME_INDEX")
 
-            self.assertTrue(has_long)
-            self.assertTrue(has_short)
+            index_types = OrganismIndex.objects.values_list("index_type", flat=True)
+            self.assertIn("TRANSCRIPTOME_LONG", index_types)
+            self.assertIn("TRANSCRIPTOME_SHORT", index_types)
 
 
 class SraRedownloadingTestCase(TransactionTestCase):
@@ -241,15 +241,33 @@ if [[ $project == "workers" ]]; then
         if [ $output_file == "downloader.nomad" ]; then
             export_log_conf "downloader"
             rams=(1024 4096 8192)
+            # The Foreman places downloader jobs on a volume to spread
+            # new work between them, so there's a spec for each volume
+            # as well as one without an index that can run anywhere.
+            indices=("" $(seq 0 $((MAX_CLIENTS - 1))))
             for r in "${rams[@]}"
             do
-                export RAM_POSTFIX="_$r.nomad"
-                export RAM="$r"
-                cat nomad-job-specs/$template \
-                    | perl -p -e 's/\$\{\{([^}]+)\}\}/defined $ENV{$1} ? $ENV{$1} : $&/eg' \
-                           > "$output_dir/$output_file$RAM_POSTFIX$TEST_POSTFIX" \
-                           2> /dev/null
-                echo "Made $output_dir/$output_file$RAM_POSTFIX$TEST_POSTFIX"
+                for j in "${indices[@]}"
+                do
+                    if [[ -z $j ]]; then
+                        export INDEX_POSTFIX=""
+                        export VOLUME_CONSTRAINT=""
+                    else
+                        export INDEX_POSTFIX="_$j"
+                        export VOLUME_CONSTRAINT="constraint {
+        attribute = \"\${meta.volume_index}\"
+        operator  = \"=\"
+        value     = \"$j\"
+      }"
+                    fi
+                    export RAM_POSTFIX="_$r.nomad"
+                    export RAM="$r"
+                    cat nomad-job-specs/$template \
+                        | perl -p -e 's/\$\{\{([^}]+)\}\}/defined $ENV{$1} ? $ENV{$1} : $&/eg' \
+                               > "$output_dir/$output_file$INDEX_POSTFIX$RAM_POSTFIX$TEST_POSTFIX" \
+                               2> /dev/null
+                    echo "Made $output_dir/$output_file$INDEX_POSTFIX$RAM_POSTFIX$TEST_POSTFIX"
+                done
             done
             echo "Made $output_dir/$output_file$TEST_POSTFIX"
         elif [ $output_file == "smasher.nomad" ] || [ $output_file == "create_qn_target.nomad" ] || [ $output_file == "create_compendia.nomad" ] || [ $output_file == "tximport.nomad" ]; then
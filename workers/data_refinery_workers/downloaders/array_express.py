@@ -1,10 +1,6 @@
 import os
-import shutil
-import time
-import urllib.request
 import zipfile
 
-from contextlib import closing
 from typing import List
 
 from data_refinery_common import microarray
@@ -40,16 +36,12 @@ def _download_file(download_url: str, file_path: str, job: DownloaderJob) -> Non
                      download_url,
                      file_path,
                      downloader_job=job.id)
-        target_file = open(file_path, "wb")
-        with closing(urllib.request.urlopen(download_url, timeout=60)) as request:
-            shutil.copyfileobj(request, target_file, CHUNK_SIZE)
+        utils.download_file_cached(download_url, file_path, chunk_size=CHUNK_SIZE, timeout=60)
     except Exception:
         logger.exception("Exception caught while downloading file.",
                          downloader_job=job.id)
         job.failure_reason = "Exception caught while downloading file"
         raise
-    finally:
-        target_file.close()
 
 
 def _extract_files(file_path: str, accession_code: str, job: DownloaderJob) -> List[str]:
@@ -60,17 +52,24 @@ def _extract_files(file_path: str, accession_code: str, job: DownloaderJob) -> L
     try:
         # This is technically an unsafe operation.
         # However, we're trusting AE as a data source.
-        zip_ref = zipfile.ZipFile(file_path, "r")
         abs_with_code_raw = LOCAL_ROOT_DIR + '/' + accession_code + '/raw/'
-        zip_ref.extractall(abs_with_code_raw)
+
         # Other zips for this same accession will go into this
         # directory too, so look at what's in the zip file rather than
         # what's in the directory it's being extracted to.
-        files_in_zip = zip_ref.namelist()
-        zip_ref.close()
+        files = []
+        with zipfile.ZipFile(file_path, "r") as zip_ref:
+            for member in zip_ref.infolist():
+                if member.filename.endswith('/'):
+                    continue
+
+                # os.abspath doesn't do what I thought it does, hency this monstrocity.
+                absolute_path = abs_with_code_raw + member.filename
+                os.makedirs(os.path.dirname(absolute_path), exist_ok=True)
+                with zip_ref.open(member) as member_file:
+                    utils.write_and_hash(member_file, absolute_path, CHUNK_SIZE)
 
-        # os.abspath doesn't do what I thought it does, hency this monstrocity.
-        files = [{'absolute_path': abs_with_code_raw + f, 'filename': f} for f in files_in_zip]
+                files.append({'absolute_path': absolute_path, 'filename': member.filename})
 
     except Exception as e:
         reason = "Exception %s caught while extracting %s", str(e), str(file_path)
@@ -112,8 +111,10 @@ def download_array_express(job_id: int) -> None:
     # download the one.
     os.makedirs(LOCAL_ROOT_DIR + '/' + accession_code, exist_ok=True)
 
-    # Add a timestamp in milliseconds to filename to prevent multiple jobs from using the same file.
-    filename = url.split('/')[-1] + "." + str(int(time.time() * 1000))
+    # Add the id of the job's first file to the filename to prevent
+    # multiple jobs from using the same file, while still letting a
+    # retry of this job resume a partial download of it.
+    filename = url.split('/')[-1] + "." + str(original_file.id)
     dl_file_path = LOCAL_ROOT_DIR + '/' + accession_code + '/' + filename + ".zip"
     _download_file(url, dl_file_path, job)
 
@@ -135,8 +136,7 @@ def download_array_express(job_id: int) -> None:
                 original_file.is_archive = False
                 original_file.absolute_file_path = og_file['absolute_path']
                 original_file.filename = og_file['absolute_path'].split('/')[-1]
-                original_file.calculate_size()
-                original_file.calculate_sha1()
+                utils.record_size_and_sha1(original_file)
                 original_file.save()
                 og_files.append(original_file)
             else:
@@ -0,0 +1,258 @@
+"""Runs file transfers with Aspera's `ascp` client.
+
+Files from the same server which are going into the same directory
+are sent through a single `ascp` invocation so that only one session
+has to be negotiated for all of them. Failed transfers are retried
+with exponential backoff and jitter, resuming whatever was already
+transferred.
+"""
+
+import os
+import random
+import re
+import subprocess
+import tempfile
+import time
+
+from typing import Dict, List, Tuple
+
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.models import DownloaderJob
+from data_refinery_common.utils import get_env_variable_gracefully
+
+
+logger = get_and_configure_logger(__name__)
+
+ASCP = ".aspera/cli/bin/ascp"
+ASPERA_KEY = ".aspera/cli/etc/asperaweb_id_dsa.openssh"
+
+# Flags required by each source's Aspera server.
+SOURCE_FLAGS = {
+    # aspera.sra.ebi.ac.uk users port 33001 for SSH communication.
+    "ENA": ["-P33001"],
+    # NCBI recommends -Q (play fair), -p preserves file times.
+    "NCBI": ["-p", "-Q", "-T"],
+    "GEO": ["-T"],
+}
+
+# The most each source wants any one transfer to use, in Mbps.
+# ex: https://github.com/AlexsLemonade/refinebio/pull/1189#issuecomment-478018580
+SOURCE_MAX_RATES = {
+    "NCBI": 450,
+}
+
+# How much bandwidth a node gives each transfer, in Mbps. Nodes pick
+# a class through ASPERA_BANDWIDTH_CLASS; None means no limit beyond
+# the source's own.
+BANDWIDTH_CLASSES = {
+    "low": 100,
+    "medium": 450,
+    "high": 1000,
+    "unlimited": None,
+}
+ASPERA_BANDWIDTH_CLASS = get_env_variable_gracefully("ASPERA_BANDWIDTH_CLASS", "unlimited")
+
+MAX_ATTEMPTS = 6
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 300
+
+# ascp writes a progress line per file, the last of which looks like:
+#   SRR1234567.sra                100% 2432MB  448Mb/s    00:45
+PROGRESS_LINE = re.compile(r"^(?P<name>\S+)\s+(?P<percent>\d+)%\s+(?P<size>[\d.]+\s*[KMGT]?B)"
+                           r"\s+(?P<rate>[\d.]+\s*[KMG]?b/s)")
+# And a summary once the session is over:
+#   Completed: 2490368K bytes transferred in 45 seconds
+#    (448153K bits/sec), in 1 file.
+SUMMARY = re.compile(r"Completed:\s+(?P<kilobytes>\d+)K bytes transferred in (?P<seconds>\d+) seconds"
+                     r"\s*\((?P<rate>[\d.]+)\s*(?P<unit>[KMG]?)\s*bits/sec\)")
+RATE_UNITS = {"": 1, "K": 1000, "M": 1000 ** 2, "G": 1000 ** 3}
+
+
+def get_rate_limit(source: str, bandwidth_class: str=None) -> int:
+    """Returns the rate limit in Mbps for a transfer from `source`, or
+    None if it shouldn't be limited."""
+    if bandwidth_class is None:
+        bandwidth_class = ASPERA_BANDWIDTH_CLASS
+
+    limits = [SOURCE_MAX_RATES.get(source, None), BANDWIDTH_CLASSES.get(bandwidth_class, None)]
+    limits = [limit for limit in limits if limit]
+    return min(limits) if limits else None
+
+
+def parse_remote_path(remote_path: str) -> Tuple[str, str, str]:
+    """Splits `user@host:path` into its parts."""
+    user, rest = remote_path.split("@", 1)
+    host, path = rest.split(":", 1)
+    return user, host, path
+
+
+def parse_progress(output: str) -> Dict:
+    """Pulls the transfer's throughput out of ascp's output.
+
+    Returns the total bytes, seconds and bits per second from the
+    session summary, plus the last reported rate for each file.
+    """
+    metrics = {"files": {}}
+
+    # Progress updates are separated by carriage returns.
+    for line in re.split(r"[\r\n]+", output):
+        match = PROGRESS_LINE.match(line.strip())
+        if match:
+            metrics["files"][match.group("name")] = {
+                "percent": int(match.group("percent")),
+                "rate": match.group("rate").replace(" ", ""),
+            }
+
+    match = SUMMARY.search(output)
+    if match:
+        metrics["bytes"] = int(match.group("kilobytes")) * 1024
+        metrics["seconds"] = int(match.group("seconds"))
+        metrics["bits_per_second"] = float(match.group("rate")) * RATE_UNITS[match.group("unit")]
+
+    return metrics
+
+
+def get_backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter so that the many jobs which
+    failed together don't all retry together."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def build_command(user: str, host: str, source: str, file_pair_list: str, target_dir: str) -> List[str]:
+    """Builds the ascp command for receiving every file in
+    `file_pair_list` into `target_dir`."""
+    command = [ASCP, "-i", ASPERA_KEY, "-k1", "--mode=recv", "--user=" + user, "--host=" + host]
+    command.extend(SOURCE_FLAGS.get(source, []))
+
+    rate_limit = get_rate_limit(source)
+    if rate_limit:
+        command.extend(["-l", str(rate_limit) + "m"])
+
+    command.extend(["--file-pair-list=" + file_pair_list, target_dir])
+    return command
+
+
+def _is_complete(target_path: str) -> bool:
+    """Aspera sometimes leaves zero-byte files behind."""
+    return os.path.exists(target_path) and os.path.getsize(target_path) > 0
+
+
+def _run_transfer(user: str,
+                  host: str,
+                  target_dir: str,
+                  pairs: List[Tuple[str, str]],
+                  source: str,
+                  downloader_job: DownloaderJob,
+                  attempts_made: int=0) -> bool:
+    """Transfers `pairs` of (remote path, local path) from one server
+    into one directory, retrying until every file has arrived."""
+    remaining_pairs = pairs
+    for attempt in range(attempts_made, MAX_ATTEMPTS):
+        if attempt > attempts_made:
+            time.sleep(get_backoff(attempt))
+
+        # -k1 resumes partial files, but there's nothing to resume in
+        # an empty one.
+        for _, target_path in remaining_pairs:
+            if os.path.exists(target_path) and os.path.getsize(target_path) < 1:
+                os.remove(target_path)
+
+        with tempfile.NamedTemporaryFile("w", suffix=".pairs") as file_pair_list:
+            # Sources and destinations alternate, destinations being
+            # relative to the target directory.
+            for remote_path, target_path in remaining_pairs:
+                file_pair_list.write(parse_remote_path(remote_path)[2] + "\n")
+                file_pair_list.write(os.path.basename(target_path) + "\n")
+            file_pair_list.flush()
+
+            command = build_command(user, host, source, file_pair_list.name, target_dir)
+            completed_command = subprocess.run(command,
+                                               stdout=subprocess.PIPE,
+                                               stderr=subprocess.PIPE)
+
+        stdout = completed_command.stdout.decode(errors="replace").strip()
+        stderr = completed_command.stderr.decode(errors="replace").strip()
+        metrics = parse_progress(stdout)
+
+        if completed_command.returncode == 0:
+            logger.info("Aspera transfer finished.",
+                        host=host,
+                        num_files=len(remaining_pairs),
+                        attempt=attempt,
+                        bytes=metrics.get("bytes", None),
+                        seconds=metrics.get("seconds", None),
+                        bits_per_second=metrics.get("bits_per_second", None),
+                        downloader_job=downloader_job.id)
+
+            remaining_pairs = [pair for pair in remaining_pairs if not _is_complete(pair[1])]
+            if not remaining_pairs:
+                return True
+
+            logger.error("Got zero byte ascp download for target, retrying.",
+                         target_urls=[remote_path for remote_path, _ in remaining_pairs],
+                         downloader_job=downloader_job.id)
+        elif attempt < MAX_ATTEMPTS - 1:
+            logger.debug("Shell call of `%s` to ascp failed with error message: %s",
+                         " ".join(command),
+                         stderr,
+                         attempt=attempt,
+                         progress=metrics["files"],
+                         downloader_job=downloader_job.id)
+        else:
+            logger.info("Final shell call of `%s` to ascp failed with error message: %s",
+                        " ".join(command),
+                        stderr + "\nSTDOUT: " + stdout,
+                        downloader_job=downloader_job.id)
+            downloader_job.failure_reason = "stderr:\n " + stderr + "\nstdout:\n " + stdout
+            return False
+
+    downloader_job.failure_reason = ("Got zero byte file from aspera after {} attempts."
+                                     .format(MAX_ATTEMPTS))
+    return False
+
+
+def download_files(pairs: List[Tuple[str, str]],
+                   source: str,
+                   downloader_job: DownloaderJob,
+                   attempts_made: int=0) -> bool:
+    """Downloads each (`user@host:path`, local path) pair in `pairs`
+    with as few ascp sessions as possible.
+
+    `source` is one of the keys of SOURCE_FLAGS. If the local path is
+    a directory the file keeps its remote name. Returns True if every
+    file was downloaded.
+    """
+    transfers = {}
+    for remote_path, target_path in pairs:
+        user, host, path = parse_remote_path(remote_path)
+        if os.path.isdir(target_path):
+            target_path = os.path.join(target_path, os.path.basename(path))
+        target_dir = os.path.dirname(target_path)
+        transfers.setdefault((user, host, target_dir), []).append((remote_path, target_path))
+
+    for (user, host, target_dir), transfer_pairs in transfers.items():
+        logger.debug("Downloading files from %s to %s via Aspera.",
+                     host,
+                     target_dir,
+                     num_files=len(transfer_pairs),
+                     downloader_job=downloader_job.id)
+
+        os.makedirs(target_dir, exist_ok=True)
+        try:
+            if not _run_transfer(user,
+                                 host,
+                                 target_dir,
+                                 transfer_pairs,
+                                 source,
+                                 downloader_job,
+                                 attempts_made):
+                return False
+        except Exception:
+            logger.exception("Exception caught while downloading files via Aspera.",
+                             host=host,
+                             downloader_job=downloader_job.id)
+            downloader_job.failure_reason = ("Exception caught while downloading "
+                                             "files via Aspera from {}").format(host)
+            return False
+
+    return True
@@ -1,13 +1,9 @@
 import gzip
 import os
-import shutil
-import subprocess
 import tarfile
-import time
 import urllib.request
 
-from contextlib import closing
-from typing import List, Dict
+from typing import Callable, List, Dict
 
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.models import (
@@ -21,7 +17,7 @@ from data_refinery_common.models import (
     Sample,
 )
 from data_refinery_common.utils import get_env_variable
-from data_refinery_workers.downloaders import utils
+from data_refinery_workers.downloaders import aspera, utils
 
 
 logger = get_and_configure_logger(__name__)
@@ -38,7 +34,24 @@ def _download_file(download_url: str, file_path: str, job: DownloaderJob, force_
     os.makedirs(file_path.rsplit('/', 1)[0], exist_ok=True)
 
     if not force_ftp:
-        return _download_file_aspera(download_url=download_url, downloader_job=job, target_file_path=file_path)
+        # Family tarballs are shared by every sample in a series, so
+        # go through the cache even though Aspera does the downloading.
+        def download_with_aspera(target_file_path):
+            if not _download_file_aspera(download_url=download_url,
+                                         downloader_job=job,
+                                         target_file_path=target_file_path):
+                raise Exception("Aspera failed to download " + download_url)
+
+        try:
+            utils.download_file_cached(download_url, file_path, download_with_aspera)
+        except Exception:
+            logger.exception("Exception caught while downloading file via Aspera.",
+                             downloader_job=job.id)
+            if not job.failure_reason:
+                job.failure_reason = "Exception caught while downloading file via Aspera"
+            return False
+
+        return True
     else:
         try:
             logger.debug("Downloading file from %s to %s.",
@@ -49,9 +62,7 @@ def _download_file(download_url: str, file_path: str, job: DownloaderJob, force_
             # Ancient unresolved bug. WTF python: https://bugs.python.org/issue27973
             urllib.request.urlcleanup()
 
-            target_file = open(file_path, "wb")
-            with closing(urllib.request.urlopen(download_url)) as request:
-                shutil.copyfileobj(request, target_file, CHUNK_SIZE)
+            utils.download_file_cached(download_url, file_path, chunk_size=CHUNK_SIZE)
 
             urllib.request.urlcleanup()
         except Exception:
@@ -59,8 +70,6 @@ def _download_file(download_url: str, file_path: str, job: DownloaderJob, force_
                              downloader_job=job.id)
             job.failure_reason = "Exception caught while downloading file"
             raise
-        finally:
-            target_file.close()
 
         return True
 
@@ -70,84 +79,76 @@ def _download_file_aspera(download_url: str,
                           target_file_path: str,
                           attempt=0) -> bool:
     """ Download a file to a location using Aspera by shelling out to the `ascp` client. """
+    url = download_url
+    ftp = "ftp-trace.ncbi.nlm.nih.gov"
+    if url.startswith("ftp://"):
+        url = url.replace("ftp://", "")
+    url = url.replace(ftp, "").replace('ftp.ncbi.nlm.nih.gov', '')
+
+    return aspera.download_files([("anonftp@{}:{}".format(ftp, url), target_file_path)],
+                                 source="GEO",
+                                 downloader_job=downloader_job,
+                                 attempts_made=attempt)
+
+
+def _extract_tar_members(file_path: str,
+                         target_dir: str,
+                         should_extract: Callable[[str], bool]=None) -> List[Dict]:
+    """Streams the members of the tarball at `file_path` into `target_dir`.
+
+    The tarball is read in stream mode so a compressed one never needs
+    to be decompressed to disk first. `should_extract` is called with
+    each member's filename before anything is written, so members we
+    have no use for are skipped entirely. gzipped members are
+    decompressed as they're written, and the size and SHA1 of the
+    compressed member are recorded as `archive_size` and
+    `archive_sha1` since it never touches the disk.
+    """
+    os.makedirs(target_dir, exist_ok=True)
 
-    try:
-        logger.debug("Downloading file from %s to %s via Aspera.",
-                     download_url,
-                     target_file_path,
-                     downloader_job=downloader_job.id)
-
-        ascp = ".aspera/cli/bin/ascp"
-        key = ".aspera/cli/etc/asperaweb_id_dsa.openssh"
-        url = download_url
-        user = "anonftp"
-        ftp = "ftp-trace.ncbi.nlm.nih.gov"
-        if url.startswith("ftp://"):
-            url = url.replace("ftp://", "")
-        url = url.replace(ftp, "").replace('ftp.ncbi.nlm.nih.gov', '')
-
-        # Resume level 1, use encryption, unlimited speed
-        command_str = "{} -i {} -k1 -T {}@{}:{} {}".format(ascp, key, user, ftp, url, target_file_path)
-        formatted_command = command_str.format(src=download_url,
-                                               dest=target_file_path)
-        completed_command = subprocess.run(formatted_command.split(),
-                                           stdout=subprocess.PIPE,
-                                           stderr=subprocess.PIPE)
-
-        # Something went wrong! Else, just fall through to returning True.
-        if completed_command.returncode != 0:
-
-            stderr = completed_command.stderr.decode().strip()
-            logger.debug("Shell call of `%s` to ascp failed with error message: %s",
-                         formatted_command,
-                         stderr,
-                         downloader_job=downloader_job.id)
-
-            # Sometimes, GEO fails mysteriously.
-            # Wait a few minutes and try again.
-            if attempt >= 5:
-                downloader_job.failure_reason = stderr
-                logger.error("All attempts to download accession via ascp failed: %s\nCommand was: %s",
-                             stderr,
-                             formatted_command,
-                             downloader_job=downloader_job.id)
-                return False
+    files = []
+    with tarfile.open(file_path, "r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            if should_extract and not should_extract(os.path.basename(member.name)):
+                continue
+
+            member_file = tar.extractfile(member)
+            if member.name.endswith('.gz'):
+                absolute_path = target_dir + member.name[:-len('.gz')]
+                os.makedirs(os.path.dirname(absolute_path), exist_ok=True)
+
+                archive_reader = utils.HashingReader(member_file)
+                with gzip.GzipFile(fileobj=archive_reader, mode='rb') as gzipped_file:
+                    utils.write_and_hash(gzipped_file, absolute_path, CHUNK_SIZE)
+                # Make sure the whole member has been hashed.
+                while archive_reader.read(CHUNK_SIZE):
+                    pass
+
+                files.append({'absolute_path': absolute_path,
+                              'filename': os.path.basename(absolute_path),
+                              'archive_filename': os.path.basename(member.name),
+                              'archive_size': archive_reader.size,
+                              'archive_sha1': archive_reader.hexdigest()})
             else:
-                time.sleep(30)
-                return _download_file_aspera(download_url,
-                                             downloader_job,
-                                             target_file_path,
-                                             attempt + 1
-                                             )
-    except Exception:
-        logger.exception("Exception caught while downloading file from the URL via Aspera: %s",
-                         download_url,
-                         downloader_job=downloader_job.id)
-        downloader_job.failure_reason = ("Exception caught while downloading "
-                                         "file from the URL via Aspera: {}").format(download_url)
-        return False
-
-    # If Aspera has given a zero-byte file for some reason, let's back off and retry.
-    if os.path.getsize(target_file_path) < 1:
-        os.remove(target_file_path)
-        if attempt > 5:
-            downloader_job.failure_reason = "Got zero byte file from aspera after 5 attempts."
-            return False
+                absolute_path = target_dir + member.name
+                os.makedirs(os.path.dirname(absolute_path), exist_ok=True)
+                utils.write_and_hash(member_file, absolute_path, CHUNK_SIZE)
+                files.append({'absolute_path': absolute_path,
+                              'filename': os.path.basename(absolute_path)})
 
-        logger.error("Got zero byte ascp download for target, retrying.",
-                     target_url=download_url,
-                     downloader_job=downloader_job.id)
-        time.sleep(10)
-        return _download_file_aspera(download_url,
-                                     downloader_job,
-                                     target_file_path,
-                                     attempt + 1
-                                     )
-    return True
+    return files
 
 
-def _extract_tar(file_path: str, accession_code: str) -> List[str]:
+def _extract_tar(file_path: str,
+                 accession_code: str,
+                 should_extract: Callable[[str], bool]=None) -> List[Dict]:
     """Extract tar and return a list of the raw files.
+
+    Only members for which `should_extract` returns True are written,
+    and gzipped members are decompressed on the way out.
     """
 
     logger.debug("Extracting %s!", file_path, file_path=file_path)
@@ -155,14 +156,8 @@ def _extract_tar(file_path: str, accession_code: str) -> List[str]:
     try:
         # This is technically an unsafe operation.
         # However, we're trusting GEO as a data source.
-        zip_ref = tarfile.TarFile(file_path, "r")
         abs_with_code_raw = LOCAL_ROOT_DIR + '/' + accession_code + '/raw/'
-        zip_ref.extractall(abs_with_code_raw)
-        zip_ref.close()
-
-        # os.abspath doesn't do what I thought it does, hency this monstrocity.
-        files = [{'absolute_path': abs_with_code_raw + f, 'filename': f}
-                 for f in os.listdir(abs_with_code_raw)]
+        files = _extract_tar_members(file_path, abs_with_code_raw, should_extract)
 
     except Exception as e:
         logger.exception("While extracting %s caught exception %s",
@@ -175,25 +170,21 @@ def _extract_tar(file_path: str, accession_code: str) -> List[str]:
     return files
 
 
-def _extract_tgz(file_path: str, accession_code: str) -> List[str]:
+def _extract_tgz(file_path: str,
+                 accession_code: str,
+                 should_extract: Callable[[str], bool]=None) -> List[Dict]:
     """Extract tgz and return a list of the raw files.
+
+    The tarball is decompressed as it's read rather than to a
+    temporary .tar file. Only members for which `should_extract`
+    returns True are written.
     """
 
     logger.debug("Extracting %s!", file_path, file_path=file_path)
 
     try:
-        extracted_filepath = file_path.replace('.tgz', '.tar')
-        with gzip.open(file_path, 'rb') as f_in:
-            with open(extracted_filepath, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-
-        zip_ref = tarfile.TarFile(extracted_filepath, "r")
         abs_with_code_raw = LOCAL_ROOT_DIR + '/' + accession_code + '/raw/'
-        zip_ref.extractall(abs_with_code_raw)
-        zip_ref.close()
-
-        files = [{'absolute_path': abs_with_code_raw + f, 'filename': f}
-                 for f in os.listdir(abs_with_code_raw)]
+        files = _extract_tar_members(file_path, abs_with_code_raw, should_extract)
 
     except Exception as e:
         reason = "Exception %s caught while extracting %s", str(e), file_path
@@ -203,6 +194,24 @@ def _extract_tgz(file_path: str, accession_code: str) -> List[str]:
     return files
 
 
+def _get_sample_accession_from_raw_filename(filename: str) -> str:
+    """GEO's _RAW.tar members are named after their sample, like
+    GSM1234_foo.CEL.gz or GSM1234.CEL.gz."""
+    if '_' in filename:
+        return filename.split('_')[0]
+    else:
+        return filename.split('.')[0]
+
+
+def _get_sample_accession_from_miniml_filename(filename: str) -> str:
+    """MINiML tables are named like GSM1234-tbl-1.txt."""
+    return filename.split('-')[0]
+
+
+def _is_known_sample(accession_code: str) -> bool:
+    return Sample.objects.filter(accession_code=accession_code).exists()
+
+
 def _extract_gz(file_path: str, accession_code: str) -> List[str]:
     """Extract gz and return a list of the raw files.
     """
@@ -213,8 +222,7 @@ def _extract_gz(file_path: str, accession_code: str) -> List[str]:
 
         extracted_filepath = file_path.replace('.gz', '')
         with gzip.open(file_path, 'rb') as f_in:
-            with open(extracted_filepath, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+            utils.write_and_hash(f_in, extracted_filepath, CHUNK_SIZE)
 
         files = [{'absolute_path': extracted_filepath,
                   'filename': extracted_filepath.rsplit('/', 1)[1]
@@ -275,8 +283,7 @@ def _get_actual_file_if_queueable(
         actual_file.is_archive = False
         actual_file.absolute_file_path = extracted_subfile['absolute_path']
         actual_file.filename = extracted_subfile['filename']
-        actual_file.calculate_size()
-        actual_file.calculate_sha1()
+        utils.record_size_and_sha1(actual_file)
         actual_file.has_raw = True
         actual_file.source_url = original_file.source_url
         actual_file.source_filename = original_file.source_filename
@@ -341,8 +348,11 @@ def download_geo(job_id: int) -> None:
 
     # These files are tarred, and also subsequently gzipped
     if '.tar' in dl_file_path:
+        def should_extract(filename):
+            return _is_known_sample(_get_sample_accession_from_raw_filename(filename))
+
         try:
-            extracted_files = _extract_tar(dl_file_path, accession_code)
+            extracted_files = _extract_tar(dl_file_path, accession_code, should_extract)
         except Exception as e:
             job.failure_reason = e
             logger.exception(
@@ -352,50 +362,44 @@ def download_geo(job_id: int) -> None:
 
         for og_file in extracted_files:
 
-            filename = og_file['filename']
-            if '_' in filename:
-                sample_id = filename.split('_')[0]
-            else:
-                sample_id = filename.split('.')[0]
+            filename = og_file.get('archive_filename', og_file['filename'])
+            sample_id = _get_sample_accession_from_raw_filename(filename)
 
             try:
                 sample = Sample.objects.get(accession_code=sample_id)
             except Exception as e:
                 # We don't have this sample, but it's not a total failure. This happens.
+                os.remove(og_file["absolute_path"])
                 continue
 
             # We don't want RNA-Seq data from GEO:
             # https://github.com/AlexsLemonade/refinebio/issues/966
             if sample.technology == 'RNA-SEQ':
                 logger.warn("RNA-Seq sample found in GEO downloader job.", sample=sample)
+                os.remove(og_file["absolute_path"])
                 continue
 
             try:
-                # Files from the GEO supplemental file are gzipped inside of the tarball. Great!
-                archive_file = OriginalFile.objects.get(source_filename__contains=sample_id)
-                archive_file.is_downloaded = True
-                archive_file.is_archive = True
-                archive_file.absolute_file_path = og_file['absolute_path']
-                archive_file.calculate_size()
-                archive_file.calculate_sha1()
-                archive_file.save()
-
-                if '.gz' in og_file['filename']:
-                    extracted_subfile = _extract_gz(og_file['absolute_path'], accession_code)
-                else:
-                    extracted_subfile = [og_file]
+                if 'archive_filename' in og_file:
+                    # Files from the GEO supplemental file are gzipped
+                    # inside of the tarball. Great! They were
+                    # decompressed while being extracted, so the gzipped
+                    # file was never written but record what it was.
+                    archive_file = OriginalFile.objects.get(source_filename__contains=sample_id)
+                    archive_file.is_downloaded = False
+                    archive_file.is_archive = True
+                    archive_file.absolute_file_path = og_file['absolute_path'] + '.gz'
+                    archive_file.size_in_bytes = og_file['archive_size']
+                    archive_file.sha1 = og_file['archive_sha1']
+                    archive_file.save()
 
                 # Check if the OriginalFile for the file contained
                 # within the archive exists already, create it if it
                 # doesn't, and then check if we actually need to queue
                 # it for processing or not.
-                actual_file = _get_actual_file_if_queueable(extracted_subfile[0], original_file, [sample])
+                actual_file = _get_actual_file_if_queueable(og_file, original_file, [sample])
                 if actual_file:
                     unpacked_sample_files.append(actual_file)
-
-                archive_file.delete_local_file()
-                archive_file.is_downloaded = False
-                archive_file.save()
             except Exception as e:
                 # TODO - is this worth failing a job for?
                 logger.debug("Found a file we didn't have an OriginalFile for! Why did this happen?: "
@@ -413,8 +417,14 @@ def download_geo(job_id: int) -> None:
         if '_family.xml.tgz' in dl_file_path:
             has_raw = False
 
+        # Only the sample tables are used, so don't bother writing
+        # the family XML or the platform tables.
+        def should_extract(filename):
+            return ('.txt' in filename
+                    and _is_known_sample(_get_sample_accession_from_miniml_filename(filename)))
+
         try:
-            extracted_files = _extract_tgz(dl_file_path, accession_code)
+            extracted_files = _extract_tgz(dl_file_path, accession_code, should_extract)
         except Exception as e:
             job.failure_reason = e
             logger.exception("Error occured while extracting tgz file.",
@@ -425,27 +435,26 @@ def download_geo(job_id: int) -> None:
 
         for og_file in extracted_files:
 
-            if '.txt' in og_file['filename']:
-                try:
-                    gsm_id = og_file['filename'].split('-')[0]
-                    sample = Sample.objects.get(accession_code=gsm_id)
-                except Exception as e:
-                    os.remove(og_file["absolute_path"])
-                    continue
+            try:
+                gsm_id = _get_sample_accession_from_miniml_filename(og_file['filename'])
+                sample = Sample.objects.get(accession_code=gsm_id)
+            except Exception as e:
+                os.remove(og_file["absolute_path"])
+                continue
 
-                # We don't want RNA-Seq data from GEO:
-                # https://github.com/AlexsLemonade/refinebio/issues/966
-                if sample.technology == 'RNA-SEQ':
-                    logger.warn("RNA-Seq sample found in GEO downloader job.", sample=sample)
-                    continue
+            # We don't want RNA-Seq data from GEO:
+            # https://github.com/AlexsLemonade/refinebio/issues/966
+            if sample.technology == 'RNA-SEQ':
+                logger.warn("RNA-Seq sample found in GEO downloader job.", sample=sample)
+                continue
 
-                # Check if the OriginalFile for the file contained
-                # within the archive exists already, create it if it
-                # doesn't, and then check if we actually need to queue
-                # it for processing or not.
-                actual_file = _get_actual_file_if_queueable(og_file, original_file, [sample])
-                if actual_file:
-                    unpacked_sample_files.append(actual_file)
+            # Check if the OriginalFile for the file contained
+            # within the archive exists already, create it if it
+            # doesn't, and then check if we actually need to queue
+            # it for processing or not.
+            actual_file = _get_actual_file_if_queueable(og_file, original_file, [sample])
+            if actual_file:
+                unpacked_sample_files.append(actual_file)
 
     # These files are only gzipped.
     # These are generally the _actually_ raw (rather than the non-raw data in a RAW file) data
@@ -474,8 +483,7 @@ def download_geo(job_id: int) -> None:
                 archive_file.is_downloaded = True
                 archive_file.is_archive = True
                 archive_file.absolute_file_path = dl_file_path
-                archive_file.calculate_size()
-                archive_file.calculate_sha1()
+                utils.record_size_and_sha1(archive_file)
                 archive_file.save()
 
                 # Check if the OriginalFile for the file contained
@@ -508,8 +516,7 @@ def download_geo(job_id: int) -> None:
         actual_file.is_archive = False
         actual_file.absolute_file_path = dl_file_path
         actual_file.filename = filename
-        actual_file.calculate_size()
-        actual_file.calculate_sha1()
+        utils.record_size_and_sha1(actual_file)
         actual_file.has_raw = True
         actual_file.source_url = original_file.source_url
         actual_file.source_filename = original_file.source_filename
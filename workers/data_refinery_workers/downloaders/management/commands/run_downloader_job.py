@@ -1,8 +1,13 @@
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
 from django.core.management.base import BaseCommand
+from django.db import connection
 from data_refinery_common.job_lookup import Downloaders
 from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.models import DownloaderJob
+from data_refinery_common.utils import get_env_variable_gracefully
+from data_refinery_workers.downloaders import utils
 from data_refinery_workers.downloaders.array_express import download_array_express
 from data_refinery_workers.downloaders.transcriptome_index import download_transcriptome
 from data_refinery_workers.downloaders.sra import download_sra
@@ -11,6 +16,48 @@ from data_refinery_workers.downloaders.geo import download_geo
 
 logger = get_and_configure_logger(__name__)
 
+# Only sources whose files are small enough for one Nomad job to get
+# through a batch of them are worth batching.
+BATCHABLE_DOWNLOADERS = [Downloaders.ARRAY_EXPRESS, Downloaders.GEO]
+MAX_BATCH_CONCURRENCY = int(get_env_variable_gracefully("MAX_BATCH_CONCURRENCY", "4"))
+
+
+def run_downloader_in_thread(downloader, job_id: int) -> None:
+    """Runs one job of a batch.
+
+    Downloaders exit the process when they're done with a job, so
+    that has to be caught here to keep the rest of the batch going.
+    """
+    try:
+        downloader(job_id)
+    except SystemExit:
+        pass
+    except Exception:
+        logger.exception("Batched downloader job failed.", downloader_job=job_id)
+    finally:
+        # Each thread gets its own database connection.
+        connection.close()
+
+
+def run_batch(downloader, job_id: int, batch_size: int) -> None:
+    """Runs the job `job_id` along with up to `batch_size - 1` other
+    pending jobs from the same source, several at a time. Their
+    processor jobs are all created once the batch is done."""
+    job = DownloaderJob.objects.get(id=job_id)
+    job_ids = [job_id] + [claimed_job.id for claimed_job
+                          in utils.claim_downloader_jobs(job, batch_size - 1)]
+
+    logger.info("Running batch of downloader jobs.",
+                downloader_job=job_id,
+                downloader_task=job.downloader_task,
+                batch=job_ids)
+
+    utils.register_signal_handlers()
+    with utils.deferred_processor_job_creation():
+        with ThreadPoolExecutor(max_workers=min(len(job_ids), MAX_BATCH_CONCURRENCY)) as executor:
+            for claimed_job_id in job_ids:
+                executor.submit(run_downloader_in_thread, downloader, claimed_job_id)
+
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
@@ -22,6 +69,12 @@ class Command(BaseCommand):
             "--job-id",
             type=int,
             help=("The downloader job's ID."))
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1,
+            help=("How many pending jobs from the same source to run along with this one."
+                  " Only used for sources with small files."))
 
     def handle(self, *args, **options):
         if options["job_id"] is None:
@@ -35,13 +88,13 @@ class Command(BaseCommand):
             sys.exit(1) 
 
         if job_type is Downloaders.ARRAY_EXPRESS:
-            download_array_express(options["job_id"])
+            downloader = download_array_express
         elif job_type is Downloaders.TRANSCRIPTOME_INDEX:
-            download_transcriptome(options["job_id"])
+            downloader = download_transcriptome
         elif job_type is Downloaders.SRA:
-            download_sra(options["job_id"])
+            downloader = download_sra
         elif job_type is Downloaders.GEO:
-            download_geo(options["job_id"])
+            downloader = download_geo
         else:
             logger.error(("A valid job name was specified for job %s with id %d but "
                           "no downloader function is known to run it."),
@@ -49,4 +102,9 @@ class Command(BaseCommand):
                          options["job_id"])
             sys.exit(1) 
 
+        if options["batch_size"] > 1 and job_type in BATCHABLE_DOWNLOADERS:
+            run_batch(downloader, options["job_id"], options["batch_size"])
+        else:
+            downloader(options["job_id"])
+
         sys.exit(0) 
@@ -1,10 +1,5 @@
-from contextlib import closing
-from typing import List
-from django.utils import timezone
+from typing import List, Tuple
 import os
-import shutil
-import subprocess
-import time
 import urllib.request
 
 from data_refinery_common.logging import get_and_configure_logger
@@ -14,28 +9,25 @@ from data_refinery_common.models import (
     OriginalFile,
 )
 from data_refinery_common.utils import get_env_variable, get_fasp_sra_download
-from data_refinery_workers.downloaders import utils
+from data_refinery_workers.downloaders import aspera, utils
 
 logger = get_and_configure_logger(__name__)
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
 # chunk_size is in bytes
 CHUNK_SIZE = 1024 * 256
 
-def _download_file(download_url: str,
-                   downloader_job: DownloaderJob,
-                   target_file_path: str,
-                   force_ftp: bool=False) -> bool:
-    """ Download file dispatcher. Dispatches to the FTP or Aspera downloader """
-
+def _get_aspera_url(download_url: str) -> Tuple[str, str]:
+    """Returns the Aspera location of `download_url` and which source's
+    Aspera server it's on, or (None, None) if it can't be had via Aspera."""
     # SRA files have Apsera downloads.
-    if 'ftp.sra.ebi.ac.uk' in download_url and not force_ftp:
+    if 'ftp.sra.ebi.ac.uk' in download_url:
         # From: ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR036/ERR036000/ERR036000_1.fastq.gz
         # To: era-fasp@fasp.sra.ebi.ac.uk:/vol1/fastq/ERR036/ERR036000/ERR036000_1.fastq.gz
         download_url = download_url.replace('ftp://', 'era-fasp@')
         download_url = download_url.replace('ftp', 'fasp')
         download_url = download_url.replace('.uk/', '.uk:/')
-        return _download_file_aspera(download_url, downloader_job, target_file_path, source="ENA")
-    elif "ncbi.nlm.nih.gov" in download_url and not force_ftp:
+        return download_url, "ENA"
+    elif "ncbi.nlm.nih.gov" in download_url:
         # Try to convert old-style endpoints into new-style endpoints if possible
         try:
             if 'anonftp' in download_url:
@@ -45,7 +37,19 @@ def _download_file(download_url: str,
                     download_url = new_url
         except Exception:
             pass
-        return _download_file_aspera(download_url, downloader_job, target_file_path, source="NCBI")
+        return download_url, "NCBI"
+    else:
+        return None, None
+
+
+def _download_file(download_url: str,
+                   downloader_job: DownloaderJob,
+                   target_file_path: str,
+                   force_ftp: bool=False) -> bool:
+    """ Download file dispatcher. Dispatches to the FTP or Aspera downloader """
+    aspera_url, source = _get_aspera_url(download_url)
+    if aspera_url and not force_ftp:
+        return _download_file_aspera(aspera_url, downloader_job, target_file_path, source=source)
     else:
         return _download_file_ftp(download_url, downloader_job, target_file_path)
 
@@ -61,9 +65,7 @@ def _download_file_ftp(download_url: str, downloader_job: DownloaderJob, target_
         # Ancient unresolved bug. WTF python: https://bugs.python.org/issue27973
         urllib.request.urlcleanup()
 
-        with closing(urllib.request.urlopen(download_url)) as request:
-            with open(target_file_path, "wb") as target_file:
-                shutil.copyfileobj(request, target_file, CHUNK_SIZE)
+        utils.download_file(download_url, target_file_path, CHUNK_SIZE)
 
         urllib.request.urlcleanup()
     except Exception:
@@ -84,90 +86,10 @@ def _download_file_aspera(download_url: str,
                           source="NCBI"
                           ) -> bool:
     """ Download a file to a location using Aspera by shelling out to the `ascp` client. """
-
-    try:
-        logger.debug("Downloading file from %s to %s via Aspera.",
-                     download_url,
-                     target_file_path,
-                     downloader_job=downloader_job.id)
-
-        if source is "ENA":
-            # aspera.sra.ebi.ac.uk users port 33001 for SSH communication
-            # We are also NOT using encryption (-T) to avoid slowdown,
-            # and we are not using any kind of rate limiting.
-            command_str = ".aspera/cli/bin/ascp -P33001 -i .aspera/cli/etc/asperaweb_id_dsa.openssh {src} {dest}"
-            formatted_command = command_str.format(src=download_url,
-                                                   dest=target_file_path)
-            completed_command = subprocess.run(formatted_command.split(),
-                                               stdout=subprocess.PIPE,
-                                               stderr=subprocess.PIPE)
-        else:
-            # NCBI requires encryption and recommends -k1 resume, as well as the 450m limit and -Q (play fair).
-            # ex: https://github.com/AlexsLemonade/refinebio/pull/1189#issuecomment-478018580
-            command_str = ".aspera/cli/bin/ascp -p -Q -T -k1 -l 450m -i .aspera/cli/etc/asperaweb_id_dsa.openssh {src} {dest}"
-            formatted_command = command_str.format(src=download_url,
-                                                   dest=target_file_path)
-            logger.info("Starting NCBI ascp", time=str(timezone.now()))
-            completed_command = subprocess.run(formatted_command.split(),
-                                               stdout=subprocess.PIPE,
-                                               stderr=subprocess.PIPE)
-            logger.info("Ending NCBI ascp", time=str(timezone.now()))
-
-        # Something went wrong! Else, just fall through to returning True.
-        if completed_command.returncode != 0:
-
-            stdout = completed_command.stdout.decode().strip()
-            stderr = completed_command.stderr.decode().strip()
-            logger.debug("Shell call of `%s` to ascp failed with error message: %s",
-                         formatted_command,
-                         stderr,
-                         downloader_job=downloader_job.id)
-
-            # Sometimes, Aspera fails mysteriously.
-            # Wait a few minutes and try again.
-            if attempt > 5:
-                logger.info("Final shell call of `%s` to ascp failed with error message: %s",
-                         formatted_command,
-                         stderr + "\nSTDOUT: " + stdout,
-                         downloader_job=downloader_job.id)
-                downloader_job.failure_reason = "stderr:\n " + stderr + "\nstdout:\n " + stdout
-                return False
-            else:
-                time.sleep(5)
-                return _download_file_aspera(download_url,
-                                             downloader_job,
-                                             target_file_path,
-                                             attempt + 1,
-                                             source
-                                             )
-    except Exception:
-        logger.exception("Exception caught while downloading file from the URL via Aspera: %s",
-                         download_url,
-                         downloader_job=downloader_job.id)
-        downloader_job.failure_reason = ("Exception caught while downloading "
-                                         "file from the URL via Aspera: {}").format(download_url)
-        return False
-
-    # If Aspera has given a zero-byte file for some reason, let's back off and retry.
-    if (not os.path.exists(target_file_path)) or (os.path.getsize(target_file_path) < 1):
-        if os.path.exists(target_file_path):
-            os.remove(target_file_path)
-
-        if attempt > 5:
-            downloader_job.failure_reason = "Got zero byte file from aspera after 5 attempts."
-            return False
-
-        logger.error("Got zero byte ascp download for target, retrying.",
-                     target_url=download_url,
-                     downloader_job=downloader_job.id)
-        time.sleep(10)
-        return _download_file_aspera(download_url,
-                                     downloader_job,
-                                     target_file_path,
-                                     attempt + 1,
-                                     source
-                                     )
-    return True
+    return aspera.download_files([(download_url, target_file_path)],
+                                 source=source,
+                                 downloader_job=downloader_job,
+                                 attempts_made=attempt)
 
 
 def download_sra(job_id: int) -> None:
@@ -179,6 +101,7 @@ def download_sra(job_id: int) -> None:
     file_assocs = DownloaderJobOriginalFileAssociation.objects.filter(downloader_job=job)
 
     downloaded_files = []
+    files_to_download = []
     success = None
     for assoc in file_assocs:
         original_file = assoc.original_file
@@ -196,20 +119,41 @@ def download_sra(job_id: int) -> None:
         os.makedirs(exp_path, exist_ok=True)
         os.makedirs(samp_path, exist_ok=True)
         dl_file_path = samp_path + '/' + original_file.source_filename
-        success = _download_file(original_file.source_url, job, dl_file_path)
+        files_to_download.append((original_file, dl_file_path))
+
+    # Paired reads come from the same server, so they can share one
+    # Aspera session.
+    aspera_pairs = {}
+    ftp_files = []
+    for original_file, dl_file_path in files_to_download:
+        aspera_url, source = _get_aspera_url(original_file.source_url)
+        if aspera_url:
+            aspera_pairs.setdefault(source, []).append((aspera_url, dl_file_path))
+        else:
+            ftp_files.append((original_file, dl_file_path))
+
+    for source, pairs in aspera_pairs.items():
+        success = aspera.download_files(pairs, source=source, downloader_job=job)
+        if not success:
+            break
+
+    if success is not False:
+        for original_file, dl_file_path in ftp_files:
+            success = _download_file_ftp(original_file.source_url, job, dl_file_path)
+            if not success:
+                break
 
-        if success:
+    if success:
+        for original_file, dl_file_path in files_to_download:
             original_file.is_downloaded = True
             original_file.absolute_file_path = dl_file_path
             original_file.filename = original_file.source_filename
             original_file.is_archive = False
-            original_file.calculate_size()
-            original_file.calculate_sha1()
+            # Downloads made with ascp get rehashed here.
+            utils.record_size_and_sha1(original_file)
             original_file.save()
 
             downloaded_files.append(original_file)
-        else:
-            break
 
     if success:
         utils.create_processor_job_for_original_files(downloaded_files, job)
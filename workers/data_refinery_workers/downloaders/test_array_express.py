@@ -24,7 +24,7 @@ class DownloadArrayExpressTestCase(TestCase):
         self.survey_job = survey_job
 
     @tag('downloaders')
-    @patch('data_refinery_workers.downloaders.utils.send_job')
+    @patch('data_refinery_workers.downloaders.utils.message_queue.send_job')
     def test_download_and_extract_file(self, mock_send_job):
         dlj = DownloaderJob()
         dlj.save()
@@ -32,7 +32,7 @@ class DownloadArrayExpressTestCase(TestCase):
         files = array_express._extract_files('dlme.zip', '123', dlj)
 
     @tag('downloaders')
-    @patch('data_refinery_workers.downloaders.utils.send_job')
+    @patch('data_refinery_workers.downloaders.utils.message_queue.send_job')
     def test_download_multiple_zips(self, mock_send_job):
         """Tests that each sample gets one processor job no matter what.
 
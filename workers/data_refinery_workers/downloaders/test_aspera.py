@@ -0,0 +1,106 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.test import TestCase, tag
+from unittest.mock import patch
+
+from data_refinery_common.models import DownloaderJob
+from data_refinery_workers.downloaders import aspera
+
+
+ASCP_OUTPUT = (
+    "SRR1234567_1.fastq.gz     45%  1094MB  448Mb/s    00:20 ETA\r"
+    "SRR1234567_1.fastq.gz    100%  2432MB  450Mb/s    00:45\n"
+    "SRR1234567_2.fastq.gz    100%  2432MB  446Mb/s    00:45\n"
+    "Completed: 4980736K bytes transferred in 90 seconds\n"
+    " (453315K bits/sec), in 2 files.\n"
+)
+
+
+class AsperaTestCase(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.job = DownloaderJob()
+        self.job.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    @tag('downloaders')
+    def test_parse_progress(self):
+        metrics = aspera.parse_progress(ASCP_OUTPUT)
+
+        self.assertEqual(metrics["bytes"], 4980736 * 1024)
+        self.assertEqual(metrics["seconds"], 90)
+        self.assertEqual(metrics["bits_per_second"], 453315 * 1000)
+        self.assertEqual(metrics["files"]["SRR1234567_1.fastq.gz"], {"percent": 100, "rate": "450Mb/s"})
+        self.assertEqual(metrics["files"]["SRR1234567_2.fastq.gz"]["rate"], "446Mb/s")
+
+    @tag('downloaders')
+    def test_rate_limit(self):
+        self.assertEqual(aspera.get_rate_limit("ENA", "unlimited"), None)
+        self.assertEqual(aspera.get_rate_limit("ENA", "low"), 100)
+        self.assertEqual(aspera.get_rate_limit("NCBI", "unlimited"), 450)
+        self.assertEqual(aspera.get_rate_limit("NCBI", "high"), 450)
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.aspera.time.sleep')
+    @patch('data_refinery_workers.downloaders.aspera.subprocess.run')
+    def test_download_files(self, mock_run, mock_sleep):
+        pairs = [
+            ("era-fasp@fasp.sra.ebi.ac.uk:/vol1/fastq/SRR123/SRR1234567/SRR1234567_1.fastq.gz",
+             os.path.join(self.work_dir, "SRR1234567_1.fastq.gz")),
+            ("era-fasp@fasp.sra.ebi.ac.uk:/vol1/fastq/SRR123/SRR1234567/SRR1234567_2.fastq.gz",
+             os.path.join(self.work_dir, "SRR1234567_2.fastq.gz")),
+        ]
+        file_pair_lists = []
+
+        def run_ascp(command, **kwargs):
+            file_pair_list = [arg for arg in command if arg.startswith("--file-pair-list=")][0]
+            with open(file_pair_list.split("=", 1)[1]) as pair_file:
+                file_pair_lists.append(pair_file.read().split())
+
+            # The first attempt fails partway through the second file.
+            if len(file_pair_lists) == 1:
+                with open(pairs[0][1], "w") as target_file:
+                    target_file.write("reads")
+                return subprocess.CompletedProcess(command, 1, b"", b"Session Stop")
+
+            for _, target_path in pairs:
+                with open(target_path, "w") as target_file:
+                    target_file.write("reads")
+            return subprocess.CompletedProcess(command, 0, ASCP_OUTPUT.encode(), b"")
+
+        mock_run.side_effect = run_ascp
+
+        self.assertTrue(aspera.download_files(pairs, "ENA", self.job))
+
+        # Both files go through one session each attempt.
+        self.assertEqual(mock_run.call_count, 2)
+        self.assertEqual(file_pair_lists[1], [
+            "/vol1/fastq/SRR123/SRR1234567/SRR1234567_1.fastq.gz", "SRR1234567_1.fastq.gz",
+            "/vol1/fastq/SRR123/SRR1234567/SRR1234567_2.fastq.gz", "SRR1234567_2.fastq.gz",
+        ])
+        command = mock_run.call_args[0][0]
+        self.assertIn("--host=fasp.sra.ebi.ac.uk", command)
+        self.assertIn("-P33001", command)
+        self.assertEqual(command[-1], self.work_dir)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.aspera.time.sleep')
+    @patch('data_refinery_workers.downloaders.aspera.subprocess.run')
+    def test_download_files_gives_up(self, mock_run, mock_sleep):
+        mock_run.return_value = subprocess.CompletedProcess([], 1, b"", b"Server aborted session")
+        target_path = os.path.join(self.work_dir, "GSE1234_RAW.tar")
+
+        self.assertFalse(aspera.download_files(
+            [("anonftp@ftp-trace.ncbi.nlm.nih.gov:/geo/series/GSE1nnn/GSE1234/suppl/GSE1234_RAW.tar",
+              target_path)],
+            "GEO",
+            self.job
+        ))
+        self.assertEqual(mock_run.call_count, aspera.MAX_ATTEMPTS)
+        self.assertIn("Server aborted session", self.job.failure_reason)
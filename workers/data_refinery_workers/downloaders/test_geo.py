@@ -31,7 +31,7 @@ class DownloadGeoTestCase(TestCase):
         geo._download_file('ftp://ftp.ncbi.nlm.nih.gov/geo/series/GSE10nnn/GSE10241/miniml/GSE10241_family.xml.tgz', '/home/user/data_store/GSE10241/raw/GSE10241_family.xml.tgz', dlj)
         files = geo._extract_tgz('/home/user/data_store/GSE10241/raw/GSE10241_family.xml.tgz', 'GSE10241')
 
-        self.assertEqual(8, len(files))
+        self.assertEqual(6, len(files))
 
         # GPL File
         self.assertTrue(os.path.isfile('/home/user/data_store/GSE10241/raw/GPL6102-tbl-1.txt'))
@@ -45,7 +45,16 @@ class DownloadGeoTestCase(TestCase):
         # Original family file
         self.assertTrue(os.path.isfile('/home/user/data_store/GSE10241/raw/GSE10241_family.xml'))
         self.assertTrue(os.path.isfile('/home/user/data_store/GSE10241/raw/GSE10241_family.xml.tgz'))
-        self.assertTrue(os.path.isfile('/home/user/data_store/GSE10241/raw/GSE10241_family.xml.tar'))
+        # The tarball is streamed rather than decompressed to disk first.
+        self.assertFalse(os.path.isfile('/home/user/data_store/GSE10241/raw/GSE10241_family.xml.tar'))
+
+        # Only the members we ask for are written.
+        files = geo._extract_tgz('/home/user/data_store/GSE10241/raw/GSE10241_family.xml.tgz',
+                                 'GSE10241_FILTERED',
+                                 lambda filename: filename.startswith('GSM258515'))
+        self.assertEqual(['GSM258515-tbl-1.txt'], [f['filename'] for f in files])
+        self.assertEqual(['GSM258515-tbl-1.txt'],
+                         os.listdir('/home/user/data_store/GSE10241_FILTERED/raw/'))
 
         # .txt.gz
         geo._download_file('ftp://ftp.ncbi.nlm.nih.gov/geo/samples/GSM254nnn/GSM254828/suppl/GSM254828.txt.gz', '/home/user/data_store/GSM254828/raw/GSM254828.txt.gz', dlj)
@@ -114,7 +123,7 @@ class DownloadGeoTestCase(TestCase):
 
 
     @tag('downloaders')
-    @patch('data_refinery_workers.downloaders.utils.send_job')
+    @patch('data_refinery_workers.downloaders.utils.message_queue.send_job')
     def test_download_geo(self, mock_send_task):
         """ Tests the main 'download_geo' function. """
 
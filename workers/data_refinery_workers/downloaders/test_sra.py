@@ -59,7 +59,7 @@ class DownloadSraTestCase(TestCase):
 
     @tag('downloaders')
     @tag('downloaders_sra')
-    @patch('data_refinery_workers.downloaders.utils.send_job')
+    @patch('data_refinery_workers.downloaders.utils.message_queue.send_job')
     def test_download_file_ncbi(self, mock_send_job):
         mock_send_job.return_value = None
         
@@ -90,7 +90,7 @@ class DownloadSraTestCase(TestCase):
 
     @tag('downloaders')
     @tag('downloaders_sra')
-    @patch('data_refinery_workers.downloaders.utils.send_job')
+    @patch('data_refinery_workers.downloaders.utils.message_queue.send_job')
     def test_download_file_swapper(self, mock_send_job):
         mock_send_job.return_value = None
         
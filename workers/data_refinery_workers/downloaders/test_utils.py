@@ -1,13 +1,35 @@
+import fcntl
+import ftplib
+import hashlib
+import io
 import os
 import psutil
+import shutil
+import sys
+import tempfile
 
 from django.test import TestCase, tag
+from django.utils import timezone
 from typing import List
-from unittest.mock import patch, call
+from unittest.mock import MagicMock, patch, call
 from urllib.error import URLError
 
+from data_refinery_common.job_lookup import ProcessorPipeline
+from data_refinery_common.models import (
+    DownloaderJob,
+    DownloaderJobOriginalFileAssociation,
+    OriginalFile,
+    OriginalFileSampleAssociation,
+    ProcessorJob,
+    Sample,
+)
+from data_refinery_common.utils import calculate_sha1
 from data_refinery_workers.downloaders import utils
 
+
+def calculate_sha1_of(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
 class UtilsTestCase(TestCase):
     @tag('downloaders')
     def test_no_jobs_to_create(self):
@@ -27,3 +49,503 @@ class UtilsTestCase(TestCase):
         # We're not going to run our tests on a prod box, so this should always be True.
         self.assertNotEqual(max_jobs, 8)
         self.assertNotEqual(max_jobs, None)
+
+
+class BatchTestCase(TestCase):
+    def tearDown(self):
+        utils.CLAIMED_JOB_IDS.clear()
+        utils.CURRENT_JOBS.clear()
+        utils.STOPPING.clear()
+
+    def create_downloader_job(self, downloader_task: str, file_size: int=1024, **kwargs) -> DownloaderJob:
+        job = DownloaderJob(downloader_task=downloader_task, **kwargs)
+        job.save()
+
+        original_file = OriginalFile(filename="GSM" + str(job.id) + ".CEL",
+                                     source_filename="GSM" + str(job.id) + ".CEL",
+                                     size_in_bytes=file_size)
+        original_file.save()
+        DownloaderJobOriginalFileAssociation.objects.create(downloader_job=job,
+                                                            original_file=original_file)
+        return job
+
+    def create_affy_files(self, accession_codes: List[str]) -> List[OriginalFile]:
+        original_files = []
+        for accession_code in accession_codes:
+            sample = Sample(accession_code=accession_code,
+                            source_database="GEO",
+                            technology="MICROARRAY",
+                            manufacturer="AFFYMETRIX",
+                            platform_accession_code="hgu133plus2")
+            sample.save()
+            original_file = OriginalFile(filename=accession_code + ".CEL",
+                                         source_filename=accession_code + ".CEL")
+            original_file.save()
+            OriginalFileSampleAssociation.objects.create(original_file=original_file,
+                                                         sample=sample)
+            original_files.append(original_file)
+
+        return original_files
+
+    @tag('downloaders')
+    def test_claim_downloader_jobs(self):
+        leader = self.create_downloader_job("GEO",
+                                            nomad_job_id="DOWNLOADER_1_1024/dispatch-1",
+                                            volume_index="1")
+        # Too big to be worth batching.
+        self.create_downloader_job("GEO", file_size=utils.MAX_BATCH_JOB_SIZE + 1)
+        # The Foreman placed this one on another volume.
+        self.create_downloader_job("GEO", volume_index="2")
+        pending = [self.create_downloader_job("GEO", volume_index=volume_index)
+                   for volume_index in [None, "1", None]]
+        # None of these can be claimed.
+        self.create_downloader_job("SRA")
+        self.create_downloader_job("GEO", start_time=timezone.now())
+        self.create_downloader_job("GEO", no_retry=True)
+
+        claimed = utils.claim_downloader_jobs(leader, 2)
+
+        self.assertEqual([job.id for job in claimed], [job.id for job in pending[:2]])
+        self.assertEqual(utils.CLAIMED_JOB_IDS, {job.id for job in pending[:2]})
+        for job in pending:
+            job.refresh_from_db()
+        self.assertEqual(pending[0].nomad_job_id, leader.nomad_job_id)
+        self.assertEqual(pending[1].nomad_job_id, leader.nomad_job_id)
+        self.assertIsNone(pending[2].nomad_job_id)
+
+        # Claimed jobs are marked as started so nothing else claims or
+        # starts them, except for the process that claimed them.
+        self.assertIsNotNone(pending[0].start_time)
+        self.assertIsNone(pending[2].start_time)
+        self.assertEqual(utils.claim_downloader_jobs(leader, 2), [pending[2]])
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.message_queue.send_job')
+    def test_deferred_processor_job_creation(self, mock_send_job):
+        original_files = self.create_affy_files(["GSM1", "GSM2"])
+
+        with utils.deferred_processor_job_creation():
+            utils.create_processor_jobs_for_original_files(original_files[:1])
+            utils.create_processor_jobs_for_original_files(original_files[1:])
+            self.assertEqual(ProcessorJob.objects.count(), 0)
+
+        self.assertEqual(ProcessorJob.objects.count(), 2)
+        self.assertEqual(mock_send_job.call_count, 2)
+        for original_file in original_files:
+            processor_job = original_file.processor_jobs.get()
+            self.assertEqual(processor_job.pipeline_applied, ProcessorPipeline.AFFY_TO_PCL.value)
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.message_queue.send_job')
+    def test_downloader_jobs_end_with_processor_jobs(self, mock_send_job):
+        original_files = self.create_affy_files(["GSM1", "GSM2"])
+        finished_job = self.create_downloader_job("GEO", start_time=timezone.now())
+        killed_job = self.create_downloader_job("GEO", start_time=timezone.now())
+
+        with utils.deferred_processor_job_creation():
+            utils.create_processor_jobs_for_original_files(original_files[:1], finished_job)
+            utils.end_downloader_job(finished_job, success=True)
+
+            finished_job.refresh_from_db()
+            self.assertIsNone(finished_job.success)
+            self.assertIsNone(finished_job.end_time)
+
+        finished_job.refresh_from_db()
+        self.assertTrue(finished_job.success)
+        self.assertEqual(original_files[0].processor_jobs.count(), 1)
+
+        # If the batch dies before its processor jobs are saved, the
+        # downloader job is left for the Foreman to retry.
+        with self.assertRaises(SystemExit):
+            with utils.deferred_processor_job_creation():
+                utils.create_processor_jobs_for_original_files(original_files[1:], killed_job)
+                utils.end_downloader_job(killed_job, success=True)
+                sys.exit(0)
+
+        killed_job.refresh_from_db()
+        self.assertIsNone(killed_job.success)
+        self.assertIsNone(killed_job.end_time)
+        self.assertEqual(original_files[1].processor_jobs.count(), 0)
+
+    @tag('downloaders')
+    def test_interrupted_jobs_stay_handed_back(self):
+        """Batch mode worker threads outlive the signal handler, so they
+        must not record the end of the jobs it handed back."""
+        running_job = self.create_downloader_job("GEO", start_time=timezone.now(), num_retries=1)
+        utils.CURRENT_JOBS[running_job.id] = running_job
+        claimed_job = self.create_downloader_job("GEO", start_time=timezone.now())
+        utils.CLAIMED_JOB_IDS.add(claimed_job.id)
+
+        with self.assertRaises(SystemExit):
+            utils.signal_handler(None, None)
+
+        # A worker thread finishing its download afterwards.
+        utils.end_downloader_job(running_job, success=True)
+        running_job.refresh_from_db()
+        self.assertIsNone(running_job.start_time)
+        self.assertIsNone(running_job.success)
+        self.assertIsNone(running_job.end_time)
+        self.assertEqual(running_job.num_retries, 0)
+
+        # One that's still downloading stops at its next chunk.
+        with self.assertRaises(Exception):
+            utils.check_stopping()
+
+        # And ones that hadn't started yet never do.
+        with self.assertRaises(SystemExit):
+            utils.start_job(claimed_job.id)
+        claimed_job.refresh_from_db()
+        self.assertIsNone(claimed_job.start_time)
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.message_queue.send_job')
+    def test_bulk_processor_job_creation(self, mock_send_job):
+        def dispatch(job_type, job, is_dispatch=False, nomad_client=None, persist=True):
+            self.assertFalse(persist)
+            job.nomad_job_id = "AFFY_TO_PCL_0_2048/dispatch-" + str(job.id)
+            return True
+        mock_send_job.side_effect = dispatch
+
+        original_files = self.create_affy_files(["GSM" + str(i) for i in range(10)])
+        utils.create_processor_jobs_for_original_files(original_files)
+
+        self.assertEqual(mock_send_job.call_count, 10)
+        # All of the jobs were sent through the same client.
+        self.assertEqual(len({mock_call[1]["nomad_client"] for mock_call in mock_send_job.call_args_list}), 1)
+        for processor_job in ProcessorJob.objects.all():
+            self.assertEqual(processor_job.nomad_job_id,
+                             "AFFY_TO_PCL_0_2048/dispatch-" + str(processor_job.id))
+            self.assertEqual(processor_job.original_files.count(), 1)
+        for sample in Sample.objects.all():
+            self.assertEqual(sample.technology, "MICROARRAY")
+
+
+class WriteAndHashTestCase(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    @tag('downloaders')
+    def test_write_and_hash(self):
+        file_path = os.path.join(self.work_dir, "GSM1234.CEL")
+        size, sha1 = utils.write_and_hash(io.BytesIO(b"A" * 1000), file_path, chunk_size=64)
+
+        self.assertEqual(size, 1000)
+        self.assertEqual(sha1, calculate_sha1(file_path))
+
+        original_file = OriginalFile()
+        original_file.absolute_file_path = file_path
+        with patch.object(OriginalFile, "calculate_sha1") as mock_calculate_sha1:
+            utils.record_size_and_sha1(original_file)
+            mock_calculate_sha1.assert_not_called()
+
+        self.assertEqual(original_file.size_in_bytes, 1000)
+        self.assertEqual(original_file.sha1, sha1)
+
+    @tag('downloaders')
+    def test_record_size_and_sha1_rehashes_other_files(self):
+        """Files written by something like ascp still get hashed."""
+        file_path = os.path.join(self.work_dir, "SRR1234.sra")
+        with open(file_path, "wb") as sra_file:
+            sra_file.write(b"B" * 1000)
+
+        original_file = OriginalFile()
+        original_file.absolute_file_path = file_path
+        utils.record_size_and_sha1(original_file)
+
+        self.assertEqual(original_file.size_in_bytes, 1000)
+        self.assertEqual(original_file.sha1, calculate_sha1(file_path))
+
+
+class ResumableDownloadTestCase(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.target_path = os.path.join(self.work_dir, "SRR1234.fastq.gz")
+        self.data = os.urandom(10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def mock_response(self, data, status):
+        response = io.BytesIO(data)
+        response.status = status
+        return response
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.urllib.request.urlopen')
+    def test_resumes_from_checkpoint(self, mock_urlopen):
+        url = "https://www.ebi.ac.uk/SRR1234.fastq.gz"
+
+        # A previous attempt wrote past its last checkpoint before dying.
+        with open(self.target_path + utils.PARTIAL_SUFFIX, "wb") as part_file:
+            part_file.write(self.data[:6000])
+        utils._save_checkpoint(url, self.target_path, 4000, calculate_sha1_of(self.data[:4000]))
+
+        mock_urlopen.return_value = self.mock_response(self.data[4000:], 206)
+        size, sha1 = utils.download_resumable(url, self.target_path)
+
+        request = mock_urlopen.call_args[0][0]
+        self.assertEqual(request.get_header("Range"), "bytes=4000-")
+        self.assertEqual(size, len(self.data))
+        self.assertEqual(sha1, calculate_sha1(self.target_path))
+        with open(self.target_path, "rb") as target_file:
+            self.assertEqual(target_file.read(), self.data)
+
+        self.assertFalse(os.path.exists(self.target_path + utils.PARTIAL_SUFFIX))
+        self.assertFalse(os.path.exists(self.target_path + utils.CHECKPOINT_SUFFIX))
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.urllib.request.urlopen')
+    def test_restarts_when_range_is_ignored(self, mock_urlopen):
+        url = "https://www.ebi.ac.uk/SRR1234.fastq.gz"
+
+        with open(self.target_path + utils.PARTIAL_SUFFIX, "wb") as part_file:
+            part_file.write(self.data[:4000])
+        utils._save_checkpoint(url, self.target_path, 4000, calculate_sha1_of(self.data[:4000]))
+
+        mock_urlopen.return_value = self.mock_response(self.data, 200)
+        size, sha1 = utils.download_resumable(url, self.target_path)
+
+        self.assertEqual(size, len(self.data))
+        with open(self.target_path, "rb") as target_file:
+            self.assertEqual(target_file.read(), self.data)
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.ftplib.FTP')
+    def test_restarts_when_rest_is_rejected(self, mock_ftp):
+        url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/SRR123/SRR1234.fastq.gz"
+
+        with open(self.target_path + utils.PARTIAL_SUFFIX, "wb") as part_file:
+            part_file.write(self.data[:4000])
+        utils._save_checkpoint(url, self.target_path, 4000, calculate_sha1_of(self.data[:4000]))
+
+        connection = MagicMock()
+        connection.makefile.return_value = io.BytesIO(self.data)
+        mock_ftp.return_value.transfercmd.side_effect = [ftplib.error_perm("502 REST not implemented"),
+                                                         connection]
+        size, sha1 = utils.download_resumable(url, self.target_path)
+
+        self.assertEqual(mock_ftp.return_value.transfercmd.call_args_list[1],
+                         call("RETR /vol1/fastq/SRR123/SRR1234.fastq.gz"))
+        self.assertEqual(size, len(self.data))
+        with open(self.target_path, "rb") as target_file:
+            self.assertEqual(target_file.read(), self.data)
+
+
+class SegmentedDownloadTestCase(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.target_path = os.path.join(self.work_dir, "E-GEOD-59071.raw.1.zip")
+        self.data = os.urandom(1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def fake_urlopen(self, request, timeout=None):
+        start, end = request.get_header("Range").split("=")[1].split("-")
+        response = io.BytesIO(self.data[int(start):int(end) + 1])
+        response.status = 206
+        return response
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.SEGMENT_SIZE', 300)
+    @patch('data_refinery_workers.downloaders.utils.urllib.request.urlopen')
+    def test_download_segmented(self, mock_urlopen):
+        mock_urlopen.side_effect = self.fake_urlopen
+        url = "https://www.ebi.ac.uk/E-GEOD-59071.raw.1.zip"
+
+        size, sha1 = utils.download_segmented(url, self.target_path, len(self.data))
+
+        self.assertEqual(mock_urlopen.call_count, 4)
+        ranges = sorted(mock_call[0][0].get_header("Range") for mock_call in mock_urlopen.call_args_list)
+        self.assertEqual(ranges, ["bytes=0-299", "bytes=300-599", "bytes=600-899", "bytes=900-999"])
+        self.assertEqual(size, len(self.data))
+        self.assertEqual(sha1, calculate_sha1_of(self.data))
+        with open(self.target_path, "rb") as target_file:
+            self.assertEqual(target_file.read(), self.data)
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.SEGMENT_SIZE', 300)
+    @patch('data_refinery_workers.downloaders.utils.urllib.request.urlopen')
+    def test_download_segmented_resumes(self, mock_urlopen):
+        mock_urlopen.side_effect = self.fake_urlopen
+        url = "https://www.ebi.ac.uk/E-GEOD-59071.raw.1.zip"
+
+        with open(self.target_path + utils.PARTIAL_SUFFIX, "wb") as part_file:
+            part_file.write(self.data[:600])
+            part_file.truncate(len(self.data))
+        utils._save_segment_checkpoint(url, self.target_path, len(self.data), [0, 1])
+
+        utils.download_segmented(url, self.target_path, len(self.data))
+
+        # Only the segments that were missing get fetched.
+        self.assertEqual(mock_urlopen.call_count, 2)
+        with open(self.target_path, "rb") as target_file:
+            self.assertEqual(target_file.read(), self.data)
+
+
+class HostConnectionSlotTestCase(TestCase):
+    def setUp(self):
+        self.slots_dir = tempfile.mkdtemp() + "/"
+
+    def tearDown(self):
+        shutil.rmtree(self.slots_dir)
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.time.sleep')
+    def test_waits_for_other_jobs_slots(self, mock_sleep):
+        host = "ftp.ncbi.nlm.nih.gov"
+
+        # Another job on the node is holding both of NCBI's slots.
+        other_job_slots = []
+        for slot in range(2):
+            slot_file = open(self.slots_dir + "{}.{}.lock".format(host, slot), "w")
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            other_job_slots.append(slot_file)
+
+        def release_slot(interval):
+            other_job_slots[1].close()
+
+        mock_sleep.side_effect = release_slot
+
+        with patch.object(utils, "CONNECTION_SLOTS_DIR", self.slots_dir):
+            with utils._host_connection_slot(host):
+                self.assertEqual(mock_sleep.call_count, 1)
+
+                # The slot is held until the block ends.
+                slot_file = open(self.slots_dir + "{}.1.lock".format(host), "w")
+                with self.assertRaises(OSError):
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            slot_file.close()
+
+        other_job_slots[0].close()
+
+
+class DownloadCacheTestCase(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.work_dir, "download_cache/")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils._get_remote_file_info')
+    def test_download_file_cached(self, mock_get_remote_file_info):
+        mock_get_remote_file_info.return_value = {"size": 4, "version": "etag-1", "ranges": True}
+        url = "ftp://ftp.ncbi.nlm.nih.gov/geo/series/GSE10nnn/GSE10241/miniml/GSE10241_family.xml.tgz"
+        downloads = []
+
+        def download(target_path):
+            downloads.append(target_path)
+            with open(target_path, "wb") as target_file:
+                target_file.write(b"GEO!")
+
+        first_path = os.path.join(self.work_dir, "first.tgz")
+        second_path = os.path.join(self.work_dir, "second.tgz")
+        with patch.object(utils, "DOWNLOAD_CACHE_DIR", self.cache_dir):
+            first_size, first_sha1 = utils.download_file_cached(url, first_path, download)
+            second_size, second_sha1 = utils.download_file_cached(url, second_path, download)
+
+            # A new version upstream means a new entry.
+            mock_get_remote_file_info.return_value = {"size": 4, "version": "etag-2", "ranges": True}
+            utils.download_file_cached(url, second_path, download)
+
+        self.assertEqual(len(downloads), 2)
+        self.assertEqual((first_size, first_sha1), (second_size, second_sha1))
+        self.assertEqual(first_sha1, calculate_sha1_of(b"GEO!"))
+        with open(second_path, "rb") as second_file:
+            self.assertEqual(second_file.read(), b"GEO!")
+
+        # Deleting the job's copy leaves the cached one.
+        os.remove(first_path)
+        self.assertTrue(os.path.exists(downloads[0]))
+
+
+class DiskLedgerTestCase(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.ledger_path = os.path.join(self.work_dir, "disk_ledger.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.shutil.disk_usage')
+    def test_reserve_and_release(self, mock_disk_usage):
+        mock_disk_usage.return_value = MagicMock(total=1000, used=0, free=1000)
+        first_job = DownloaderJob(downloader_task="SRA")
+        first_job.save()
+        second_job = DownloaderJob(downloader_task="SRA")
+        second_job.save()
+
+        with patch.multiple(utils,
+                            DISK_LEDGER_PATH=self.ledger_path,
+                            DOWNLOAD_CACHE_MAX_SIZE=0,
+                            MIN_FREE_DISK_SPACE=100):
+            self.assertTrue(utils.reserve_disk_space(first_job, 600))
+            # Only 300 bytes are left once the headroom and the first
+            # reservation are taken out.
+            self.assertFalse(utils.reserve_disk_space(second_job, 400))
+            # Nothing is known about its size, so it goes ahead.
+            self.assertTrue(utils.reserve_disk_space(second_job, 0))
+
+            utils.release_disk_space(first_job)
+            self.assertTrue(utils.reserve_disk_space(second_job, 400))
+
+            # Reservations for jobs that ended without releasing them
+            # don't count.
+            second_job.end_time = timezone.now()
+            second_job.save()
+            self.assertTrue(utils.reserve_disk_space(first_job, 800))
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.shutil.disk_usage')
+    def test_room_held_for_download_cache(self, mock_disk_usage):
+        mock_disk_usage.return_value = MagicMock(total=1000, used=100, free=900)
+        job = DownloaderJob(downloader_task="SRA")
+        job.save()
+
+        cache_dir = os.path.join(self.work_dir, "download_cache/")
+        os.makedirs(cache_dir)
+        with open(cache_dir + "entry", "wb") as cache_file:
+            cache_file.write(b"x" * 100)
+
+        with patch.multiple(utils,
+                            DISK_LEDGER_PATH=self.ledger_path,
+                            DOWNLOAD_CACHE_DIR=cache_dir,
+                            DOWNLOAD_CACHE_MAX_SIZE=300,
+                            MIN_FREE_DISK_SPACE=100):
+            # The cache can still grow by 200 bytes, which leaves 600.
+            self.assertFalse(utils.reserve_disk_space(job, 700))
+            self.assertTrue(utils.reserve_disk_space(job, 600))
+
+    @tag('downloaders')
+    @patch('data_refinery_workers.downloaders.utils.shutil.disk_usage')
+    def test_job_too_big_for_volume(self, mock_disk_usage):
+        mock_disk_usage.return_value = MagicMock(total=1000, used=0, free=1000)
+        job = DownloaderJob(downloader_task="SRA")
+        job.save()
+        original_file = OriginalFile(filename="SRR1.sra",
+                                     source_filename="SRR1.sra",
+                                     size_in_bytes=800)
+        original_file.save()
+        DownloaderJobOriginalFileAssociation.objects.create(downloader_job=job,
+                                                            original_file=original_file)
+
+        with patch.multiple(utils,
+                            DISK_LEDGER_PATH=self.ledger_path,
+                            DOWNLOAD_CACHE_MAX_SIZE=200,
+                            MIN_FREE_DISK_SPACE=100):
+            with self.assertRaises(SystemExit):
+                utils.start_job(job.id)
+
+        # It fails for good rather than being deferred forever.
+        job.refresh_from_db()
+        self.assertFalse(job.success)
+        self.assertTrue(job.no_retry)
+        self.assertIsNotNone(job.end_time)
@@ -1,8 +1,6 @@
 import os
-import shutil
 import urllib.request
 
-from contextlib import closing
 from typing import List
 
 from data_refinery_common.job_lookup import ProcessorPipeline
@@ -38,9 +36,7 @@ def _download_file(download_url: str, file_path: str, job: DownloaderJob) -> Dow
                      file_path,
                      downloader_job=job.id)
         urllib.request.urlcleanup()
-        target_file = open(file_path, "wb")
-        with closing(urllib.request.urlopen(download_url)) as request:
-            shutil.copyfileobj(request, target_file, CHUNK_SIZE)
+        utils.download_file(download_url, file_path, CHUNK_SIZE)
 
         # Ancient unresolved bug. WTF python: https://bugs.python.org/issue27973
         urllib.request.urlcleanup()
@@ -52,8 +48,6 @@ def _download_file(download_url: str, file_path: str, job: DownloaderJob) -> Dow
         job.failure_reason = failure_template % download_url
         job.success = False
         return job
-    finally:
-        target_file.close()
 
     job.success = True
     return job
@@ -94,8 +88,7 @@ def download_transcriptome(job_id: int) -> None:
         original_file.filename = original_file.source_filename
         original_file.is_archive = True
         original_file.has_raw = True
-        original_file.calculate_size()
-        original_file.calculate_sha1()
+        utils.record_size_and_sha1(original_file)
         original_file.save()
         files_to_process.append(original_file)
 
@@ -103,37 +96,25 @@ def download_transcriptome(job_id: int) -> None:
         logger.debug("Files downloaded successfully.",
                      downloader_job=job_id)
 
-        create_long_and_short_processor_jobs(files_to_process)
+        create_processor_job(files_to_process)
 
     utils.end_downloader_job(job, job.success)
 
-def create_long_and_short_processor_jobs(files_to_process):
-    """ Creates two processor jobs for the files needed for this transcriptome"""
+def create_processor_job(files_to_process):
+    """Creates a processor job which builds both the long and the short
+    index from the files for this transcriptome."""
 
-    processor_job_long = ProcessorJob()
-    processor_job_long.pipeline_applied = "TRANSCRIPTOME_INDEX_LONG"
-    processor_job_long.ram_amount = 8192
-    processor_job_long.save()
+    processor_job = ProcessorJob()
+    processor_job.pipeline_applied = ProcessorPipeline.TRANSCRIPTOME_INDEX.value
+    # Both salmon index commands run at the same time.
+    processor_job.ram_amount = 16384
+    processor_job.save()
 
     for original_file in files_to_process:
 
         assoc = ProcessorJobOriginalFileAssociation()
         assoc.original_file = original_file
-        assoc.processor_job = processor_job_long
+        assoc.processor_job = processor_job
         assoc.save()
 
-    send_job(ProcessorPipeline[processor_job_long.pipeline_applied], processor_job_long)
-
-    processor_job_short = ProcessorJob()
-    processor_job_short.pipeline_applied = "TRANSCRIPTOME_INDEX_SHORT"
-    processor_job_short.ram_amount = 8192
-    processor_job_short.save()
-
-    for original_file in files_to_process:
-
-        assoc = ProcessorJobOriginalFileAssociation()
-        assoc.original_file = original_file
-        assoc.processor_job = processor_job_short
-        assoc.save()
-
-    send_job(ProcessorPipeline[processor_job_short.pipeline_applied], processor_job_short)
+    send_job(ProcessorPipeline.TRANSCRIPTOME_INDEX, processor_job)
@@ -1,17 +1,31 @@
 import datetime
+import fcntl
+import ftplib
+import hashlib
+import json
+import os
 import psutil
+import shutil
 import signal
 import sys
+import threading
+import time
+import urllib.request
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from django.db import transaction
+from django.db.models import Q, prefetch_related_objects
 from django.conf import settings
 from django.utils import timezone
 from retrying import retry
-from typing import List, Dict
+from typing import Callable, List, Dict, Tuple
+from urllib.parse import urlparse
 
 from data_refinery_common.job_lookup import ProcessorPipeline, determine_processor_pipeline, determine_ram_amount
 from data_refinery_common.logging import get_and_configure_logger
-from data_refinery_common.message_queue import send_job
+from data_refinery_common import message_queue
+from data_refinery_common.message_queue import get_nomad_client
 from data_refinery_common.models import (
     DownloaderJob,
     DownloaderJobOriginalFileAssociation,
@@ -24,8 +38,12 @@ from data_refinery_common.models import (
     Sample,
 )
 from data_refinery_common.utils import (
+    calculate_sha1,
     get_env_variable,
+    get_env_variable_gracefully,
     get_instance_id,
+    get_volume_disk_usage,
+    get_volume_index,
 )
 
 logger = get_and_configure_logger(__name__)
@@ -34,6 +52,83 @@ SYSTEM_VERSION = get_env_variable("SYSTEM_VERSION")
 # TODO: extend this list.
 BLACKLISTED_EXTENSIONS = ["xml", "chp", "exp"]
 CURRENT_JOB = None
+# Every job this process is working on, keyed by id. In batch mode
+# there's more than one and all of them need resetting if interrupted.
+CURRENT_JOBS = {}
+# Jobs claim_downloader_jobs has claimed for this process which
+# haven't been started yet.
+CLAIMED_JOB_IDS = set()
+# Set by signal_handler. In batch mode the worker threads keep running
+# after the main thread is interrupted, so they check this to stop
+# downloading and leave their jobs as the handler reset them.
+STOPPING = threading.Event()
+# Held while a job's end is recorded so that signal_handler can't
+# reset it at the same time. Reentrant since the handler may interrupt
+# the main thread while it holds it.
+_JOB_STATE_LOCK = threading.RLock()
+# Only jobs whose files add up to less than this are claimed for a
+# batch, since the point is to save on overhead for small files.
+MAX_BATCH_JOB_SIZE = int(get_env_variable_gracefully("MAX_BATCH_JOB_MB", "100")) * 1024 ** 2
+# While not None, processor jobs are collected here instead of being
+# created straight away, along with the successful downloader jobs
+# which created them. See deferred_processor_job_creation.
+_DEFERRED_PROCESSOR_JOBS = None
+_DEFERRED_DOWNLOADER_JOBS = None
+_DEFERRED_PROCESSOR_JOBS_LOCK = threading.Lock()
+# chunk_size is in bytes
+CHUNK_SIZE = 1024 * 256
+
+# The size and SHA1 of every file written by write_and_hash, keyed by
+# absolute path, along with the mtime it had when it was written.
+_WRITTEN_FILE_HASHES = {}
+
+# Resumable downloads are written to `<target>.part` and every
+# CHECKPOINT_INTERVAL bytes the offset and SHA1 of what has been
+# written so far are saved to `<target>.part.json`.
+PARTIAL_SUFFIX = ".part"
+CHECKPOINT_SUFFIX = ".part.json"
+CHECKPOINT_INTERVAL = 1024 * 1024 * 64
+
+# Files at least this big are fetched over several connections at
+# once, each downloading one SEGMENT_SIZE byte range, because EBI and
+# ENA throttle each connection well below what our nodes can pull.
+SEGMENTED_DOWNLOAD_MIN_SIZE = 1024 * 1024 * 128
+SEGMENT_SIZE = 1024 * 1024 * 64
+MAX_CONNECTIONS_PER_DOWNLOAD = int(get_env_variable_gracefully("MAX_CONNECTIONS_PER_DOWNLOAD", "4"))
+# Caps on how many connections all of the downloader jobs on a node
+# will hold open to a single host together so that we don't get
+# banned. Hosts not listed here get the default. See
+# _host_connection_slot for how they're shared between jobs.
+DEFAULT_MAX_CONNECTIONS_PER_HOST = int(get_env_variable_gracefully("MAX_CONNECTIONS_PER_HOST", "8"))
+MAX_CONNECTIONS_PER_HOST = {
+    "ftp.ncbi.nlm.nih.gov": 2,
+}
+CONNECTION_SLOT_POLL_INTERVAL = 1
+# How long to wait for the server to acknowledge the end of an FTP
+# transfer, which it may never do if we stopped reading early.
+FTP_CLOSE_TIMEOUT = 30
+
+# Files shared by several jobs, like GEO family tarballs and
+# ArrayExpress zips, are downloaded once per volume into this cache,
+# which the janitor keeps to a fixed size.
+LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
+DOWNLOAD_CACHE_DIR = LOCAL_ROOT_DIR + "/download_cache/"
+# Should match the janitor's, which trims the cache back down to it.
+DOWNLOAD_CACHE_MAX_SIZE = int(get_env_variable_gracefully("DOWNLOAD_CACHE_MAX_GB", "100")) * 1024 ** 3
+CONNECTION_SLOTS_DIR = LOCAL_ROOT_DIR + "/connection_slots/"
+
+# Every job on a volume reserves room for its files in this ledger
+# before downloading anything, so that jobs don't all start at once
+# and fill the volume up. Room is also held back for the download
+# cache to grow to its maximum size, since its entries outlive the
+# jobs that downloaded them.
+DISK_LEDGER_PATH = LOCAL_ROOT_DIR + "/disk_ledger.json"
+# Room to leave for processor jobs' output.
+MIN_FREE_DISK_SPACE = int(get_env_variable_gracefully("MIN_FREE_DISK_GB", "5")) * 1024 ** 3
+# Extracting an archive needs room for both it and its contents.
+ARCHIVE_SPACE_FACTOR = 2
+# Reservations left behind by jobs that were killed.
+DISK_RESERVATION_TTL = datetime.timedelta(days=1)
 
 def get_max_jobs_for_current_node():
     """ Determine the maximum number of Downloader jobs that this node should sustain,
@@ -58,15 +153,44 @@ MAX_DOWNLOADER_JOBS_PER_NODE = get_max_jobs_for_current_node()
 
 def signal_handler(sig, frame):
     """Signal Handler, works for both SIGTERM and SIGINT"""
-    global CURRENT_JOB
-    if not CURRENT_JOB:
-        sys.exit(0)
-    else:
-        CURRENT_JOB.start_time = None
-        CURRENT_JOB.num_retries = CURRENT_JOB.num_retries - 1
-        CURRENT_JOB.failure_reason = "Interruped by SIGTERM/SIGINT"
-        CURRENT_JOB.save()
-        sys.exit(0)
+    with _JOB_STATE_LOCK:
+        STOPPING.set()
+        _reset_interrupted_jobs()
+
+    sys.exit(0)
+
+def _reset_interrupted_jobs():
+    for job in list(CURRENT_JOBS.values()):
+        job.start_time = None
+        job.num_retries = job.num_retries - 1
+        job.failure_reason = "Interruped by SIGTERM/SIGINT"
+        job.save()
+
+    # Hand back the jobs this batch claimed but never got to.
+    if CLAIMED_JOB_IDS:
+        DownloaderJob.objects.filter(
+            id__in=list(CLAIMED_JOB_IDS),
+            end_time__isnull=True
+        ).update(start_time=None)
+
+def check_stopping() -> None:
+    """Raises if this process has been told to stop, so that batch mode
+    worker threads don't keep downloading."""
+    if STOPPING.is_set():
+        raise Exception("Interrupted by SIGTERM/SIGINT")
+
+def register_signal_handlers():
+    """Set up the SIGTERM handler so we can appropriately handle being interrupted.
+
+    (`docker stop` uses SIGTERM, not SIGINT.)
+    (however, Nomad sends an SIGINT so catch both.)
+
+    Signal handlers can only be installed from the main thread, so
+    batch mode calls this itself before starting its workers.
+    """
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, signal_handler)
+        signal.signal(signal.SIGINT, signal_handler)
 
 def start_job(job_id: int, max_downloader_jobs_per_node=MAX_DOWNLOADER_JOBS_PER_NODE, force_harakiri=False) -> DownloaderJob:
     """Record in the database that this job is being started.
@@ -75,6 +199,11 @@ def start_job(job_id: int, max_downloader_jobs_per_node=MAX_DOWNLOADER_JOBS_PER_
     it as started.
     """
     logger.debug("Starting Downloader Job.", downloader_job=job_id)
+    if STOPPING.is_set():
+        # The signal handler already handed back the jobs this batch
+        # hadn't got to yet.
+        sys.exit(0)
+
     try:
         job = DownloaderJob.objects.get(id=job_id)
     except DownloaderJob.DoesNotExist:
@@ -107,21 +236,23 @@ def start_job(job_id: int, max_downloader_jobs_per_node=MAX_DOWNLOADER_JOBS_PER_
     #                 # What is dead may never die!
     #                 sys.exit(0)
 
-    # This job should not have been started.
-    if job.start_time is not None:
-        logger.error("This downloader job has already been started!!!", downloader_job=job.id)
-        raise Exception("downloaders.start_job called on a job that has already been started!")
-
-    # Set up the SIGTERM handler so we can appropriately handle being interrupted.
-    # (`docker stop` uses SIGTERM, not SIGINT.)
-    # (however, Nomad sends an SIGINT so catch both.)
-    signal.signal(signal.SIGTERM, signal_handler)
-    signal.signal(signal.SIGINT, signal_handler)
-
+    # This job should not have been started, unless this process
+    # claimed it for a batch. Checking start_time and setting it are
+    # done in one UPDATE so that two workers can't both start it.
     job.worker_id = worker_id
     job.worker_version = SYSTEM_VERSION
     job.start_time = timezone.now()
-    job.save()
+    if job.id in CLAIMED_JOB_IDS:
+        CLAIMED_JOB_IDS.discard(job.id)
+        job.save()
+    elif DownloaderJob.objects.filter(id=job.id, start_time__isnull=True).update(
+            worker_id=job.worker_id,
+            worker_version=job.worker_version,
+            start_time=job.start_time) == 0:
+        logger.error("This downloader job has already been started!!!", downloader_job=job.id)
+        raise Exception("downloaders.start_job called on a job that has already been started!")
+
+    register_signal_handlers()
 
     needs_downloading = False
     for original_file in job.original_files.all():
@@ -140,8 +271,32 @@ def start_job(job_id: int, max_downloader_jobs_per_node=MAX_DOWNLOADER_JOBS_PER_
         job.save()
         sys.exit(0)
 
+    expected_size = get_expected_download_size(job)
+    if expected_size > get_max_reservable_space():
+        logger.error("This job's files will never fit on this volume! Aborting!",
+                     downloader_job=job.id,
+                     expected_size=expected_size)
+        job.failure_reason = "Needs more disk space than this volume could ever have free."
+        job.success = False
+        job.no_retry = True
+        job.end_time = timezone.now()
+        job.save()
+        sys.exit(0)
+
+    if not reserve_disk_space(job, expected_size):
+        logger.info("Not enough free disk space for this job yet, deferring it.",
+                    downloader_job=job.id,
+                    expected_size=expected_size)
+        # Let the Foreman requeue it without counting this as a retry.
+        job.start_time = None
+        job.num_retries = job.num_retries - 1
+        job.failure_reason = "Deferred until there is enough free disk space."
+        job.save()
+        sys.exit(0)
+
     global CURRENT_JOB
     CURRENT_JOB = job
+    CURRENT_JOBS[job.id] = job
 
     return job
 
@@ -149,8 +304,28 @@ def start_job(job_id: int, max_downloader_jobs_per_node=MAX_DOWNLOADER_JOBS_PER_
 def end_downloader_job(job: DownloaderJob, success: bool):
     """
     Record in the database that this job has completed.
+
+    While processor job creation is being deferred, successful jobs
+    are only marked as such once their processor jobs have been saved.
+
+    Nothing is recorded once the process has been told to stop, since
+    signal_handler has already handed the job back to the Foreman.
     """
+    with _JOB_STATE_LOCK:
+        if STOPPING.is_set():
+            logger.info("Not recording the end of an interrupted downloader job.",
+                        downloader_job=job.id)
+            return
+
+        _end_downloader_job(job, success)
+
+def _end_downloader_job(job: DownloaderJob, success: bool):
     if success:
+        with _DEFERRED_PROCESSOR_JOBS_LOCK:
+            if _DEFERRED_DOWNLOADER_JOBS is not None:
+                _DEFERRED_DOWNLOADER_JOBS.append(job)
+                return
+
         logger.debug("Downloader Job completed successfully.",
                     downloader_job=job.id)
     else:
@@ -174,7 +349,764 @@ def end_downloader_job(job: DownloaderJob, success: bool):
 
     job.success = success
     job.end_time = timezone.now()
+    job.bytes_downloaded = _get_bytes_downloaded(job) if success else 0
+    if not job.volume_index:
+        job.volume_index = get_volume_index()
+    job.volume_disk_usage = get_volume_disk_usage(LOCAL_ROOT_DIR)
     job.save()
+    CURRENT_JOBS.pop(job.id, None)
+    release_disk_space(job)
+
+def _get_bytes_downloaded(job: DownloaderJob) -> int:
+    """Sums the size of the files the job downloaded, for the
+    Foreman's throughput measurements."""
+    total = 0
+    for original_file in job.original_files.all():
+        if original_file.size_in_bytes:
+            total += original_file.size_in_bytes
+
+    return total
+
+def claim_downloader_jobs(job: DownloaderJob, max_jobs: int) -> List[DownloaderJob]:
+    """Claims up to `max_jobs` other jobs from the same downloader task
+    as `job` so they can all be run by the same Nomad job.
+
+    Only jobs whose files are known to add up to less than
+    MAX_BATCH_JOB_SIZE are claimed. Rows other workers have already
+    locked are skipped rather than waited on. The claimed jobs are
+    marked as started while they're locked, so no other worker will
+    claim or start them, and take over `job`'s nomad_job_id so that the
+    Foreman checks on the Nomad job that's actually running them.
+
+    Jobs the Foreman placed on a different volume are left for it,
+    since their files would otherwise land on this one.
+    """
+    if max_jobs < 1 or not job.nomad_job_id:
+        return []
+
+    volume_index = job.volume_index or get_volume_index()
+    with transaction.atomic():
+        # Some candidates will turn out to be too big.
+        candidates = DownloaderJob.objects.select_for_update(skip_locked=True).filter(
+            Q(volume_index=volume_index) | Q(volume_index__isnull=True),
+            downloader_task=job.downloader_task,
+            start_time__isnull=True,
+            success__isnull=True,
+            retried=False,
+            no_retry=False
+        ).exclude(id=job.id).order_by("id")[:max_jobs * 2]
+
+        claimed_jobs = []
+        for candidate in candidates:
+            size = _get_download_size(candidate.original_files.all())
+            if size and size <= MAX_BATCH_JOB_SIZE:
+                claimed_jobs.append(candidate)
+                if len(claimed_jobs) == max_jobs:
+                    break
+
+        worker_id = get_instance_id()
+        now = timezone.now()
+        DownloaderJob.objects.filter(
+            id__in=[claimed_job.id for claimed_job in claimed_jobs]
+        ).update(nomad_job_id=job.nomad_job_id, worker_id=worker_id, start_time=now)
+
+    CLAIMED_JOB_IDS.update(claimed_job.id for claimed_job in claimed_jobs)
+    return claimed_jobs
+
+def _get_file_download_size(original_file: OriginalFile) -> int:
+    """Returns how much disk space `original_file` will take up, using
+    the size the surveyor recorded if it did and otherwise asking the
+    server. Returns None if the size can't be found."""
+    size = original_file.size_in_bytes
+    if not size and urlparse(original_file.source_url or "").scheme in ["ftp", "http", "https"]:
+        size = _get_remote_file_info(original_file.source_url, timeout=30)["size"]
+
+    if not size:
+        return None
+
+    return size * (ARCHIVE_SPACE_FACTOR if original_file.is_archive else 1)
+
+def _get_download_size(original_files: List[OriginalFile]) -> int:
+    """Returns how much disk space `original_files` will take up, or
+    None if the size of any of them can't be found."""
+    total = 0
+    for original_file in original_files:
+        size = _get_file_download_size(original_file)
+        if not size:
+            return None
+
+        total += size
+
+    return total
+
+def get_expected_download_size(job: DownloaderJob) -> int:
+    """Estimates how much disk space the job's files will take up.
+
+    Uses the sizes the surveyor recorded where it could, and otherwise
+    asks the server. Files whose size can't be found don't count.
+    """
+    total = 0
+    for original_file in job.original_files.all():
+        if original_file.needs_downloading():
+            total += _get_file_download_size(original_file) or 0
+
+    return total
+
+@contextmanager
+def _locked_disk_ledger():
+    """Yields the volume's disk ledger, a dict from job id to
+    [bytes reserved, time reserved], and saves any changes made to it."""
+    with open(DISK_LEDGER_PATH + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            with open(DISK_LEDGER_PATH) as ledger_file:
+                ledger = json.load(ledger_file)
+        except (OSError, ValueError):
+            ledger = {}
+
+        yield ledger
+
+        with open(DISK_LEDGER_PATH + ".tmp", "w") as ledger_file:
+            json.dump(ledger, ledger_file)
+        os.replace(DISK_LEDGER_PATH + ".tmp", DISK_LEDGER_PATH)
+
+def get_max_reservable_space() -> int:
+    """The most a single job could ever reserve on this volume, once
+    the headroom and a full download cache are taken out."""
+    return shutil.disk_usage(LOCAL_ROOT_DIR).total - MIN_FREE_DISK_SPACE - DOWNLOAD_CACHE_MAX_SIZE
+
+def _get_download_cache_headroom() -> int:
+    """How much more the download cache can grow before the janitor
+    starts evicting from it."""
+    cache_size = 0
+    try:
+        items = os.listdir(DOWNLOAD_CACHE_DIR)
+    except OSError:
+        items = []
+
+    for item in items:
+        try:
+            cache_size += os.stat(DOWNLOAD_CACHE_DIR + item).st_size
+        except OSError:
+            pass
+
+    return max(DOWNLOAD_CACHE_MAX_SIZE - cache_size, 0)
+
+def reserve_disk_space(job: DownloaderJob, size: int) -> bool:
+    """Reserves `size` bytes on this volume for `job`.
+
+    Returns False if the volume doesn't have that much space free
+    once everything already reserved, and the room the download cache
+    may still grow into, are accounted for.
+    """
+    if not size:
+        # There's nothing to go on, so let it through.
+        return True
+
+    with _locked_disk_ledger() as ledger:
+        # Drop reservations which weren't released because the job died.
+        expired = (timezone.now() - DISK_RESERVATION_TTL).timestamp()
+        ended_job_ids = set(DownloaderJob.objects.filter(
+            id__in=[int(job_id) for job_id in ledger],
+            end_time__isnull=False
+        ).values_list("id", flat=True))
+        for job_id in list(ledger):
+            if int(job_id) in ended_job_ids or ledger[job_id][1] < expired:
+                del ledger[job_id]
+
+        reserved = sum(reservation[0] for reservation in ledger.values())
+        free_space = (shutil.disk_usage(LOCAL_ROOT_DIR).free
+                      - reserved
+                      - _get_download_cache_headroom()
+                      - MIN_FREE_DISK_SPACE)
+        if size > free_space:
+            return False
+
+        ledger[str(job.id)] = [size, timezone.now().timestamp()]
+        return True
+
+def release_disk_space(job: DownloaderJob) -> None:
+    """Releases whatever space `job` reserved on this volume."""
+    try:
+        with _locked_disk_ledger() as ledger:
+            ledger.pop(str(job.id), None)
+    except OSError:
+        logger.exception("Could not release disk space reservation.",
+                         downloader_job=job.id)
+
+class HashingReader:
+    """Wraps a file-like object, hashing whatever is read from it.
+
+    Useful for recording the size and SHA1 of a compressed stream
+    which is being decompressed on the fly and so never hits the disk.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.hash_object = hashlib.sha1()
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.source.read(size)
+        self.hash_object.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+    def hexdigest(self) -> str:
+        return self.hash_object.hexdigest()
+
+
+def write_and_hash(source, target_path: str, chunk_size: int=CHUNK_SIZE) -> Tuple[int, str]:
+    """Copies the file-like `source` to `target_path`, returning its size and SHA1.
+
+    The SHA1 is computed from the chunks as they're written so that
+    large downloads and extracted archive members don't have to be read
+    back from disk afterwards. The results are remembered so that
+    record_size_and_sha1 can use them.
+    """
+    hash_object = hashlib.sha1()
+    size = 0
+    with open(target_path, "wb") as target_file:
+        while True:
+            check_stopping()
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+
+            hash_object.update(chunk)
+            target_file.write(chunk)
+            size += len(chunk)
+
+    sha1 = hash_object.hexdigest()
+    _remember_hash(target_path, size, sha1)
+
+    return size, sha1
+
+
+def _remember_hash(path: str, size: int, sha1: str) -> None:
+    _WRITTEN_FILE_HASHES[path] = (size, os.stat(path).st_mtime_ns, sha1)
+
+
+def _load_checkpoint(download_url: str, target_path: str) -> Tuple:
+    """Returns the offset to resume downloading `target_path` from and
+    the SHA1 of everything before it.
+
+    The partial file is rehashed up to the checkpointed offset and
+    compared against the checkpoint, which is a lot cheaper than
+    downloading it again. Anything written after the last checkpoint
+    is discarded since we can't vouch for it.
+    """
+    part_path = target_path + PARTIAL_SUFFIX
+    checkpoint_path = target_path + CHECKPOINT_SUFFIX
+    hash_object = hashlib.sha1()
+
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return 0, hash_object
+
+    if (checkpoint.get("url") != download_url
+            or "offset" not in checkpoint
+            or not os.path.exists(part_path)):
+        return 0, hash_object
+
+    offset = checkpoint["offset"]
+    remaining = offset
+    with open(part_path, "rb") as part_file:
+        while remaining > 0:
+            chunk = part_file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+
+            hash_object.update(chunk)
+            remaining -= len(chunk)
+
+    if remaining != 0 or hash_object.hexdigest() != checkpoint["sha1"]:
+        logger.info("Discarding partial download which doesn't match its checkpoint.",
+                    partial_file=part_path)
+        return 0, hashlib.sha1()
+
+    return offset, hash_object
+
+
+def _save_checkpoint(download_url: str, target_path: str, offset: int, sha1: str) -> None:
+    checkpoint_path = target_path + CHECKPOINT_SUFFIX
+    temp_path = checkpoint_path + ".tmp"
+    with open(temp_path, "w") as checkpoint_file:
+        json.dump({"url": download_url, "offset": offset, "sha1": sha1}, checkpoint_file)
+    os.replace(temp_path, checkpoint_path)
+
+
+def _open_download_stream(download_url: str, offset: int, timeout: int=None, end: int=None):
+    """Opens `download_url` starting at byte `offset` if possible.
+
+    If `end` is given, HTTP servers are asked to stop after that byte,
+    but FTP servers will keep sending until the end of the file so the
+    caller has to stop reading on its own.
+
+    Returns the stream, the offset it actually starts at, and a
+    function to call once it has been read.
+    """
+    parsed_url = urlparse(download_url)
+
+    if parsed_url.scheme == "ftp":
+        # urllib's FTP handler can't send REST, so talk to the server directly.
+        ftp = ftplib.FTP(parsed_url.hostname, timeout=timeout)
+        ftp.login()
+        ftp.voidcmd("TYPE I")
+        try:
+            connection = ftp.transfercmd("RETR " + parsed_url.path, rest=offset or None)
+        except (ftplib.error_reply, ftplib.error_perm):
+            if not offset:
+                raise
+
+            # The server doesn't support REST, it either answers with
+            # something other than 350 or rejects it outright.
+            connection = ftp.transfercmd("RETR " + parsed_url.path)
+            offset = 0
+        stream = connection.makefile("rb")
+
+        def close():
+            stream.close()
+            connection.close()
+            try:
+                ftp.sock.settimeout(FTP_CLOSE_TIMEOUT)
+                ftp.voidresp()
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+        return stream, offset, close
+
+    request = urllib.request.Request(download_url)
+    if end is not None:
+        request.add_header("Range", "bytes={}-{}".format(offset, end))
+    elif offset:
+        request.add_header("Range", "bytes={}-".format(offset))
+
+    if timeout:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    else:
+        response = urllib.request.urlopen(request)
+
+    if (offset or end is not None) and getattr(response, "status", None) != 206:
+        # The server ignored the Range header, start from the top.
+        offset = 0
+
+    return response, offset, response.close
+
+
+def download_resumable(download_url: str,
+                       target_path: str,
+                       chunk_size: int=CHUNK_SIZE,
+                       timeout: int=None) -> Tuple[int, str]:
+    """Downloads `download_url` to `target_path` over HTTP(S) or FTP,
+    resuming from a previous attempt if one left a checkpoint behind.
+
+    Data is written to `<target_path>.part` and moved into place once
+    the download completes. If the download is interrupted, the
+    partial file and its checkpoint are left for the next job to pick
+    up from, using a Range request or FTP's REST command.
+
+    Like write_and_hash, returns the size and SHA1 of the file.
+    """
+    part_path = target_path + PARTIAL_SUFFIX
+    offset, hash_object = _load_checkpoint(download_url, target_path)
+
+    stream, start, close = _open_download_stream(download_url, offset, timeout)
+    if start != offset:
+        hash_object = hashlib.sha1()
+    elif start:
+        logger.info("Resuming partial download.",
+                    download_url=download_url,
+                    offset=start)
+
+    size = start
+    last_checkpoint = start
+    try:
+        with open(part_path, "r+b" if start else "wb") as part_file:
+            part_file.seek(start)
+            part_file.truncate()
+
+            try:
+                while True:
+                    check_stopping()
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+
+                    hash_object.update(chunk)
+                    part_file.write(chunk)
+                    size += len(chunk)
+
+                    if size - last_checkpoint >= CHECKPOINT_INTERVAL:
+                        part_file.flush()
+                        os.fsync(part_file.fileno())
+                        _save_checkpoint(download_url, target_path, size, hash_object.hexdigest())
+                        last_checkpoint = size
+            except Exception:
+                # Save how far we got so the next attempt can pick up from here.
+                part_file.flush()
+                os.fsync(part_file.fileno())
+                _save_checkpoint(download_url, target_path, size, hash_object.hexdigest())
+                raise
+    finally:
+        close()
+
+    sha1 = hash_object.hexdigest()
+    os.replace(part_path, target_path)
+    try:
+        os.remove(target_path + CHECKPOINT_SUFFIX)
+    except OSError:
+        pass
+
+    _remember_hash(target_path, size, sha1)
+
+    return size, sha1
+
+
+@contextmanager
+def _host_connection_slot(host: str):
+    """Holds one of the connection slots for `host` until the block ends,
+    waiting for one to free up if they're all taken.
+
+    Every downloader job on a node shares its volume, so each slot is
+    an flock on a file there. That caps the connections all of the
+    node's jobs hold open to the host, not just this one's.
+    """
+    limit = MAX_CONNECTIONS_PER_HOST.get(host, DEFAULT_MAX_CONNECTIONS_PER_HOST)
+    os.makedirs(CONNECTION_SLOTS_DIR, exist_ok=True)
+
+    while True:
+        for slot in range(limit):
+            slot_file = open(CONNECTION_SLOTS_DIR + "{}.{}.lock".format(host, slot), "w")
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                slot_file.close()
+                continue
+
+            try:
+                yield
+            finally:
+                fcntl.flock(slot_file, fcntl.LOCK_UN)
+                slot_file.close()
+            return
+
+        check_stopping()
+        time.sleep(CONNECTION_SLOT_POLL_INTERVAL)
+
+
+def _get_remote_file_info(download_url: str, timeout: int=None) -> Dict:
+    """Returns what the server will tell us about the file at `download_url`.
+
+    The result has the file's `size`, a `version` string which changes
+    when the file does (its ETag or Last-Modified over HTTP, its MDTM
+    over FTP), and whether the server supports byte `ranges`. Any of
+    these may be None or False if the server doesn't say.
+    """
+    info = {"size": None, "version": None, "ranges": False}
+    parsed_url = urlparse(download_url)
+    try:
+        if parsed_url.scheme == "ftp":
+            ftp = ftplib.FTP(parsed_url.hostname, timeout=timeout)
+            try:
+                ftp.login()
+                ftp.voidcmd("TYPE I")
+                info["size"] = ftp.size(parsed_url.path)
+                info["ranges"] = True
+                info["version"] = ftp.sendcmd("MDTM " + parsed_url.path).split()[-1]
+            finally:
+                ftp.close()
+
+            return info
+
+        request = urllib.request.Request(download_url, method="HEAD")
+        if timeout:
+            response = urllib.request.urlopen(request, timeout=timeout)
+        else:
+            response = urllib.request.urlopen(request)
+
+        with response:
+            if response.headers.get("Content-Length"):
+                info["size"] = int(response.headers["Content-Length"])
+            info["ranges"] = response.headers.get("Accept-Ranges") == "bytes"
+            info["version"] = (response.headers.get("ETag")
+                               or response.headers.get("Last-Modified"))
+    except Exception:
+        pass
+
+    return info
+
+
+def _load_segment_checkpoint(download_url: str, target_path: str, size: int) -> List[int]:
+    """Returns the indices of the segments a previous segmented download
+    of `download_url` already finished."""
+    try:
+        with open(target_path + CHECKPOINT_SUFFIX) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return []
+
+    if (checkpoint.get("url") != download_url
+            or checkpoint.get("size") != size
+            or not os.path.exists(target_path + PARTIAL_SUFFIX)):
+        return []
+
+    return checkpoint.get("completed_segments", [])
+
+
+def _save_segment_checkpoint(download_url: str,
+                             target_path: str,
+                             size: int,
+                             completed_segments: List[int]) -> None:
+    checkpoint_path = target_path + CHECKPOINT_SUFFIX
+    temp_path = checkpoint_path + ".tmp"
+    with open(temp_path, "w") as checkpoint_file:
+        json.dump({"url": download_url,
+                   "size": size,
+                   "completed_segments": sorted(completed_segments)},
+                  checkpoint_file)
+    os.replace(temp_path, checkpoint_path)
+
+
+def _download_segment(download_url: str,
+                      file_descriptor: int,
+                      start: int,
+                      end: int,
+                      chunk_size: int,
+                      timeout: int=None) -> None:
+    """Writes bytes `start` through `end` (inclusive) of `download_url`
+    into `file_descriptor` at the same offsets."""
+    with _host_connection_slot(urlparse(download_url).hostname):
+        stream, actual_start, close = _open_download_stream(download_url, start, timeout, end)
+        try:
+            if actual_start != start:
+                raise Exception("Server ignored the byte range request for " + download_url)
+
+            position = start
+            while position <= end:
+                chunk = stream.read(min(chunk_size, end - position + 1))
+                if not chunk:
+                    break
+
+                os.pwrite(file_descriptor, chunk, position)
+                position += len(chunk)
+        finally:
+            close()
+
+    if position != end + 1:
+        raise Exception("Segment {}-{} of {} ended early at {}.".format(start,
+                                                                       end,
+                                                                       download_url,
+                                                                       position))
+
+
+def download_segmented(download_url: str,
+                       target_path: str,
+                       size: int,
+                       chunk_size: int=CHUNK_SIZE,
+                       timeout: int=None) -> Tuple[int, str]:
+    """Downloads `download_url`, which is `size` bytes, over several
+    connections at once.
+
+    The file is split into SEGMENT_SIZE byte ranges which are fetched
+    concurrently into a preallocated `<target_path>.part`. Finished
+    segments are checkpointed so that a retry only fetches the ones
+    that are missing. Once every segment is in, the file's size is
+    verified and it is moved into place.
+
+    Returns the size and SHA1 of the file. Since the segments arrive
+    out of order the SHA1 has to be computed from the finished file.
+    """
+    part_path = target_path + PARTIAL_SUFFIX
+    segments = [(start, min(start + SEGMENT_SIZE, size) - 1)
+                for start in range(0, size, SEGMENT_SIZE)]
+
+    completed_segments = set(_load_segment_checkpoint(download_url, target_path, size))
+    if completed_segments:
+        logger.info("Resuming segmented download.",
+                    download_url=download_url,
+                    completed_segments=len(completed_segments),
+                    total_segments=len(segments))
+    else:
+        with open(part_path, "wb") as part_file:
+            # Reserve the space up front so we fail now rather than
+            # halfway through if the volume is full.
+            os.posix_fallocate(part_file.fileno(), 0, size)
+
+    checkpoint_lock = threading.Lock()
+
+    def download_segment(index):
+        start, end = segments[index]
+        _download_segment(download_url, file_descriptor, start, end, chunk_size, timeout)
+        with checkpoint_lock:
+            completed_segments.add(index)
+            _save_segment_checkpoint(download_url, target_path, size, list(completed_segments))
+
+    file_descriptor = os.open(part_path, os.O_WRONLY)
+    try:
+        remaining = [index for index in range(len(segments)) if index not in completed_segments]
+        num_connections = max(1, min(MAX_CONNECTIONS_PER_DOWNLOAD, len(remaining)))
+        with ThreadPoolExecutor(max_workers=num_connections) as executor:
+            # list() so that the first exception is raised here.
+            list(executor.map(download_segment, remaining))
+
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+
+    actual_size = os.path.getsize(part_path)
+    if actual_size != size:
+        raise Exception("Segmented download of {} is {} bytes but should be {}.".format(download_url,
+                                                                                       actual_size,
+                                                                                       size))
+
+    os.replace(part_path, target_path)
+    try:
+        os.remove(target_path + CHECKPOINT_SUFFIX)
+    except OSError:
+        pass
+
+    sha1 = calculate_sha1(target_path)
+    _remember_hash(target_path, size, sha1)
+
+    return size, sha1
+
+
+def download_file(download_url: str,
+                  target_path: str,
+                  chunk_size: int=CHUNK_SIZE,
+                  timeout: int=None,
+                  remote_info: Dict=None) -> Tuple[int, str]:
+    """Downloads `download_url` to `target_path` over HTTP(S) or FTP.
+
+    Large files on servers which support byte ranges are downloaded
+    with download_segmented, everything else with download_resumable.
+    `remote_info` can be passed in if _get_remote_file_info has already
+    been called for this URL. Returns the size and SHA1 of the file.
+    """
+    if remote_info is None:
+        remote_info = _get_remote_file_info(download_url, timeout)
+
+    size = remote_info["size"]
+    if (remote_info["ranges"]
+            and size
+            and size >= SEGMENTED_DOWNLOAD_MIN_SIZE
+            and MAX_CONNECTIONS_PER_DOWNLOAD > 1):
+        return download_segmented(download_url, target_path, size, chunk_size, timeout)
+
+    with _host_connection_slot(urlparse(download_url).hostname):
+        return download_resumable(download_url, target_path, chunk_size, timeout)
+
+
+def _place_cached_file(cache_path: str, target_path: str) -> None:
+    """Hard links the cached file to `target_path`, which is free since
+    the cache lives on the same volume, copying it if that fails."""
+    if os.path.exists(target_path):
+        os.remove(target_path)
+
+    try:
+        os.link(cache_path, target_path)
+    except OSError:
+        shutil.copyfile(cache_path, target_path)
+
+
+def download_file_cached(download_url: str,
+                         target_path: str,
+                         download: Callable[[str], None]=None,
+                         chunk_size: int=CHUNK_SIZE,
+                         timeout: int=None) -> Tuple[int, str]:
+    """Downloads `download_url` to `target_path` through this volume's
+    download cache.
+
+    Entries are keyed by the URL along with the size and version the
+    server reports for it, so a file which changes upstream is fetched
+    again. Jobs wanting the same entry at the same time take turns on
+    an flock, so only the first one actually downloads it and the rest
+    just link to the result. The janitor evicts entries least recently
+    used first.
+
+    `download` is called with the path to write to if the file
+    shouldn't be fetched with download_file, for example to use
+    Aspera. If the server won't tell us a size or version the cache is
+    skipped, since we'd have no way to tell if an entry was stale.
+
+    Returns the size and SHA1 of the file.
+    """
+    remote_info = _get_remote_file_info(download_url, timeout)
+    if remote_info["size"] is None and remote_info["version"] is None:
+        if download:
+            download(target_path)
+            size = os.path.getsize(target_path)
+            sha1 = calculate_sha1(target_path)
+            _remember_hash(target_path, size, sha1)
+            return size, sha1
+
+        return download_file(download_url, target_path, chunk_size, timeout, remote_info)
+
+    cache_key = hashlib.sha1("{}|{}|{}".format(download_url,
+                                               remote_info["size"],
+                                               remote_info["version"]).encode()).hexdigest()
+    cache_path = DOWNLOAD_CACHE_DIR + cache_key
+    metadata_path = cache_path + ".json"
+    os.makedirs(DOWNLOAD_CACHE_DIR, exist_ok=True)
+
+    with open(cache_path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            with open(metadata_path) as metadata_file:
+                metadata = json.load(metadata_file)
+        except (OSError, ValueError):
+            metadata = None
+
+        if metadata and os.path.exists(cache_path):
+            logger.debug("Using cached download.",
+                         download_url=download_url,
+                         cache_path=cache_path)
+            # The janitor evicts by mtime, so mark this entry as used.
+            os.utime(cache_path)
+        else:
+            if download:
+                download(cache_path)
+                size = os.path.getsize(cache_path)
+                sha1 = calculate_sha1(cache_path)
+            else:
+                size, sha1 = download_file(download_url, cache_path, chunk_size, timeout, remote_info)
+
+            metadata = {"url": download_url, "size": size, "sha1": sha1}
+            with open(metadata_path + ".tmp", "w") as metadata_file:
+                json.dump(metadata, metadata_file)
+            os.replace(metadata_path + ".tmp", metadata_path)
+
+        _place_cached_file(cache_path, target_path)
+
+    _remember_hash(target_path, metadata["size"], metadata["sha1"])
+    return metadata["size"], metadata["sha1"]
+
+
+def record_size_and_sha1(original_file: OriginalFile) -> None:
+    """Sets the size and SHA1 of `original_file` from when it was written.
+
+    Files which weren't written by write_and_hash, such as ones
+    downloaded by ascp, or which have changed since, are rehashed.
+    """
+    path = original_file.absolute_file_path
+    written = _WRITTEN_FILE_HASHES.get(path)
+    if written:
+        size, mtime, sha1 = written
+        stat = os.stat(path)
+        if stat.st_size == size and stat.st_mtime_ns == mtime:
+            original_file.size_in_bytes = size
+            original_file.sha1 = sha1
+            return
+
+    original_file.calculate_size()
+    original_file.calculate_sha1()
+
 
 def delete_if_blacklisted(original_file: OriginalFile) -> OriginalFile:
     extension = original_file.filename.split(".")[-1]
@@ -191,13 +1123,110 @@ def delete_if_blacklisted(original_file: OriginalFile) -> OriginalFile:
     return original_file
 
 
+@contextmanager
+def deferred_processor_job_creation():
+    """Holds back the processor jobs created inside this block so they
+    can all be created and queued together at the end of it.
+
+    Used by batch mode so that a batch of downloader jobs doesn't make
+    a round trip to the database for every processor job.
+    """
+    global _DEFERRED_PROCESSOR_JOBS, _DEFERRED_DOWNLOADER_JOBS
+    _DEFERRED_PROCESSOR_JOBS = []
+    _DEFERRED_DOWNLOADER_JOBS = []
+    try:
+        yield
+    except BaseException:
+        # The downloader jobs are left as they were, which the signal
+        # handler or the Foreman's hung job pass will sort out.
+        _DEFERRED_PROCESSOR_JOBS = None
+        _DEFERRED_DOWNLOADER_JOBS = None
+        raise
+
+    deferred_jobs = _DEFERRED_PROCESSOR_JOBS
+    downloader_jobs = _DEFERRED_DOWNLOADER_JOBS
+    _DEFERRED_PROCESSOR_JOBS = None
+    _DEFERRED_DOWNLOADER_JOBS = None
+
+    # Successful downloader jobs are only marked as such along with
+    # their processor jobs so that a worker dying in between can't leave
+    # downloaded files without anything to process them.
+    _save_and_queue_processor_jobs(deferred_jobs, downloader_jobs)
+
+
+def _create_processor_jobs(new_jobs: List[Tuple], downloader_job: DownloaderJob=None) -> None:
+    """Creates and queues `new_jobs`, a list of (processor_job,
+    original_files, pipeline) tuples, unless creation is being deferred."""
+    with _DEFERRED_PROCESSOR_JOBS_LOCK:
+        if _DEFERRED_PROCESSOR_JOBS is not None:
+            _DEFERRED_PROCESSOR_JOBS.extend(
+                new_job + (downloader_job,) for new_job in new_jobs
+            )
+            return
+
+    _save_and_queue_processor_jobs([new_job + (downloader_job,) for new_job in new_jobs])
+
+
+def _save_and_queue_processor_jobs(new_jobs: List[Tuple],
+                                   finished_downloader_jobs: List[DownloaderJob]=[]) -> None:
+    """Saves the processor jobs and their file associations in bulk,
+    then sends them to Nomad with send_jobs.
+
+    `finished_downloader_jobs` are marked as successful in the same
+    transaction as the processor jobs are saved in.
+    """
+    if not new_jobs and not finished_downloader_jobs:
+        return
+
+    # Every job created here is for files downloaded onto this volume.
+    volume_index = get_volume_index()
+    for processor_job, _, _, _ in new_jobs:
+        processor_job.volume_index = volume_index
+
+    with transaction.atomic():
+        ProcessorJob.objects.bulk_create([processor_job for processor_job, _, _, _ in new_jobs])
+        ProcessorJobOriginalFileAssociation.objects.bulk_create([
+            ProcessorJobOriginalFileAssociation(processor_job=processor_job,
+                                                original_file=original_file)
+            for processor_job, original_files, _, _ in new_jobs
+            for original_file in original_files
+        ])
+
+        for downloader_job in finished_downloader_jobs:
+            end_downloader_job(downloader_job, success=True)
+
+    if not new_jobs:
+        return
+
+    # send_jobs dispatches and saves jobs of a single pipeline at a
+    # time. If a job can't be queued now the Foreman will do it later.
+    jobs_by_pipeline = {}
+    for processor_job, original_files, pipeline_to_apply, downloader_job in new_jobs:
+        logger.debug("Queuing processor job.",
+                     processor_job=processor_job.id,
+                     original_files=[original_file.id for original_file in original_files],
+                     downloader_job=downloader_job.id if downloader_job else None)
+        jobs_by_pipeline.setdefault(pipeline_to_apply, []).append(processor_job)
+
+    nomad_client = get_nomad_client()
+    for pipeline_to_apply, processor_jobs in jobs_by_pipeline.items():
+        message_queue.send_jobs(pipeline_to_apply, processor_jobs, nomad_client=nomad_client)
+
 def create_processor_jobs_for_original_files(original_files: List[OriginalFile],
                                              downloader_job: DownloaderJob=None):
     """
     Create a processor jobs and queue a processor task for samples related to an experiment.
+
+    Archives can hold hundreds of samples, so their samples are all
+    fetched up front and the jobs are created in bulk.
     """
+    prefetch_related_objects(original_files, "samples")
+
+    new_jobs = []
+    mislabeled_affy_samples = []
     for original_file in original_files:
-        sample_object = original_file.samples.first()
+        samples = list(original_file.samples.all())
+        sample_object = min(samples, key=lambda sample: sample.id) if samples else None
 
         if not delete_if_blacklisted(original_file):
             continue
@@ -210,7 +1239,7 @@ def create_processor_jobs_for_original_files(original_files: List[OriginalFile],
             # Only Affymetrix Microarrays produce .CEL files
             sample_object.technology = 'MICROARRAY'
             sample_object.manufacturer = 'AFFYMETRTIX'
-            sample_object.save()
+            mislabeled_affy_samples.append(sample_object.id)
 
         pipeline_to_apply = determine_processor_pipeline(sample_object, original_file)
 
@@ -224,30 +1253,16 @@ def create_processor_jobs_for_original_files(original_files: List[OriginalFile],
         else:
             processor_job = ProcessorJob()
             processor_job.pipeline_applied = pipeline_to_apply.value
-            processor_job.ram_amount = determine_ram_amount(sample_object, processor_job)
-            processor_job.save()
-
-            assoc = ProcessorJobOriginalFileAssociation()
-            assoc.original_file = original_file
-            assoc.processor_job = processor_job
-            assoc.save()
-
-            if downloader_job:
-                logger.debug("Queuing processor job.",
-                             processor_job=processor_job.id,
-                             original_file=original_file.id,
-                             downloader_job=downloader_job.id)
-            else:
-                logger.debug("Queuing processor job.",
-                             processor_job=processor_job.id,
-                             original_file=original_file.id)
+            processor_job.ram_amount = determine_ram_amount(sample_object, processor_job, [original_file])
+            new_jobs.append((processor_job, [original_file], pipeline_to_apply))
 
-            try:
-                send_job(pipeline_to_apply, processor_job)
-            except:
-                # If we cannot queue the job now the Foreman will do
-                # it later.
-                pass
+    if mislabeled_affy_samples:
+        Sample.objects.filter(id__in=mislabeled_affy_samples).update(
+            technology='MICROARRAY',
+            manufacturer='AFFYMETRTIX'
+        )
+
+    _create_processor_jobs(new_jobs, downloader_job)
 
 
 def create_processor_job_for_original_files(original_files: List[OriginalFile],
@@ -276,20 +1291,6 @@ def create_processor_job_for_original_files(original_files: List[OriginalFile],
     else:
         processor_job = ProcessorJob()
         processor_job.pipeline_applied = pipeline_to_apply.value
-        processor_job.ram_amount = determine_ram_amount(sample_object, processor_job)
-        processor_job.save()
-        for original_file in original_files:
-            assoc = ProcessorJobOriginalFileAssociation()
-            assoc.original_file = original_file
-            assoc.processor_job = processor_job
-            assoc.save()
-
-        logger.debug("Queuing processor job.",
-                     processor_job=processor_job.id)
-
-        try:
-            send_job(pipeline_to_apply, processor_job)
-        except:
-            # If we cannot queue the job now the Foreman will do
-            # it later.
-            pass
+        processor_job.ram_amount = determine_ram_amount(sample_object, processor_job, original_files)
+        _create_processor_jobs([(processor_job, original_files, pipeline_to_apply)],
+                               downloader_job)
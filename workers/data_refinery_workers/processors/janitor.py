@@ -1,3 +1,4 @@
+import fcntl
 import os
 import random
 import shutil
@@ -23,10 +24,25 @@ from data_refinery_common.models import (
     SampleResultAssociation,
     ProcessorJob
 )
-from data_refinery_common.utils import get_env_variable
+from data_refinery_common.utils import get_env_variable, get_env_variable_gracefully
 from data_refinery_workers.processors import utils
 
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
+# This is where downloaders.utils.download_file_cached keeps its cache.
+DOWNLOAD_CACHE_DIR = LOCAL_ROOT_DIR + "/download_cache/"
+DOWNLOAD_CACHE_MAX_SIZE = int(get_env_variable_gracefully("DOWNLOAD_CACHE_MAX_GB", "100")) * 1024 ** 3
+# The suffixes of the partial files and checkpoints that
+# downloaders.utils.download_resumable leaves behind when a download
+# is interrupted. Ones which no retry has picked up after
+# PARTIAL_DOWNLOAD_MAX_AGE seconds are deleted.
+PARTIAL_DOWNLOAD_SUFFIXES = (".part", ".part.json", ".part.json.tmp")
+PARTIAL_DOWNLOAD_MAX_AGE = 3 * 24 * 60 * 60
+# This is where salmon._get_cached_gene_summaries keeps its cache.
+# Summaries used within TXIMPORT_CACHE_MIN_AGE seconds are never
+# evicted so that they don't disappear from under the job using them.
+TXIMPORT_CACHE_DIR = LOCAL_ROOT_DIR + "/tximport_cache/"
+TXIMPORT_CACHE_MAX_SIZE = int(get_env_variable_gracefully("TXIMPORT_CACHE_MAX_GB", "20")) * 1024 ** 3
+TXIMPORT_CACHE_MIN_AGE = 60 * 60
 logger = get_and_configure_logger(__name__)
 
 
@@ -121,10 +137,135 @@ def _find_and_remove_expired_jobs(job_context):
     job_context['success'] = True
     return job_context
 
+def _clean_download_cache(job_context):
+    """ Evicts the least recently used entries from the download cache
+    until it's no bigger than DOWNLOAD_CACHE_MAX_SIZE. """
+
+    job_context.setdefault('deleted_items', [])
+
+    if not os.path.isdir(DOWNLOAD_CACHE_DIR):
+        job_context['success'] = True
+        return job_context
+
+    # Each entry is a file named after its key, plus its .json metadata,
+    # its .lock file, and .part files while it's being downloaded.
+    entries = {}
+    for item in os.listdir(DOWNLOAD_CACHE_DIR):
+        key = item.split('.')[0]
+        entry = entries.setdefault(key, {'size': 0, 'last_used': 0})
+        try:
+            stat = os.stat(DOWNLOAD_CACHE_DIR + item)
+        except OSError:
+            continue
+
+        entry['size'] += stat.st_size
+        entry['last_used'] = max(entry['last_used'], stat.st_mtime)
+
+    total_size = sum(entry['size'] for entry in entries.values())
+    for key, entry in sorted(entries.items(), key=lambda item: item[1]['last_used']):
+        if total_size <= DOWNLOAD_CACHE_MAX_SIZE:
+            break
+
+        with open(DOWNLOAD_CACHE_DIR + key + ".lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # A downloader is using this entry right now.
+                continue
+
+            # The lock file is left behind since a downloader could
+            # already be waiting on it.
+            for suffix in ["", ".json", ".part", ".part.json"]:
+                try:
+                    os.remove(DOWNLOAD_CACHE_DIR + key + suffix)
+                except OSError:
+                    pass
+
+        logger.info("Janitor evicting download cache entry " + key, size=entry['size'])
+        job_context['deleted_items'].append(DOWNLOAD_CACHE_DIR + key)
+        total_size -= entry['size']
+
+    job_context['success'] = True
+    return job_context
+
+def _clean_partial_downloads(job_context):
+    """ Deletes partial downloads which were abandoned by their jobs. """
+
+    job_context.setdefault('deleted_items', [])
+
+    min_last_modified = time.time() - PARTIAL_DOWNLOAD_MAX_AGE
+    for root, dirs, files in os.walk(LOCAL_ROOT_DIR):
+        # The download cache evicts its own partial files.
+        if root.rstrip('/') == DOWNLOAD_CACHE_DIR.rstrip('/'):
+            dirs[:] = []
+            continue
+
+        for item in files:
+            if not item.endswith(PARTIAL_DOWNLOAD_SUFFIXES):
+                continue
+
+            path = os.path.join(root, item)
+            try:
+                if os.stat(path).st_mtime > min_last_modified:
+                    continue
+
+                os.remove(path)
+            except OSError:
+                continue
+
+            logger.info("Janitor deleting abandoned partial download " + path)
+            job_context['deleted_items'].append(path)
+
+    job_context['success'] = True
+    return job_context
+
+def _clean_tximport_cache(job_context):
+    """ Evicts the least recently used gene summaries from the tximport
+    cache until it's no bigger than TXIMPORT_CACHE_MAX_SIZE. """
+
+    job_context.setdefault('deleted_items', [])
+
+    if not os.path.isdir(TXIMPORT_CACHE_DIR):
+        job_context['success'] = True
+        return job_context
+
+    # Summaries are kept in a directory per organism index.
+    entries = []
+    for root, dirs, files in os.walk(TXIMPORT_CACHE_DIR):
+        for item in files:
+            path = os.path.join(root, item)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for last_used, size, path in entries)
+    min_last_used = time.time() - TXIMPORT_CACHE_MIN_AGE
+    for last_used, size, path in sorted(entries):
+        if total_size <= TXIMPORT_CACHE_MAX_SIZE or last_used > min_last_used:
+            break
+
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+
+        job_context['deleted_items'].append(path)
+        total_size -= size
+
+    logger.info("Janitor cleaned the tximport cache.", size=total_size)
+    job_context['success'] = True
+    return job_context
+
 def run_janitor(job_id: int) -> None:
     pipeline = Pipeline(name=utils.PipelineEnum.JANITOR.value)
     job_context = utils.run_pipeline({"job_id": job_id, "pipeline": pipeline},
                        [utils.start_job,
                         _find_and_remove_expired_jobs,
+                        _clean_download_cache,
+                        _clean_partial_downloads,
+                        _clean_tximport_cache,
                         utils.end_job])
     return job_context
@@ -38,6 +38,9 @@ class Command(BaseCommand):
         if job_type is ProcessorPipeline.AFFY_TO_PCL:
             from data_refinery_workers.processors.array_express import affy_to_pcl
             affy_to_pcl(options["job_id"])
+        elif job_type is ProcessorPipeline.TRANSCRIPTOME_INDEX:
+            from data_refinery_workers.processors.transcriptome_index import build_transcriptome_indices
+            build_transcriptome_indices(options["job_id"])
         elif job_type is ProcessorPipeline.TRANSCRIPTOME_INDEX_SHORT:
             from data_refinery_workers.processors.transcriptome_index import build_transcriptome_index
             build_transcriptome_index(options["job_id"], length="short")
@@ -53,6 +56,9 @@ class Command(BaseCommand):
         elif job_type is ProcessorPipeline.SALMON:
             from data_refinery_workers.processors.salmon import salmon
             salmon(options["job_id"])
+        elif job_type is ProcessorPipeline.SALMON_BATCH:
+            from data_refinery_workers.processors.salmon import salmon_batch
+            salmon_batch(options["job_id"])
         elif job_type is ProcessorPipeline.SMASHER:
             from data_refinery_workers.processors.smasher import smash
             smash(options["job_id"])
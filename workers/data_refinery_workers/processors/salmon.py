@@ -8,17 +8,19 @@ import re
 import shutil
 import subprocess
 import tarfile
+import threading
 import untangle
 
 from botocore.client import Config
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
 from django.utils import timezone
 from typing import Dict, List
 import numpy as np
 import pandas as pd
 
-from data_refinery_common.job_lookup import Downloaders
+from data_refinery_common.job_lookup import Downloaders, ProcessorPipeline
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.models import (
     ComputationalResult,
@@ -27,13 +29,16 @@ from data_refinery_common.models import (
     Experiment,
     ExperimentSampleAssociation,
     OrganismIndex,
+    OriginalFile,
     Pipeline,
     Processor,
+    ProcessorJob,
+    ProcessorJobOriginalFileAssociation,
     Sample,
     SampleComputedFileAssociation,
     SampleResultAssociation,
 )
-from data_refinery_common.utils import get_env_variable
+from data_refinery_common.utils import get_env_variable, get_env_variable_gracefully
 from data_refinery_workers.processors import utils
 
 # We have to set the signature_version to v4 since us-east-1 buckets require
@@ -64,6 +69,33 @@ S3_BUCKET_NAME = get_env_variable("S3_BUCKET_NAME", "data-refinery")
 EARLY_TXIMPORT_MIN_SIZE = 25
 EARLY_TXIMPORT_MIN_PERCENT = .80
 
+# Incremental tximport caches the gene level summary of each sample's
+# quant.sf file on the volume so that tximport runs over the same
+# experiment only need to read the quant.sf files of newly processed
+# samples. See `_run_incremental_tximport`.
+USE_INCREMENTAL_TXIMPORT = get_env_variable_gracefully("USE_INCREMENTAL_TXIMPORT", "False") == "True"
+TXIMPORT_CACHE_DIR = os.path.join(LOCAL_ROOT_DIR, "tximport_cache")
+QUANT_FILE_DOWNLOAD_THREADS = 8
+
+# Rob recommends 16 threads/process, which fits snugly on an x1 at 8GB RAM per Salmon container:
+# (2 threads/core * 16 cores/socket * 64 vCPU) / (1TB/8GB) = ~17
+# On smaller instance types we scale down from there based on the
+# CPU quota and memory we actually got. Each thread needs roughly
+# this much memory on top of the index itself. Every salmon quant
+# process loads its own copy of the index, so quant runs sharing a
+# container each need room for it. Until the index has been found its
+# size is assumed to be DEFAULT_SALMON_INDEX_MB.
+MAX_SALMON_THREADS = 16
+SALMON_MB_PER_THREAD = 512
+DEFAULT_SALMON_INDEX_MB = 1024
+
+# Salmon's default for --biasSpeedSamp is 5. When we're running with
+# only a handful of threads the bias model becomes a large fraction
+# of the runtime, so we sample it more coarsely.
+DEFAULT_BIAS_SPEED_SAMP = 5
+LOW_THREAD_BIAS_SPEED_SAMP = 10
+LOW_THREAD_COUNT = 4
+
 
 def _set_job_prefix(job_context: Dict) -> Dict:
     """ Sets the `job_dir_prefix` value in the job context object."""
@@ -71,6 +103,76 @@ def _set_job_prefix(job_context: Dict) -> Dict:
     return job_context
 
 
+def _get_directory_size_mb(directory: str) -> int:
+    """Returns the size of every file under `directory` in megabytes."""
+    total_bytes = 0
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            try:
+                total_bytes += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+
+    return total_bytes // (1024 * 1024)
+
+
+def _determine_salmon_resources(job_context: Dict, index_mb: int=None) -> Dict:
+    """Picks the salmon thread count and bias sampling for this container.
+
+    The thread count is bounded by the cgroup CPU quota and by the
+    cgroup memory limit or the RAM Nomad was asked to reserve for the
+    job, less the size of the index, unless SALMON_THREADS is set.
+    Also records how many quant runs of this size, each with its own
+    copy of the index, could share the container's CPUs and memory,
+    which `_run_salmon_batch` uses.
+
+    index_mb is the size of the index, measured from the context's
+    index_directory if it isn't given.
+    """
+    cpu_limit = utils.get_cpu_limit()
+    memory_limit = utils.get_memory_limit_mb()
+
+    ram_amount = job_context["job"].ram_amount
+    if ram_amount:
+        memory_limit = min(memory_limit, ram_amount)
+
+    if index_mb is None:
+        if job_context.get("index_directory", None):
+            index_mb = _get_directory_size_mb(job_context["index_directory"])
+        else:
+            index_mb = DEFAULT_SALMON_INDEX_MB
+    available_memory = max(0, memory_limit - index_mb)
+
+    threads_override = get_env_variable_gracefully("SALMON_THREADS")
+    if threads_override:
+        threads = int(threads_override)
+    else:
+        threads = min(MAX_SALMON_THREADS, cpu_limit, available_memory // SALMON_MB_PER_THREAD)
+    threads = max(1, threads)
+
+    if threads <= LOW_THREAD_COUNT:
+        bias_speed_samp = LOW_THREAD_BIAS_SPEED_SAMP
+    else:
+        bias_speed_samp = DEFAULT_BIAS_SPEED_SAMP
+
+    job_context["salmon_threads"] = threads
+    job_context["salmon_bias_speed_samp"] = bias_speed_samp
+    job_context["salmon_max_concurrent_quants"] = max(1, min(
+        cpu_limit // threads,
+        memory_limit // (index_mb + threads * SALMON_MB_PER_THREAD)))
+
+    logger.info("Determined salmon resource profile.",
+                processor_job=job_context["job_id"],
+                cpu_limit=cpu_limit,
+                memory_limit_mb=memory_limit,
+                index_mb=index_mb,
+                salmon_threads=threads,
+                bias_speed_samp=bias_speed_samp,
+                max_concurrent_quants=job_context["salmon_max_concurrent_quants"])
+
+    return job_context
+
+
 def _prepare_files(job_context: Dict) -> Dict:
     """Moves the file(s) from the raw directory to the temp directory.
 
@@ -439,38 +541,68 @@ def _find_salmon_quant_results(experiment: Experiment):
     return results
 
 
-def _run_tximport_for_experiment(
-        job_context: Dict,
-        experiment: Experiment,
-        quant_files: List[ComputedFile]) -> Dict:
+def _quant_file_sample_dir(quant_file: ComputedFile) -> str:
+    """Returns the name of the directory salmon wrote `quant_file` to.
 
+    tximport assigns column names based on the parent directory name,
+    and we need those names so that we can reassociate with samples later.
+    ex., a file with absolute_file_path: /processor_job_1/SRR123_output/quant.sf
+    gets the column name "SRR123_output", which we can associate with sample SRR123.
+    """
+    return str(quant_file.absolute_file_path.split('/')[-2])
+
+
+def _download_quant_files(job_context: Dict, quant_files: List[ComputedFile]) -> Dict:
+    """Fetches `quant_files` into the work directory in parallel.
+
+    Returns a mapping from each quant file to its local path, or None
+    if any of them could not be fetched.
+    """
+    def download_quant_file(quant_file):
+        # We create a directory in the work directory for each (quant.sf)
+        # file so that it keeps the name of the sample's directory.
+        sample_output = job_context["work_dir"] + _quant_file_sample_dir(quant_file) + "/"
+        os.makedirs(sample_output, exist_ok=True)
+        quant_work_path = sample_output + quant_file.filename
+        return quant_file.get_synced_file_path(path=quant_work_path)
+
+    with ThreadPoolExecutor(max_workers=QUANT_FILE_DOWNLOAD_THREADS) as executor:
+        quant_file_paths = dict(zip(quant_files, executor.map(download_quant_file, quant_files)))
+
+    missing_files = [quant_file.id for quant_file, path in quant_file_paths.items() if not path]
+    if missing_files:
+        logger.error("Could not fetch quant files for tximport.",
+                     processor_job=job_context["job_id"],
+                     computed_files=missing_files)
+        return None
+
+    return quant_file_paths
+
+
+def _run_tximport_script(job_context: Dict,
+                         experiment: Experiment,
+                         quant_files: List[ComputedFile],
+                         rds_file_path: str,
+                         tpm_file_path: str) -> List[str]:
+    """Runs tximport.R over every quant.sf file in `quant_files`.
+
+    Returns the command that was run, or None if it failed.
+    """
     # Download all the quant.sf fles for this experiment. Write all
     # their paths to a file so we can pass a path to that to
     # tximport.R rather than having to pass in one argument per
     # sample.
+    quant_file_paths = _download_quant_files(job_context, quant_files)
+    if quant_file_paths is None:
+        job_context["job"].failure_reason = "Unable to fetch quant.sf files for tximport."
+        job_context["success"] = False
+        return None
+
     tximport_path_list_file = job_context["work_dir"] + "tximport_inputs.txt"
-    quant_file_paths = {}
     with open(tximport_path_list_file, "w") as input_list:
         for quant_file in quant_files:
-            # We create a directory in the work directory for each (quant.sf) file, as
-            # tximport assigns column names based on the parent directory name,
-            # and we need those names so that we can reassociate withe samples later.
-            # ex., a file with absolute_file_path: /processor_job_1/SRR123_output/quant.sf
-            # downloads to: /processor_job_2/SRR123_output/quant.sf
-            # So the result file has frame "SRR123_output", which we can associate with sample SRR123
-            sample_output = job_context["work_dir"] + str(quant_file.absolute_file_path.split('/')[-2]) + "/"
-            os.makedirs(sample_output, exist_ok=True)
-            quant_work_path = sample_output + quant_file.filename
-            quant_file_path = quant_file.get_synced_file_path(path=quant_work_path)
-            input_list.write(quant_file_path + "\n")
-            quant_file_paths[quant_file_path] = os.stat(quant_file_path).st_size
-
+            input_list.write(quant_file_paths[quant_file] + "\n")
 
-    rds_filename = "txi_out.RDS"
-    rds_file_path = job_context["work_dir"] + rds_filename
-    tpm_filename = "gene_lengthScaledTPM.tsv"
-    tpm_file_path = job_context["work_dir"] + tpm_filename
-    result = ComputationalResult()
     cmd_tokens = [
         "/usr/bin/Rscript", "--vanilla",
         "/home/user/data_refinery_workers/processors/tximport.R",
@@ -479,7 +611,6 @@ def _run_tximport_for_experiment(
         "--rds_file", rds_file_path,
         "--tpm_file", tpm_file_path
     ]
-    result.time_start = timezone.now()
 
     logger.debug("Running tximport with: %s",
                  str(cmd_tokens),
@@ -494,7 +625,7 @@ def _run_tximport_for_experiment(
         logger.error(error_message, processor_job=job_context["job_id"], experiment=experiment.id)
         job_context["job"].failure_reason = error_message
         job_context["success"] = False
-        return job_context
+        return None
 
     if tximport_result.returncode != 0:
         error_template = ("Found non-zero exit code from R code while running tximport.R: {}")
@@ -504,10 +635,223 @@ def _run_tximport_for_experiment(
             experiment=experiment.id,
             quant_files=quant_files,
             cmd_tokens=cmd_tokens,
-            quant_file_paths=quant_file_paths,
+            quant_file_paths={path: os.stat(path).st_size for path in quant_file_paths.values()},
             )
         job_context["job"].failure_reason = error_message
         job_context["success"] = False
+        return None
+
+    return cmd_tokens
+
+
+def _load_tx2gene(genes_to_transcripts_path: str) -> pd.Series:
+    """Returns a Series mapping transcript ids to gene ids."""
+    gene2tx = pd.read_csv(genes_to_transcripts_path,
+                          sep="\t",
+                          header=None,
+                          names=["gene_id", "tx_name"],
+                          dtype=str)
+    return gene2tx.drop_duplicates("tx_name").set_index("tx_name")["gene_id"]
+
+
+def _summarize_quant_file(quant_file_path: str, tx2gene: pd.Series) -> pd.DataFrame:
+    """Summarizes a quant.sf file to the gene level the same way
+    tximport::summarizeToGene does for a single sample.
+
+    The returned frame is indexed by gene and has the columns:
+      * abundance: the sum of the transcripts' TPMs.
+      * counts: the sum of the transcripts' NumReads.
+      * length: the abundance-weighted mean effective length, which
+        is NaN for genes with zero abundance.
+      * mean_tx_length: the unweighted mean effective length, which
+        tximport falls back to when a gene has no abundance anywhere.
+    """
+    quant = pd.read_csv(quant_file_path,
+                        sep="\t",
+                        index_col="Name",
+                        usecols=["Name", "EffectiveLength", "TPM", "NumReads"])
+
+    # tximport drops transcripts that aren't in tx2gene.
+    gene_ids = tx2gene.reindex(quant.index)
+    quant = quant[gene_ids.notnull().values]
+    gene_ids = gene_ids.dropna()
+
+    grouped = quant.groupby(gene_ids.values)
+    summary = pd.DataFrame({
+        "abundance": grouped["TPM"].sum(),
+        "counts": grouped["NumReads"].sum(),
+        "weighted_length": (quant["TPM"] * quant["EffectiveLength"]).groupby(gene_ids.values).sum(),
+        "mean_tx_length": grouped["EffectiveLength"].mean(),
+    })
+    summary["length"] = summary["weighted_length"] / summary["abundance"]
+    summary.index.name = "Gene"
+    return summary[["abundance", "counts", "length", "mean_tx_length"]]
+
+
+def _get_cached_gene_summaries(job_context: Dict,
+                               quant_files: List[ComputedFile]) -> Dict[str, pd.DataFrame]:
+    """Returns the gene level summary of each quant file, keyed by the
+    name of its sample's directory.
+
+    Summaries are cached on the volume by the quant file's SHA1 and the
+    organism index they were summarized with, so only quant files which
+    haven't been summarized before need to be fetched and read.
+    """
+    cache_dir = os.path.join(TXIMPORT_CACHE_DIR, str(job_context["organism_index"].id))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(quant_file):
+        return os.path.join(cache_dir, quant_file.sha1 + ".tsv")
+
+    uncached_files = []
+    for quant_file in quant_files:
+        try:
+            # The janitor evicts the summaries which were used least
+            # recently, see janitor._clean_tximport_cache.
+            os.utime(cache_path(quant_file))
+        except FileNotFoundError:
+            uncached_files.append(quant_file)
+
+    if uncached_files:
+        quant_file_paths = _download_quant_files(job_context, uncached_files)
+        if quant_file_paths is None:
+            return None
+
+        tx2gene = _load_tx2gene(job_context["genes_to_transcripts_path"])
+        for quant_file, quant_file_path in quant_file_paths.items():
+            summary = _summarize_quant_file(quant_file_path, tx2gene)
+
+            # Write then rename so that a job on the same volume never
+            # reads a partially written summary.
+            temp_path = cache_path(quant_file) + "." + str(job_context["job_id"])
+            summary.to_csv(temp_path, sep="\t")
+            os.rename(temp_path, cache_path(quant_file))
+
+    logger.info("Using cached tximport summaries.",
+                processor_job=job_context["job_id"],
+                num_cached=len(quant_files) - len(uncached_files),
+                num_summarized=len(uncached_files))
+
+    return {
+        _quant_file_sample_dir(quant_file): pd.read_csv(cache_path(quant_file),
+                                                        sep="\t",
+                                                        index_col="Gene")
+        for quant_file in quant_files
+    }
+
+
+def _aggregate_gene_summaries(summaries: Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+    """Combines per-sample gene summaries into the matrices tximport returns.
+
+    This is the cross-sample part of tximport::summarizeToGene and
+    makeCountsFromAbundance, so it's cheap compared to reading every
+    quant.sf file again.
+    """
+    abundance = pd.DataFrame({sample: summary["abundance"] for sample, summary in summaries.items()})
+    counts = pd.DataFrame({sample: summary["counts"] for sample, summary in summaries.items()})
+    length = pd.DataFrame({sample: summary["length"] for sample, summary in summaries.items()})
+    mean_tx_length = pd.DataFrame(
+        {sample: summary["mean_tx_length"] for sample, summary in summaries.items()}
+    ).mean(axis=1)
+
+    # Genes without abundance in some samples get the geometric mean
+    # of their length in the other samples, and genes without
+    # abundance in any sample get their average transcript length.
+    missing = length.isnull()
+    geometric_mean = np.exp(np.log(length).mean(axis=1))
+    length = length.apply(lambda column: column.fillna(geometric_mean))
+    all_missing = missing.all(axis=1)
+    length.loc[all_missing] = np.repeat(mean_tx_length[all_missing].values[:, np.newaxis],
+                                        len(length.columns),
+                                        axis=1)
+
+    # countsFromAbundance = "lengthScaledTPM"
+    scaled_counts = abundance.multiply(length.mean(axis=1), axis=0)
+    scaled_counts = scaled_counts * (counts.sum() / scaled_counts.sum())
+
+    return {
+        "abundance": abundance,
+        "counts": counts,
+        "length": length,
+        "length_scaled_tpm": scaled_counts,
+    }
+
+
+def _run_incremental_tximport(job_context: Dict,
+                              experiment: Experiment,
+                              quant_files: List[ComputedFile],
+                              rds_file_path: str,
+                              tpm_file_path: str) -> List[str]:
+    """Produces the same outputs as tximport.R from cached per-sample
+    gene summaries.
+
+    Only the RDS file still needs R, and writing it only requires
+    reading the aggregated matrices rather than every quant.sf file.
+    Returns the command that was run, or None if it failed.
+    """
+    summaries = _get_cached_gene_summaries(job_context, quant_files)
+    if summaries is None:
+        job_context["job"].failure_reason = "Unable to fetch quant.sf files for tximport."
+        job_context["success"] = False
+        return None
+
+    matrices = _aggregate_gene_summaries(summaries)
+
+    matrix_paths = {}
+    for name in ["abundance", "counts", "length"]:
+        matrix_paths[name] = job_context["work_dir"] + "txi_" + name + ".tsv"
+        matrices[name].to_csv(matrix_paths[name], sep="\t", index_label="Gene")
+
+    matrices["length_scaled_tpm"].to_csv(tpm_file_path, sep="\t", index_label="Gene")
+
+    cmd_tokens = [
+        "/usr/bin/Rscript", "--vanilla",
+        "/home/user/data_refinery_workers/processors/tximport_rds.R",
+        "--abundance_file", matrix_paths["abundance"],
+        "--counts_file", matrix_paths["counts"],
+        "--length_file", matrix_paths["length"],
+        "--rds_file", rds_file_path
+    ]
+
+    logger.debug("Writing tximport RDS file with: %s",
+                 str(cmd_tokens),
+                 processor_job=job_context['job_id'],
+                 experiment=experiment.id)
+
+    rds_result = subprocess.run(cmd_tokens, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if rds_result.returncode != 0:
+        error_template = ("Found non-zero exit code from R code while running tximport_rds.R: {}")
+        error_message = error_template.format(rds_result.stderr.decode().strip())
+        logger.error(error_message,
+                     processor_job=job_context["job_id"],
+                     experiment=experiment.id)
+        job_context["job"].failure_reason = error_message
+        job_context["success"] = False
+        return None
+
+    return cmd_tokens
+
+
+def _run_tximport_for_experiment(
+        job_context: Dict,
+        experiment: Experiment,
+        quant_files: List[ComputedFile]) -> Dict:
+
+    rds_filename = "txi_out.RDS"
+    rds_file_path = job_context["work_dir"] + rds_filename
+    tpm_filename = "gene_lengthScaledTPM.tsv"
+    tpm_file_path = job_context["work_dir"] + tpm_filename
+    result = ComputationalResult()
+    result.time_start = timezone.now()
+
+    if USE_INCREMENTAL_TXIMPORT:
+        cmd_tokens = _run_incremental_tximport(
+            job_context, experiment, quant_files, rds_file_path, tpm_file_path)
+    else:
+        cmd_tokens = _run_tximport_script(
+            job_context, experiment, quant_files, rds_file_path, tpm_file_path)
+
+    if cmd_tokens is None:
         return job_context
 
     result.time_end = timezone.now()
@@ -700,6 +1044,21 @@ def tximport(job_context: Dict) -> Dict:
     return job_context
 
 
+def _make_fifo(name: str, job_context: Dict) -> str:
+    """Creates a named pipe in /tmp for streaming reads out of an SRA file.
+
+    The pipe is named after the sample so that a batch job can run
+    several samples one after another in the same container.
+    """
+    fifo_path = "/tmp/{}_{}".format(name, job_context["sample_accession_code"])
+    if os.path.exists(fifo_path):
+        os.remove(fifo_path)
+
+    os.mkfifo(fifo_path)
+    job_context.setdefault("fifos", []).append(fifo_path)
+    return fifo_path
+
+
 def _run_salmon(job_context: Dict) -> Dict:
     """Runs Salmon Quant."""
     logger.debug("Running Salmon..")
@@ -712,20 +1071,22 @@ def _run_salmon(job_context: Dict) -> Dict:
         # Single reads
         if job_context['sra_num_reads'] == 1:
 
-            fifo = "/tmp/barney"
-            os.mkfifo(fifo)
+            fifo = _make_fifo("barney", job_context)
 
             dump_str = "fastq-dump --stdout {input_sra_file} > {fifo} &"
             formatted_dump_command = dump_str.format(input_sra_file=job_context["sra_input_file_path"],
                                                    fifo=fifo)
             dump_po = subprocess.Popen(formatted_dump_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-            command_str = ( "salmon --no-version-check quant -l A -i {index} "
-                            "-r {fifo} -p 16 -o {output_directory} --seqBias --dumpEq --writeUnmappedNames"
+            command_str = ( "salmon --no-version-check quant -l A --biasSpeedSamp {bias_speed_samp}"
+                            " -i {index} -r {fifo} -p {threads} -o {output_directory}"
+                            " --seqBias --dumpEq --writeUnmappedNames"
                          )
             formatted_command = command_str.format(index=job_context["index_directory"],
                                                    input_sra_file=job_context["sra_input_file_path"],
                                                    fifo=fifo,
+                                                   threads=job_context["salmon_threads"],
+                                                   bias_speed_samp=job_context["salmon_bias_speed_samp"],
                                                    output_directory=job_context["output_directory"])
         # Paired are trickier
         else:
@@ -733,10 +1094,8 @@ def _run_salmon(job_context: Dict) -> Dict:
             # Okay, for some reason I can't explain, this only works in the temp directory,
             # otherwise the `tee` part will only output to one or the other of the streams (non-deterministically),
             # but not both. This doesn't appear to happen if the fifos are in tmp.
-            alpha = "/tmp/alpha"
-            os.mkfifo(alpha)
-            beta = "/tmp/beta"
-            os.mkfifo(beta)
+            alpha = _make_fifo("alpha", job_context)
+            beta = _make_fifo("beta", job_context)
 
             dump_str = "fastq-dump --stdout --split-files -I {input_sra_file} | tee >(grep '@.*\.1\s' -A3 --no-group-separator > {fifo_alpha}) >(grep '@.*\.2\s' -A3 --no-group-separator > {fifo_beta}) > /dev/null &"
             formatted_dump_command = dump_str.format(input_sra_file=job_context["sra_input_file_path"],
@@ -748,37 +1107,42 @@ def _run_salmon(job_context: Dict) -> Dict:
                                         stdout=subprocess.PIPE,
                                         stderr=subprocess.STDOUT)
 
-            command_str = ( "salmon --no-version-check quant -l A -i {index} "
-                            "-1 {fifo_alpha} -2 {fifo_beta} -p 16 -o {output_directory} --seqBias --dumpEq --writeUnmappedNames"
+            command_str = ( "salmon --no-version-check quant -l A --biasSpeedSamp {bias_speed_samp}"
+                            " -i {index} -1 {fifo_alpha} -2 {fifo_beta} -p {threads} -o {output_directory}"
+                            " --seqBias --dumpEq --writeUnmappedNames"
                          )
             formatted_command = command_str.format(index=job_context["index_directory"],
                                                    input_sra_file=job_context["sra_input_file_path"],
                                                    fifo_alpha=alpha,
                                                    fifo_beta=beta,
+                                                   threads=job_context["salmon_threads"],
+                                                   bias_speed_samp=job_context["salmon_bias_speed_samp"],
                                                    output_directory=job_context["output_directory"])
 
     else:
         if "input_file_path_2" in job_context:
             second_read_str = " -2 {}".format(job_context["input_file_path_2"])
 
-            # Rob recommends 16 threads/process, which fits snugly on an x1 at 8GB RAM per Salmon container:
-            # (2 threads/core * 16 cores/socket * 64 vCPU) / (1TB/8GB) = ~17
-            command_str = ("salmon --no-version-check quant -l A --biasSpeedSamp 5 -i {index}"
-                           " -1 {input_one}{second_read_str} -p 16 -o {output_directory}"
+            command_str = ("salmon --no-version-check quant -l A --biasSpeedSamp {bias_speed_samp}"
+                           " -i {index} -1 {input_one}{second_read_str} -p {threads} -o {output_directory}"
                            " --seqBias --gcBias --dumpEq --writeUnmappedNames")
 
             formatted_command = command_str.format(index=job_context["index_directory"],
                                                    input_one=job_context["input_file_path"],
                                                    second_read_str=second_read_str,
+                                                   threads=job_context["salmon_threads"],
+                                                   bias_speed_samp=job_context["salmon_bias_speed_samp"],
                                                    output_directory=job_context["output_directory"])
         else:
             # Related: https://github.com/COMBINE-lab/salmon/issues/83
-            command_str = ("salmon --no-version-check quant -l A -i {index}"
-                           " -r {input_one} -p 16 -o {output_directory}"
+            command_str = ("salmon --no-version-check quant -l A --biasSpeedSamp {bias_speed_samp}"
+                           " -i {index} -r {input_one} -p {threads} -o {output_directory}"
                            " --seqBias --dumpEq --writeUnmappedNames")
 
             formatted_command = command_str.format(index=job_context["index_directory"],
                                                    input_one=job_context["input_file_path"],
+                                                   threads=job_context["salmon_threads"],
+                                                   bias_speed_samp=job_context["salmon_bias_speed_samp"],
                                                    output_directory=job_context["output_directory"])
 
     logger.debug("Running Salmon Quant using the following shell command: %s",
@@ -791,6 +1155,9 @@ def _run_salmon(job_context: Dict) -> Dict:
                                        stderr=subprocess.PIPE)
     job_context['time_end'] = timezone.now()
 
+    for fifo_path in job_context.pop("fifos", []):
+        os.remove(fifo_path)
+
     ## To me, this looks broken: error codes are anything non-zero.
     ## However, Salmon (seems) to output with negative status codes
     ## even with successful executions.
@@ -820,10 +1187,17 @@ def _run_salmon(job_context: Dict) -> Dict:
         except Exception as e:
             return utils.handle_processor_exception(job_context, processor_key, e)
 
-        # Zip up the output of Salmon Quant
+        # Zip up the output of Salmon Quant, uploading it as it's compressed.
+        salmon_quant_archive = ComputedFile()
+        salmon_quant_archive.absolute_file_path = job_context["output_archive"]
+        salmon_quant_archive.filename = os.path.split(job_context["output_archive"])[-1]
+        s3_key = utils.get_s3_key(salmon_quant_archive.filename)
         try:
-            with tarfile.open(job_context['output_archive'], "w:gz") as tar:
-                tar.add(job_context["output_directory"], arcname=os.sep)
+            packaged = utils.package_directory(job_context["output_directory"],
+                                               job_context["output_archive"],
+                                               "SALMON_QUANT",
+                                               utils.S3_BUCKET_NAME,
+                                               s3_key)
         except Exception:
             logger.exception("Exception caught while zipping processed directory %s",
                              job_context["output_directory"],
@@ -834,11 +1208,11 @@ def _run_salmon(job_context: Dict) -> Dict:
             job_context["success"] = False
             return job_context
 
-        salmon_quant_archive = ComputedFile()
-        salmon_quant_archive.absolute_file_path = job_context["output_archive"]
-        salmon_quant_archive.filename = os.path.split(job_context["output_archive"])[-1]
-        salmon_quant_archive.calculate_sha1()
-        salmon_quant_archive.calculate_size()
+        salmon_quant_archive.sha1 = packaged["sha1"]
+        salmon_quant_archive.size_in_bytes = packaged["size"]
+        if packaged["uploaded"]:
+            salmon_quant_archive.s3_bucket = utils.S3_BUCKET_NAME
+            salmon_quant_archive.s3_key = s3_key
         salmon_quant_archive.is_public = True
         salmon_quant_archive.is_smashable = False
         salmon_quant_archive.is_qc = False
@@ -875,6 +1249,9 @@ def _run_salmon(job_context: Dict) -> Dict:
                 failure_template = "Exception caught while uploading quantfile to S3: {}"
                 job_context["job"].failure_reason = failure_template.format(quant_file.absolute_file_path)
                 job_context["success"] = False
+                # The archive was already uploaded but end_job won't know about it.
+                if salmon_quant_archive.s3_key:
+                    salmon_quant_archive.delete_s3_file()
                 return job_context
 
         # Here select_for_update() is used as a mutex that forces multiple
@@ -928,12 +1305,31 @@ def _run_salmon(job_context: Dict) -> Dict:
         except Exception:
             # See: https://github.com/AlexsLemonade/refinebio/issues/1167
             logger.exception("Error parsing Salmon meta_info JSON output!", processor_job=job_context["job_id"])
+        else:
+            _log_salmon_throughput(job_context, meta_info)
 
         job_context["success"] = True
 
     return job_context
 
 
+def _log_salmon_throughput(job_context: Dict, meta_info: Dict) -> None:
+    """Logs how many reads/sec salmon quant achieved with the threads it
+    was given so that we can tune how jobs get packed onto instances."""
+    num_processed = meta_info.get("num_processed", None)
+    elapsed_seconds = (job_context['time_end'] - job_context['time_start']).total_seconds()
+    if not num_processed or elapsed_seconds <= 0:
+        return
+
+    logger.info("Salmon quant throughput.",
+                processor_job=job_context["job_id"],
+                num_processed=num_processed,
+                elapsed_seconds=elapsed_seconds,
+                reads_per_second=num_processed / elapsed_seconds,
+                salmon_threads=job_context["salmon_threads"],
+                ram_amount=job_context["job"].ram_amount)
+
+
 def _run_salmontools(job_context: Dict) -> Dict:
     """ Run Salmontools to extract unmapped genes. """
 
@@ -975,10 +1371,14 @@ def _run_salmontools(job_context: Dict) -> Dict:
     status_str = completed_command.stderr.decode().strip()
     success_pattern = r'^There were \d+ unmapped reads$'
     if re.match(success_pattern, status_str):
-        # Zip up the output of salmontools
+        # Zip up the output of salmontools, uploading it as it's compressed.
+        s3_key = utils.get_s3_key(job_context["salmontools_archive"].split("/")[-1])
         try:
-            with tarfile.open(job_context['salmontools_archive'], "w:gz") as tar:
-                tar.add(job_context["salmontools_directory"], arcname=os.sep)
+            packaged = utils.package_directory(job_context["salmontools_directory"],
+                                               job_context["salmontools_archive"],
+                                               "SALMONTOOLS",
+                                               utils.S3_BUCKET_NAME,
+                                               s3_key)
         except Exception:
             logger.exception("Exception caught while zipping processed directory %s",
                              job_context["salmontools_directory"],
@@ -1012,8 +1412,11 @@ def _run_salmontools(job_context: Dict) -> Dict:
         computed_file = ComputedFile()
         computed_file.filename = job_context["salmontools_archive"].split("/")[-1]
         computed_file.absolute_file_path = job_context["salmontools_archive"]
-        computed_file.calculate_sha1()
-        computed_file.calculate_size()
+        computed_file.sha1 = packaged["sha1"]
+        computed_file.size_in_bytes = packaged["size"]
+        if packaged["uploaded"]:
+            computed_file.s3_bucket = utils.S3_BUCKET_NAME
+            computed_file.s3_key = s3_key
         computed_file.is_public = True
         computed_file.is_smashable = False
         computed_file.is_qc = True
@@ -1054,9 +1457,326 @@ def salmon(job_id: int) -> None:
                         _determine_index_length,
                         _find_or_download_index,
 
+                        _determine_salmon_resources,
                         _run_salmon,
                         get_tximport_inputs,
                         tximport,
                         _run_salmontools,
                         utils.end_job])
     return final_context
+
+
+def _group_original_files_by_sample(original_files) -> Dict[Sample, List]:
+    """Returns a mapping from each sample to its original files, keeping
+    paired reads together and in filename order."""
+    files_by_sample = {}
+    for original_file in sorted(original_files, key=lambda og_file: og_file.filename):
+        sample = original_file.samples.first()
+        files_by_sample.setdefault(sample, []).append(original_file)
+
+    return files_by_sample
+
+
+def _get_folded_jobs(original_files: List):
+    """Returns the SALMON jobs for original_files which were folded into
+    a batch and haven't been closed out yet."""
+    return ProcessorJob.objects.filter(
+        pipeline_applied=ProcessorPipeline.SALMON.value,
+        retried=False,
+        retried_job__isnull=False,
+        original_files__in=original_files
+    )
+
+
+def _prepare_batch_files(job_context: Dict) -> Dict:
+    """Picks the samples of the batch which can be quantified now.
+
+    The SALMON jobs folded into the batch are closed out first so that
+    they don't count as processing their own samples. Samples which
+    have already been processed are then dropped from the batch, as
+    are samples whose files aren't on disk once a downloader job is
+    waiting to download them again, which will queue a new SALMON job
+    when it's done. This way one sample can't hold up the rest.
+    """
+    batch_job = job_context["job"]
+    relations = ProcessorJobOriginalFileAssociation.objects.filter(processor_job=batch_job)
+    original_files = list(OriginalFile.objects.filter(id__in=relations.values('original_file_id')))
+
+    if not original_files:
+        logger.error("No files found.", processor_job=batch_job.id)
+        job_context["success"] = False
+        batch_job.failure_reason = "No files were found for the job."
+        return job_context
+
+    now = timezone.now()
+    _get_folded_jobs(original_files).update(
+        start_time=now,
+        end_time=now,
+        success=False,
+        retried=True,
+        retried_job=batch_job,
+        failure_reason="Folded into SALMON_BATCH job {}.".format(batch_job.id)
+    )
+
+    batch_files = []
+    dropped_files = []
+    for sample, sample_files in _group_original_files_by_sample(original_files).items():
+        if not sample_files[0].needs_processing(job_context["job_id"]):
+            logger.info("Sample in salmon batch has already been processed, dropping it.",
+                        processor_job=job_context["job_id"],
+                        sample=sample.accession_code)
+            dropped_files.extend(sample_files)
+            continue
+
+        missing_files = [original_file for original_file in sample_files
+                         if not original_file.absolute_file_path
+                         or not os.path.exists(original_file.absolute_file_path)]
+        if not missing_files:
+            batch_files.extend(sample_files)
+            continue
+
+        undownloaded_files = [original_file for original_file in missing_files
+                              if original_file.needs_downloading(job_context["job_id"])]
+        if not undownloaded_files:
+            logger.info("Sample in salmon batch is waiting on a downloader job, dropping it.",
+                        processor_job=job_context["job_id"],
+                        sample=sample.accession_code)
+            dropped_files.extend(sample_files)
+            continue
+
+        for original_file in undownloaded_files:
+            if original_file.is_downloaded:
+                # The is_downloaded field should stop lying about it.
+                original_file.is_downloaded = False
+                original_file.save()
+
+        if utils.create_downloader_job(undownloaded_files, job_context["job_id"]):
+            logger.info("Sample in salmon batch is missing files, recreated its downloader job.",
+                        processor_job=job_context["job_id"],
+                        sample=sample.accession_code,
+                        missing_files=undownloaded_files)
+            dropped_files.extend(sample_files)
+        else:
+            # It will fail on its own and get retried by itself.
+            logger.error("Missing file for sample in salmon batch but unable to recreate downloader job!",
+                         processor_job=job_context["job_id"],
+                         sample=sample.accession_code)
+            batch_files.extend(sample_files)
+
+    # Retries of the batch shouldn't pick them back up.
+    if dropped_files:
+        relations.filter(original_file__in=dropped_files).delete()
+
+    job_context["original_files"] = batch_files
+    job_context["computed_files"] = []
+    return job_context
+
+
+def _find_or_download_batch_index(job_context: Dict) -> Dict:
+    """Finds the index for this sample's length, reusing it if an earlier
+    sample in the batch already found it.
+
+    The index gets installed under a directory named after the batch
+    job and the index length rather than the per-sample work directory
+    so that it isn't removed with the work directory.
+    """
+    index_cache = job_context["index_cache"]
+    index_length = job_context["index_length"]
+
+    # Samples quantified at the same time mustn't download the same
+    # index twice.
+    with job_context["index_lock"]:
+        if index_length not in index_cache:
+            index_context = _find_or_download_index(
+                dict(job_context,
+                     job_dir_prefix=job_context["batch_job_dir_prefix"] + "_" + index_length))
+            if index_context.get("success", True) is False:
+                job_context["success"] = False
+                return job_context
+
+            index_cache[index_length] = {
+                key: index_context[key] for key in ["index_directory",
+                                                    "genes_to_transcripts_path",
+                                                    "organism_index"]
+            }
+
+    job_context.update(index_cache[index_length])
+    return job_context
+
+
+# The steps `salmon_batch` runs for each sample after its files have
+# been prepared. The index lookup only goes to the database and disk
+# once per index length.
+BATCH_SAMPLE_STEPS = [_determine_index_length,
+                      _find_or_download_batch_index,
+                      _run_salmon,
+                      get_tximport_inputs,
+                      tximport,
+                      _run_salmontools]
+
+
+def _record_sample_failure(job_context: Dict, sample_context: Dict, original_files: List) -> None:
+    """Saves a failed SALMON ProcessorJob for a sample from the batch.
+
+    This keeps the failure visible per sample and lets the foreman retry
+    the sample by itself, the same way it would any failed SALMON job.
+    """
+    failed_job = sample_context["job"]
+    failed_job.worker_id = job_context["job"].worker_id
+    failed_job.worker_version = job_context["job"].worker_version
+    failed_job.start_time = sample_context["start_time"]
+    failed_job.end_time = timezone.now()
+    failed_job.success = False
+    failed_job.save()
+
+    for original_file in original_files:
+        ProcessorJobOriginalFileAssociation.objects.get_or_create(processor_job=failed_job,
+                                                                  original_file=original_file)
+
+    for computed_file in sample_context.get("computed_files", []):
+        if computed_file.s3_bucket and computed_file.s3_key:
+            computed_file.delete_s3_file()
+        computed_file.delete_local_file()
+        computed_file.delete()
+
+    logger.error("Sample in salmon batch failed.",
+                 processor_job=job_context["job_id"],
+                 sample=sample_context["sample_accession_code"],
+                 failed_processor_job=failed_job.id,
+                 failure_reason=failed_job.failure_reason)
+
+
+def _run_batch_sample(job_context: Dict, sample: Sample, original_files: List) -> Dict:
+    """Quantifies one sample of the batch and returns its context.
+
+    Each sample gets its own unsaved SALMON ProcessorJob to collect
+    failure information, which only gets saved if that sample fails.
+    """
+    batch_job = job_context["job"]
+    sample_context = {
+        "job_id": job_context["job_id"],
+        "job": ProcessorJob(pipeline_applied=ProcessorPipeline.SALMON.value,
+                            ram_amount=batch_job.ram_amount,
+                            volume_index=batch_job.volume_index),
+        "pipeline": job_context["pipeline"],
+        "original_files": original_files,
+        "computed_files": [],
+        "job_dir_prefix": os.path.join(job_context["job_dir_prefix"], sample.accession_code),
+        "batch_job_dir_prefix": job_context["job_dir_prefix"],
+        "index_cache": job_context["index_cache"],
+        "index_lock": job_context["index_lock"],
+        "salmon_threads": job_context["salmon_threads"],
+        "salmon_bias_speed_samp": job_context["salmon_bias_speed_samp"],
+        "sample_accession_code": sample.accession_code,
+        "start_time": timezone.now(),
+    }
+
+    try:
+        sample_context = _prepare_files(sample_context)
+        for step in BATCH_SAMPLE_STEPS:
+            if sample_context.get("success", True) is False:
+                break
+            sample_context = step(sample_context)
+    except Exception as e:
+        logger.exception("Unhandled exception while processing sample in salmon batch.",
+                         processor_job=job_context["job_id"],
+                         sample=sample.accession_code)
+        sample_context["success"] = False
+        sample_context["job"].failure_reason = ("Unhandled exception caught while running"
+                                                " salmon batch: " + str(e))
+
+    if sample_context.get("success", True) is False:
+        _record_sample_failure(job_context, sample_context, original_files)
+
+    return sample_context
+
+
+def _run_batch_sample_in_thread(job_context: Dict, sample: Sample, original_files: List) -> Dict:
+    try:
+        return _run_batch_sample(job_context, sample, original_files)
+    finally:
+        # Each thread gets its own database connection.
+        connection.close()
+
+
+def _run_salmon_batch(job_context: Dict) -> Dict:
+    """Quantifies every sample in the batch.
+
+    The first sample is quantified by itself, which finds its index.
+    The resources are then picked again based on the size of the
+    largest index found, and up to `salmon_max_concurrent_quants` of
+    the rest are quantified at once. Every sample in the batch uses the
+    same one or two indices, so they stay in the page cache between
+    salmon invocations.
+    """
+    job_context["work_dir"] = os.path.join(LOCAL_ROOT_DIR, job_context["job_dir_prefix"]) + "/"
+    os.makedirs(job_context["work_dir"], exist_ok=True)
+    job_context["index_cache"] = {}
+    job_context["index_lock"] = threading.Lock()
+
+    files_by_sample = _group_original_files_by_sample(job_context["original_files"])
+    sample_items = list(files_by_sample.items())
+
+    job_context = _determine_salmon_resources(job_context)
+    sample_contexts = [_run_batch_sample(job_context, sample, original_files)
+                       for sample, original_files in sample_items[:1]]
+
+    index_sizes = [_get_directory_size_mb(index["index_directory"])
+                   for index in job_context["index_cache"].values()]
+    if index_sizes:
+        job_context = _determine_salmon_resources(job_context, index_mb=max(index_sizes))
+
+    max_concurrent_quants = min(job_context["salmon_max_concurrent_quants"], len(sample_items) - 1)
+    if max_concurrent_quants > 1:
+        with ThreadPoolExecutor(max_workers=max_concurrent_quants) as executor:
+            sample_contexts.extend(executor.map(
+                lambda item: _run_batch_sample_in_thread(job_context, *item),
+                sample_items[1:]))
+    else:
+        sample_contexts.extend([_run_batch_sample(job_context, sample, original_files)
+                                for sample, original_files in sample_items[1:]])
+
+    processed_samples = []
+    successful_files = []
+    num_failed = 0
+    for sample_context in sample_contexts:
+        if sample_context.get("success", True) is False:
+            num_failed += 1
+            continue
+
+        job_context["computed_files"].extend(sample_context["computed_files"])
+        successful_files.extend(sample_context["original_files"])
+        if sample_context.get("tximported", False):
+            processed_samples.extend(sample_context["samples"])
+
+    # end_job only cleans up the files it's told about and marks the
+    # samples it's given as processed, so hand it the successful ones.
+    job_context["original_files"] = successful_files
+    job_context["samples"] = processed_samples
+    job_context["success"] = True
+
+    logger.info("Finished salmon batch.",
+                processor_job=job_context["job_id"],
+                num_samples=len(files_by_sample),
+                num_failed=num_failed,
+                max_concurrent_quants=max_concurrent_quants,
+                index_lengths=list(job_context["index_cache"].keys()))
+
+    return job_context
+
+
+def salmon_batch(job_id: int) -> None:
+    """Main processor function for batched Salmon jobs.
+
+    Runs salmon quant, tximport and Salmontools on each sample of a
+    SALMON_BATCH job in the same worker so that the index only needs
+    to be found and loaded from disk once for the whole batch.
+    """
+    pipeline = Pipeline(name=utils.PipelineEnum.SALMON.value)
+    final_context = utils.run_pipeline({"job_id": job_id, "pipeline": pipeline},
+                       [utils.start_job,
+                        _prepare_batch_files,
+                        _set_job_prefix,
+                        _run_salmon_batch,
+                        utils.end_job])
+    return final_context
@@ -3,6 +3,8 @@ import json
 import os
 import shutil
 import sys
+import tempfile
+import time
 import zipfile
 
 from io import StringIO
@@ -131,3 +133,101 @@ class JanitorTestCase(TestCase):
 
         # Deleted all the working directories except for the one that's still running.
         self.assertEqual(len(final_context['deleted_items']), (JOBS*2)-1)
+
+
+class DownloadCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp() + "/"
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def make_entry(self, key, size, last_used):
+        with open(self.cache_dir + key, "wb") as cached_file:
+            cached_file.write(b"0" * size)
+        with open(self.cache_dir + key + ".json", "w") as metadata_file:
+            json.dump({"size": size}, metadata_file)
+        os.utime(self.cache_dir + key, (last_used, last_used))
+        os.utime(self.cache_dir + key + ".json", (last_used, last_used))
+
+    @tag("janitor")
+    def test_evicts_least_recently_used(self):
+        self.make_entry("oldest", 1000, 100)
+        self.make_entry("older", 1000, 200)
+        self.make_entry("newest", 1000, 300)
+
+        with patch.object(janitor, "DOWNLOAD_CACHE_DIR", self.cache_dir), \
+             patch.object(janitor, "DOWNLOAD_CACHE_MAX_SIZE", 1500):
+            job_context = janitor._clean_download_cache({})
+
+        self.assertTrue(job_context["success"])
+        self.assertFalse(os.path.exists(self.cache_dir + "oldest"))
+        self.assertFalse(os.path.exists(self.cache_dir + "older.json"))
+        self.assertTrue(os.path.exists(self.cache_dir + "newest"))
+        self.assertEqual(job_context["deleted_items"],
+                         [self.cache_dir + "oldest", self.cache_dir + "older"])
+
+
+class TximportCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp() + "/"
+        os.makedirs(self.cache_dir + "1")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def make_summary(self, name, size, last_used):
+        path = self.cache_dir + "1/" + name + ".tsv"
+        with open(path, "wb") as summary_file:
+            summary_file.write(b"0" * size)
+        os.utime(path, (last_used, last_used))
+        return path
+
+    @tag("janitor")
+    def test_evicts_least_recently_used(self):
+        now = time.time()
+        oldest = self.make_summary("oldest", 1000, now - 3 * 60 * 60)
+        older = self.make_summary("older", 1000, now - 2 * 60 * 60)
+        # Too big for the cache, but it might still be being read.
+        in_use = self.make_summary("in_use", 1000, now)
+
+        with patch.object(janitor, "TXIMPORT_CACHE_DIR", self.cache_dir), \
+             patch.object(janitor, "TXIMPORT_CACHE_MAX_SIZE", 1500):
+            job_context = janitor._clean_tximport_cache({})
+
+        self.assertTrue(job_context["success"])
+        self.assertEqual(job_context["deleted_items"], [oldest, older])
+        self.assertTrue(os.path.exists(in_use))
+
+
+class PartialDownloadsTestCase(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root_dir, "raw", "SRR123"))
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def make_file(self, name, last_modified):
+        path = os.path.join(self.root_dir, "raw", "SRR123", name)
+        with open(path, "wb") as new_file:
+            new_file.write(b"0")
+        os.utime(path, (last_modified, last_modified))
+        return path
+
+    @tag("janitor")
+    def test_deletes_abandoned_partial_downloads(self):
+        now = time.time()
+        old = now - janitor.PARTIAL_DOWNLOAD_MAX_AGE - 60
+        abandoned = self.make_file("SRR123.sra.part", old)
+        abandoned_checkpoint = self.make_file("SRR123.sra.part.json", old)
+        resumable = self.make_file("SRR124.sra.part", now)
+        downloaded = self.make_file("SRR125.sra", old)
+
+        with patch.object(janitor, "LOCAL_ROOT_DIR", self.root_dir):
+            job_context = janitor._clean_partial_downloads({})
+
+        self.assertTrue(job_context["success"])
+        self.assertEqual(sorted(job_context["deleted_items"]), [abandoned, abandoned_checkpoint])
+        self.assertTrue(os.path.exists(resumable))
+        self.assertTrue(os.path.exists(downloaded))
@@ -1,20 +1,24 @@
 import hashlib
 import numpy
 import os
+import pandas
 import random
 import scipy.stats
 import shutil
 import subprocess
+import tempfile
 
 from contextlib import closing
 from django.test import TestCase, tag
 from typing import Dict, List
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from data_refinery_common.utils import get_env_variable
 from data_refinery_common.models import (
     ComputationalResult,
     ComputedFile,
+    DownloaderJob,
+    DownloaderJobOriginalFileAssociation,
     Experiment,
     ExperimentSampleAssociation,
     Organism,
@@ -275,6 +279,7 @@ class SalmonTestCase(TestCase):
         if "test_experiment" in sample_dir:
             job_context["index_directory"] = job_context["index_directory"].replace("SHORT", "LONG")
 
+        job_context = salmon._determine_salmon_resources(job_context)
         job_context = salmon._run_salmon(job_context)
         job_context = salmon.get_tximport_inputs(job_context)
         job_context = salmon.tximport(job_context)
@@ -517,6 +522,236 @@ class SalmonTestCase(TestCase):
         self.assertEqual({}, quantified_experiments)
 
 
+class SalmonResourcesTestCase(TestCase):
+    """Tests that the salmon resource profile follows the container limits."""
+
+    @tag('salmon')
+    @patch('data_refinery_workers.processors.salmon.utils.get_memory_limit_mb')
+    @patch('data_refinery_workers.processors.salmon.utils.get_cpu_limit')
+    def test_threads_bounded_by_cpu_quota(self, mock_cpu_limit, mock_memory_limit):
+        mock_cpu_limit.return_value = 8
+        mock_memory_limit.return_value = 65536
+
+        job_context = salmon._determine_salmon_resources({"job_id": "TEST",
+                                                          "job": ProcessorJob(ram_amount=12288)})
+
+        self.assertEqual(job_context["salmon_threads"], 8)
+        self.assertEqual(job_context["salmon_bias_speed_samp"], salmon.DEFAULT_BIAS_SPEED_SAMP)
+        self.assertEqual(job_context["salmon_max_concurrent_quants"], 1)
+
+    @tag('salmon')
+    @patch('data_refinery_workers.processors.salmon.utils.get_memory_limit_mb')
+    @patch('data_refinery_workers.processors.salmon.utils.get_cpu_limit')
+    def test_threads_bounded_by_ram_amount(self, mock_cpu_limit, mock_memory_limit):
+        mock_cpu_limit.return_value = 64
+        mock_memory_limit.return_value = 1024 * 1024
+
+        job_context = salmon._determine_salmon_resources({"job_id": "TEST",
+                                                          "job": ProcessorJob(ram_amount=2048)})
+
+        self.assertEqual(job_context["salmon_threads"],
+                         (2048 - salmon.DEFAULT_SALMON_INDEX_MB) // salmon.SALMON_MB_PER_THREAD)
+        self.assertEqual(job_context["salmon_bias_speed_samp"], salmon.LOW_THREAD_BIAS_SPEED_SAMP)
+        self.assertEqual(job_context["salmon_max_concurrent_quants"], 1)
+
+    @tag('salmon')
+    @patch('data_refinery_workers.processors.salmon._get_directory_size_mb')
+    @patch('data_refinery_workers.processors.salmon.utils.get_memory_limit_mb')
+    @patch('data_refinery_workers.processors.salmon.utils.get_cpu_limit')
+    def test_concurrent_quants_each_load_index(self, mock_cpu_limit, mock_memory_limit, mock_index_size):
+        mock_cpu_limit.return_value = 64
+        mock_memory_limit.return_value = 1024 * 1024
+        mock_index_size.return_value = 4096
+
+        job_context = salmon._determine_salmon_resources({"job_id": "TEST",
+                                                          "job": ProcessorJob(ram_amount=32768),
+                                                          "index_directory": "/tmp/index"})
+
+        # Every quant run loads its own copy of the index.
+        self.assertEqual(job_context["salmon_threads"], salmon.MAX_SALMON_THREADS)
+        self.assertEqual(job_context["salmon_max_concurrent_quants"],
+                         32768 // (4096 + salmon.MAX_SALMON_THREADS * salmon.SALMON_MB_PER_THREAD))
+
+        # Once the index is found in a batch, its size is passed in.
+        job_context = salmon._determine_salmon_resources({"job_id": "TEST",
+                                                          "job": ProcessorJob(ram_amount=32768)},
+                                                         index_mb=8192)
+        self.assertEqual(job_context["salmon_max_concurrent_quants"],
+                         32768 // (8192 + salmon.MAX_SALMON_THREADS * salmon.SALMON_MB_PER_THREAD))
+
+
+class SalmonBatchTestCase(TestCase):
+    """Tests that samples which can't be run are dropped from a batch
+    instead of taking the whole batch down."""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.organism = Organism.get_object_for_name("CAENORHABDITIS_ELEGANS")
+        self.batch_job = ProcessorJob(pipeline_applied="SALMON_BATCH", ram_amount=12288)
+        self.batch_job.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def add_sample(self, accession_code: str, on_disk=True) -> ProcessorJob:
+        """Adds a sample to the batch along with the SALMON job and the
+        DownloaderJob it came from."""
+        sample = Sample(accession_code=accession_code,
+                        organism=self.organism,
+                        source_database="SRA",
+                        technology="RNA-SEQ")
+        sample.save()
+
+        original_file = OriginalFile(filename=accession_code + ".fastq",
+                                     source_filename=accession_code + ".fastq",
+                                     absolute_file_path=os.path.join(self.work_dir,
+                                                                     accession_code + ".fastq"),
+                                     is_downloaded=True)
+        original_file.save()
+        if on_disk:
+            with open(original_file.absolute_file_path, "w") as fastq_file:
+                fastq_file.write("@read\nACGT\n+\nFFFF\n")
+
+        OriginalFileSampleAssociation.objects.create(original_file=original_file, sample=sample)
+        ProcessorJobOriginalFileAssociation.objects.create(processor_job=self.batch_job,
+                                                           original_file=original_file)
+
+        downloader_job = DownloaderJob(downloader_task="SRA",
+                                       accession_code=accession_code,
+                                       success=True)
+        downloader_job.save()
+        DownloaderJobOriginalFileAssociation.objects.create(downloader_job=downloader_job,
+                                                            original_file=original_file)
+
+        folded_job = ProcessorJob(pipeline_applied="SALMON", retried_job=self.batch_job)
+        folded_job.save()
+        ProcessorJobOriginalFileAssociation.objects.create(processor_job=folded_job,
+                                                           original_file=original_file)
+
+        return folded_job
+
+    def start_batch(self) -> Dict:
+        job_context = utils.start_job({"job_id": self.batch_job.id, "job": self.batch_job})
+        return salmon._prepare_batch_files(job_context)
+
+    def assert_batch_files(self, job_context: Dict, accession_codes: List[str]) -> None:
+        expected_filenames = [accession_code + ".fastq" for accession_code in accession_codes]
+        self.assertEqual([original_file.filename for original_file in job_context["original_files"]],
+                         expected_filenames)
+        self.assertEqual(sorted(self.batch_job.original_files.values_list("filename", flat=True)),
+                         expected_filenames)
+
+    @tag('salmon')
+    def test_processed_sample_dropped(self):
+        processed_job = self.add_sample("SRR100")
+        other_job = self.add_sample("SRR101")
+
+        result = ComputationalResult(processor=utils.find_processor('SALMON_QUANT'))
+        result.save()
+        computed_file = ComputedFile(filename="quant.sf",
+                                     result=result,
+                                     size_in_bytes=1337,
+                                     sha1="ABC",
+                                     s3_bucket="bucket",
+                                     s3_key="quant.sf")
+        computed_file.save()
+        SampleComputedFileAssociation.objects.create(
+            sample=processed_job.original_files.first().samples.first(),
+            computed_file=computed_file
+        )
+
+        job_context = self.start_batch()
+
+        self.assertNotIn("abort", job_context)
+        self.assert_batch_files(job_context, ["SRR101"])
+        for folded_job in [processed_job, other_job]:
+            folded_job.refresh_from_db()
+            self.assertTrue(folded_job.retried)
+            self.assertEqual(folded_job.retried_job, self.batch_job)
+
+    @tag('salmon')
+    def test_missing_sample_redownloaded(self):
+        missing_job = self.add_sample("SRR100", on_disk=False)
+        other_job = self.add_sample("SRR101")
+
+        job_context = self.start_batch()
+
+        self.assertNotIn("delete_self", job_context)
+        self.assertTrue(ProcessorJob.objects.filter(id=self.batch_job.id).exists())
+        self.assert_batch_files(job_context, ["SRR101"])
+
+        missing_file = missing_job.original_files.first()
+        recreated_job = missing_file.downloader_jobs.latest('id')
+        self.assertTrue(recreated_job.was_recreated)
+        self.assertIsNone(recreated_job.start_time)
+        missing_file.refresh_from_db()
+        self.assertFalse(missing_file.is_downloaded)
+
+        for folded_job in [missing_job, other_job]:
+            folded_job.refresh_from_db()
+            self.assertTrue(folded_job.retried)
+            self.assertEqual(folded_job.retried_job, self.batch_job)
+
+    @tag('salmon')
+    def test_folded_job_left_to_batch(self):
+        folded_job = self.add_sample("SRR100")
+
+        salmon.salmon(folded_job.id)
+
+        folded_job.refresh_from_db()
+        self.assertIsNone(folded_job.start_time)
+        self.assertIsNone(folded_job.success)
+        self.assertFalse(folded_job.retried)
+
+
+class IncrementalTximportTestCase(TestCase):
+    """Tests the gene level summaries used by incremental tximport."""
+
+    def write_quant_file(self, directory, rows):
+        quant_path = os.path.join(directory, "quant.sf")
+        with open(quant_path, "w") as quant_file:
+            quant_file.write("Name\tLength\tEffectiveLength\tTPM\tNumReads\n")
+            for row in rows:
+                quant_file.write("\t".join(str(value) for value in row) + "\n")
+
+        return quant_path
+
+    @tag('salmon')
+    def test_summarize_and_aggregate(self):
+        tx2gene = pandas.Series({"tx1": "geneA", "tx2": "geneA", "tx3": "geneB"})
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # tx4 isn't in tx2gene so it should be dropped.
+            quant_one = self.write_quant_file(temp_dir, [("tx1", 1000, 800, 30, 10),
+                                                         ("tx2", 2000, 1800, 10, 5),
+                                                         ("tx3", 500, 300, 0, 0),
+                                                         ("tx4", 500, 300, 60, 20)])
+            summary_one = salmon._summarize_quant_file(quant_one, tx2gene)
+
+            quant_two = self.write_quant_file(temp_dir, [("tx1", 1000, 700, 0, 0),
+                                                         ("tx2", 2000, 1700, 0, 0),
+                                                         ("tx3", 500, 320, 50, 25)])
+            summary_two = salmon._summarize_quant_file(quant_two, tx2gene)
+
+        self.assertEqual(list(summary_one.index), ["geneA", "geneB"])
+        self.assertEqual(summary_one.loc["geneA", "abundance"], 40)
+        self.assertEqual(summary_one.loc["geneA", "counts"], 15)
+        self.assertEqual(summary_one.loc["geneA", "length"], (30 * 800 + 10 * 1800) / 40)
+        self.assertTrue(numpy.isnan(summary_one.loc["geneB", "length"]))
+
+        matrices = salmon._aggregate_gene_summaries({"SRR1_output": summary_one,
+                                                     "SRR2_output": summary_two})
+
+        # Zero abundance lengths come from the other sample.
+        self.assertEqual(matrices["length"].loc["geneB", "SRR1_output"], 320)
+        self.assertEqual(matrices["length"].loc["geneA", "SRR2_output"],
+                         matrices["length"].loc["geneA", "SRR1_output"])
+
+        # lengthScaledTPM preserves each sample's library size.
+        self.assertAlmostEqual(matrices["length_scaled_tpm"]["SRR1_output"].sum(), 15)
+        self.assertAlmostEqual(matrices["length_scaled_tpm"]["SRR2_output"].sum(), 25)
+
+
 class SalmonToolsTestCase(TestCase):
     """Test SalmonTools command."""
 
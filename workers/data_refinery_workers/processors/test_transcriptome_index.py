@@ -114,3 +114,35 @@ class TXTestCase(TestCase):
         file2 = job_context2["computed_file"]
         unpacked2 = '/'.join(file2.get_synced_file_path().split('/')[:-1])
         self.assertTrue('LONG' in unpacked2)
+
+    @tag('transcriptome')
+    def test_tx_both_lengths(self):
+        """Builds the long and short indices in one job."""
+        # This job deletes its input files when it succeeds, so give it
+        # its own copy of them so the other tests still have theirs.
+        input_dir = "/home/user/data_store/raw/TEST/TRANSCRIPTOME_INDEX_BOTH/AEGILOPS_TAUSCHII/"
+        shutil.rmtree(input_dir, ignore_errors=True)
+        os.makedirs(input_dir)
+
+        job = prepare_job("short")
+        job.pipeline_applied = "TRANSCRIPTOME_INDEX"
+        job.save()
+        for original_file in job.original_files.all():
+            shutil.copy(original_file.absolute_file_path, input_dir)
+            original_file.absolute_file_path = input_dir + os.path.basename(original_file.absolute_file_path)
+            original_file.save()
+
+        job_context = transcriptome_index.build_transcriptome_indices(job.pk)
+        job = ProcessorJob.objects.get(id=job.pk)
+        self.assertTrue(job.success)
+
+        long_context = job_context["indices"]["long"]
+        short_context = job_context["indices"]["short"]
+        self.assertEqual(long_context["kmer_size"], "31")
+        self.assertEqual(short_context["kmer_size"], "23")
+        self.assertEqual(long_context["index"].index_type, "TRANSCRIPTOME_LONG")
+        self.assertEqual(short_context["index"].index_type, "TRANSCRIPTOME_SHORT")
+
+        for length_context in [long_context, short_context]:
+            self.assertTrue(os.path.exists(length_context["computed_file"].get_synced_file_path()))
+            self.assertTrue(os.path.exists(length_context["output_dir"] + "genes_to_transcripts.txt"))
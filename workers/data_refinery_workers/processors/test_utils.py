@@ -1,7 +1,10 @@
 import copy
 import os
+import shutil
+import tarfile
+import tempfile
 from io import StringIO
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from django.core.management import call_command
 from django.test import TestCase
 from data_refinery_common.models import (
@@ -14,6 +17,7 @@ from data_refinery_common.models import (
     Organism
 )
 from django.utils import timezone
+from data_refinery_common.utils import calculate_sha1
 from data_refinery_workers.processors import utils
 
 
@@ -89,6 +93,41 @@ class StartJobTestCase(TestCase):
 
             self.assertRaises(utils.start_job({"job": job}))
 
+    @patch('data_refinery_workers.processors.utils.get_peak_memory_mb')
+    def test_records_resource_usage(self, mock_get_peak_memory_mb):
+        mock_get_peak_memory_mb.return_value = 1500
+
+        processor_job = prepare_job()
+        processor_job.original_files.update(size_in_bytes=5000000)
+
+        utils.end_job({"job": processor_job, "job_id": processor_job.id, "success": True})
+
+        processor_job.refresh_from_db()
+        self.assertEqual(processor_job.peak_memory, 1500)
+        self.assertEqual(processor_job.input_size, 5000000)
+        self.assertEqual(processor_job.organism_name, "CAENORHABDITIS_ELEGANS")
+
+    @patch.object(utils, '_PEAK_ANON_MEMORY', 0)
+    @patch('data_refinery_workers.processors.utils._read_cgroup_value')
+    def test_peak_memory_leaves_out_page_cache(self, mock_read_cgroup_value):
+        memory_stats = {
+            # cgroup v2, where most of the usage is page cache.
+            "/sys/fs/cgroup/memory.stat": "anon 2147483648\nfile 8589934592\n",
+        }
+        mock_read_cgroup_value.side_effect = lambda path: memory_stats.get(path)
+
+        self.assertEqual(utils.get_peak_memory_mb(), 2048)
+
+        # The peak is kept once the job frees that memory.
+        memory_stats["/sys/fs/cgroup/memory.stat"] = "anon 1073741824\nfile 8589934592\n"
+        self.assertEqual(utils.get_peak_memory_mb(), 2048)
+
+        # cgroup v1 calls it total_rss.
+        memory_stats = {
+            "/sys/fs/cgroup/memory/memory.stat": "cache 8589934592\nrss 1073741824\ntotal_rss 3221225472\n",
+        }
+        self.assertEqual(utils.get_peak_memory_mb(), 3072)
+
 class RunPipelineTestCase(TestCase):
     def test_no_job(self):
         mock_processor = MagicMock()
@@ -113,3 +152,39 @@ class RunPipelineTestCase(TestCase):
         processor_job.refresh_from_db()
         self.assertFalse(processor_job.success)
         self.assertIsNotNone(processor_job.end_time)
+
+
+class PackageDirectoryTestCase(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.work_dir, "output/")
+        os.makedirs(os.path.join(self.directory, "aux_info"))
+        with open(os.path.join(self.directory, "quant.sf"), "w") as quant_file:
+            quant_file.write("Name\tLength\tEffectiveLength\tTPM\tNumReads\n" * 1000)
+        with open(os.path.join(self.directory, "aux_info", "meta_info.json"), "w") as meta_file:
+            meta_file.write("{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def check_archive(self, archive_path, packaged):
+        self.assertEqual(packaged["sha1"], calculate_sha1(archive_path))
+        self.assertEqual(packaged["size"], os.path.getsize(archive_path))
+        with tarfile.open(archive_path, "r:gz") as archive:
+            names = [os.path.normpath(name) for name in archive.getnames()]
+        self.assertIn("quant.sf", names)
+        self.assertIn("aux_info/meta_info.json", names)
+
+    def test_package_directory(self):
+        archive_path = os.path.join(self.work_dir, "result.tar.gz")
+        packaged = utils.package_directory(self.directory, archive_path, "SALMON_QUANT")
+        self.assertFalse(packaged["uploaded"])
+        self.check_archive(archive_path, packaged)
+
+    @patch("data_refinery_workers.processors.utils.shutil.which")
+    def test_package_directory_without_pigz(self, mock_which):
+        mock_which.return_value = None
+        archive_path = os.path.join(self.work_dir, "result.tar.gz")
+        packaged = utils.package_directory(self.directory, archive_path, "SALMONTOOLS")
+        self.assertFalse(packaged["uploaded"])
+        self.check_archive(archive_path, packaged)
@@ -2,8 +2,8 @@ import gzip
 import os
 import shutil
 import subprocess
-import tarfile
 
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 from django.utils import timezone
 from typing import Dict
@@ -29,10 +29,29 @@ GENE_TO_TRANSCRIPT_TEMPLATE = "{gene_id}\t{transcript_id}\n"
 GENE_TYPE_COLUMN = 2
 S3_TRANSCRIPTOME_INDEX_BUCKET_NAME = get_env_variable_gracefully("S3_TRANSCRIPTOME_INDEX_BUCKET_NAME", False)
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
+# Salmon indices which get built for each organism. See `_create_index`.
+INDEX_LENGTHS = ["long", "short"]
+# The filtered GTF is written in large chunks since it's most of the GTF.
+GTF_WRITE_BUFFER_SIZE = 1024 * 1024
 # Removes each occurrance of ; and "
 IDS_CLEANUP_TABLE = str.maketrans({";": None, "\"": None})
 
 
+def _compute_length_paths(job_context: Dict, length_dir: str) -> Dict:
+    """Computes the paths of the index directory and archive for
+    job_context["length"], nested under `length_dir`."""
+    job_context["output_dir"] = length_dir + "index/"
+    os.makedirs(job_context["output_dir"], exist_ok=True)
+
+    stamp = str(timezone.now().timestamp()).split('.')[0]
+    archive_file_name = job_context["organism_name"] + "_" + \
+                        job_context['length'].upper() + "_" + stamp + '.tar.gz'
+
+    job_context["computed_archive"] = length_dir + archive_file_name
+
+    return job_context
+
+
 def _compute_paths(job_context: Dict) -> str:
     """Computes the paths for all the directories used/created by this processor.
 
@@ -52,19 +71,51 @@ def _compute_paths(job_context: Dict) -> str:
         job_context["success"] = False
         return job_context
 
-    job_context["output_dir"] = job_context["work_dir"] + "index/"
-    os.makedirs(job_context["output_dir"], exist_ok=True)
     job_context["rsem_index_dir"] = job_context["work_dir"] + "rsem_index/"
     os.makedirs(job_context["rsem_index_dir"], exist_ok=True)
 
     # I think this is a bit sketchy.
     job_context["organism_name"] = job_context["base_file_path"].split('/')[-1]
 
-    stamp = str(timezone.now().timestamp()).split('.')[0]
-    archive_file_name = job_context["organism_name"] + "_" + \
-                        job_context['length'].upper() + "_" + stamp + '.tar.gz'
+    return _compute_length_paths(job_context, job_context["work_dir"])
+
 
-    job_context["computed_archive"] = job_context["work_dir"] + archive_file_name
+def _compute_paths_for_both_lengths(job_context: Dict) -> Dict:
+    """Computes the paths used when building both index lengths in one job.
+
+    The files shared between the two lengths live directly in the work
+    directory, and each length gets its own subdirectory with its own
+    job context under job_context["indices"].
+    """
+    first_file_path = job_context["original_files"][0].absolute_file_path
+    job_context["base_file_path"] = '/'.join(first_file_path.split('/')[:-1])
+    job_context["work_dir"] = job_context["base_file_path"] + '/' + \
+                              JOB_DIR_PREFIX + str(job_context["job_id"]) + "/"
+    try:
+        os.makedirs(job_context["work_dir"])
+    except Exception as e:
+        logger.exception("Could not create work directory for processor job.",
+                         job_context=job_context)
+        job_context["job"].failure_reason = str(e)
+        job_context["success"] = False
+        return job_context
+
+    job_context["rsem_index_dir"] = job_context["work_dir"] + "rsem_index/"
+    os.makedirs(job_context["rsem_index_dir"], exist_ok=True)
+
+    job_context["organism_name"] = job_context["base_file_path"].split('/')[-1]
+
+    job_context["indices"] = {}
+    for length in INDEX_LENGTHS:
+        length_context = {
+            "job_id": job_context["job_id"],
+            "job": job_context["job"],
+            "pipeline": job_context["pipeline"],
+            "length": length,
+            "organism_name": job_context["organism_name"],
+        }
+        length_dir = job_context["work_dir"] + length.upper() + "/"
+        job_context["indices"][length] = _compute_length_paths(length_context, length_dir)
 
     return job_context
 
@@ -85,15 +136,10 @@ def _prepare_files(job_context: Dict) -> Dict:
                     open(job_context["fasta_file_path"], "wb") as gunzipped_file:
                 shutil.copyfileobj(gzipped_file, gunzipped_file)
         elif "gtf.gz" in og_file.source_filename:
-            gzipped_gtf_file_path = og_file.absolute_file_path
+            # The GTF file gets streamed straight out of the gzip file
+            # by _process_gtf, so it doesn't need to be extracted.
             job_context["gtf_file"] = og_file
-            # Gunzip the GTF file into the work directory.
-            gunzipped_path = gzipped_gtf_file_path.replace(".gz", "")
-            job_context["gtf_file_path"] = os.path.join(job_context["work_dir"],
-                                                        gunzipped_path.split("/")[-1])
-            with gzip.open(gzipped_gtf_file_path, "rb") as gzipped_file, \
-                    open(job_context["gtf_file_path"], "wb") as gunzipped_file:
-                shutil.copyfileobj(gzipped_file, gunzipped_file)
+            job_context["gtf_file_path"] = og_file.absolute_file_path
 
     job_context["success"] = True
     return job_context
@@ -137,7 +183,7 @@ def _extract_assembly_information(job_context: Dict) -> Dict:
 
 
 def _process_gtf(job_context: Dict) -> Dict:
-    """Reads in a .gtf file and generates two new files from it.
+    """Streams a gzipped .gtf file and generates two new files from it.
 
     The first is a new .gtf file which has all of the pseudogenes
     filtered out of it. The other is a tsv mapping between gene_ids
@@ -145,12 +191,12 @@ def _process_gtf(job_context: Dict) -> Dict:
     "genes_to_transcripts_path" to job_context.
     """
     filtered_gtf_path = os.path.join(job_context["work_dir"], "no_pseudogenes.gtf")
-    # Generate "genes_to_transcripts.txt" in job_context["output_dir"]
-    # so that it will be included in the computed tarball.
-    genes_to_transcripts_path = os.path.join(job_context["output_dir"], "genes_to_transcripts.txt")
+    # This gets copied into each index's directory once it's been
+    # built so that it will be included in the computed tarball.
+    genes_to_transcripts_path = os.path.join(job_context["work_dir"], "genes_to_transcripts.txt")
 
-    with open(job_context["gtf_file_path"], 'r') as input_gtf, \
-            open(filtered_gtf_path, "w") as filtered_gtf, \
+    with gzip.open(job_context["gtf_file_path"], 'rt') as input_gtf, \
+            open(filtered_gtf_path, "w", buffering=GTF_WRITE_BUFFER_SIZE) as filtered_gtf, \
             open(genes_to_transcripts_path, "w") as genes_to_transcripts:
         for line in input_gtf:
             # Filter out any lines containing "pseudogene".
@@ -158,12 +204,14 @@ def _process_gtf(job_context: Dict) -> Dict:
                 continue
 
             filtered_gtf.write(line)
-            tab_split_line = line.split("\t")
 
-            # Skip header lines (they're short and contain no tabs):
-            if len(tab_split_line) < 2:
+            # Only transcript lines contribute to the mapping, so
+            # don't bother splitting the rest, including the short
+            # header lines which contain no tabs.
+            if "\ttranscript\t" not in line:
                 continue
 
+            tab_split_line = line.split("\t")
             if tab_split_line[GENE_TYPE_COLUMN] == "transcript":
                 ids_column = tab_split_line[-1].translate(IDS_CLEANUP_TABLE)
                 split_ids_column = ids_column.split(" ")
@@ -177,8 +225,6 @@ def _process_gtf(job_context: Dict) -> Dict:
                     GENE_TO_TRANSCRIPT_TEMPLATE.format(gene_id=gene_id,
                                                        transcript_id=transcript_id))
 
-    # Clean up the unfiltered gtf file, which we no longer need.
-    os.remove(job_context["gtf_file_path"])
     job_context["gtf_file_path"] = filtered_gtf_path
     job_context["genes_to_transcripts_path"] = genes_to_transcripts_path
     return job_context
@@ -195,39 +241,28 @@ def _handle_shell_error(job_context: Dict, stderr: str, command: str) -> None:
     job_context["success"] = False
 
 
-def _create_index(job_context: Dict) -> Dict:
-    """Creates a salmon transcriptome index.
-
-    This index will only be appropriate for use in running salmon on
-    transcripts collected from an organism from the same species as
-    the file. Additionally it will either be a "long" index or a
-    "short" index, which means that it will be appropriate for reads
-    with a certain range of base pair lengths. The creator of Salmon,
-    the esteemed Dr. Rob Patro, has said (via personal communication):
-
-    "For *most* data (i.e. 75bp or longer), the default k should work
-    well.  For reads shorter than 75bp ... one should absolutely use a
-    shorter k (probably 23 or 21)."
-    """
-    # RSEM takes a prefix path and then all files generated by it will
-    # start with that
-
+def _prepare_reference(job_context: Dict) -> Dict:
+    """Runs RSEM's prepare-reference, whose output is shared by the long
+    and short indices."""
     # Version goes to stderr up until the version where it doesn't:
     # https://github.com/COMBINE-lab/salmon/issues/148
     job_context["salmon_version"] = subprocess.run(['salmon', '--version'],
                                                 stderr=subprocess.PIPE,
                                                 stdout=subprocess.PIPE).stderr.decode().strip()
 
+    # RSEM takes a prefix path and then all files generated by it will
+    # start with that
     # TODO: is this providing a filename prefix or a directory or both?
     rsem_prefix = os.path.join(job_context["rsem_index_dir"],
                                job_context['base_file_path'].split('/')[-1])
 
     rsem_command_string = (
-        "rsem-prepare-reference --num-threads 16 --gtf {gtf_file}"
+        "rsem-prepare-reference --num-threads {threads} --gtf {gtf_file}"
         " --transcript-to-gene-map {genes_to_transcripts} {fasta_file} {rsem_prefix}"
     )
 
     rsem_formatted_command = rsem_command_string.format(
+        threads=utils.get_cpu_limit(),
         gtf_file=job_context["gtf_file_path"],
         genes_to_transcripts=job_context["genes_to_transcripts_path"],
         fasta_file=job_context["fasta_file_path"],
@@ -251,35 +286,94 @@ def _create_index(job_context: Dict) -> Dict:
         job_context["success"] = False
         return job_context
 
-    salmon_command_string = ("salmon --threads=16 --no-version-check index -t {rsem_transcripts}"
+    # rsem-prepare-reference outputs a transcripts.fa file which needs
+    # to be passed into salmon.
+    job_context["rsem_transcripts"] = rsem_prefix + ".transcripts.fa"
+    job_context["success"] = True
+    return job_context
+
+
+def _run_salmon_index(length_context: Dict, threads: int) -> Dict:
+    """Runs salmon index for length_context["length"].
+
+    See the docstring of `_create_index` for why the lengths differ.
+    """
+    salmon_command_string = ("salmon --threads={threads} --no-version-check index -t {rsem_transcripts}"
                              " -i {index_dir} --type quasi -k {kmer_size}")
 
-    # See this function's docstring for more info.
-    if job_context['length'] is "long":
-        job_context['kmer_size'] = "31"
+    if length_context['length'] == "long":
+        length_context['kmer_size'] = "31"
     else:
-        job_context['kmer_size'] = "23"
+        length_context['kmer_size'] = "23"
 
-    # rsem-prepare-reference outputs a transcripts.fa file which needs
-    # to be passed into salmon.
-    rsem_transcripts = rsem_prefix + ".transcripts.fa"
-    job_context["salmon_formatted_command"] = salmon_command_string.format(
-        rsem_transcripts=rsem_transcripts,
-        index_dir=job_context["output_dir"],
-        kmer_size=job_context['kmer_size'])
+    length_context["salmon_formatted_command"] = salmon_command_string.format(
+        threads=threads,
+        rsem_transcripts=length_context["rsem_transcripts"],
+        index_dir=length_context["output_dir"],
+        kmer_size=length_context['kmer_size'])
 
-    salmon_completed_command = subprocess.run(job_context["salmon_formatted_command"].split(),
+    salmon_completed_command = subprocess.run(length_context["salmon_formatted_command"].split(),
                                               stdout=subprocess.PIPE,
                                               stderr=subprocess.PIPE)
-    job_context['time_end'] = timezone.now()
+    length_context['time_end'] = timezone.now()
 
     if salmon_completed_command.returncode != 0:
         stderr = salmon_completed_command.stderr.decode().strip()
-        _handle_shell_error(job_context, stderr, "salmon")
-        job_context["success"] = False
+        _handle_shell_error(length_context, stderr, "salmon")
+        length_context["success"] = False
+        return length_context
+
+    # Include the mapping in the index so the salmon processor can
+    # find it next to the index.
+    shutil.copy(length_context["genes_to_transcripts_path"], length_context["output_dir"])
+
+    length_context["success"] = True
+    return length_context
+
+
+def _create_index(job_context: Dict) -> Dict:
+    """Creates a salmon transcriptome index.
+
+    This index will only be appropriate for use in running salmon on
+    transcripts collected from an organism from the same species as
+    the file. Additionally it will either be a "long" index or a
+    "short" index, which means that it will be appropriate for reads
+    with a certain range of base pair lengths. The creator of Salmon,
+    the esteemed Dr. Rob Patro, has said (via personal communication):
+
+    "For *most* data (i.e. 75bp or longer), the default k should work
+    well.  For reads shorter than 75bp ... one should absolutely use a
+    shorter k (probably 23 or 21)."
+    """
+    job_context = _prepare_reference(job_context)
+    if not job_context["success"]:
         return job_context
 
-    job_context["success"] = True
+    return _run_salmon_index(job_context, utils.get_cpu_limit())
+
+
+def _create_indices(job_context: Dict) -> Dict:
+    """Creates the long and short salmon indices at the same time.
+
+    RSEM's prepare-reference only needs to run once for both of them,
+    then the host's CPUs get split between the two salmon index runs.
+    """
+    job_context = _prepare_reference(job_context)
+    if not job_context["success"]:
+        return job_context
+
+    length_contexts = list(job_context["indices"].values())
+    for length_context in length_contexts:
+        for key in ["rsem_transcripts", "genes_to_transcripts_path", "salmon_version",
+                    "time_start", "assembly_version", "assembly_name"]:
+            length_context[key] = job_context[key]
+
+    threads = max(1, utils.get_cpu_limit() // len(length_contexts))
+    with ThreadPoolExecutor(max_workers=len(length_contexts)) as executor:
+        results = list(executor.map(lambda context: _run_salmon_index(context, threads),
+                                    length_contexts))
+
+    job_context["success"] = all(result["success"] for result in results)
     return job_context
 
 
@@ -292,9 +386,11 @@ def _zip_index(job_context: Dict) -> Dict:
     """
 
     try:
-        with tarfile.open(job_context["computed_archive"], "w:gz") as tar:
-            tar.add(job_context["output_dir"],
-                    arcname=os.path.basename(job_context["output_dir"]))
+        # The index is uploaded to its own bucket once the OrganismIndex
+        # has been created, so it's only packaged locally here.
+        job_context["packaged_archive"] = utils.package_directory(job_context["output_dir"],
+                                                                  job_context["computed_archive"],
+                                                                  "TRANSCRIPTOME_INDEX")
     except:
         logger.exception("Exception caught while zipping index directory %s",
                          job_context["output_dir"],
@@ -312,6 +408,19 @@ def _zip_index(job_context: Dict) -> Dict:
     job_context["success"] = True
     return job_context
 
+
+def _zip_indices(job_context: Dict) -> Dict:
+    """Zips the directories of both index lengths."""
+    for length_context in job_context["indices"].values():
+        length_context = _zip_index(length_context)
+        if not length_context["success"]:
+            job_context["success"] = False
+            return job_context
+
+    job_context["success"] = True
+    return job_context
+
+
 def _populate_index_object(job_context: Dict) -> Dict:
     """ """
 
@@ -332,8 +441,8 @@ def _populate_index_object(job_context: Dict) -> Dict:
     computed_file = ComputedFile()
     computed_file.absolute_file_path = job_context["computed_archive"]
     computed_file.filename = os.path.split(job_context["computed_archive"])[-1]
-    computed_file.calculate_sha1()
-    computed_file.calculate_size()
+    computed_file.sha1 = job_context["packaged_archive"]["sha1"]
+    computed_file.size_in_bytes = job_context["packaged_archive"]["size"]
     computed_file.result = result
     computed_file.is_smashable = False
     computed_file.is_qc = False
@@ -412,3 +521,38 @@ def build_transcriptome_index(job_id: int, length="long") -> None:
                                _zip_index,
                                _populate_index_object,
                                utils.end_job])
+
+
+def _populate_index_objects(job_context: Dict) -> Dict:
+    """Creates the OrganismIndex records for both index lengths."""
+    for length_context in job_context["indices"].values():
+        length_context["computed_files"] = []
+        length_context["original_files"] = job_context["original_files"]
+        length_context = _populate_index_object(length_context)
+        if length_context.get("success", True) is False:
+            job_context["success"] = False
+            return job_context
+
+    # Both indices were uploaded by _populate_index_object.
+    job_context["computed_files"] = []
+    return job_context
+
+
+def build_transcriptome_indices(job_id: int) -> None:
+    """Builds both the long and the short transcriptome index in one job.
+
+    This runs the same steps as `build_transcriptome_index`, but the
+    input files are only prepared and passed through RSEM once, and
+    the two salmon index commands run at the same time.
+    """
+    pipeline = Pipeline(name=utils.PipelineEnum.TX_INDEX.value)
+    return utils.run_pipeline({"job_id": job_id, "pipeline": pipeline},
+                              [utils.start_job,
+                               _compute_paths_for_both_lengths,
+                               _prepare_files,
+                               _extract_assembly_information,
+                               _process_gtf,
+                               _create_indices,
+                               _zip_indices,
+                               _populate_index_objects,
+                               utils.end_job])
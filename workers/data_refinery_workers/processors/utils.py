@@ -1,12 +1,20 @@
+import boto3
+import hashlib
+import multiprocessing
 import os
 import random
+import resource
 import shutil
 import signal
 import string
 import subprocess
 import sys
+import tarfile
+import threading
+import time
 import yaml
 
+from botocore.client import Config
 from django.conf import settings
 from django.utils import timezone
 from enum import Enum, unique
@@ -30,9 +38,12 @@ from data_refinery_common.models import (
     Sample,
 )
 from data_refinery_common.utils import (
+    calculate_file_size,
+    calculate_sha1,
     get_env_variable,
     get_env_variable_gracefully,
     get_instance_id,
+    get_volume_disk_usage,
 )
 
 
@@ -40,8 +51,28 @@ logger = get_and_configure_logger(__name__)
 # Let this fail if SYSTEM_VERSION is unset.
 SYSTEM_VERSION = get_env_variable("SYSTEM_VERSION")
 S3_BUCKET_NAME = get_env_variable("S3_BUCKET_NAME", "data-refinery")
+LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
+S3 = boto3.client('s3', config=Config(signature_version='s3v4'))
+
+# gzip compression levels for the archives built by package_directory,
+# by the kind of artifact being packaged. Salmon quant results are
+# downloaded by users so they're worth compressing well, whereas the
+# unmapped reads from salmontools are large and rarely looked at again.
+DEFAULT_COMPRESSION_LEVEL = 6
+ARCHIVE_COMPRESSION_LEVELS = {
+    "SALMON_QUANT": int(get_env_variable_gracefully("SALMON_QUANT_COMPRESSION_LEVEL", "6")),
+    "SALMONTOOLS": int(get_env_variable_gracefully("SALMONTOOLS_COMPRESSION_LEVEL", "1")),
+    "TRANSCRIPTOME_INDEX": int(get_env_variable_gracefully("TRANSCRIPTOME_INDEX_COMPRESSION_LEVEL", "6")),
+}
+# S3 requires multipart chunks of at least 5MB.
+ARCHIVE_CHUNK_SIZE = 8 * 1024 * 1024
 DIRNAME = os.path.dirname(os.path.abspath(__file__))
 CURRENT_JOB = None
+# How often the memory a job's processes are using is sampled, see
+# get_peak_memory_mb.
+MEMORY_SAMPLE_INTERVAL = 5
+_PEAK_ANON_MEMORY = 0
+_MEMORY_SAMPLER = None
 
 
 def signal_handler(sig, frame):
@@ -287,6 +318,17 @@ def start_job(job_context: Dict):
     """
     job = job_context["job"]
 
+    # SALMON jobs which were folded into a SALMON_BATCH job get closed
+    # out or handed back by the batch, see salmon._prepare_batch_files.
+    if job.retried_job_id and not job.retried and job.pipeline_applied == "SALMON":
+        logger.info("Processor job has been folded into a batch, leaving it to the batch.",
+                    processor_job=job.id,
+                    batch_job=job.retried_job_id)
+        job_context["original_files"] = []
+        job_context["computed_files"] = []
+        job_context["folded"] = True
+        return job_context
+
     # This job should not have been started.
     if job.start_time is not None and settings.RUNNING_IN_CLOUD:
 
@@ -316,8 +358,11 @@ def start_job(job_context: Dict):
         logger.error("This processor job has already been started!!!", processor_job=job.id)
         raise Exception("processors.start_job called on job %s that has already been started!" % str(job.id))
 
+    # Batched salmon jobs check each of their samples instead, so that
+    # one processed sample doesn't abort the whole batch.
     original_file = job.original_files.first()
-    if original_file and not original_file.needs_processing(job_context["job_id"]):
+    if job.pipeline_applied != "SALMON_BATCH" \
+       and original_file and not original_file.needs_processing(job_context["job_id"]):
         failure_reason = ("Sample has a good computed file, it must have been processed, "
                           "so it doesn't need to be downloaded! Aborting!")
         logger.error(failure_reason,
@@ -345,12 +390,16 @@ def start_job(job_context: Dict):
     global CURRENT_JOB
     CURRENT_JOB = job
 
+    start_memory_sampler()
+
     logger.debug("Starting processor Job.", processor_job=job.id, pipeline=job.pipeline_applied)
 
     # Janitor jobs don't operate on file objects.
     # Tximport jobs don't need to download the original file, they
     # just need it to know what experiment to process.
-    if job.pipeline_applied not in ["JANITOR", "TXIMPORT"]:
+    # Batched salmon jobs prepare their own files so that a sample
+    # whose files are missing doesn't take the rest of the batch down.
+    if job.pipeline_applied not in ["JANITOR", "TXIMPORT", "SALMON_BATCH"]:
         # Some jobs take OriginalFiles, other take Datasets
         if job.pipeline_applied not in ["SMASHER", "QN_REFERENCE", "COMPENDIA"]:
             job_context = prepare_original_files(job_context)
@@ -420,13 +469,19 @@ def end_job(job_context: Dict, abort=False):
     if success:
         # S3-sync Computed Files
         for computed_file in job_context.get('computed_files', []):
-            # Ensure even distribution across S3 servers
-            nonce = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(24))
-            result = computed_file.sync_to_s3(S3_BUCKET_NAME, nonce + "_" + computed_file.filename)
+            # Files packaged with package_directory were uploaded while
+            # they were being compressed.
+            if computed_file.s3_bucket and computed_file.s3_key:
+                computed_file.delete_local_file()
+                continue
+
+            result = computed_file.sync_to_s3(S3_BUCKET_NAME, get_s3_key(computed_file.filename))
             if result:
                 computed_file.delete_local_file()
     else:
         for computed_file in job_context.get('computed_files', []):
+            if computed_file.s3_bucket and computed_file.s3_key:
+                computed_file.delete_s3_file()
             computed_file.delete_local_file()
             computed_file.delete()
 
@@ -439,6 +494,7 @@ def end_job(job_context: Dict, abort=False):
     if "work_dir" in job_context and settings.RUNNING_IN_CLOUD:
         shutil.rmtree(job_context["work_dir"], ignore_errors=True)
 
+    _record_resource_usage(job, job_context)
     job.success = success
     job.end_time = timezone.now()
     job.save()
@@ -464,6 +520,160 @@ def end_job(job_context: Dict, abort=False):
     return job_context
 
 
+def _record_resource_usage(job: ProcessorJob, job_context: Dict) -> None:
+    """Records how much memory the job used and what it was run on, so
+    that job_lookup.determine_ram_amount can learn how much RAM jobs
+    like it need. Also records how full the job's volume is for the
+    Foreman's volume placement."""
+    job.peak_memory = get_peak_memory_mb()
+    job.volume_disk_usage = get_volume_disk_usage(LOCAL_ROOT_DIR)
+
+    if not job_lookup.does_processor_job_have_samples(job):
+        return
+
+    original_files = job_context.get("original_files") or job.original_files.all()
+    job.input_size = sum(original_file.size_in_bytes or 0 for original_file in original_files)
+
+    sample = job_context.get("sample")
+    if not sample:
+        sample = job_lookup.get_job_sample(job)
+    if sample:
+        job.platform_accession_code = sample.platform_accession_code
+        job.organism_name = sample.organism.name if sample.organism else None
+
+
+def get_s3_key(filename: str) -> str:
+    """Returns the key to upload a computed file with `filename` to."""
+    # Ensure even distribution across S3 servers
+    nonce = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(24))
+    return nonce + "_" + filename
+
+
+class _ArchiveStream:
+    """A read-only file object over a compressor's output.
+
+    Everything read from it is also written to the local copy of the
+    archive and hashed, so the archive doesn't need to be read back
+    from disk to upload it or to calculate its SHA1 and size.
+    """
+
+    def __init__(self, source, local_file):
+        self.source = source
+        self.local_file = local_file
+        self.hash_object = hashlib.sha1()
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.source.read(size)
+        if chunk:
+            self.hash_object.update(chunk)
+            self.local_file.write(chunk)
+            self.size += len(chunk)
+
+        return chunk
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def drain(self):
+        """Reads whatever the compressor hasn't written yet."""
+        while self.read(ARCHIVE_CHUNK_SIZE):
+            pass
+
+
+def _package_directory_with_tarfile(directory: str, archive_path: str, level: int) -> Dict:
+    """Single threaded fallback for when pigz isn't installed."""
+    with tarfile.open(archive_path, "w:gz", compresslevel=level) as tar:
+        tar.add(directory, arcname=".")
+
+    return {
+        "sha1": calculate_sha1(archive_path),
+        "size": calculate_file_size(archive_path),
+        "uploaded": False,
+    }
+
+
+def package_directory(directory: str,
+                      archive_path: str,
+                      artifact_type: str,
+                      s3_bucket: str=None,
+                      s3_key: str=None) -> Dict:
+    """Writes the contents of `directory` to a .tar.gz file at `archive_path`.
+
+    tar is piped into pigz so the archive is compressed on all of the
+    container's CPUs, at the level configured for `artifact_type` in
+    ARCHIVE_COMPRESSION_LEVELS. If `s3_bucket` and `s3_key` are
+    given and we're running in the cloud, pigz's output is also
+    streamed into a multipart upload so that compression and upload
+    overlap.
+
+    Returns a dict with the archive's `sha1`, `size` and whether it
+    was `uploaded`. Raises an exception if packaging or uploading fails.
+    """
+    level = ARCHIVE_COMPRESSION_LEVELS.get(artifact_type, DEFAULT_COMPRESSION_LEVEL)
+    should_upload = settings.RUNNING_IN_CLOUD and s3_bucket and s3_key
+
+    if not shutil.which("pigz"):
+        packaged = _package_directory_with_tarfile(directory, archive_path, level)
+        if should_upload:
+            S3.upload_file(archive_path,
+                           s3_bucket,
+                           s3_key,
+                           ExtraArgs={
+                               'ACL': 'public-read',
+                               'StorageClass': 'STANDARD_IA'
+                           })
+            packaged["uploaded"] = True
+
+        return packaged
+
+    tar_process = subprocess.Popen(["tar", "-cf", "-", "-C", directory, "."],
+                                   stdout=subprocess.PIPE)
+    pigz_process = subprocess.Popen(["pigz", "-" + str(level), "-p", str(get_cpu_limit())],
+                                    stdin=tar_process.stdout,
+                                    stdout=subprocess.PIPE,
+                                    bufsize=ARCHIVE_CHUNK_SIZE)
+    # Let tar get a SIGPIPE if pigz exits early.
+    tar_process.stdout.close()
+
+    try:
+        with open(archive_path, "wb") as local_file:
+            stream = _ArchiveStream(pigz_process.stdout, local_file)
+            if should_upload:
+                S3.upload_fileobj(stream,
+                                  s3_bucket,
+                                  s3_key,
+                                  ExtraArgs={
+                                      'ACL': 'public-read',
+                                      'StorageClass': 'STANDARD_IA'
+                                  })
+            stream.drain()
+    except Exception:
+        pigz_process.kill()
+        tar_process.kill()
+        raise
+    finally:
+        pigz_returncode = pigz_process.wait()
+        tar_returncode = tar_process.wait()
+
+    if tar_returncode != 0 or pigz_returncode != 0:
+        if should_upload:
+            # Don't leave a truncated archive in the bucket.
+            S3.delete_object(Bucket=s3_bucket, Key=s3_key)
+
+        raise Exception("tar exited with {} and pigz exited with {}".format(tar_returncode,
+                                                                           pigz_returncode))
+
+    return {
+        "sha1": stream.hash_object.hexdigest(),
+        "size": stream.size,
+        "uploaded": bool(should_upload),
+    }
+
+
 def run_pipeline(start_value: Dict, pipeline: List[Callable]):
     """Runs a pipeline of processor functions.
 
@@ -516,8 +726,9 @@ def run_pipeline(start_value: Dict, pipeline: List[Callable]):
             return end_job(last_result)
 
         # We don't want to run end_job at all if the job has deleted
-        # itself, which happens if the data for the job was missing.
-        if last_result.get("delete_self", False):
+        # itself, which happens if the data for the job was missing,
+        # or if it has been folded into a batch which will end it.
+        if last_result.get("delete_self", False) or last_result.get("folded", False):
             break
 
         if last_result.get("abort", False):
@@ -883,3 +1094,133 @@ def handle_processor_exception(job_context, processor_key, ex):
     job_context["job"].failure_reason = err_str
     job_context["success"] = False
     return job_context
+
+
+def _read_cgroup_value(path: str):
+    """Returns the stripped contents of a cgroup control file, or None
+    if it doesn't exist in this container."""
+    try:
+        with open(path) as cgroup_file:
+            return cgroup_file.read().strip()
+    except (OSError, IOError):
+        return None
+
+
+def get_cpu_limit() -> int:
+    """Returns the number of CPUs this container is allowed to use.
+
+    Nomad enforces CPU limits through cgroup quotas, so
+    multiprocessing.cpu_count() reports every core on the host. The
+    cgroup v2 `cpu.max` and v1 `cpu.cfs_quota_us` files are checked
+    first, falling back to the host's CPU count if no quota is set.
+    """
+    host_cpus = multiprocessing.cpu_count()
+
+    quota = None
+    period = None
+    cpu_max = _read_cgroup_value("/sys/fs/cgroup/cpu.max")
+    if cpu_max:
+        fields = cpu_max.split()
+        if fields[0] != "max" and len(fields) == 2:
+            quota, period = int(fields[0]), int(fields[1])
+    else:
+        cfs_quota = _read_cgroup_value("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        cfs_period = _read_cgroup_value("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+        if cfs_quota and cfs_period and int(cfs_quota) > 0:
+            quota, period = int(cfs_quota), int(cfs_period)
+
+    if not quota or not period:
+        return host_cpus
+
+    return max(1, min(host_cpus, quota // period))
+
+
+def get_memory_limit_mb() -> int:
+    """Returns the memory limit of this container in megabytes.
+
+    Checks the cgroup v2 `memory.max` and v1 `memory.limit_in_bytes`
+    files, falling back to the host's physical memory if neither
+    imposes a limit.
+    """
+    host_bytes = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+    limit = _read_cgroup_value("/sys/fs/cgroup/memory.max")
+    if limit is None:
+        limit = _read_cgroup_value("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+
+    if limit and limit != "max":
+        # cgroup v1 reports an absurdly large number when unlimited.
+        limit_bytes = min(int(limit), host_bytes)
+    else:
+        limit_bytes = host_bytes
+
+    return limit_bytes // (1024 * 1024)
+
+
+def _get_anon_memory():
+    """Returns how many bytes of anonymous memory this container is
+    using right now, or None if it isn't in a memory cgroup.
+
+    Unlike the cgroup's usage, this leaves out the page cache, which
+    the kernel can reclaim and which grows with every file a job
+    reads or writes. Uses `anon` from the cgroup v2 `memory.stat` and
+    `total_rss` from the v1 one.
+    """
+    for path, key in [("/sys/fs/cgroup/memory.stat", "anon"),
+                      ("/sys/fs/cgroup/memory/memory.stat", "total_rss")]:
+        stat = _read_cgroup_value(path)
+        if not stat:
+            continue
+
+        for line in stat.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == key:
+                return int(fields[1])
+
+    return None
+
+
+def _sample_anon_memory() -> None:
+    """Records the most anonymous memory seen so far."""
+    global _PEAK_ANON_MEMORY
+    anon = _get_anon_memory()
+    if anon:
+        _PEAK_ANON_MEMORY = max(_PEAK_ANON_MEMORY, anon)
+
+
+def start_memory_sampler() -> None:
+    """Starts sampling this container's anonymous memory in the
+    background every MEMORY_SAMPLE_INTERVAL seconds.
+
+    The cgroup only keeps a peak of its total usage, so the peak of
+    anon has to be tracked while the job runs.
+    """
+    global _MEMORY_SAMPLER
+    if _MEMORY_SAMPLER:
+        return
+
+    def sample_forever():
+        while True:
+            _sample_anon_memory()
+            time.sleep(MEMORY_SAMPLE_INTERVAL)
+
+    _MEMORY_SAMPLER = threading.Thread(target=sample_forever, daemon=True)
+    _MEMORY_SAMPLER.start()
+
+
+def get_peak_memory_mb() -> int:
+    """Returns the most memory this container's processes have used so
+    far in megabytes.
+
+    Uses the peak of the anonymous memory sampled by
+    start_memory_sampler, which includes any subprocesses like salmon
+    or R but not the page cache. Never reports less than the peak
+    resident set size of this process or its largest finished child,
+    which is all there is to go on outside of a memory cgroup.
+    """
+    _sample_anon_memory()
+
+    # ru_maxrss is in kilobytes on Linux.
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return max(_PEAK_ANON_MEMORY // (1024 * 1024), max_rss // 1024)
@@ -1,4 +1,4 @@
-job "DOWNLOADER_${{RAM}}" {
+job "DOWNLOADER${{INDEX_POSTFIX}}_${{RAM}}" {
   datacenters = ["dc1"]
 
   type = "batch"
@@ -87,6 +87,9 @@ job "DOWNLOADER_${{RAM}}" {
         value = "true"
       }
 
+      # Set when the Foreman places this job on a specific volume.
+      ${{VOLUME_CONSTRAINT}}
+
       config {
         image = "${{DOCKERHUB_REPO}}/${{DOWNLOADERS_DOCKER_IMAGE}}"
         force_pull = false
@@ -97,7 +100,8 @@ job "DOWNLOADER_${{RAM}}" {
           "manage.py",
           "run_downloader_job",
           "--job-name", "${NOMAD_META_JOB_NAME}",
-          "--job-id", "${NOMAD_META_JOB_ID}"
+          "--job-id", "${NOMAD_META_JOB_ID}",
+          "--batch-size", "10"
         ]
         ${{EXTRA_HOSTS}}
         volumes = ["${{VOLUME_DIR}}:/home/user/data_store"]